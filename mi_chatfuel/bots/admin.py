@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Bot, Flow, MessageLog, AIKey
+from . import ai_usage
+from .models import Bot, Conversation, Flow, MessageLog, AIKey, AIUsage, IntentModel, KnowledgeIndex
 
 
 @admin.register(Bot)
@@ -18,14 +19,48 @@ class FlowAdmin(admin.ModelAdmin):
 
 @admin.register(MessageLog)
 class MessageLogAdmin(admin.ModelAdmin):
-	list_display = ("bot", "direction", "message_type", "wa_from", "wa_to", "status", "created_at")
-	search_fields = ("wa_from", "wa_to", "message_type", "status")
+	list_display = ("bot", "direction", "message_type", "wa_from", "wa_to", "status", "intent_label", "created_at")
+	search_fields = ("wa_from", "wa_to", "message_type", "status", "wamid", "body_text")
 	list_filter = ("direction", "message_type")
 
 
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+	list_display = ("bot", "wa_id", "in_count", "out_count", "unread_count", "first_out_at", "last_message_at")
+	search_fields = ("wa_id", "last_snippet")
+	list_filter = ("bot",)
+
+
 @admin.register(AIKey)
 class AIKeyAdmin(admin.ModelAdmin):
 	list_display = ("provider", "name", "is_active", "priority", "failure_count", "last_used_at", "updated_at")
 	list_filter = ("provider", "is_active")
 	search_fields = ("name", "api_key")
 	readonly_fields = ("last_used_at", "failure_count", "created_at", "updated_at")
+
+
+@admin.register(IntentModel)
+class IntentModelAdmin(admin.ModelAdmin):
+	list_display = ("bot", "version", "samples", "accuracy", "created_at")
+	list_filter = ("bot",)
+	readonly_fields = ("bot", "version", "samples", "accuracy", "created_at")
+	exclude = ("artifact",)
+
+
+@admin.register(KnowledgeIndex)
+class KnowledgeIndexAdmin(admin.ModelAdmin):
+	list_display = ("version", "flow", "chunks", "knowledge_tokens", "created_at")
+	readonly_fields = ("flow", "version", "chunks", "knowledge_tokens", "created_at")
+	exclude = ("data",)
+
+
+@admin.register(AIUsage)
+class AIUsageAdmin(admin.ModelAdmin):
+	list_display = ("bucket", "bot", "task", "model", "key", "calls", "errors", "prompt_tokens", "completion_tokens", "cost_usd", "p95_ms")
+	list_filter = ("task", "bot", "model")
+	date_hierarchy = "bucket"
+	readonly_fields = [f.name for f in AIUsage._meta.fields]
+
+	@admin.display(description="p95 ms")
+	def p95_ms(self, obj):
+		return ai_usage.hist_percentile(obj.latency_hist or {}, 95)
@@ -0,0 +1,364 @@
+"""Cliente único de OpenRouter (chat/completions).
+
+Un solo httpx.AsyncClient con pool de conexiones vive en un event loop de fondo
+(hilo daemon por worker). El código síncrono usa chat(), que agenda la llamada en
+ese loop y espera el resultado; el código async usa achat(). chat_many() lanza
+varias llamadas en paralelo (p.ej. clasificar y generar) sin ocupar un hilo por
+llamada.
+
+Política común de reintento/failover: se prueban las claves activas (AIKey por
+prioridad + OPENROUTER_API_KEY del entorno al final). 401/403/429/5xx o errores
+de red marcan la clave como fallida y se pasa a la siguiente. `timeout` es el
+tiempo total que espera el llamador, failovers incluidos.
+
+Single-flight: llamadas idénticas en curso (mismo modelo, mensajes y parámetros)
+comparten una sola petición a OpenRouter, también entre hilos del worker; p.ej.
+decenas de "precio" simultáneos en una campaña. stats()['coalesced'] las cuenta.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from . import ai_usage
+from .models import AIKey
+
+
+logger = logging.getLogger(__name__)
+
+FAILOVER_STATUSES = frozenset({401, 403, 429, 500, 502, 503, 504})
+# Estados en los que vale la pena reintentar con la misma clave antes de pasar a otra
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def openrouter_keys() -> list[str]:
+    """Claves activas por prioridad (menos usadas primero) + la del entorno como último recurso."""
+    keys = []
+    try:
+        rows = AIKey.objects.filter(provider=AIKey.PROVIDER_OPENROUTER, is_active=True).order_by('priority', 'last_used_at')
+        keys = [k for k in ((r or '').strip() for r in rows.values_list('api_key', flat=True)) if k]
+    except Exception:
+        logger.exception('could not load AI keys')
+    env_key = (getattr(settings, 'OPENROUTER_API_KEY', '') or '').strip()
+    if env_key and env_key not in keys:
+        keys.append(env_key)
+    return keys
+
+
+def record_attempts(attempts: list[tuple[str, bool, int | None]]) -> None:
+    """Actualiza last_used_at/failure_count de las claves usadas (un UPDATE por intento)."""
+    now = timezone.now()
+    for key, ok, status in attempts:
+        qs = AIKey.objects.filter(provider=AIKey.PROVIDER_OPENROUTER, api_key=key)
+        try:
+            if ok:
+                qs.update(last_used_at=now, failure_count=0)
+            elif status is None or status in FAILOVER_STATUSES:
+                qs.update(last_used_at=now, failure_count=F('failure_count') + 1)
+        except Exception:
+            logger.exception('could not record AI key usage')
+
+
+def build_payload(messages: list[dict], model: str | None = None, temperature: float = 0.3,
+                  max_tokens: int | None = None, **params) -> dict:
+    payload = {
+        'model': model or getattr(settings, 'OPENROUTER_MODEL', 'openrouter/auto'),
+        'messages': messages,
+        'temperature': temperature,
+        **params,
+    }
+    if max_tokens:
+        payload['max_tokens'] = max_tokens
+    return payload
+
+
+def fingerprint(payload: dict) -> str:
+    """Clave de single-flight: el payload completo (modelo, mensajes y parámetros) serializado estable."""
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def message_text(data: dict | None) -> str:
+    """Contenido del primer choice ('' si no hay)."""
+    try:
+        return (((data or {}).get('choices') or [{}])[0].get('message') or {}).get('content', '').strip()
+    except Exception:
+        return ''
+
+
+class ChatResult:
+    """Respuesta JSON (o None) y los intentos realizados: [(clave, ok, status HTTP | None)]."""
+    __slots__ = ('data', 'attempts', 'elapsed_ms')
+
+    def __init__(self, data: dict | None, attempts: list, elapsed_ms: float):
+        self.data = data
+        self.attempts = attempts
+        self.elapsed_ms = elapsed_ms
+
+    @property
+    def key(self) -> str | None:
+        """Última clave usada (la que respondió, si hubo respuesta)."""
+        return self.attempts[-1][0] if self.attempts else None
+
+    @property
+    def usage(self) -> dict:
+        return (self.data or {}).get('usage') or {}
+
+    @property
+    def failovers(self) -> int:
+        return len({k for k, _ok, _st in self.attempts}) - 1 if self.attempts else 0
+
+
+class AIClient:
+    """Cliente con pool de conexiones compartido y failover entre claves."""
+
+    def __init__(self, url: str | None = None, max_connections: int | None = None,
+                 retries: int | None = None, backoff_s: float | None = None, transport=None,
+                 single_flight: bool | None = None, key_provider=None, record_usage: bool = True):
+        self.url = url or getattr(settings, 'OPENROUTER_API_URL', 'https://openrouter.ai/api/v1/chat/completions')
+        self.max_connections = max_connections or getattr(settings, 'AI_CLIENT_MAX_CONNECTIONS', 20)
+        self.retries = retries if retries is not None else getattr(settings, 'AI_CLIENT_RETRIES', 0)
+        self.backoff_s = backoff_s if backoff_s is not None else getattr(settings, 'AI_CLIENT_BACKOFF_S', 0.25)
+        self.headers = {
+            'Content-Type': 'application/json',
+            'HTTP-Referer': getattr(settings, 'OPENROUTER_SITE_URL', 'https://opti.chat'),
+            'X-Title': getattr(settings, 'OPENROUTER_APP_NAME', 'OptiChat'),
+        }
+        self._transport = transport
+        # Origen de las claves y registro de uso en AIKey (los benchmarks usan claves ficticias)
+        self.key_provider = key_provider or openrouter_keys
+        self.record_usage = record_usage
+        self.single_flight = single_flight if single_flight is not None else getattr(settings, 'AI_SINGLE_FLIGHT', True)
+        # fingerprint -> Future de la petición en curso
+        self._inflight: dict[str, object] = {}
+        self._inflight_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._http: httpx.AsyncClient | None = None
+        self._stats_lock = threading.Lock()
+        self._stats = {'requests': 0, 'attempts': 0, 'failovers': 0, 'retries': 0, 'errors': 0, 'coalesced': 0}
+
+    # ===== Loop de fondo =====
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='ai-client', daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def _client(self) -> httpx.AsyncClient:
+        # Sólo se llama dentro del loop de fondo
+        if self._http is None:
+            limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+            self._http = httpx.AsyncClient(limits=limits, transport=self._transport)
+        return self._http
+
+    def submit(self, coro):
+        """Agenda una corrutina en el loop de fondo y devuelve un concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def _shared(self, payload: dict, keys: list[str], timeout: float, headers: dict | None):
+        """(future, leader). Si ya hay una petición idéntica en curso se reutiliza su future;
+        sólo el líder registra el uso de claves."""
+        if not self.single_flight:
+            return self.submit(self._post(payload, keys, timeout, headers)), True
+        fp = fingerprint(payload)
+        with self._inflight_lock:
+            fut = self._inflight.get(fp)
+            if fut is not None:
+                self._count('coalesced')
+                return fut, False
+            fut = self.submit(self._post(payload, keys, timeout, headers))
+            self._inflight[fp] = fut
+
+        def _done(_f, fp=fp):
+            with self._inflight_lock:
+                if self._inflight.get(fp) is _f:
+                    del self._inflight[fp]
+        fut.add_done_callback(_done)
+        return fut, True
+
+    def close(self) -> None:
+        with self._lock:
+            loop, http = self._loop, self._http
+            self._loop = self._http = None
+        if loop is None:
+            return
+        if http is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(http.aclose(), loop).result(timeout=5)
+            except Exception:
+                pass
+        loop.call_soon_threadsafe(loop.stop)
+
+    # ===== Política de reintento/failover =====
+
+    async def _post(self, payload: dict, keys: list[str], timeout: float, headers: dict | None = None) -> ChatResult:
+        started = time.monotonic()
+        deadline = started + timeout
+        attempts: list[tuple[str, bool, int | None]] = []
+        data = None
+        base_headers = {**self.headers, **(headers or {})}
+        for key in keys:
+            for attempt in range(self.retries + 1):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                status = None
+                try:
+                    resp = await asyncio.wait_for(
+                        self._client().post(self.url, json=payload, headers={**base_headers, 'Authorization': f'Bearer {key}'}),
+                        remaining,
+                    )
+                    status = resp.status_code
+                    if 200 <= status < 300:
+                        data = resp.json()
+                        attempts.append((key, True, status))
+                        break
+                except Exception as exc:
+                    logger.debug('openrouter request failed: %r', exc)
+                attempts.append((key, False, status))
+                if status in RETRY_STATUSES and attempt < self.retries:
+                    self._count('retries')
+                    await asyncio.sleep(min(self.backoff_s * (2 ** attempt), max(0.0, deadline - time.monotonic())))
+                    continue
+                break
+            if data is not None or time.monotonic() >= deadline:
+                break
+        result = ChatResult(data, attempts, (time.monotonic() - started) * 1000.0)
+        self._count('requests')
+        self._count('attempts', len(attempts))
+        self._count('failovers', result.failovers)
+        if data is None:
+            self._count('errors')
+        return result
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._stats_lock:
+            self._stats[name] += n
+
+    def stats(self, reset: bool = False) -> dict:
+        with self._stats_lock:
+            snap = dict(self._stats)
+            if reset:
+                for k in self._stats:
+                    self._stats[k] = 0
+        return snap
+
+    # ===== Entradas síncrona / asíncrona =====
+
+    def _finish(self, payload: dict, result: ChatResult, task: str, bot_id: int | None) -> None:
+        """Registro en el hilo del llamador (usa el ORM): uso de claves y contabilidad por bot/tarea."""
+        if not self.record_usage:
+            return
+        record_attempts(result.attempts)
+        ai_usage.record(
+            task, payload.get('model') or '', result.key, result.data is not None, result.elapsed_ms,
+            usage=result.usage, bot_id=bot_id,
+        )
+
+    def chat(self, payload: dict, timeout: float = 20, headers: dict | None = None, keys: list[str] | None = None,
+             task: str = 'chat') -> dict | None:
+        """Llamada bloqueante (vistas Django). Devuelve el JSON de respuesta o None."""
+        return self.chat_many([payload], timeout=timeout, headers=headers, keys=keys, task=task)[0]
+
+    def chat_many(self, payloads: list[dict], timeout: float = 20, headers: dict | None = None,
+                  keys: list[str] | None = None, task: str = 'chat') -> list[dict | None]:
+        """Varias llamadas en paralelo sobre el mismo pool; espera todas (máx. `timeout`).
+        `task` etiqueta la contabilidad de uso (ver bots/ai_usage.py)."""
+        keys = self.key_provider() if keys is None else keys
+        if not keys or not payloads:
+            return [None] * len(payloads)
+        futures = [self._shared(p, keys, timeout, headers) for p in payloads]
+        out = []
+        for payload, (fut, leader) in zip(payloads, futures):
+            try:
+                result = fut.result(timeout=timeout + 1)
+            except Exception:
+                # La petición en curso termina sola (tiene su propio deadline) y puede servir a otros
+                out.append(None)
+                continue
+            if leader:
+                self._finish(payload, result, task, ai_usage.current_bot())
+            out.append(result.data)
+        return out
+
+    async def achat(self, payload: dict, timeout: float = 20, headers: dict | None = None,
+                    keys: list[str] | None = None, task: str = 'chat') -> dict | None:
+        """Versión async: corre en el loop de fondo (pool compartido) y se espera desde el loop del llamador."""
+        if keys is None:
+            keys = await sync_to_async(self.key_provider)()
+        if not keys:
+            return None
+        fut, leader = self._shared(payload, keys, timeout, headers)
+        result = await _await_shared(fut)
+        if leader:
+            await sync_to_async(self._finish)(payload, result, task, ai_usage.current_bot())
+        return result.data
+
+
+async def _await_shared(fut):
+    """Espera un concurrent.futures.Future compartido sin propagarle la cancelación del llamador
+    (asyncio.wrap_future cancelaría la petición para todos los que la comparten)."""
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+
+    def _relay(f):
+        def _set():
+            if waiter.cancelled():
+                return
+            exc = f.exception() if not f.cancelled() else asyncio.CancelledError()
+            if exc is not None:
+                waiter.set_exception(exc)
+            else:
+                waiter.set_result(f.result())
+        loop.call_soon_threadsafe(_set)
+    fut.add_done_callback(_relay)
+    return await waiter
+
+
+_client_lock = threading.Lock()
+_client: AIClient | None = None
+
+
+def get_client() -> AIClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = AIClient()
+        return _client
+
+
+def reset_client(client: AIClient | None = None) -> None:
+    """Reemplaza el cliente del worker (tests/benchmarks apuntan a otro servidor)."""
+    global _client
+    with _client_lock:
+        old, _client = _client, client
+    if old is not None and old is not client:
+        old.close()
+
+
+def chat(payload: dict, timeout: float = 20, headers: dict | None = None, task: str = 'chat') -> dict | None:
+    return get_client().chat(payload, timeout=timeout, headers=headers, task=task)
+
+
+def chat_many(payloads: list[dict], timeout: float = 20, headers: dict | None = None, task: str = 'chat') -> list[dict | None]:
+    return get_client().chat_many(payloads, timeout=timeout, headers=headers, task=task)
+
+
+async def achat(payload: dict, timeout: float = 20, headers: dict | None = None, task: str = 'chat') -> dict | None:
+    return await get_client().achat(payload, timeout=timeout, headers=headers, task=task)
+
+
+def client_stats(reset: bool = False) -> dict:
+    return get_client().stats(reset=reset)
@@ -0,0 +1,153 @@
+"""Ruteo de modelos por tarea con SLO de latencia.
+
+Cada tarea (trigger, intent, naturalize, answer, …) tiene una lista de modelos en
+orden de preferencia: Bot.ai_models del bot en curso o AI_TASK_MODELS de settings.
+El router guarda, por (tarea, modelo), una ventana de las últimas llamadas
+(latencia y éxito). Un modelo que supera el SLO de la tarea (p95 > AI_TASK_SLO_MS)
+o la tasa de error máxima se relega detrás de los sanos durante
+AI_ROUTER_COOLDOWN_S; pasado ese tiempo vuelve a probarse. Si la llamada con un
+modelo falla, se intenta el siguiente dentro del mismo timeout total.
+"""
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from . import ai_usage
+from .ai_client import build_payload, get_client
+from .models import Bot
+
+
+TASKS = ('trigger', 'intent', 'naturalize', 'answer')
+
+
+def default_models(task: str) -> list[str]:
+    configured = (getattr(settings, 'AI_TASK_MODELS', {}) or {}).get(task)
+    return list(configured or [getattr(settings, 'OPENROUTER_MODEL', 'openrouter/auto')])
+
+
+# ===== Modelos configurados por bot (caché corta por worker) =====
+
+_bot_models_lock = threading.Lock()
+_bot_models: dict[int, tuple[float, dict]] = {}
+_BOT_MODELS_TTL_S = 60
+
+
+def bot_models(bot_id: int | None) -> dict:
+    if not bot_id:
+        return {}
+    now = time.monotonic()
+    with _bot_models_lock:
+        cached = _bot_models.get(bot_id)
+    if cached and now - cached[0] < _BOT_MODELS_TTL_S:
+        return cached[1]
+    value = Bot.objects.filter(pk=bot_id).values_list('ai_models', flat=True).first() or {}
+    with _bot_models_lock:
+        _bot_models[bot_id] = (now, value)
+    return value
+
+
+def invalidate_bot(bot_id: int) -> None:
+    with _bot_models_lock:
+        _bot_models.pop(bot_id, None)
+
+
+def models_for(task: str, bot_id: int | None = None) -> list[str]:
+    """Modelos configurados para la tarea: los del bot (si definió alguno) o los de settings."""
+    configured = [m for m in (bot_models(bot_id).get(task) or []) if (m or '').strip()]
+    return configured or default_models(task)
+
+
+# ===== Observaciones y SLO =====
+
+class _ModelStats:
+    __slots__ = ('window', 'breached_at')
+
+    def __init__(self, size: int):
+        self.window: deque[tuple[float, bool]] = deque(maxlen=size)
+        self.breached_at: float | None = None
+
+
+class ModelRouter:
+    def __init__(self, window: int | None = None):
+        self.window_size = window or getattr(settings, 'AI_ROUTER_WINDOW', 20)
+        self._lock = threading.Lock()
+        self._stats: dict[tuple[str, str], _ModelStats] = {}
+
+    def slo_ms(self, task: str) -> float:
+        return float((getattr(settings, 'AI_TASK_SLO_MS', {}) or {}).get(task) or 8000)
+
+    def observe(self, task: str, model: str, latency_ms: float, ok: bool) -> None:
+        with self._lock:
+            st = self._stats.setdefault((task, model), _ModelStats(self.window_size))
+            st.window.append((latency_ms, ok))
+            if st.breached_at is None and self._breaching(task, st):
+                st.breached_at = time.monotonic()
+
+    def _breaching(self, task: str, st: _ModelStats) -> bool:
+        n = len(st.window)
+        if n < getattr(settings, 'AI_ROUTER_MIN_SAMPLES', 5):
+            return False
+        errors = sum(1 for _ms, ok in st.window if not ok)
+        if errors / n > getattr(settings, 'AI_ROUTER_MAX_ERROR_RATE', 0.3):
+            return True
+        latencies = sorted(ms for ms, _ok in st.window)
+        p95 = latencies[min(n - 1, int(0.95 * n))]
+        return p95 > self.slo_ms(task)
+
+    def is_healthy(self, task: str, model: str) -> bool:
+        cooldown = getattr(settings, 'AI_ROUTER_COOLDOWN_S', 30)
+        with self._lock:
+            st = self._stats.get((task, model))
+            if st is None or st.breached_at is None:
+                return True
+            if time.monotonic() - st.breached_at >= cooldown:
+                # Reprobar con una ventana limpia
+                st.window.clear()
+                st.breached_at = None
+                return True
+            return False
+
+    def order(self, task: str, models: list[str]) -> list[str]:
+        """Modelos sanos primero (en el orden configurado) y luego los que violan el SLO."""
+        healthy = [m for m in models if self.is_healthy(task, m)]
+        return healthy + [m for m in models if m not in healthy]
+
+    def snapshot(self) -> dict:
+        """{tarea: {modelo: {calls, errors, p95_ms, breached}}} de este worker."""
+        out: dict = {}
+        with self._lock:
+            for (task, model), st in self._stats.items():
+                lat = sorted(ms for ms, _ok in st.window)
+                out.setdefault(task, {})[model] = {
+                    'calls': len(st.window),
+                    'errors': sum(1 for _ms, ok in st.window if not ok),
+                    'p95_ms': round(lat[min(len(lat) - 1, int(0.95 * len(lat)))], 1) if lat else None,
+                    'breached': st.breached_at is not None,
+                }
+        return out
+
+
+router = ModelRouter()
+
+
+def chat(messages: list[dict], task: str, timeout: float = 20, headers: dict | None = None,
+         temperature: float = 0.3, max_tokens: int | None = None, bot_id: int | None = None, **params) -> dict | None:
+    """Chat completion con el modelo de la tarea; ante error pasa al siguiente modelo
+    mientras quede tiempo del `timeout` total. `params` extra van al payload (p.ej. response_format)."""
+    if bot_id is None:
+        bot_id = ai_usage.current_bot()
+    deadline = time.monotonic() + timeout
+    client = get_client()
+    for model in router.order(task, models_for(task, bot_id)):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0.2:
+            break
+        t0 = time.monotonic()
+        payload = build_payload(messages, model=model, temperature=temperature, max_tokens=max_tokens, **params)
+        data = client.chat(payload, timeout=remaining, headers=headers, task=task)
+        router.observe(task, model, (time.monotonic() - t0) * 1000.0, data is not None)
+        if data is not None:
+            return data
+    return None
@@ -0,0 +1,179 @@
+"""Servidor local compatible con OpenRouter/OpenAI (POST /v1/chat/completions) para medir
+la ruta de IA sin gastar la API pagada.
+
+Latencia configurable (fixed, uniform, lognormal, exponential), tasas de error
+401/429/5xx y respuestas enlatadas según el prompt (p.ej. 'clasificador de
+intención' → una etiqueta). Lo usan `manage.py openrouter_stub` y `benchmark_ai`.
+"""
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal', 'exponential')
+
+# (subcadena del prompt de sistema, respuesta): la primera que coincide gana
+DEFAULT_REPLIES = [
+    ('clasificador de intención', 'precios'),
+    ('clasificador binario', 'SI'),
+    ('Elige el trigger', 'NONE'),
+    ('Responde ÚNICAMENTE con un objeto JSON', '{"trigger": null, "intent": "precios", "confidence": 0.9}'),
+    ('Reescribe la respuesta', '¡Claro! Te cuento: tenemos envíos a todo el país.'),
+]
+DEFAULT_COMPLETION = 'Hola, soy la asistente de la tienda. ¿En qué te puedo ayudar?'
+
+
+class StubConfig:
+    """Parámetros del servidor. Las tasas son probabilidades por petición (0..1)."""
+
+    def __init__(self, latency_ms: float = 300.0, jitter_ms: float = 100.0, distribution: str = 'lognormal',
+                 p401: float = 0.0, p429: float = 0.0, p5xx: float = 0.0,
+                 replies: list[tuple[str, str]] | None = None, completion: str = DEFAULT_COMPLETION,
+                 seed: int | None = None):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(f'distribution debe ser una de {DISTRIBUTIONS}')
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.distribution = distribution
+        self.p401 = p401
+        self.p429 = p429
+        self.p5xx = p5xx
+        self.replies = list(DEFAULT_REPLIES if replies is None else replies)
+        self.completion = completion
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts = {'requests': 0, '200': 0, '401': 0, '429': 0, '5xx': 0}
+
+    def sample_latency_s(self) -> float:
+        mean, jitter = self.latency_ms, self.jitter_ms
+        with self._lock:
+            if self.distribution == 'fixed':
+                ms = mean
+            elif self.distribution == 'uniform':
+                ms = self._rnd.uniform(mean - jitter, mean + jitter)
+            elif self.distribution == 'exponential':
+                ms = self._rnd.expovariate(1.0 / mean) if mean > 0 else 0.0
+            else:
+                # lognormal con media `mean` y desviación `jitter`
+                if mean <= 0:
+                    ms = 0.0
+                else:
+                    sigma2 = math.log(1 + (jitter / mean) ** 2)
+                    ms = self._rnd.lognormvariate(math.log(mean) - sigma2 / 2, math.sqrt(sigma2))
+        return max(0.0, ms) / 1000.0
+
+    def sample_status(self) -> int:
+        with self._lock:
+            r = self._rnd.random()
+        if r < self.p401:
+            return 401
+        if r < self.p401 + self.p429:
+            return 429
+        if r < self.p401 + self.p429 + self.p5xx:
+            return 503
+        return 200
+
+    def reply_for(self, messages: list[dict]) -> str:
+        system = ' '.join(m.get('content') or '' for m in messages if m.get('role') == 'system')
+        for needle, reply in self.replies:
+            if needle in system:
+                return reply
+        return self.completion
+
+    def count(self, status: int) -> None:
+        key = str(status) if status in (200, 401, 429) else '5xx'
+        with self._lock:
+            self.counts['requests'] += 1
+            self.counts[key] += 1
+
+
+def _completion(model: str, content: str, prompt_chars: int) -> dict:
+    prompt_tokens = (prompt_chars + 3) // 4
+    completion_tokens = (len(content) + 3) // 4
+    return {
+        'id': f'stub-{time.time_ns()}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model or 'stub/model',
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        },
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'OpenRouterStub/1.0'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: dict) -> None:
+        raw = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_POST(self):
+        cfg: StubConfig = self.server.config
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError:
+            self._send(400, {'error': {'message': 'invalid json'}})
+            return
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send(404, {'error': {'message': 'not found'}})
+            return
+        time.sleep(cfg.sample_latency_s())
+        status = cfg.sample_status()
+        if not (self.headers.get('Authorization') or '').startswith('Bearer '):
+            status = 401
+        cfg.count(status)
+        if status != 200:
+            self._send(status, {'error': {'code': status, 'message': 'stub error'}})
+            return
+        messages = body.get('messages') or []
+        prompt_chars = sum(len(m.get('content') or '') for m in messages)
+        self._send(200, _completion(body.get('model'), cfg.reply_for(messages), prompt_chars))
+
+
+class StubServer:
+    """Servidor en un hilo de fondo; url apunta a /v1/chat/completions."""
+
+    def __init__(self, config: StubConfig | None = None, host: str = '127.0.0.1', port: int = 0):
+        self.config = config or StubConfig()
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.config = self.config
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/v1/chat/completions'
+
+    def start(self) -> 'StubServer':
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='openrouter-stub', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        self.httpd.serve_forever()
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> 'StubServer':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
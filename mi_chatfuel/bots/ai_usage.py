@@ -0,0 +1,225 @@
+"""Contabilidad de uso de IA: tokens, costo y latencia por clave, bot y tarea.
+
+Cada llamada (bots/ai_client.py) se suma a un buffer en memoria agrupado por
+(hora, bot, tarea, modelo, clave); el buffer se vuelca a AIUsage en lote cada
+AI_USAGE_FLUSH_S segundos o AI_USAGE_FLUSH_EVERY llamadas (y al salir el proceso).
+
+El bot se toma del contexto (usage_scope/set_bot en el webhook); la tarea la indica
+cada punto de llamada: 'trigger', 'intent', 'naturalize', 'answer', 'generate'.
+"""
+import atexit
+import contextlib
+import contextvars
+import functools
+import logging
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import AIKey, AIUsage
+
+
+logger = logging.getLogger(__name__)
+
+# Límites superiores (ms) del histograma de latencia; el último bucket es "más"
+LATENCY_BUCKETS_MS = (100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 8000, 12000, 20000)
+_OVER = 'inf'
+
+_bot_id: contextvars.ContextVar[int | None] = contextvars.ContextVar('ai_usage_bot_id', default=None)
+
+
+@contextlib.contextmanager
+def usage_scope(bot_id: int | None = None):
+    """Atribuye al bot las llamadas de IA hechas dentro del bloque (y restaura al salir)."""
+    token = _bot_id.set(bot_id)
+    try:
+        yield
+    finally:
+        _bot_id.reset(token)
+
+
+def scoped(view):
+    """Decorador de vistas: cada request tiene su propio usage_scope (set_bot no se filtra entre requests)."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with usage_scope():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def set_bot(bot_id: int | None) -> None:
+    """Fija el bot dentro del usage_scope actual (p.ej. una vez resuelto el bot del webhook)."""
+    _bot_id.set(bot_id)
+
+
+def current_bot() -> int | None:
+    return _bot_id.get()
+
+
+def latency_bucket(ms: float) -> str:
+    for upper in LATENCY_BUCKETS_MS:
+        if ms <= upper:
+            return str(upper)
+    return _OVER
+
+
+def call_cost(model: str, usage: dict) -> Decimal:
+    """Costo en USD: `usage.cost` si OpenRouter lo informa; si no, AI_MODEL_PRICES (USD por 1M tokens)."""
+    if usage.get('cost') is not None:
+        try:
+            return Decimal(str(usage['cost']))
+        except Exception:
+            pass
+    prices = (getattr(settings, 'AI_MODEL_PRICES', {}) or {}).get(model)
+    if not prices:
+        return Decimal(0)
+    prompt_price, completion_price = prices
+    return (
+        Decimal(str(prompt_price)) * int(usage.get('prompt_tokens') or 0)
+        + Decimal(str(completion_price)) * int(usage.get('completion_tokens') or 0)
+    ) / Decimal(1_000_000)
+
+
+# ===== Buffer y volcado en lote =====
+
+_lock = threading.Lock()
+_buffer: dict[tuple, dict] = {}
+_pending = 0
+_last_flush = time.monotonic()
+
+
+def _hour(now=None):
+    now = now or timezone.now()
+    return now.replace(minute=0, second=0, microsecond=0)
+
+
+def record(task: str, model: str, api_key: str | None, ok: bool, latency_ms: float,
+           usage: dict | None = None, bot_id: int | None = None) -> None:
+    """Suma una llamada al buffer (bot por defecto: el del contexto) y vuelca si toca."""
+    global _pending
+    usage = usage or {}
+    if bot_id is None:
+        bot_id = current_bot()
+    key = (_hour(), bot_id, task, model or '', api_key or '')
+    with _lock:
+        acc = _buffer.setdefault(key, {
+            'calls': 0, 'errors': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+            'cost_usd': Decimal(0), 'latency_ms_total': 0.0, 'latency_hist': {},
+        })
+        acc['calls'] += 1
+        acc['errors'] += 0 if ok else 1
+        acc['prompt_tokens'] += int(usage.get('prompt_tokens') or 0)
+        acc['completion_tokens'] += int(usage.get('completion_tokens') or 0)
+        acc['cost_usd'] += call_cost(model, usage)
+        acc['latency_ms_total'] += latency_ms
+        b = latency_bucket(latency_ms)
+        acc['latency_hist'][b] = acc['latency_hist'].get(b, 0) + 1
+        _pending += 1
+        due = (
+            _pending >= getattr(settings, 'AI_USAGE_FLUSH_EVERY', 50)
+            or time.monotonic() - _last_flush >= getattr(settings, 'AI_USAGE_FLUSH_S', 30)
+        )
+    if due:
+        flush()
+
+
+def flush() -> int:
+    """Vuelca el buffer a AIUsage (una fila por grupo). Devuelve cuántos grupos se escribieron."""
+    global _pending, _last_flush
+    with _lock:
+        batch = dict(_buffer)
+        _buffer.clear()
+        _pending = 0
+        _last_flush = time.monotonic()
+    if not batch:
+        return 0
+    try:
+        key_ids = dict(AIKey.objects.values_list('api_key', 'id'))
+        with transaction.atomic():
+            for (bucket, bot_id, task, model, api_key), acc in batch.items():
+                lookup = {'bucket': bucket, 'bot_id': bot_id, 'task': task, 'model': model, 'key_id': key_ids.get(api_key)}
+                row = AIUsage.objects.select_for_update().filter(**lookup).first()
+                if row is None:
+                    AIUsage.objects.create(**lookup, **acc)
+                    continue
+                hist = dict(row.latency_hist or {})
+                for b, n in acc['latency_hist'].items():
+                    hist[b] = hist.get(b, 0) + n
+                AIUsage.objects.filter(pk=row.pk).update(
+                    calls=F('calls') + acc['calls'],
+                    errors=F('errors') + acc['errors'],
+                    prompt_tokens=F('prompt_tokens') + acc['prompt_tokens'],
+                    completion_tokens=F('completion_tokens') + acc['completion_tokens'],
+                    cost_usd=F('cost_usd') + acc['cost_usd'],
+                    latency_ms_total=F('latency_ms_total') + acc['latency_ms_total'],
+                    latency_hist=hist,
+                )
+    except Exception:
+        logger.exception('could not flush AI usage (%d groups dropped)', len(batch))
+        return 0
+    return len(batch)
+
+
+atexit.register(flush)
+
+
+# ===== Reporte =====
+
+def hist_percentile(hist: dict, pct: float) -> float | None:
+    """Percentil aproximado (límite superior del bucket) desde un histograma agregado."""
+    total = sum(hist.values())
+    if not total:
+        return None
+    target = pct / 100.0 * total
+    seen = 0
+    for upper in (*LATENCY_BUCKETS_MS, _OVER):
+        seen += hist.get(str(upper), 0)
+        if seen >= target:
+            return float('inf') if upper == _OVER else float(upper)
+    return None
+
+
+def report(bots, hours: int = 24 * 7) -> dict:
+    """Resumen de las últimas `hours` horas para los bots dados: por bot y por tarea
+    (llamadas, errores, tokens, costo, latencia promedio y p95)."""
+    since = _hour() - timedelta(hours=hours)
+    rows = AIUsage.objects.filter(bot__in=bots, bucket__gte=since).select_related('bot')
+    by_bot: dict = {}
+    by_task: dict = {}
+    for r in rows:
+        for group, label in ((by_bot, r.bot.name if r.bot else '—'), (by_task, r.task)):
+            g = group.setdefault(label, {
+                'calls': 0, 'errors': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+                'cost_usd': Decimal(0), 'latency_ms_total': 0.0, 'hist': {},
+            })
+            g['calls'] += r.calls
+            g['errors'] += r.errors
+            g['prompt_tokens'] += r.prompt_tokens
+            g['completion_tokens'] += r.completion_tokens
+            g['cost_usd'] += r.cost_usd
+            g['latency_ms_total'] += r.latency_ms_total
+            for b, n in (r.latency_hist or {}).items():
+                g['hist'][b] = g['hist'].get(b, 0) + n
+
+    def _rows(group):
+        out = []
+        for label, g in sorted(group.items(), key=lambda kv: -kv[1]['cost_usd']):
+            out.append({
+                'label': label,
+                'calls': g['calls'],
+                'errors': g['errors'],
+                'prompt_tokens': g['prompt_tokens'],
+                'completion_tokens': g['completion_tokens'],
+                'cost_usd': g['cost_usd'],
+                'avg_ms': round(g['latency_ms_total'] / g['calls']) if g['calls'] else None,
+                'p95_ms': hist_percentile(g['hist'], 95),
+            })
+        return out
+
+    return {'since': since, 'by_bot': _rows(by_bot), 'by_task': _rows(by_task)}
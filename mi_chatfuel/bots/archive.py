@@ -0,0 +1,184 @@
+"""Retención de MessageLog en segmentos comprimidos.
+
+Las filas más antiguas que MESSAGE_RETENTION_DAYS se copian, por bot y mes, a
+MESSAGE_ARCHIVE_DIR/<bot_id>/<AAAA-MM>.ndjson.gz (una línea JSON por mensaje) y
+se borran de la base en lotes de MESSAGE_ARCHIVE_CHUNK. Cada lote se agrega al
+segmento como un miembro gzip nuevo (gzip admite miembros concatenados): el
+archivo nunca se reescribe y un corte a mitad de lote deja, a lo sumo, filas
+archivadas sin borrar, que se vuelven a archivar en la siguiente corrida
+(read_history descarta ids repetidos).
+
+MESSAGE_ARCHIVE_DIR no tiene valor por defecto: como las filas se borran de la
+base, debe apuntar a almacenamiento persistente (en Render, un Disk montado; el
+disco del servicio se pierde en cada deploy). Sin configurar, archive_bot se niega
+a correr y read_history no encuentra nada.
+
+Junto a cada segmento, <AAAA-MM>.idx.json guarda por wa_id la posición (offset,
+largo) de los miembros gzip que contienen mensajes suyos. read_history, que el
+panel usa para seguir hacia atrás cuando la base ya no tiene esos mensajes, sólo
+descomprime esos miembros: se salta los meses y lotes sin la conversación.
+"""
+import gzip
+import json
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .models import MessageLog
+
+
+FIELDS = (
+    'id', 'bot_id', 'direction', 'wa_from', 'wa_to', 'message_type', 'payload', 'status', 'error',
+    'intent_label', 'body_text', 'options', 'wamid', 'conversation_id', 'created_at',
+)
+
+
+def archive_dir() -> Path | None:
+    """Carpeta de segmentos, o None si MESSAGE_ARCHIVE_DIR no está configurado."""
+    value = getattr(settings, 'MESSAGE_ARCHIVE_DIR', None)
+    return Path(value) if value else None
+
+
+def require_archive_dir() -> Path:
+    folder = archive_dir()
+    if folder is None:
+        raise ImproperlyConfigured(
+            'MESSAGE_ARCHIVE_DIR no está configurado: apúntalo a un disco persistente antes de archivar '
+            '(los mensajes archivados se borran de la base).'
+        )
+    return folder
+
+
+def segment_path(bot_id: int, year: int, month: int) -> Path:
+    return require_archive_dir() / str(bot_id) / f'{year:04d}-{month:02d}.ndjson.gz'
+
+
+def index_path(segment: Path) -> Path:
+    return segment.with_name(segment.name.replace('.ndjson.gz', '.idx.json'))
+
+
+def cutoff(days: int | None = None) -> datetime:
+    days = getattr(settings, 'MESSAGE_RETENTION_DAYS', 90) if days is None else days
+    return timezone.now() - timedelta(days=days)
+
+
+def _peer(row: dict) -> str:
+    return row['wa_from'] if row['direction'] == MessageLog.IN else row['wa_to']
+
+
+def _load_index(segment: Path) -> dict[str, list[list[int]]] | None:
+    try:
+        with open(index_path(segment), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _append(path: Path, rows: list[dict]):
+    """Agrega `rows` como un miembro gzip nuevo y lo registra en el índice del segmento."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = ''.join(json.dumps(r, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n' for r in rows)
+    with open(path, 'ab') as raw:
+        offset = raw.tell()
+        with gzip.GzipFile(fileobj=raw, mode='wb') as gz:
+            gz.write(data.encode('utf-8'))
+        raw.flush()
+        # En disco antes de borrar las filas de la base
+        os.fsync(raw.fileno())
+        length = raw.tell() - offset
+    # Un corte antes de reemplazar el índice deja el miembro sin indexar; sus filas siguen
+    # en la base y se vuelven a archivar (e indexar) en la siguiente corrida
+    index = _load_index(path) or {}
+    for wa_id in {_peer(r) for r in rows}:
+        index.setdefault(wa_id, []).append([offset, length])
+    tmp = index_path(path).with_suffix('.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(index, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, index_path(path))
+
+
+def archive_bot(bot_id: int, before: datetime, chunk: int | None = None) -> int:
+    """Archiva y borra los mensajes del bot anteriores a `before`; devuelve cuántos."""
+    require_archive_dir()
+    chunk = chunk or getattr(settings, 'MESSAGE_ARCHIVE_CHUNK', 1000)
+    total = 0
+    last_pk = 0
+    while True:
+        rows = list(
+            MessageLog.objects.filter(bot_id=bot_id, created_at__lt=before, pk__gt=last_pk)
+            .order_by('pk').values(*FIELDS)[:chunk]
+        )
+        if not rows:
+            break
+        by_month = defaultdict(list)
+        for r in rows:
+            by_month[(r['created_at'].year, r['created_at'].month)].append(r)
+        for (year, month), items in by_month.items():
+            _append(segment_path(bot_id, year, month), items)
+        MessageLog.objects.filter(pk__in=[r['id'] for r in rows]).delete()
+        last_pk = rows[-1]['id']
+        total += len(rows)
+    return total
+
+
+def _parse(lines):
+    for line in lines:
+        if line.strip():
+            row = json.loads(line)
+            row['created_at'] = datetime.fromisoformat(row['created_at'])
+            yield row
+
+
+def iter_segment(path: Path):
+    """Filas de un segmento (created_at como datetime)."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        yield from _parse(f)
+
+
+def conversation_rows(path: Path, wa_id: str):
+    """Filas del segmento que pueden ser de `wa_id`: sólo los miembros que el índice le asigna
+    (segmento sin índice: se lee entero)."""
+    index = _load_index(path)
+    if index is None:
+        yield from iter_segment(path)
+        return
+    members = index.get(wa_id)
+    if not members:
+        return
+    with open(path, 'rb') as raw:
+        for offset, length in members:
+            raw.seek(offset)
+            yield from _parse(gzip.decompress(raw.read(length)).decode('utf-8').splitlines())
+
+
+def segments(bot_id: int) -> list[Path]:
+    """Segmentos del bot, del mes más reciente al más antiguo."""
+    folder = archive_dir()
+    if folder is None or not (folder / str(bot_id)).is_dir():
+        return []
+    return sorted((folder / str(bot_id)).glob('*.ndjson.gz'), reverse=True)
+
+
+def read_history(bot_id: int, wa_id: str, before: datetime | None = None, limit: int = 50) -> list[dict]:
+    """Últimos `limit` mensajes archivados de la conversación anteriores a `before`, en orden ascendente.
+    Lee segmentos hacia atrás (sólo los miembros indexados para `wa_id`) y se detiene en cuanto junta suficientes."""
+    month_cap = f'{before.year:04d}-{before.month:02d}' if before else None
+    found: dict[int, dict] = {}
+    for path in segments(bot_id):
+        if month_cap and path.name[:7] > month_cap:
+            continue
+        for row in conversation_rows(path, wa_id):
+            if _peer(row) == wa_id and (before is None or row['created_at'] < before):
+                found[row['id']] = row
+        if len(found) >= limit:
+            break
+    rows = sorted(found.values(), key=lambda r: (r['created_at'], r['id']))
+    return rows[-limit:] if limit else []
@@ -0,0 +1,234 @@
+"""Cascada de respuesta para mensajes de texto libre con presupuesto de latencia.
+
+Orden por defecto (configurable con AI_CASCADE_STAGES):
+  1. persona: motor determinista del Cerebro (sin IA) si la coincidencia es confiable.
+  2. answer:  IA generativa anclada al Cerebro (ai_answer).
+  3. intent:  IA sólo para detectar intención + respuesta desde el Cerebro (+ naturalizar).
+
+Cada etapa de IA se omite si el tiempo restante del mensaje no alcanza su mínimo.
+El resultado incluye una traza (etapa, resultado, ms) para ajustar el presupuesto.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .inbound import InboundMessage
+from .intent import predict_local, record_llm_label
+from .services import PERSONA_MISSING_PREFIX, ai_answer, answer_from_persona
+
+
+logger = logging.getLogger(__name__)
+
+INTENT_LABELS = [
+    'ubicacion', 'telefono', 'web', 'redes', 'horarios', 'pagos', 'yape', 'plin', 'tarjeta', 'transferencia', 'contraentrega',
+    'envios', 'mayorista', 'ruc', 'boleta', 'factura',
+    # Conversión/venta
+    'compra', 'producto', 'productos', 'recomendacion', 'catalogo', 'modelos', 'precios',
+]
+# Etiquetas de venta que se resuelven con el prompt canónico 'comprar'
+BUY_LABELS = ('compra', 'producto', 'productos', 'recomendacion', 'catalogo', 'modelos', 'precios')
+
+HIT = 'hit'
+MISS = 'miss'
+SKIPPED = 'skipped'
+ERROR = 'error'
+
+
+class _Skipped(Exception):
+    """La etapa no tiene presupuesto suficiente para su llamada de IA."""
+
+
+_stats_lock = threading.Lock()
+_stats: dict[str, dict] = {}
+
+
+def _record_stat(stage: str, outcome: str, ms: float) -> None:
+    with _stats_lock:
+        st = _stats.setdefault(stage, {'total_ms': 0.0, 'count': 0})
+        st['count'] += 1
+        st['total_ms'] += ms
+        st[outcome] = st.get(outcome, 0) + 1
+
+
+def cascade_stats(reset: bool = False) -> dict:
+    """Copia de los contadores por etapa en este worker: {stage: {hit, miss, skipped, error, count, total_ms}}."""
+    with _stats_lock:
+        snap = {k: dict(v) for k, v in _stats.items()}
+        if reset:
+            _stats.clear()
+    return snap
+
+
+def persona_is_confident(user_text: str, answer: str | None) -> bool:
+    """Una respuesta determinista es confiable si trae datos reales del Cerebro
+    (no un 'Por el momento no contamos…') y el mensaje es corto: en textos largos
+    una palabra clave suelta no garantiza que se respondió lo que se preguntó.
+    """
+    if not answer or answer.startswith(PERSONA_MISSING_PREFIX):
+        return False
+    max_words = getattr(settings, 'AI_CASCADE_PERSONA_MAX_WORDS', 8)
+    return len((user_text or '').split()) <= max_words
+
+
+def fallback_reply(persona: dict) -> str:
+    """Respuesta amable sin inventar información cuando ninguna etapa respondió."""
+    order_lines = [ln.strip() for ln in (persona.get('order_required') or '').split('\n') if ln.strip()]
+    pedido_hint = ("\nSi deseas hacer un pedido, por favor comparte: " + ", ".join(order_lines[:5])) if order_lines else ''
+    return f"Disculpa, no te entendí bien. ¿Podrías reformular o darme un poco más de detalle?{pedido_hint}"
+
+
+class CascadeResult:
+    __slots__ = ('text', 'stage', 'trace')
+
+    def __init__(self, text: str, stage: str, trace: list[dict]):
+        self.text = text
+        self.stage = stage
+        self.trace = trace
+
+
+class AnswerCascade:
+    """Ejecuta las etapas configuradas hasta obtener respuesta o agotar el presupuesto.
+
+    started_at: time.monotonic() de recepción del mensaje; así el tiempo gastado antes
+    (p.ej. selección de trigger por IA) también cuenta contra el presupuesto.
+    """
+
+    def __init__(
+        self,
+        persona: dict,
+        brand: str | None = None,
+        budget_s: float | None = None,
+        started_at: float | None = None,
+        stages: list[str] | None = None,
+        classify_intent_label=None,
+        naturalize_from_answer=None,
+        bot_id: int | None = None,
+        inbound_log_id: int | None = None,
+        persona_version: str | None = None,
+        knowledge_index=None,
+        history: list[dict] | None = None,
+        classification=None,
+    ):
+        self.persona = persona or {}
+        self.brand = brand
+        self.budget_s = budget_s if budget_s is not None else getattr(settings, 'AI_CASCADE_BUDGET_S', 12.0)
+        self.started_at = started_at if started_at is not None else time.monotonic()
+        self.stages = list(stages or getattr(settings, 'AI_CASCADE_STAGES', ['persona', 'answer', 'intent']))
+        self.min_remaining = getattr(settings, 'AI_CASCADE_MIN_REMAINING_S', {})
+        self.classify_intent_label = classify_intent_label
+        self.naturalize_from_answer = naturalize_from_answer
+        self.bot_id = bot_id
+        self.inbound_log_id = inbound_log_id
+        self.persona_version = persona_version
+        self.knowledge_index = knowledge_index
+        self.history = history
+        # services.Classification ya obtenida junto con la selección de trigger: no se vuelve a clasificar
+        self.classification = classification
+        self.trace: list[dict] = []
+        # Respuesta determinista no confiable: se usa sólo si la IA no respondió
+        self._weak_answer: str | None = None
+
+    def remaining(self) -> float:
+        return self.budget_s - (time.monotonic() - self.started_at)
+
+    def _can_run(self, stage: str) -> bool:
+        # Etapas sin mínimo configurado (deterministas) siempre corren
+        if stage not in self.min_remaining:
+            return True
+        return self.remaining() >= float(self.min_remaining[stage])
+
+    def _require_budget(self, stage: str) -> None:
+        if not self._can_run(stage):
+            raise _Skipped(stage)
+
+    def _timeout(self, default: float) -> float:
+        return max(0.5, min(default, self.remaining()))
+
+    def run(self, message: 'str | InboundMessage') -> CascadeResult:
+        if not isinstance(message, InboundMessage):
+            message = InboundMessage.from_text(message)
+        for stage in self.stages:
+            handler = getattr(self, f'_stage_{stage}', None)
+            if handler is None:
+                continue
+            t0 = time.monotonic()
+            try:
+                text = handler(message)
+            except _Skipped:
+                self._trace(stage, SKIPPED, (time.monotonic() - t0) * 1000.0)
+                continue
+            except Exception:
+                logger.exception('answer cascade stage %s failed', stage)
+                text, outcome = None, ERROR
+            else:
+                outcome = HIT if text else MISS
+            self._trace(stage, outcome, (time.monotonic() - t0) * 1000.0)
+            if text:
+                return self._done(text, stage)
+        if self._weak_answer:
+            return self._done(self._weak_answer, 'persona_weak')
+        return self._done(fallback_reply(self.persona), 'fallback')
+
+    def _trace(self, stage: str, outcome: str, ms: float) -> None:
+        self.trace.append({'stage': stage, 'outcome': outcome, 'ms': round(ms, 1)})
+        _record_stat(stage, outcome, ms)
+
+    def _done(self, text: str, stage: str) -> CascadeResult:
+        total_ms = (time.monotonic() - self.started_at) * 1000.0
+        logger.info('answer cascade: stage=%s total_ms=%.0f trace=%s', stage, total_ms, self.trace)
+        return CascadeResult(text, stage, self.trace)
+
+    # ===== Etapas =====
+
+    def _stage_persona(self, message: InboundMessage) -> str | None:
+        quick = answer_from_persona(message, self.persona, brand=self.brand, version=self.persona_version)
+        if persona_is_confident(message.text, quick):
+            return quick
+        if quick and not self._weak_answer:
+            self._weak_answer = quick
+        return None
+
+    def _stage_answer(self, message: InboundMessage) -> str | None:
+        self._require_budget('answer')
+        return ai_answer(
+            message.text, brand=self.brand, persona=self.persona, timeout=self._timeout(20),
+            persona_version=self.persona_version, knowledge_index=self.knowledge_index,
+            history=self.history,
+        )
+
+    def _stage_intent(self, message: InboundMessage) -> str | None:
+        # Intención (modelo local o IA); la respuesta final se arma desde el Cerebro
+        user_text = message.text
+        language = self.persona.get('language') or 'español'
+        label = predict_local(self.bot_id, user_text, INTENT_LABELS)
+        source = 'local'
+        if not label and self.classification is not None:
+            label = self.classification.intent
+            source = 'llm'
+            if not label:
+                return None
+            record_llm_label(self.inbound_log_id, label)
+        elif not label:
+            # Confianza local insuficiente: clasificar con IA si hay presupuesto
+            if not callable(self.classify_intent_label):
+                return None
+            self._require_budget('intent')
+            label = self.classify_intent_label(user_text, INTENT_LABELS, language=language, timeout=self._timeout(8))
+            source = 'llm'
+            if not label:
+                return None
+            record_llm_label(self.inbound_log_id, label)
+        logger.debug('answer cascade intent=%s source=%s', label, source)
+        mapped = 'comprar' if label in BUY_LABELS else label
+        quick = answer_from_persona(mapped, self.persona, brand=self.brand, version=self.persona_version)
+        if not quick:
+            return None
+        if callable(self.naturalize_from_answer) and self._can_run('naturalize'):
+            refined = self.naturalize_from_answer(
+                user_text, quick, assistant_name=self.persona.get('name'), language=language, timeout=self._timeout(8)
+            )
+            if (refined or '').strip():
+                return refined.strip()
+        return quick
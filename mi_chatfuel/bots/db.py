@@ -0,0 +1,114 @@
+"""Ruteo a la réplica de lectura y métricas de conexiones a la base.
+
+Las vistas de sólo lectura del panel se decoran con @read_replica: las lecturas
+hechas dentro van al alias 'replica' si DATABASE_REPLICA_URL está configurada
+(ver settings.py); las escrituras y todo lo demás (webhook incluido) usan 'default'.
+
+Las métricas cuentan requests y conexiones nuevas por alias: con conexiones
+persistentes (DB_CONN_MAX_AGE) las conexiones por request tienden a 0. El costo de
+abrir una conexión se mide con `manage.py benchmark --suite db`.
+
+Perfil SQLITE_TUNED (un solo nodo con varios workers de gunicorn): cada conexión
+SQLite nueva activa WAL, busy_timeout, synchronous=NORMAL y mmap_size, y las
+transacciones empiezan con BEGIN IMMEDIATE (settings.py). Así la cola de un solo
+escritor es la propia de SQLite: cada transacción toma el candado de escritura al
+empezar y espera su turno hasta busy_timeout, en lugar de fallar con "database is
+locked" al pasar de lectura a escritura. `manage.py loadtest_sqlite` mide
+mensajes por segundo con y sin el perfil.
+"""
+import contextvars
+import functools
+import threading
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db.backends.signals import connection_created
+
+
+REPLICA = 'replica'
+
+_use_replica: contextvars.ContextVar[bool] = contextvars.ContextVar('db_use_replica', default=False)
+_lock = threading.Lock()
+_stats = {'requests': 0, 'connections': {}}
+
+
+def replica_configured() -> bool:
+    return REPLICA in settings.DATABASES
+
+
+def read_replica(view):
+    """Las lecturas de la vista van a la réplica (si hay); las escrituras siguen en 'default'."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = _use_replica.set(True)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            _use_replica.reset(token)
+    return wrapper
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _use_replica.get() and replica_configured():
+            return REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Misma base replicada: las relaciones entre alias son válidas
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+def _on_request(sender, **kwargs):
+    with _lock:
+        _stats['requests'] += 1
+
+
+def _on_connection(sender, connection, **kwargs):
+    with _lock:
+        _stats['connections'][connection.alias] = _stats['connections'].get(connection.alias, 0) + 1
+    if connection.vendor == 'sqlite' and sqlite_tuned():
+        tune_sqlite(connection)
+
+
+def install_signals():
+    request_started.connect(_on_request, dispatch_uid='bots.db.request')
+    connection_created.connect(_on_connection, dispatch_uid='bots.db.connection')
+
+
+def sqlite_tuned() -> bool:
+    return bool(getattr(settings, 'SQLITE_TUNED', False))
+
+
+def tune_sqlite(connection):
+    """PRAGMAs del perfil SQLITE_TUNED (WAL persiste en el archivo; el resto es por conexión)."""
+    with connection.cursor() as c:
+        c.execute(f'PRAGMA busy_timeout={int(getattr(settings, "SQLITE_BUSY_TIMEOUT_MS", 5000))}')
+        c.execute('PRAGMA journal_mode=WAL')
+        c.execute('PRAGMA synchronous=NORMAL')
+        c.execute(f'PRAGMA mmap_size={int(getattr(settings, "SQLITE_MMAP_SIZE", 0))}')
+
+
+def stats() -> dict:
+    """Requests atendidos y conexiones abiertas por alias en este worker."""
+    with _lock:
+        requests = _stats['requests']
+        conns = dict(_stats['connections'])
+    return {
+        'requests': requests,
+        'connections': conns,
+        'connections_per_request': round(sum(conns.values()) / requests, 3) if requests else None,
+        'conn_max_age': {alias: db.get('CONN_MAX_AGE', 0) for alias, db in settings.DATABASES.items()},
+    }
+
+
+def reset_stats():
+    with _lock:
+        _stats['requests'] = 0
+        _stats['connections'] = {}
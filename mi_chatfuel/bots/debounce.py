@@ -0,0 +1,79 @@
+"""Agrupación de ráfagas de texto por conversación antes de triggers e IA.
+
+Los usuarios suelen escribir una idea en varios mensajes seguidos ("hola" /
+"quería saber" / "precio del disfraz"). Cada mensaje de texto se guarda en la
+caché con un número de secuencia por (bot, wa_id) y el request espera
+AI_DEBOUNCE_S: si en ese lapso llegó otro mensaje, éste termina sin responder y
+el último de la ráfaga procesa todos los textos juntos (una sola respuesta).
+
+Viene desactivado (AI_DEBOUNCE_S=0: el texto se procesa de inmediato). La espera
+ocupa el hilo del request, así que para activarlo hacen falta una caché compartida
+entre workers (CACHE_URL=redis://…; la locmem por defecto no ve los mensajes de
+otros procesos) y workers con hilos (gunicorn --threads N): con workers sync el
+mensaje siguiente espera en cola a que termine la ventana y nunca se agrupa.
+Los botones no pasan por aquí.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Máximo de mensajes que se agrupan en una sola respuesta
+MAX_BURST = 10
+
+
+def _seq_key(bot_id: int, wa_id: str) -> str:
+    return f'debounce:{bot_id}:{wa_id}'
+
+
+def _msg_key(bot_id: int, wa_id: str, seq: int) -> str:
+    return f'debounce:{bot_id}:{wa_id}:{seq}'
+
+
+def window_s() -> float:
+    return float(getattr(settings, 'AI_DEBOUNCE_S', 0) or 0)
+
+
+def push(bot_id: int, wa_id: str, text: str, window: float) -> int:
+    """Registra el texto en la ráfaga de la conversación y devuelve su número de secuencia."""
+    ttl = max(10, int(window * 4) + 1)
+    seq_key = _seq_key(bot_id, wa_id)
+    cache.add(seq_key, 0, ttl)
+    try:
+        seq = cache.incr(seq_key)
+    except ValueError:
+        # La clave expiró entre add e incr
+        cache.set(seq_key, 1, ttl)
+        seq = 1
+    cache.touch(seq_key, ttl)
+    cache.set(_msg_key(bot_id, wa_id, seq), text, ttl)
+    return seq
+
+
+def take(bot_id: int, wa_id: str, seq: int) -> list[str]:
+    """Textos pendientes de la ráfaga hasta `seq` (en orden de llegada); los consume."""
+    keys = [_msg_key(bot_id, wa_id, s) for s in range(max(1, seq - MAX_BURST + 1), seq + 1)]
+    found = cache.get_many(keys)
+    cache.delete_many(list(found))
+    # Sólo el tramo contiguo final: lo anterior ya lo consumió otra ráfaga
+    texts = []
+    for key in reversed(keys):
+        if key not in found:
+            break
+        texts.append(found[key])
+    return list(reversed(texts))
+
+
+def collect(bot_id: int, wa_id: str, text: str, window: float | None = None, sleep=time.sleep) -> str | None:
+    """Espera la ventana de la conversación. Devuelve el texto agrupado de la ráfaga si este
+    mensaje fue el último, o None si llegó otro después (ese request responderá por todos)."""
+    window = window_s() if window is None else window
+    if window <= 0:
+        return text
+    seq = push(bot_id, wa_id, text, window)
+    sleep(window)
+    if (cache.get(_seq_key(bot_id, wa_id)) or 0) != seq:
+        return None
+    texts = take(bot_id, wa_id, seq)
+    return '\n'.join(texts) if texts else text
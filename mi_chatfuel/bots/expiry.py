@@ -0,0 +1,144 @@
+"""Vencimiento de temporizadores de WaUser: chat humano y flujo inactivo.
+
+- Chat humano: el nodo asesora y el panel fijan human_expires_at; al vencer se
+  vuelve a modo IA (human_requested=False) con un UPDATE por lote.
+- Flujo inactivo: si el usuario no responde en FLOW_INACTIVITY_MIN minutos desde
+  su último mensaje (last_in_at) se cierra el flujo y se le envía el aviso de cierre.
+
+El worker (manage.py run_expiry) no revisa en cada request ni barre la tabla:
+next_due() consulta el vencimiento más próximo (MIN sobre índices parciales que
+sólo contienen filas con temporizador activo) y duerme hasta entonces, como
+máximo EXPIRY_MAX_SLEEP_S para ver temporizadores creados mientras dormía.
+
+Si el worker no está corriendo, el webhook aplica expire_on_message() al usuario
+que escribe (sin consultas extra): lo vencido se resuelve, a más tardar, con su
+siguiente mensaje.
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from .models import Bot, WaUser
+
+
+logger = logging.getLogger(__name__)
+
+CLOSE_MESSAGE = "Cerramos este flujo por inactividad (no hubo respuesta). Puedes escribirnos en cualquier momento."
+_SOCIAL = (
+    ('instagram', 'Instagram'), ('facebook', 'Facebook'), ('tiktok', 'TikTok'),
+    ('youtube', 'YouTube'), ('x', 'X'), ('linktree', 'Linktree'),
+)
+
+
+def flow_inactivity() -> timedelta:
+    return timedelta(minutes=getattr(settings, 'FLOW_INACTIVITY_MIN', 5))
+
+
+def _batch() -> int:
+    return max(1, getattr(settings, 'EXPIRY_BATCH', 500))
+
+
+def close_message(flow_cfg: dict | None) -> str:
+    """Aviso de cierre por inactividad + redes sociales configuradas en la IA del flujo."""
+    from .views2 import _flatten_ai_cfg
+    ai_cfg = _flatten_ai_cfg(flow_cfg or {})
+    redes = [f"{label}: {ai_cfg[key]}" for key, label in _SOCIAL if ai_cfg.get(key)]
+    if redes:
+        return CLOSE_MESSAGE + "\nSíguenos: " + " | ".join(redes)
+    return CLOSE_MESSAGE
+
+
+def expire_human(now: datetime | None = None) -> int:
+    """Devuelve a modo IA los chats humanos vencidos; cantidad de usuarios liberados."""
+    now = now or timezone.now()
+    due = WaUser.objects.filter(human_requested=True, human_expires_at__lte=now)
+    total = 0
+    while True:
+        ids = list(due.values_list('pk', flat=True)[:_batch()])
+        if not ids:
+            return total
+        total += due.filter(pk__in=ids).update(human_requested=False, human_expires_at=None)
+
+
+def _claim_flows(cutoff: datetime) -> list[tuple[int, int, str]]:
+    """Cierra un lote de flujos vencidos y devuelve (pk, bot_id, wa_id) de los cerrados."""
+    with transaction.atomic():
+        due = WaUser.objects.filter(flow_node__isnull=False, last_in_at__lte=cutoff)
+        # skip_locked: varios workers no reclaman las mismas filas (en SQLite se ignora)
+        rows = list(due.select_for_update(skip_locked=True).values_list('pk', 'bot_id', 'wa_id')[:_batch()])
+        if rows:
+            due.filter(pk__in=[pk for pk, _, _ in rows]).update(flow_node=None)
+    return rows
+
+
+def expire_flows(now: datetime | None = None, send=None) -> int:
+    """Cierra los flujos sin respuesta y envía el aviso (después del commit); cantidad de flujos cerrados."""
+    if send is None:
+        from .services import send_whatsapp_text as send
+    cutoff = (now or timezone.now()) - flow_inactivity()
+    total = 0
+    while True:
+        rows = _claim_flows(cutoff)
+        if not rows:
+            return total
+        total += len(rows)
+        by_bot: dict[int, list[str]] = {}
+        for _, bot_id, wa_id in rows:
+            by_bot.setdefault(bot_id, []).append(wa_id)
+        for bot in Bot.objects.filter(pk__in=by_bot, is_active=True):
+            flow = bot.flows.filter(is_active=True).order_by('-updated_at').only('definition').first()
+            text = close_message(flow.definition if flow else None)
+            for wa_id in by_bot[bot.pk]:
+                try:
+                    send(bot, wa_id, text)
+                except Exception:
+                    # el flujo queda cerrado aunque falle el aviso
+                    logger.exception('inactivity close message failed for %s', wa_id)
+
+
+def expire_on_message(user: WaUser, last_in: datetime | None, now: datetime) -> bool:
+    """Vence en memoria los temporizadores de `user` (la fila que ya cargó el webhook) según su
+    mensaje anterior (`last_in`). True si se cerró su flujo: el llamador envía close_message()."""
+    if user.human_requested and user.human_expires_at and user.human_expires_at <= now:
+        user.human_requested = False
+        user.human_expires_at = None
+    if user.flow_node and last_in and now - last_in > flow_inactivity():
+        user.flow_node = None
+        return True
+    return False
+
+
+def next_due(now: datetime | None = None) -> datetime | None:
+    """Próximo vencimiento (chat humano o flujo), o None si no hay temporizadores activos."""
+    human = WaUser.objects.filter(human_requested=True).aggregate(m=Min('human_expires_at'))['m']
+    last_in = WaUser.objects.filter(flow_node__isnull=False).aggregate(m=Min('last_in_at'))['m']
+    candidates = [d for d in (human, last_in and last_in + flow_inactivity()) if d]
+    return min(candidates) if candidates else None
+
+
+def run_once(now: datetime | None = None) -> dict:
+    now = now or timezone.now()
+    return {'human': expire_human(now), 'flows': expire_flows(now)}
+
+
+def run_forever(stop: threading.Event | None = None, max_sleep: float | None = None, on_tick=None) -> None:
+    """Vence lo debido y duerme hasta el próximo vencimiento (o max_sleep) hasta que `stop` se active."""
+    stop = stop or threading.Event()
+    if max_sleep is None:
+        max_sleep = getattr(settings, 'EXPIRY_MAX_SLEEP_S', 30)
+    while not stop.is_set():
+        try:
+            result = run_once()
+            if on_tick and (result['human'] or result['flows']):
+                on_tick(result)
+            due = next_due()
+            wait = max_sleep if due is None else (due - timezone.now()).total_seconds()
+        except Exception:
+            logger.exception('expiry scheduler tick failed')
+            wait = max_sleep
+        stop.wait(min(max(wait, 0.05), max_sleep))
@@ -0,0 +1,135 @@
+"""Exportación en streaming de contactos (WaUser) e historial de mensajes (MessageLog).
+
+Las filas se leen con .values_list().iterator(chunk_size=EXPORT_CHUNK) (cursor del
+lado del servidor en PostgreSQL, fetchmany en SQLite) y se serializan de a una a
+CSV o NDJSON; con gzip se comprimen al vuelo. Nada acumula el resultado completo:
+la memoria queda constante sin importar cuántas filas haya. Lo usan las vistas
+/panel/api/export/... (StreamingHttpResponse) y `manage.py export_data`.
+"""
+import csv
+import json
+import zlib
+from datetime import date, datetime, time, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import MessageLog, WaUser
+
+
+CONTACTS = 'contacts'
+MESSAGES = 'messages'
+FIELDS = {
+    CONTACTS: ('bot_id', 'wa_id', 'name', 'human_requested', 'flow_node', 'last_in_at', 'last_message_at'),
+    MESSAGES: (
+        'id', 'bot_id', 'created_at', 'direction', 'wa_from', 'wa_to', 'message_type',
+        'status', 'error', 'body_text', 'wamid',
+    ),
+}
+CONTENT_TYPES = {'csv': 'text/csv; charset=utf-8', 'ndjson': 'application/x-ndjson'}
+# Tamaño aproximado de cada bloque que se entrega (evita un write por fila)
+_BLOCK = 64 * 1024
+
+
+class ExportError(ValueError):
+    pass
+
+
+def parse_bound(value: str | None, end: bool = False) -> datetime | None:
+    """Fecha o fecha-hora ISO → datetime aware. Una fecha sola como `end` incluye todo ese día."""
+    if not value:
+        return None
+    try:
+        # parse_datetime/parse_date lanzan ValueError con fechas bien formadas pero imposibles (2024-02-30)
+        dt = parse_datetime(value)
+        d = parse_date(value) if dt is None else None
+    except ValueError:
+        raise ExportError(f'fecha inválida: {value}')
+    if dt is None:
+        if d is None:
+            raise ExportError(f'fecha inválida: {value}')
+        dt = datetime.combine(d + timedelta(days=1) if end else d, time.min)
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt)
+    return dt
+
+
+def queryset(kind: str, bot_ids, since: datetime | None = None, until: datetime | None = None,
+             direction: str | None = None):
+    """Filas de `kind` de esos bots, ordenadas por id. Contactos: por último mensaje; mensajes: por fecha."""
+    if kind == CONTACTS:
+        qs = WaUser.objects.filter(bot_id__in=bot_ids)
+        date_field = 'last_message_at'
+    elif kind == MESSAGES:
+        qs = MessageLog.objects.filter(bot_id__in=bot_ids)
+        date_field = 'created_at'
+        if direction:
+            if direction not in (MessageLog.IN, MessageLog.OUT):
+                raise ExportError(f'direction inválida: {direction}')
+            qs = qs.filter(direction=direction)
+    else:
+        raise ExportError(f'tipo de exportación desconocido: {kind}')
+    if since is not None:
+        qs = qs.filter(**{f'{date_field}__gte': since})
+    if until is not None:
+        qs = qs.filter(**{f'{date_field}__lt': until})
+    return qs.order_by('pk')
+
+
+def _cell(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return '' if value is None else value
+
+
+class _Echo:
+    """Destino de csv.writer que devuelve la línea en vez de guardarla."""
+    def write(self, value):
+        return value
+
+
+def _csv_lines(fields, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([_cell(v) for v in row])
+
+
+def _ndjson_lines(fields, rows):
+    for row in rows:
+        yield json.dumps({f: _cell(v) for f, v in zip(fields, row)}, ensure_ascii=False) + '\n'
+
+
+def stream(qs, fields, fmt: str = 'csv', compress: bool = False, chunk: int | None = None):
+    """Iterador de bloques de bytes con las filas de `qs` en CSV o NDJSON (gzip opcional).
+    Valida el formato al llamarse; la consulta corre recién al consumir el iterador."""
+    if fmt not in CONTENT_TYPES:
+        raise ExportError(f'formato inválido: {fmt}')
+    return _blocks(qs, fields, fmt, compress, chunk or getattr(settings, 'EXPORT_CHUNK', 2000))
+
+
+def _blocks(qs, fields, fmt, compress, chunk):
+    rows = qs.values_list(*fields).iterator(chunk_size=chunk)
+    lines = _csv_lines(fields, rows) if fmt == 'csv' else _ndjson_lines(fields, rows)
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits=31: formato gzip
+    buf, size = [], 0
+    for line in lines:
+        data = line.encode('utf-8')
+        buf.append(data)
+        size += len(data)
+        if size >= _BLOCK:
+            block = b''.join(buf)
+            buf, size = [], 0
+            block = gz.compress(block) if gz else block
+            if block:
+                yield block
+    block = b''.join(buf)
+    if gz:
+        block = gz.compress(block) + gz.flush()
+    if block:
+        yield block
+
+
+def filename(kind: str, fmt: str, compress: bool) -> str:
+    return f"{kind}-{timezone.now():%Y%m%d-%H%M}.{fmt}{'.gz' if compress else ''}"
@@ -0,0 +1,50 @@
+"""Campos de modelo propios de la app."""
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+
+
+class CompressedJSONField(models.BinaryField):
+    """JSON compacto (sin espacios) comprimido con zlib en una columna binaria.
+
+    En Python se lee y escribe como dict/list igual que un JSONField; no admite
+    lookups sobre claves (payload__x), así que las consultas filtran por columnas
+    propias (body_text, wamid, status…) y el payload sólo se decodifica al leerlo.
+    """
+    description = 'JSON comprimido'
+
+    def __init__(self, *args, level: int = 6, **kwargs):
+        self.level = level
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.level != 6:
+            kwargs['level'] = self.level
+        return name, path, args, kwargs
+
+    def compress(self, value) -> bytes:
+        raw = json.dumps(value, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':'))
+        return zlib.compress(raw.encode('utf-8'), self.level)
+
+    @staticmethod
+    def decompress(value):
+        return json.loads(zlib.decompress(bytes(value)))
+
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else self.decompress(value)
+
+    def to_python(self, value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return self.decompress(value)
+        return value
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is None:
+            return None
+        return connection.Database.Binary(self.compress(value))
+
+    def value_to_string(self, obj):
+        return json.dumps(self.value_from_object(obj), cls=DjangoJSONEncoder, ensure_ascii=False)
@@ -2,6 +2,15 @@ from django import forms
 from .models import Bot, Flow
 
 
+# Tareas de IA cuyo modelo se puede elegir por bot (ver bots/ai_router.py)
+AI_MODEL_TASKS = (
+    ('trigger', 'Modelo para disparar flujos'),
+    ('intent', 'Modelo para clasificar intención'),
+    ('naturalize', 'Modelo para naturalizar respuestas'),
+    ('answer', 'Modelo para responder con el Cerebro'),
+)
+
+
 class BotForm(forms.ModelForm):
     class Meta:
         model = Bot
@@ -16,6 +25,27 @@ class BotForm(forms.ModelForm):
             'access_token': forms.Textarea(attrs={'rows': 3}),
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        current = self.instance.ai_models or {}
+        for task, label in AI_MODEL_TASKS:
+            self.fields[f'model_{task}'] = forms.CharField(
+                label=label,
+                required=False,
+                initial=', '.join(current.get(task) or []),
+                help_text='Separados por coma, en orden de preferencia. Vacío = modelo por defecto.',
+            )
+
+    def clean(self):
+        cleaned = super().clean()
+        ai_models = {}
+        for task, _label in AI_MODEL_TASKS:
+            models = [m.strip() for m in (cleaned.get(f'model_{task}') or '').split(',') if m.strip()]
+            if models:
+                ai_models[task] = models
+        self.instance.ai_models = ai_models
+        return cleaned
+
 
 class FlowForm(forms.ModelForm):
     class Meta:
@@ -0,0 +1,133 @@
+"""Mensaje entrante de WhatsApp parseado una sola vez.
+
+El webhook construye un InboundMessage desde el body de Meta y lo pasa a cada
+etapa (triggers, Cerebro, cascada de IA, memoria): el texto ya viene en minúsculas,
+sin tildes y tokenizado, así nadie vuelve a normalizar ni a recorrer el payload.
+
+La normalización usa una tabla de traducción precalculada (letra acentuada → base)
+en lugar de unicodedata por carácter; sólo se tocan los caracteres acentuados, así
+el texto ASCII o con pocas tildes cuesta casi nada.
+"""
+import re
+import unicodedata
+
+
+def _fold_table() -> dict[str, str]:
+    """Tabla letra acentuada → letra base (Latin-1 y Latin Extendido-A/B) y marcas combinantes → ''."""
+    table: dict[str, str] = {}
+    for cp in range(0xC0, 0x250):
+        ch = chr(cp)
+        base = ''.join(c for c in unicodedata.normalize('NFD', ch) if unicodedata.category(c) != 'Mn')
+        if base and base != ch:
+            table[ch] = base
+    for cp in range(0x300, 0x370):
+        table[chr(cp)] = ''
+    return table
+
+
+_FOLD = _fold_table()
+# str.translate consulta el dict por cada carácter; el regex sólo se detiene en los que cambian
+_FOLD_RE = re.compile('[' + ''.join(re.escape(ch) for ch in _FOLD) + ']')
+_WORD_RE = re.compile(r'\w+')
+
+
+def _fold(m: re.Match) -> str:
+    return _FOLD[m.group()]
+
+
+def normalize(s: str) -> str:
+    """Minúsculas, sin espacios en los extremos y sin tildes ('¿Envíos?' → '¿envios?')."""
+    s = (s or '').lower().strip()
+    return s if s.isascii() else _FOLD_RE.sub(_fold, s)
+
+
+def tokenize(normalized: str) -> list[str]:
+    return _WORD_RE.findall(normalized)
+
+
+class InboundMessage:
+    """Campos del primer mensaje de un webhook de WhatsApp.
+
+    text: texto escrito (sólo type='text'); title: etiqueta del botón/lista elegido;
+    payload_id: id del botón/lista (o payload del botón de plantilla);
+    norm/tokens: `text` normalizado y sus palabras.
+    """
+    __slots__ = ('wamid', 'wa_from', 'type', 'text', 'title', 'payload_id', 'profile_name',
+                 'phone_number_id', 'norm', 'tokens')
+
+    def __init__(self, wamid: str = '', wa_from: str = '', type: str = '', text: str = '', title: str = '',
+                 payload_id: str | None = None, profile_name: str = '', phone_number_id: str = ''):
+        self.wamid = wamid
+        self.wa_from = wa_from
+        self.type = type
+        self.text = (text or '').strip()
+        self.title = title or ''
+        self.payload_id = payload_id
+        self.profile_name = profile_name
+        self.phone_number_id = phone_number_id
+        self.norm = normalize(self.text)
+        self.tokens = tokenize(self.norm)
+
+    @classmethod
+    def from_text(cls, text: str) -> 'InboundMessage':
+        return cls(type='text', text=text)
+
+    @classmethod
+    def from_webhook(cls, body: dict | None) -> 'InboundMessage | None':
+        """Primer mensaje del body crudo de Meta, o None si no trae mensajes (p.ej. statuses)."""
+        try:
+            entry = ((body or {}).get('entry') or [{}])[0]
+            changes = entry.get('changes') or []
+            value = (changes[0].get('value') if changes else None) or {}
+            messages = value.get('messages') or []
+        except (AttributeError, IndexError, TypeError):
+            return None
+        if not messages:
+            return None
+        contacts = value.get('contacts') or []
+        profile = (contacts[0].get('profile') if contacts else None) or {}
+        meta = value.get('metadata') or {}
+        return cls.from_message(messages[0], profile_name=profile.get('name') or '',
+                                phone_number_id=meta.get('phone_number_id') or '')
+
+    @classmethod
+    def from_message(cls, msg: dict, profile_name: str = '', phone_number_id: str = '') -> 'InboundMessage':
+        mtype = msg.get('type') or ''
+        text = title = ''
+        payload_id = None
+        if mtype == 'text':
+            text = (msg.get('text') or {}).get('body') or ''
+        elif mtype == 'interactive':
+            inter = msg.get('interactive') or {}
+            reply = inter.get('button_reply') or inter.get('list_reply') or {}
+            payload_id = reply.get('id')
+            title = reply.get('title') or ''
+        elif mtype == 'button':
+            button = msg.get('button') or {}
+            payload_id = button.get('payload') or button.get('text')
+            title = button.get('text') or ''
+        return cls(
+            wamid=msg.get('id') or '', wa_from=msg.get('from') or '', type=mtype, text=text, title=title,
+            payload_id=payload_id, profile_name=profile_name, phone_number_id=phone_number_id,
+        )
+
+    def with_text(self, text: str) -> 'InboundMessage':
+        """Copia con otro texto (p.ej. la ráfaga agrupada por bots/debounce.py)."""
+        return InboundMessage(self.wamid, self.wa_from, self.type, text, self.title, self.payload_id,
+                              self.profile_name, self.phone_number_id)
+
+    @property
+    def turn_text(self) -> str:
+        """Texto visible del turno: lo escrito o la etiqueta del botón elegido."""
+        return self.text or self.title
+
+    def display_text(self) -> str:
+        """Texto para el panel de conversaciones ('[imagen]' etc. para otros tipos)."""
+        if self.type == 'text':
+            return self.text
+        if self.type in ('interactive', 'button'):
+            return self.title or self.payload_id or '[interacción]'
+        return f'[{self.type or "mensaje"}]'
+
+    def __repr__(self):
+        return f'InboundMessage(type={self.type!r}, text={self.text[:40]!r}, payload_id={self.payload_id!r})'
@@ -0,0 +1,165 @@
+"""Clasificador local de intención (CPU, sin dependencias).
+
+Features: n-gramas de caracteres (2..4) sobre el texto normalizado sin acentos.
+Modelo: Naive Bayes multinomial con suavizado de Laplace. Se entrena con las
+etiquetas que la IA decidió en el pasado (MessageLog.intent_label) y sólo se
+consulta a la IA cuando la confianza local queda por debajo del umbral.
+"""
+import math
+import threading
+import time
+
+from django.conf import settings
+
+from .inbound import InboundMessage, normalize as _norm_text
+from .models import IntentModel, MessageLog
+
+
+NGRAM_RANGE = (2, 4)
+
+
+def char_ngrams(text: str, ngram_range: tuple[int, int] = NGRAM_RANGE) -> dict[str, int]:
+    """Cuenta n-gramas de caracteres por palabra (con bordes ' ') del texto normalizado."""
+    counts: dict[str, int] = {}
+    lo, hi = ngram_range
+    for word in _norm_text(text).split():
+        w = f' {word} '
+        for n in range(lo, hi + 1):
+            for i in range(len(w) - n + 1):
+                g = w[i:i + n]
+                counts[g] = counts.get(g, 0) + 1
+    return counts
+
+
+class NaiveBayesIntentClassifier:
+    """Naive Bayes multinomial sobre n-gramas de caracteres."""
+
+    def __init__(self, alpha: float = 0.5):
+        self.alpha = alpha
+        self.labels: list[str] = []
+        self.log_prior: dict[str, float] = {}
+        # log P(feature | label) para features vistas; `unseen` para el resto
+        self.log_prob: dict[str, dict[str, float]] = {}
+        self.unseen: dict[str, float] = {}
+
+    def fit(self, texts: list[str], labels: list[str]) -> 'NaiveBayesIntentClassifier':
+        per_label: dict[str, dict[str, int]] = {}
+        docs: dict[str, int] = {}
+        vocab: set[str] = set()
+        for text, label in zip(texts, labels):
+            feats = char_ngrams(text)
+            acc = per_label.setdefault(label, {})
+            for g, c in feats.items():
+                acc[g] = acc.get(g, 0) + c
+            vocab.update(feats)
+            docs[label] = docs.get(label, 0) + 1
+        total_docs = sum(docs.values()) or 1
+        v = len(vocab) or 1
+        self.labels = sorted(per_label)
+        for label in self.labels:
+            feats = per_label[label]
+            denom = sum(feats.values()) + self.alpha * v
+            self.log_prior[label] = math.log(docs[label] / total_docs)
+            self.log_prob[label] = {g: math.log((c + self.alpha) / denom) for g, c in feats.items()}
+            self.unseen[label] = math.log(self.alpha / denom)
+        return self
+
+    def predict(self, text: str) -> tuple[str | None, float]:
+        """Devuelve (etiqueta, probabilidad posterior) o (None, 0.0) si no hay modelo/features."""
+        if not self.labels:
+            return None, 0.0
+        feats = char_ngrams(text)
+        if not feats:
+            return None, 0.0
+        scores = {}
+        for label in self.labels:
+            lp = self.log_prob[label]
+            un = self.unseen[label]
+            scores[label] = self.log_prior[label] + sum(c * lp.get(g, un) for g, c in feats.items())
+        best = max(scores, key=scores.get)
+        top = scores[best]
+        norm = sum(math.exp(s - top) for s in scores.values())
+        return best, 1.0 / norm
+
+    def to_dict(self) -> dict:
+        return {
+            'alpha': self.alpha,
+            'ngram_range': list(NGRAM_RANGE),
+            'labels': self.labels,
+            'log_prior': self.log_prior,
+            'log_prob': self.log_prob,
+            'unseen': self.unseen,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'NaiveBayesIntentClassifier':
+        clf = cls(alpha=float(data.get('alpha') or 0.5))
+        clf.labels = list(data.get('labels') or [])
+        clf.log_prior = dict(data.get('log_prior') or {})
+        clf.log_prob = dict(data.get('log_prob') or {})
+        clf.unseen = dict(data.get('unseen') or {})
+        return clf
+
+
+# ===== Carga por worker =====
+
+_lock = threading.Lock()
+# bot_id -> (checked_at monotonic, version, clasificador | None)
+_loaded: dict[int, tuple[float, int, NaiveBayesIntentClassifier | None]] = {}
+
+
+def get_classifier(bot_id: int) -> NaiveBayesIntentClassifier | None:
+    """Clasificador de la última versión del bot, cargado una vez por worker.
+    Cada INTENT_MODEL_RECHECK_S se consulta sólo el número de versión para detectar reentrenos.
+    """
+    recheck = getattr(settings, 'INTENT_MODEL_RECHECK_S', 300)
+    now = time.monotonic()
+    cached = _loaded.get(bot_id)
+    if cached and now - cached[0] < recheck:
+        return cached[2]
+    latest = (
+        IntentModel.objects.filter(bot_id=bot_id).order_by('-version').values_list('version', flat=True).first()
+    )
+    with _lock:
+        cached = _loaded.get(bot_id)
+        if cached and cached[1] == (latest or 0):
+            _loaded[bot_id] = (now, cached[1], cached[2])
+            return cached[2]
+        clf = None
+        if latest:
+            row = IntentModel.objects.filter(bot_id=bot_id, version=latest).only('artifact').first()
+            if row:
+                clf = NaiveBayesIntentClassifier.from_dict(row.artifact)
+        _loaded[bot_id] = (now, latest or 0, clf)
+        return clf
+
+
+def reset_cache() -> None:
+    with _lock:
+        _loaded.clear()
+
+
+def predict_local(bot_id: int | None, user_text: str, labels: list[str]) -> str | None:
+    """Etiqueta del modelo local si su confianza supera INTENT_LOCAL_THRESHOLD; si no, None
+    (y el llamador decide si consulta a la IA)."""
+    if not bot_id:
+        return None
+    clf = get_classifier(bot_id)
+    if clf is None:
+        return None
+    label, conf = clf.predict(user_text)
+    if label in labels and conf >= getattr(settings, 'INTENT_LOCAL_THRESHOLD', 0.75):
+        return label
+    return None
+
+
+def record_llm_label(inbound_log_id: int | None, label: str) -> None:
+    """Guarda la decisión de la IA en el MessageLog entrante para el próximo entrenamiento."""
+    if inbound_log_id and label:
+        MessageLog.objects.filter(pk=inbound_log_id).update(intent_label=label)
+
+
+def inbound_text(payload: dict) -> str:
+    """Texto de un webhook entrante guardado en MessageLog.payload ('' si no es texto)."""
+    inbound = InboundMessage.from_webhook(payload)
+    return inbound.text if inbound else ''
@@ -0,0 +1,237 @@
+"""Recuperación BM25 sobre la base de conocimiento del Cerebro (persona).
+
+El prompt de ai_answer incluía todas las secciones del negocio (catálogo, pagos,
+envíos, FAQs…) en cada mensaje. Aquí esas secciones (KnowledgeSection) se cortan
+en fragmentos y se indexan con BM25 una vez por versión de flujo (al guardar el
+flujo); por mensaje sólo se envían los fragmentos más relevantes dentro de
+AI_KNOWLEDGE_TOKEN_BUDGET. Las reglas de identidad/tono se envían siempre.
+"""
+import logging
+import math
+import re
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .inbound import normalize as _norm_text
+from .models import Flow, KnowledgeIndex
+from .services import CompiledPrompt, compiled_system_prompt, estimate_tokens
+
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r'[a-z0-9]+')
+_STOPWORDS = frozenset(
+    'a al con de del el en es la las lo los mi me o para por que se su sus te tu un una uno y ya '
+    'hola quiero tienen tiene hay como cual cuales donde cuanto cuando esta este eso esa'.split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """Palabras sin acentos ni stopwords con un stemming mínimo (plural y prefijo de 6 letras)."""
+    out = []
+    for w in _WORD_RE.findall(_norm_text(text)):
+        if w in _STOPWORDS:
+            continue
+        if len(w) > 4 and w.endswith('es'):
+            w = w[:-2]
+        elif len(w) > 3 and w.endswith('s'):
+            w = w[:-1]
+        out.append(w[:6])
+    return out
+
+
+def chunk_sections(sections: list[str], max_tokens: int | None = None) -> list[str]:
+    """Corta cada sección por líneas en fragmentos de ~max_tokens, repitiendo el
+    encabezado de la sección ('Pagos:', 'Envíos y cobertura:'…) en cada fragmento."""
+    max_tokens = max_tokens or getattr(settings, 'AI_KNOWLEDGE_CHUNK_TOKENS', 80)
+    chunks: list[str] = []
+    for section in sections:
+        lines = [ln for ln in str(section).split('\n') if ln.strip()]
+        if not lines:
+            continue
+        header, body = lines[0], lines[1:]
+        if not body or estimate_tokens(str(section)) <= max_tokens:
+            chunks.append('\n'.join(lines))
+            continue
+        cur: list[str] = []
+        for ln in body:
+            if cur and estimate_tokens('\n'.join([header, *cur, ln])) > max_tokens:
+                chunks.append('\n'.join([header, *cur]))
+                cur = []
+            cur.append(ln)
+        if cur:
+            chunks.append('\n'.join([header, *cur]))
+    return chunks
+
+
+class BM25Index:
+    """Okapi BM25 en memoria sobre una lista fija de fragmentos."""
+
+    def __init__(self, chunks: list[str], k1: float = 1.2, b: float = 0.75):
+        self.chunks = list(chunks)
+        self.k1 = k1
+        self.b = b
+        self.tf: list[dict[str, int]] = []
+        self.lengths: list[int] = []
+        self.idf: dict[str, float] = {}
+        self.avgdl = 0.0
+        self.tokens = [estimate_tokens(c) for c in self.chunks]
+        self._build()
+
+    def _build(self) -> None:
+        df: dict[str, int] = {}
+        for chunk in self.chunks:
+            counts: dict[str, int] = {}
+            for t in tokenize(chunk):
+                counts[t] = counts.get(t, 0) + 1
+            self.tf.append(counts)
+            self.lengths.append(sum(counts.values()))
+            for t in counts:
+                df[t] = df.get(t, 0) + 1
+        n = len(self.chunks)
+        self.avgdl = (sum(self.lengths) / n) if n else 0.0
+        self.idf = {t: math.log(1 + (n - d + 0.5) / (d + 0.5)) for t, d in df.items()}
+
+    def search(self, query: str, top_k: int = 5) -> list[tuple[int, float]]:
+        """[(índice de fragmento, score)] de mayor a menor, sólo con score > 0."""
+        terms = set(tokenize(query))
+        if not terms or not self.chunks:
+            return []
+        scores = []
+        avgdl = self.avgdl or 1.0
+        for i, counts in enumerate(self.tf):
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / avgdl)
+            s = 0.0
+            for t in terms:
+                f = counts.get(t)
+                if f:
+                    s += self.idf[t] * f * (self.k1 + 1) / (f + norm)
+            if s > 0:
+                scores.append((i, s))
+        scores.sort(key=lambda x: -x[1])
+        return scores[:top_k]
+
+    def to_dict(self) -> dict:
+        return {'k1': self.k1, 'b': self.b, 'chunks': self.chunks}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'BM25Index':
+        return cls(list(data.get('chunks') or []), k1=float(data.get('k1') or 1.2), b=float(data.get('b') or 0.75))
+
+
+def build_index(compiled: CompiledPrompt) -> BM25Index:
+    return BM25Index(chunk_sections(list(compiled.knowledge)))
+
+
+# ===== Índices por versión de flujo (caché por worker + tabla KnowledgeIndex) =====
+
+_lock = threading.Lock()
+_loaded: OrderedDict[str, BM25Index] = OrderedDict()
+_LOADED_MAX = 64
+
+
+def _remember(version: str, index: BM25Index) -> None:
+    with _lock:
+        _loaded[version] = index
+        _loaded.move_to_end(version)
+        while len(_loaded) > _LOADED_MAX:
+            _loaded.popitem(last=False)
+
+
+def save_index(persona: dict, version: str, flow: Flow | None = None) -> BM25Index:
+    """Construye y guarda el índice de una versión de flujo (reemplaza versiones anteriores del flujo)."""
+    compiled = compiled_system_prompt(persona, version=version)
+    index = build_index(compiled)
+    row, _ = KnowledgeIndex.objects.update_or_create(
+        version=version,
+        defaults={
+            'flow': flow,
+            'data': index.to_dict(),
+            'chunks': len(index.chunks),
+            'knowledge_tokens': compiled.knowledge_tokens,
+        },
+    )
+    if flow is not None:
+        KnowledgeIndex.objects.filter(flow=flow).exclude(pk=row.pk).delete()
+    _remember(version, index)
+    return index
+
+
+def index_for_version(version: str | None, persona: dict, flow_id: int | None = None) -> BM25Index | None:
+    """Índice de la versión (memoria → base de datos → se construye si falta).
+    None si la recuperación está deshabilitada o no hay versión estable."""
+    if not version or not getattr(settings, 'AI_RETRIEVAL_ENABLED', True):
+        return None
+    with _lock:
+        index = _loaded.get(version)
+        if index is not None:
+            _loaded.move_to_end(version)
+            return index
+    row = KnowledgeIndex.objects.filter(version=version).only('data').first()
+    if row is not None:
+        index = BM25Index.from_dict(row.data)
+        _remember(version, index)
+        return index
+    try:
+        flow = Flow.objects.filter(pk=flow_id).first() if flow_id else None
+        return save_index(persona, version, flow=flow)
+    except Exception:
+        logger.exception('knowledge index build failed for %s', version)
+        return None
+
+
+def reset_cache() -> None:
+    with _lock:
+        _loaded.clear()
+
+
+# ===== Selección por mensaje =====
+
+_stats_lock = threading.Lock()
+_stats = {'calls': 0, 'retrieved': 0, 'full_tokens': 0, 'sent_tokens': 0}
+
+
+def retrieval_stats(reset: bool = False) -> dict:
+    """Tokens de conocimiento que se hubieran enviado completos vs. los enviados, en este worker."""
+    with _stats_lock:
+        snap = dict(_stats)
+        if reset:
+            for k in _stats:
+                _stats[k] = 0
+    snap['saved_tokens'] = snap['full_tokens'] - snap['sent_tokens']
+    return snap
+
+
+def select_knowledge(compiled: CompiledPrompt, index: BM25Index, user_text: str,
+                     budget: int | None = None, top_k: int | None = None) -> str:
+    """Prompt de sistema con reglas fijas + los fragmentos más relevantes dentro del presupuesto.
+    Si todo el conocimiento ya cabe en el presupuesto se envía completo."""
+    budget = budget if budget is not None else getattr(settings, 'AI_KNOWLEDGE_TOKEN_BUDGET', 600)
+    top_k = top_k or getattr(settings, 'AI_KNOWLEDGE_TOP_K', 6)
+    full = compiled.knowledge_tokens
+    if full <= budget:
+        _count(full, full, retrieved=False)
+        return compiled.text
+    picked: list[int] = []
+    used = 0
+    for i, _score in index.search(user_text, top_k=top_k):
+        cost = index.tokens[i]
+        if used + cost > budget:
+            continue
+        picked.append(i)
+        used += cost
+    # Orden original: las secciones se leen igual que en el prompt completo
+    chunks = [index.chunks[i] for i in sorted(picked)]
+    _count(full, used, retrieved=True)
+    logger.debug('knowledge retrieval: %d/%d chunks, %d/%d tokens', len(chunks), len(index.chunks), used, full)
+    return compiled.render(chunks)
+
+
+def _count(full: int, sent: int, retrieved: bool) -> None:
+    with _stats_lock:
+        _stats['calls'] += 1
+        _stats['retrieved'] += int(retrieved)
+        _stats['full_tokens'] += full
+        _stats['sent_tokens'] += sent
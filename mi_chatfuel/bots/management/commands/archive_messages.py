@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from bots import archive
+from bots.models import Bot, MessageLog
+
+
+class Command(BaseCommand):
+    help = (
+        "Archiva en NDJSON gzip (un archivo por bot y mes) los MessageLog más antiguos que la retención "
+        "y los borra de la base en lotes. Pensado para correr a diario (cron / scheduler de la plataforma)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Días a conservar en la base (por defecto MESSAGE_RETENTION_DAYS).')
+        parser.add_argument('--bot', type=int, action='append', help='ID de bot (repetible). Por defecto, todos.')
+        parser.add_argument('--chunk-size', type=int, help='Filas por lote (por defecto MESSAGE_ARCHIVE_CHUNK).')
+        parser.add_argument('--dry-run', action='store_true', help='Solo cuenta las filas que se archivarían.')
+
+    def handle(self, *args, **opts):
+        if opts['days'] is not None and opts['days'] < 0:
+            raise CommandError('--days debe ser >= 0')
+        if opts['chunk_size'] is not None and opts['chunk_size'] <= 0:
+            raise CommandError('--chunk-size debe ser > 0')
+        if not opts['dry_run'] and archive.archive_dir() is None:
+            raise CommandError(
+                'MESSAGE_ARCHIVE_DIR no está configurado: apúntalo a un disco persistente '
+                '(los mensajes archivados se borran de la base).'
+            )
+        before = archive.cutoff(opts['days'])
+        bots = Bot.objects.all()
+        if opts['bot']:
+            bots = bots.filter(pk__in=opts['bot'])
+        for bot in bots:
+            if opts['dry_run']:
+                n = MessageLog.objects.filter(bot=bot, created_at__lt=before).count()
+                self.stdout.write(f"{bot.name}: {n} mensajes por archivar (anteriores a {before:%Y-%m-%d})")
+                continue
+            n = archive.archive_bot(bot.id, before, chunk=opts['chunk_size'])
+            self.stdout.write(f"{bot.name}: {n} mensajes archivados en {archive.archive_dir() / str(bot.id)}")
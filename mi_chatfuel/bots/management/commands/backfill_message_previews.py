@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from bots.models import MessageLog
+
+
+class Command(BaseCommand):
+    help = (
+        "Completa body_text, options y wamid de los MessageLog anteriores a esas columnas, "
+        "en lotes por id para no cargar toda la tabla en memoria."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **opts):
+        size = opts['batch_size']
+        if size <= 0:
+            raise CommandError('--batch-size debe ser > 0')
+        last_pk = 0
+        total = 0
+        while True:
+            batch = list(
+                MessageLog.objects.filter(body_text__isnull=True, pk__gt=last_pk)
+                .order_by('pk')
+                .only('pk', 'direction', 'message_type', 'payload', 'wamid')[:size]
+            )
+            if not batch:
+                break
+            for m in batch:
+                m.fill_preview()
+            MessageLog.objects.bulk_update(batch, ['body_text', 'options', 'wamid'])
+            last_pk = batch[-1].pk
+            total += len(batch)
+        self.stdout.write(f"{total} mensajes completados")
@@ -0,0 +1,168 @@
+import json
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+
+from bots import persona_engine, query_budget, services
+
+
+def _sample_persona() -> dict:
+    """Persona de tamaño realista (tienda con FAQ y tarifas largas)."""
+    faq = "\n".join(f"P: ¿Pregunta frecuente {i}? R: Respuesta detallada número {i} sobre tallas y modelos." for i in range(40))
+    districts = "\n".join(f"Distrito {i}; S/{5 + i % 10}; 24-48h" for i in range(30))
+    return {
+        'name': 'Luna', 'trade_name': 'Tienda Sol', 'legal_name': 'Sol S.A.C.', 'ruc': '20123456789',
+        'about': 'Tienda de disfraces y accesorios.', 'knowledge': faq, 'style': 'cálido',
+        'language': 'español', 'website': 'https://tiendasol.pe', 'phone': '+51 999 888 777',
+        'address': 'Av. Sol 123', 'city': 'Lima', 'country': 'Perú', 'hours_mon_fri': '9-18', 'hours_sat': '9-13',
+        'instagram': 'https://instagram.com/tiendasol', 'facebook': 'https://facebook.com/tiendasol',
+        'catalog_url': 'https://tiendasol.pe/catalogo', 'yape_number': '999888777', 'yape_holder': 'Sol SAC',
+        'card_brands': 'Visa, MasterCard', 'card_provider': 'Culqi', 'transfer_accounts': 'BCP 123-456\nBBVA 789',
+        'districts_costs': districts, 'typical_delivery_time': '24-48h', 'free_shipping_from': 'S/199',
+        'returns_policy': '7 días', 'boleta_yes': 'Sí', 'factura_yes': 'Sí',
+        'order_required': 'Nombre\nDNI\nDirección\nTalla', 'out_of_scope': 'Reparaciones',
+    }
+
+
+def _timeit(fn, iterations: int) -> float:
+    """Microsegundos promedio por llamada."""
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - t0) / iterations * 1e6
+
+
+def bench_prompt(iterations: int) -> dict:
+    """Compilación del prompt de sistema de ai_answer: sin memoizar vs memoizado por versión."""
+    persona = _sample_persona()
+    services.clear_prompt_cache()
+    uncached = _timeit(lambda: "\n".join(services._build_prompt_rules(persona, 'Tienda Sol')), iterations)
+    services.compiled_system_prompt(persona, 'Tienda Sol', version='bench')
+    cached = _timeit(lambda: services.compiled_system_prompt(persona, 'Tienda Sol', version='bench'), iterations)
+    fingerprint = _timeit(lambda: services.compiled_system_prompt(persona, 'Tienda Sol'), iterations)
+    compiled = services.compiled_system_prompt(persona, 'Tienda Sol', version='bench')
+    return {
+        'uncached_us': round(uncached, 2),
+        'cached_by_version_us': round(cached, 2),
+        'cached_by_content_us': round(fingerprint, 2),
+        'speedup': round(uncached / cached, 1) if cached else None,
+        'prompt_tokens_estimate': compiled.token_estimate,
+    }
+
+
+PERSONA_MESSAGES = [
+    '¿Quién eres?', '¿Tienen yape?', '¿Hacen envíos a provincia?', 'gracias, nos vemos', 'precio del disfraz de pirata',
+    'tienes tarjeta?', '¿cuál es su horario y dirección?', 'me pasas el número de contacto', 'precio mayorista',
+    'hola, quería saber si aceptan plin o transferencia y cuánto demora el delivery', 'xd ok', 'boleta o factura?',
+]
+
+
+def bench_persona(iterations: int) -> dict:
+    """answer_from_persona sobre mensajes típicos: detección de intenciones en una pasada y
+    fragmentos renderizados por versión de persona vs. renderizados en cada mensaje."""
+    persona = _sample_persona()
+    msgs = PERSONA_MESSAGES
+    n = max(1, iterations // len(msgs))
+
+    def run(version):
+        for m in msgs:
+            services.answer_from_persona(m, persona, brand='Tienda Sol', version=version)
+
+    def run_uncached():
+        for m in msgs:
+            intents = persona_engine.detect(m)
+            if intents:
+                persona_engine.PersonaAnswers(persona, 'Tienda Sol').answer(intents)
+
+    persona_engine.clear_cache()
+    detect = _timeit(lambda: [persona_engine.detect(m) for m in msgs], n) / len(msgs)
+    uncached = _timeit(run_uncached, n) / len(msgs)
+    cached = _timeit(lambda: run('bench'), n) / len(msgs)
+    by_content = _timeit(lambda: run(None), n) / len(msgs)
+    return {
+        'messages': len(msgs),
+        'detect_us': round(detect, 2),
+        'fragments_per_message_us': round(uncached, 2),
+        'cached_by_version_us': round(cached, 2),
+        'cached_by_content_us': round(by_content, 2),
+        'speedup': round(uncached / cached, 1) if cached else None,
+    }
+
+
+def bench_db(iterations: int) -> dict:
+    """Costo de abrir conexión por request (CONN_MAX_AGE=0) vs reutilizar la conexión persistente."""
+    n = max(1, iterations // 20)
+
+    def query():
+        with connection.cursor() as c:
+            c.execute('SELECT 1')
+            c.fetchone()
+
+    def fresh():
+        connection.close()
+        query()
+
+    query()
+    reused = _timeit(query, n)
+    new = _timeit(fresh, n)
+    return {
+        'vendor': connection.vendor,
+        'new_connection_us': round(new, 2),
+        'reused_connection_us': round(reused, 2),
+        'saved_per_request_us': round(new - reused, 2),
+    }
+
+
+def bench_queries(iterations: int) -> dict:
+    """Consultas y ms de SQL por request de las rutas calientes contra su presupuesto (bots/query_budget.py).
+    Los datos de prueba se crean en una transacción que se revierte al terminar."""
+    n = max(1, iterations // 200)
+    report = {}
+    with transaction.atomic(), override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        fx = query_budget.build_fixtures(username=f'bench-{time.monotonic_ns()}')
+        client = Client()
+        client.force_login(fx.owner)
+        runs = [query_budget.run(client, fx) for _ in range(n)]
+        for i, name in enumerate(query_budget.BUDGETS):
+            ms = [r[i] for r in runs]
+            worst = max(ms, key=lambda m: (m.count, m.sql_ms))
+            max_queries, max_ms = query_budget.BUDGETS[name]
+            entry = {
+                'queries': worst.count,
+                'max_queries': max_queries,
+                'sql_ms_median': round(statistics.median(m.sql_ms for m in ms), 3),
+                'max_sql_ms': max_ms,
+                'ok': worst.count <= max_queries and worst.sql_ms <= max_ms,
+            }
+            if not entry['ok']:
+                entry['report'] = worst.report().splitlines()
+            report[name] = entry
+        transaction.set_rollback(True)
+    return report
+
+
+SUITES = {
+    'db': bench_db,
+    'persona': bench_persona,
+    'prompt': bench_prompt,
+    'queries': bench_queries,
+}
+
+
+class Command(BaseCommand):
+    help = "Microbenchmarks de rutas calientes; imprime JSON para comparar corridas."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--suite', action='append', choices=sorted(SUITES), help='Suite a correr (repetible). Por defecto, todas.')
+        parser.add_argument('--iterations', type=int, default=2000)
+
+    def handle(self, *args, **opts):
+        if opts['iterations'] <= 0:
+            raise CommandError('--iterations debe ser > 0')
+        names = opts['suite'] or sorted(SUITES)
+        report = {name: SUITES[name](opts['iterations']) for name in names}
+        self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
@@ -0,0 +1,144 @@
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from bots import ai_client, services
+from bots.ai_stub import DISTRIBUTIONS, StubConfig, StubServer
+from bots.cascade import INTENT_LABELS
+from bots.management.commands.benchmark import _sample_persona
+
+
+def _ai_service():
+    # services/ai_service.py vive en la raíz del repo (junto a app.py)
+    root = str(Path(settings.BASE_DIR).parent)
+    if root not in sys.path:
+        sys.path.append(root)
+    from services import ai_service
+    return ai_service
+
+
+def percentile(values: list[float], pct: float) -> float | None:
+    """Percentil por rango más cercano."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+def _targets(ai_service, persona: dict) -> dict:
+    return {
+        'generate_reply': lambda text: ai_service.generate_reply([{'role': 'user', 'content': text}]),
+        'classify_intent_label': lambda text: ai_service.classify_intent_label(text, INTENT_LABELS),
+        'ai_classify': lambda text: services.ai_classify(
+            text, [{'id': 'catalogo', 'patterns': 'quiero ver modelos\nqué disfraces tienen'}], INTENT_LABELS,
+        ),
+        'naturalize_from_answer': lambda text: ai_service.naturalize_from_answer(
+            text, 'Hacemos envíos a todo el Perú en 24-48h.', assistant_name='Luna'
+        ),
+        'ai_answer': lambda text: services.ai_answer(text, brand='Tienda Sol', persona=persona, persona_version='bench'),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Mide la ruta de IA (generate_reply, classify_intent_label, ai_classify, naturalize_from_answer, ai_answer) "
+        "contra un servidor OpenRouter local a una concurrencia dada; imprime JSON con throughput, "
+        "p50/p95/p99 y failovers."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', action='append', help='Función a medir (repetible). Por defecto, todas.')
+        parser.add_argument('--requests', type=int, default=200, help='Llamadas por función.')
+        parser.add_argument('--concurrency', type=int, default=20)
+        parser.add_argument('--keys', type=int, default=3, help='Claves ficticias para ejercitar el failover.')
+        parser.add_argument('--same-text', action='store_true', help='Mismo mensaje en todas las llamadas (single-flight).')
+        parser.add_argument('--url', default=None, help='Servidor ya levantado (openrouter_stub); si no, se levanta uno.')
+        parser.add_argument('--latency-ms', type=float, default=300.0)
+        parser.add_argument('--jitter-ms', type=float, default=100.0)
+        parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='lognormal')
+        parser.add_argument('--p401', type=float, default=0.0)
+        parser.add_argument('--p429', type=float, default=0.05)
+        parser.add_argument('--p5xx', type=float, default=0.02)
+        parser.add_argument('--seed', type=int, default=7)
+
+    def handle(self, *args, **opts):
+        if opts['requests'] <= 0 or opts['concurrency'] <= 0:
+            raise CommandError('--requests y --concurrency deben ser > 0')
+        ai_service = _ai_service()
+        targets = _targets(ai_service, _sample_persona())
+        names = opts['target'] or list(targets)
+        unknown = set(names) - set(targets)
+        if unknown:
+            raise CommandError(f"Funciones desconocidas: {', '.join(sorted(unknown))}")
+
+        server = None
+        url = opts['url']
+        if not url:
+            server = StubServer(StubConfig(
+                latency_ms=opts['latency_ms'], jitter_ms=opts['jitter_ms'], distribution=opts['distribution'],
+                p401=opts['p401'], p429=opts['p429'], p5xx=opts['p5xx'], seed=opts['seed'],
+            )).start()
+            url = server.url
+        keys = [f'bench-key-{i}' for i in range(max(1, opts['keys']))]
+        client = ai_client.AIClient(
+            url=url, max_connections=opts['concurrency'], key_provider=lambda: list(keys), record_usage=False,
+        )
+        ai_client.reset_client(client)
+        prev_enabled, ai_service.AI_ENABLED = ai_service.AI_ENABLED, True
+        report = {
+            'config': {k: opts[k] for k in ('requests', 'concurrency', 'keys', 'same_text', 'latency_ms', 'jitter_ms',
+                                            'distribution', 'p401', 'p429', 'p5xx')},
+            'results': {},
+        }
+        try:
+            for name in names:
+                report['results'][name] = self._run(client, targets[name], opts)
+        finally:
+            ai_service.AI_ENABLED = prev_enabled
+            ai_client.reset_client(None)
+            if server is not None:
+                report['stub'] = dict(server.config.counts)
+                server.stop()
+        self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
+
+    def _run(self, client: ai_client.AIClient, fn, opts) -> dict:
+        n = opts['requests']
+        texts = [
+            '¿tienen disfraz de pirata en talla M?' if opts['same_text'] else f'consulta {i}: ¿tienen disfraz de pirata en talla M?'
+            for i in range(n)
+        ]
+        latencies: list[float] = []
+        ok = 0
+
+        def call(text):
+            t0 = time.perf_counter()
+            result = fn(text)
+            return (time.perf_counter() - t0) * 1000.0, bool(result)
+
+        client.stats(reset=True)
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=opts['concurrency']) as pool:
+            for ms, good in pool.map(call, texts):
+                latencies.append(ms)
+                ok += int(good)
+        wall = time.perf_counter() - t0
+        stats = client.stats()
+        return {
+            'requests': n,
+            'ok': ok,
+            'errors': n - ok,
+            'throughput_rps': round(n / wall, 1) if wall else None,
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+            'upstream_requests': stats['requests'],
+            'attempts': stats['attempts'],
+            'failovers': stats['failovers'],
+            'coalesced': stats['coalesced'],
+        }
@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from bots import knowledge
+from bots.models import Flow
+from bots.services import compiled_system_prompt
+from bots.views2 import _persona_for_flow
+
+
+class Command(BaseCommand):
+    help = (
+        "Reconstruye el índice BM25 del conocimiento del Cerebro para los flujos activos "
+        "y reporta los tokens de conocimiento que se dejan de enviar por mensaje."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--flow', type=int, action='append', help='ID de flujo (repetible). Por defecto, todos los activos.')
+        parser.add_argument('--query', action='append', default=[], help='Mensaje de ejemplo para medir la selección (repetible).')
+
+    def handle(self, *args, **opts):
+        flows = Flow.objects.filter(is_active=True).select_related('bot')
+        if opts['flow']:
+            flows = Flow.objects.filter(pk__in=opts['flow']).select_related('bot')
+            if not flows.exists():
+                raise CommandError('No se encontró ningún flujo con esos IDs')
+        budget = getattr(settings, 'AI_KNOWLEDGE_TOKEN_BUDGET', 600)
+        for flow in flows:
+            version = flow.version_key
+            persona = _persona_for_flow(flow.definition or {}, version)
+            index = knowledge.save_index(persona, version, flow=flow)
+            compiled = compiled_system_prompt(persona, version=version)
+            full = compiled.knowledge_tokens
+            sent = min(full, budget)
+            saved = (100.0 * (full - sent) / full) if full else 0.0
+            self.stdout.write(
+                f"{flow.bot.name} / {flow.name}: {len(index.chunks)} fragmentos, "
+                f"conocimiento ~{full} tokens, máximo por mensaje ~{sent} ({saved:.0f}% menos)"
+            )
+            for q in opts['query']:
+                text = knowledge.select_knowledge(compiled, index, q, budget=budget)
+                self.stdout.write(f"  '{q}': prompt ~{compiled.token_estimate} -> ~{len(text) // 4} tokens")
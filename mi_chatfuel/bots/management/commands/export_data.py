@@ -0,0 +1,51 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bots import export
+from bots.models import Bot, MessageLog
+
+
+class Command(BaseCommand):
+    help = (
+        "Exporta contactos (WaUser) o mensajes (MessageLog) en CSV o NDJSON, opcionalmente gzip, "
+        "leyendo la base por lotes con memoria constante. Escribe en stdout o en --output."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=[export.CONTACTS, export.MESSAGES])
+        parser.add_argument('--bot', type=int, action='append', help='ID de bot (repetible). Por defecto, todos.')
+        parser.add_argument('--since', help='Desde (fecha o fecha-hora ISO, inclusive).')
+        parser.add_argument('--until', help='Hasta (fecha ISO inclusive o fecha-hora exclusiva).')
+        parser.add_argument('--direction', choices=[MessageLog.IN, MessageLog.OUT], help='Sólo mensajes entrantes o salientes.')
+        parser.add_argument('--format', choices=sorted(export.CONTENT_TYPES), default='csv')
+        parser.add_argument('--gzip', action='store_true', help='Comprimir la salida con gzip.')
+        parser.add_argument('--chunk-size', type=int, help='Filas por lote (por defecto EXPORT_CHUNK).')
+        parser.add_argument('--output', '-o', help='Archivo de salida (por defecto stdout).')
+
+    def handle(self, *args, **opts):
+        if opts['chunk_size'] is not None and opts['chunk_size'] <= 0:
+            raise CommandError('--chunk-size debe ser > 0')
+        bot_ids = opts['bot'] or list(Bot.objects.values_list('pk', flat=True))
+        try:
+            qs = export.queryset(
+                opts['kind'], bot_ids,
+                since=export.parse_bound(opts['since']),
+                until=export.parse_bound(opts['until'], end=True),
+                direction=opts['direction'],
+            )
+            blocks = export.stream(qs, export.FIELDS[opts['kind']], opts['format'], opts['gzip'], opts['chunk_size'])
+        except export.ExportError as e:
+            raise CommandError(str(e))
+        if not opts['output']:
+            out = sys.stdout.buffer
+            for block in blocks:
+                out.write(block)
+            out.flush()
+            return
+        size = 0
+        with open(opts['output'], 'wb') as fh:
+            for block in blocks:
+                fh.write(block)
+                size += len(block)
+        self.stderr.write(f"{opts['output']}: {size} bytes")
@@ -0,0 +1,109 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError
+
+from bots.models import Bot, MessageLog, WaUser
+
+
+def _inbound(wa_id: str, i: int) -> dict:
+    return {'entry': [{'changes': [{'value': {
+        'metadata': {'phone_number_id': 'load'},
+        'messages': [{'id': f'wamid.{wa_id}.{i}', 'from': wa_id, 'type': 'text', 'text': {'body': f'mensaje {i}'}}],
+    }}]}]}
+
+
+def handle_message(bot: Bot, wa_id: str, i: int):
+    """Escrituras de un mensaje entrante típico: log de entrada, estado del WaUser y respuesta."""
+    MessageLog.objects.create(bot=bot, direction=MessageLog.IN, wa_from=wa_id, wa_to=bot.phone_number_id,
+                              message_type='text', payload=_inbound(wa_id, i), status='received')
+    user, _ = WaUser.objects.get_or_create(bot=bot, wa_id=wa_id)
+    user.flow_node = f'n{i % 5}'
+    user.save(update_fields=['flow_node'])
+    MessageLog.objects.create(bot=bot, direction=MessageLog.OUT, wa_from=bot.phone_number_id, wa_to=wa_id,
+                              message_type='text', payload={'request': {'type': 'text', 'text': {'body': 'ok'}},
+                                                            'response': {'messages': [{'id': f'out.{i}'}]}},
+                              status='sent')
+
+
+class Command(BaseCommand):
+    help = (
+        "Prueba de carga de escrituras en SQLite con varios procesos (como workers de gunicorn): "
+        "mensajes/s sostenidos y errores 'database is locked', sin y con SQLITE_TUNED."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--messages', type=int, default=200, help='Mensajes por worker.')
+        parser.add_argument('--profile', choices=['default', 'tuned'], action='append', help='Perfil (repetible). Por defecto, ambos.')
+        # Uso interno: procesos hijos
+        parser.add_argument('--setup', action='store_true', help='(interno) Crea el bot de prueba.')
+        parser.add_argument('--worker', type=int, help='(interno) Corre como worker N.')
+
+    def handle(self, *args, **opts):
+        if opts['setup']:
+            owner, _ = Bot._meta.get_field('owner').related_model.objects.get_or_create(username='loadtest')
+            Bot.objects.get_or_create(name='loadtest', defaults={'owner': owner, 'phone_number_id': 'load', 'access_token': 't', 'verify_token': 'v'})
+            return
+        if opts['worker'] is not None:
+            self._run_worker(opts['worker'], opts['messages'])
+            return
+        if opts['workers'] <= 0 or opts['messages'] <= 0:
+            raise CommandError('--workers y --messages deben ser > 0')
+        report = {}
+        for profile in opts['profile'] or ['default', 'tuned']:
+            report[profile] = self._run_profile(profile, opts['workers'], opts['messages'])
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def _run_worker(self, n: int, messages: int):
+        bot = Bot.objects.get(name='loadtest')
+        ok = locked = 0
+        t0 = time.perf_counter()
+        for i in range(messages):
+            try:
+                handle_message(bot, f'51{n:03d}{i % 20:04d}', i)
+                ok += 1
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                locked += 1
+        self.stdout.write(json.dumps({'ok': ok, 'locked': locked, 'elapsed_s': time.perf_counter() - t0}))
+
+    def _run_profile(self, profile: str, workers: int, messages: int) -> dict:
+        manage = [sys.executable, os.path.abspath(sys.argv[0]), 'loadtest_sqlite']
+        with tempfile.TemporaryDirectory() as tmp:
+            env = {
+                **os.environ,
+                'DATABASE_URL': f'sqlite:///{os.path.join(tmp, "load.sqlite3")}',
+                'SQLITE_TUNED': '1' if profile == 'tuned' else '0',
+                # Sin réplica ni conexiones de otra configuración
+                'DATABASE_REPLICA_URL': '',
+            }
+            subprocess.run([sys.executable, os.path.abspath(sys.argv[0]), 'migrate', '-v0'], env=env, check=True)
+            subprocess.run(manage + ['--setup'], env=env, check=True)
+            t0 = time.perf_counter()
+            procs = [
+                subprocess.Popen(manage + ['--worker', str(n), '--messages', str(messages)], env=env,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                for n in range(workers)
+            ]
+            results = []
+            for p in procs:
+                out, err = p.communicate()
+                if p.returncode != 0:
+                    raise CommandError(f'worker falló ({profile}): {err.strip()[-500:]}')
+                results.append(json.loads(out.strip().splitlines()[-1]))
+            elapsed = time.perf_counter() - t0
+        ok = sum(r['ok'] for r in results)
+        return {
+            'workers': workers,
+            'messages': ok,
+            'locked_errors': sum(r['locked'] for r in results),
+            'elapsed_s': round(elapsed, 2),
+            'messages_per_s': round(ok / elapsed, 1) if elapsed else None,
+        }
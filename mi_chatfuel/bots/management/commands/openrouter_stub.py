@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from bots.ai_stub import DEFAULT_REPLIES, DISTRIBUTIONS, StubConfig, StubServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Levanta un servidor local compatible con OpenRouter (/v1/chat/completions) con latencia y "
+        "errores configurables. Apunta OPENROUTER_API_URL a la URL que imprime."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency-ms', type=float, default=300.0, help='Latencia media por respuesta.')
+        parser.add_argument('--jitter-ms', type=float, default=100.0, help='Dispersión (uniform: ±; lognormal: desviación).')
+        parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='lognormal')
+        parser.add_argument('--p401', type=float, default=0.0, help='Probabilidad de 401 por petición.')
+        parser.add_argument('--p429', type=float, default=0.0, help='Probabilidad de 429 por petición.')
+        parser.add_argument('--p5xx', type=float, default=0.0, help='Probabilidad de 503 por petición.')
+        parser.add_argument('--reply', action='append', default=[], metavar='TEXTO=>RESPUESTA',
+                            help='Respuesta enlatada si el prompt de sistema contiene TEXTO (repetible).')
+        parser.add_argument('--completion', default=None, help='Respuesta por defecto.')
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **opts):
+        replies = []
+        for item in opts['reply']:
+            if '=>' not in item:
+                raise CommandError(f"--reply debe tener la forma 'TEXTO=>RESPUESTA': {item}")
+            needle, reply = item.split('=>', 1)
+            replies.append((needle, reply))
+        cfg_kwargs = dict(
+            latency_ms=opts['latency_ms'], jitter_ms=opts['jitter_ms'], distribution=opts['distribution'],
+            p401=opts['p401'], p429=opts['p429'], p5xx=opts['p5xx'],
+            replies=replies + DEFAULT_REPLIES, seed=opts['seed'],
+        )
+        if opts['completion']:
+            cfg_kwargs['completion'] = opts['completion']
+        server = StubServer(StubConfig(**cfg_kwargs), host=opts['host'], port=opts['port'])
+        self.stdout.write(f"OpenRouter stub en {server.url} (Ctrl+C para salir)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.httpd.server_close()
+            self.stdout.write(f"Peticiones: {server.config.counts}")
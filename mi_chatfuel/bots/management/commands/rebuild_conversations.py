@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from bots.models import rebuild_conversations
+
+
+class Command(BaseCommand):
+    help = (
+        "Reconstruye el agregado Conversation (contadores y fechas por bot y wa_id) desde MessageLog "
+        "y enlaza los mensajes anteriores a la tabla. Conserva el contador de no leídos existente."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bot', type=int, action='append', help='ID de bot (repetible). Por defecto, todos.')
+
+    def handle(self, *args, **opts):
+        total = rebuild_conversations(opts['bot'])
+        self.stdout.write(f"{total} conversaciones reconstruidas")
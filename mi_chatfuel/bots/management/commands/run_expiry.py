@@ -0,0 +1,35 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from bots import expiry
+
+
+class Command(BaseCommand):
+    help = (
+        "Worker que vence los temporizadores de WaUser: vuelve a modo IA los chats humanos vencidos y "
+        "cierra (con aviso) los flujos sin respuesta. Duerme hasta el próximo vencimiento."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Vence lo debido y sale (para cron).')
+        parser.add_argument('--max-sleep', type=float, help='Espera máxima entre pasadas en segundos (por defecto EXPIRY_MAX_SLEEP_S).')
+
+    def handle(self, *args, **opts):
+        if opts['max_sleep'] is not None and opts['max_sleep'] <= 0:
+            raise CommandError('--max-sleep debe ser > 0')
+        if opts['once']:
+            result = expiry.run_once()
+            self.stdout.write(f"chats humanos vencidos: {result['human']}, flujos cerrados: {result['flows']}")
+            return
+        stop = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: stop.set())
+
+        def on_tick(result):
+            self.stdout.write(f"{timezone.now():%H:%M:%S} humanos: {result['human']}, flujos: {result['flows']}")
+
+        self.stdout.write('Scheduler de vencimientos iniciado (Ctrl+C para salir)')
+        expiry.run_forever(stop, max_sleep=opts['max_sleep'], on_tick=on_tick)
@@ -0,0 +1,58 @@
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+
+from bots.intent import NaiveBayesIntentClassifier, inbound_text
+from bots.models import Bot, IntentModel, MessageLog
+
+
+class Command(BaseCommand):
+    help = (
+        "Entrena el clasificador local de intención por bot con los mensajes entrantes "
+        "que la IA ya etiquetó (MessageLog.intent_label) y guarda una nueva versión."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bot', type=int, action='append', help='ID de bot (repetible). Por defecto, todos los activos.')
+        parser.add_argument('--min-samples', type=int, default=30, help='Mínimo de ejemplos etiquetados para entrenar.')
+        parser.add_argument('--alpha', type=float, default=0.5, help='Suavizado de Laplace.')
+        parser.add_argument('--holdout', type=float, default=0.2, help='Fracción para validar exactitud (0 = sin validación).')
+        parser.add_argument('--seed', type=int, default=13)
+
+    def handle(self, *args, **opts):
+        bots = Bot.objects.filter(is_active=True)
+        if opts['bot']:
+            bots = Bot.objects.filter(pk__in=opts['bot'])
+            if not bots.exists():
+                raise CommandError('No se encontró ningún bot con esos IDs')
+        rnd = random.Random(opts['seed'])
+        for bot in bots:
+            rows = (
+                MessageLog.objects.filter(bot=bot, direction=MessageLog.IN)
+                .exclude(intent_label='')
+                .values_list('payload', 'intent_label')
+                .iterator(chunk_size=500)
+            )
+            samples = [(t, label) for t, label in ((inbound_text(p or {}), label) for p, label in rows) if t]
+            if len(samples) < opts['min_samples']:
+                self.stdout.write(f"{bot.name}: {len(samples)} ejemplos (< {opts['min_samples']}), se omite")
+                continue
+            rnd.shuffle(samples)
+            accuracy = None
+            n_test = int(len(samples) * opts['holdout'])
+            if n_test:
+                test, train = samples[:n_test], samples[n_test:]
+                clf = NaiveBayesIntentClassifier(alpha=opts['alpha']).fit([t for t, _ in train], [lb for _, lb in train])
+                hits = sum(1 for t, lb in test if clf.predict(t)[0] == lb)
+                accuracy = hits / n_test
+            # El artefacto final se entrena con todos los ejemplos
+            clf = NaiveBayesIntentClassifier(alpha=opts['alpha']).fit([t for t, _ in samples], [lb for _, lb in samples])
+            version = (IntentModel.objects.filter(bot=bot).aggregate(v=Max('version'))['v'] or 0) + 1
+            IntentModel.objects.create(
+                bot=bot, version=version, artifact=clf.to_dict(), samples=len(samples), accuracy=accuracy,
+            )
+            acc_txt = f"{accuracy:.1%}" if accuracy is not None else 'n/d'
+            self.stdout.write(self.style.SUCCESS(
+                f"{bot.name}: v{version} con {len(samples)} ejemplos, {len(clf.labels)} etiquetas, exactitud {acc_txt}"
+            ))
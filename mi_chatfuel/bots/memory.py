@@ -0,0 +1,117 @@
+"""Memoria corta por conversación para el contexto de la IA.
+
+Buffer circular con los últimos turnos (sólo texto) de cada WaUser, acotado por
+AI_MEMORY_TURNS y AI_MEMORY_TOKENS. Se actualiza al registrar cada mensaje
+entrante/saliente, así ai_answer no necesita consultar MessageLog ni parsear
+payloads. Se guarda en la caché de Django y en WaUser.memory como respaldo
+(si la caché se vacía o es local a otro worker).
+
+Cuando los turnos exceden el presupuesto, los más antiguos se pliegan en un
+resumen acumulado (extractivo, sin llamadas a la IA) de AI_MEMORY_SUMMARY_TOKENS.
+"""
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import unit_of_work
+from .models import WaUser
+from .services import estimate_tokens
+
+
+logger = logging.getLogger(__name__)
+
+USER = 'user'
+ASSISTANT = 'assistant'
+_SPEAKER = {USER: 'Cliente', ASSISTANT: 'Asistente'}
+# Largo máximo de un turno al guardarlo (los mensajes largos del bot no aportan más contexto)
+_TURN_MAX_CHARS = 600
+
+
+def _key(bot_id: int, wa_id: str) -> str:
+    return f'convmem:{bot_id}:{wa_id}'
+
+
+def _empty() -> dict:
+    return {'turns': [], 'summary': ''}
+
+
+def load(bot_id: int, wa_id: str, stored: dict | None = None) -> dict:
+    """Memoria de la conversación: caché → WaUser.memory → vacía.
+    `stored`: WaUser.memory ya leído por el llamador (evita volver a consultarlo)."""
+    data = cache.get(_key(bot_id, wa_id))
+    if data is not None:
+        return data
+    if stored is not None:
+        row = stored
+    else:
+        row = WaUser.objects.filter(bot_id=bot_id, wa_id=wa_id).values_list('memory', flat=True).first()
+    data = row if isinstance(row, dict) and 'turns' in row else _empty()
+    cache.set(_key(bot_id, wa_id), data, getattr(settings, 'AI_MEMORY_TTL_S', 86400))
+    return data
+
+
+def _fold(summary: str, role: str, text: str, max_tokens: int) -> str:
+    """Agrega un turno antiguo al resumen y lo recorta por el inicio (se conserva lo más reciente)."""
+    snippet = ' '.join(text.split())[:160]
+    summary = f"{summary} {_SPEAKER.get(role, role)}: {snippet}".strip()
+    max_chars = max_tokens * 4
+    if len(summary) > max_chars:
+        cut = summary[-max_chars:]
+        summary = '…' + cut[cut.find(' ') + 1:] if ' ' in cut else cut
+    return summary
+
+
+def append(data: dict, role: str, text: str) -> dict:
+    """Agrega un turno y aplica los límites (turnos y tokens) plegando el excedente en el resumen."""
+    text = (text or '').strip()[:_TURN_MAX_CHARS]
+    if not text:
+        return data
+    max_turns = getattr(settings, 'AI_MEMORY_TURNS', 8)
+    max_tokens = getattr(settings, 'AI_MEMORY_TOKENS', 400)
+    summary_tokens = getattr(settings, 'AI_MEMORY_SUMMARY_TOKENS', 120)
+    turns = list(data.get('turns') or [])
+    summary = data.get('summary') or ''
+    turns.append([role, text])
+    while len(turns) > 1 and (
+        len(turns) > max_turns or sum(estimate_tokens(t) for _, t in turns) > max_tokens
+    ):
+        old_role, old_text = turns.pop(0)
+        summary = _fold(summary, old_role, old_text, summary_tokens)
+    return {'turns': turns, 'summary': summary}
+
+
+def _persist(bot_id: int, wa_id: str, data: dict) -> None:
+    try:
+        WaUser.objects.filter(bot_id=bot_id, wa_id=wa_id).update(memory=data)
+    except Exception:
+        logger.exception('conversation memory update failed for %s', wa_id)
+
+
+def record_turn(bot_id: int, wa_id: str, role: str, text: str) -> None:
+    """Registra un turno de la conversación (no interrumpe el flujo si falla)."""
+    if not (bot_id and wa_id and (text or '').strip()):
+        return
+    try:
+        data = append(load(bot_id, wa_id), role, text)
+        cache.set(_key(bot_id, wa_id), data, getattr(settings, 'AI_MEMORY_TTL_S', 86400))
+        # Dentro del webhook el respaldo en la base se escribe una vez al final (bots/unit_of_work.py)
+        if not unit_of_work.defer(('memory', bot_id, wa_id), lambda: _persist(bot_id, wa_id, data)):
+            _persist(bot_id, wa_id, data)
+    except Exception:
+        logger.exception('conversation memory update failed for %s', wa_id)
+
+
+def context_messages(bot_id: int, wa_id: str, stored: dict | None = None) -> list[dict]:
+    """Turnos previos en formato chat (resumen como mensaje de sistema + últimos turnos)."""
+    data = load(bot_id, wa_id, stored)
+    messages = []
+    if data.get('summary'):
+        messages.append({'role': 'system', 'content': f"Resumen de la conversación previa: {data['summary']}"})
+    messages.extend({'role': role, 'content': text} for role, text in data.get('turns') or [])
+    return messages
+
+
+def clear(bot_id: int, wa_id: str) -> None:
+    cache.delete(_key(bot_id, wa_id))
+    WaUser.objects.filter(bot_id=bot_id, wa_id=wa_id).update(memory={})
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.3 on 2026-10-19 17:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bots', '0003_aikey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='intent_label',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.CreateModel(
+            name='IntentModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField()),
+                ('artifact', models.JSONField(default=dict)),
+                ('samples', models.PositiveIntegerField(default=0)),
+                ('accuracy', models.FloatField(blank=True, help_text='Exactitud sobre el conjunto de validación', null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('bot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='intent_models', to='bots.bot')),
+            ],
+            options={
+                'ordering': ['bot', '-version'],
+                'unique_together': {('bot', 'version')},
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.3 on 2026-10-19 17:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bots', '0004_intent_model'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KnowledgeIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.CharField(max_length=100, unique=True)),
+                ('data', models.JSONField(default=dict)),
+                ('chunks', models.PositiveIntegerField(default=0)),
+                ('knowledge_tokens', models.PositiveIntegerField(default=0, help_text='Tokens estimados del conocimiento completo')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('flow', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='knowledge_indexes', to='bots.flow')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-19 17:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bots', '0005_knowledge_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wauser',
+            name='memory',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
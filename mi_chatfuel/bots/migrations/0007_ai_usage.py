@@ -0,0 +1,37 @@
+# Generated by Django 5.1.3 on 2026-10-19 17:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bots', '0006_wauser_memory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AIUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField(help_text='Inicio de la hora (UTC)')),
+                ('task', models.CharField(max_length=32)),
+                ('model', models.CharField(blank=True, max_length=120)),
+                ('calls', models.PositiveIntegerField(default=0)),
+                ('errors', models.PositiveIntegerField(default=0)),
+                ('prompt_tokens', models.PositiveBigIntegerField(default=0)),
+                ('completion_tokens', models.PositiveBigIntegerField(default=0)),
+                ('cost_usd', models.DecimalField(decimal_places=6, default=0, max_digits=12)),
+                ('latency_ms_total', models.FloatField(default=0)),
+                ('latency_hist', models.JSONField(blank=True, default=dict)),
+                ('bot', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ai_usage', to='bots.bot')),
+                ('key', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='usage', to='bots.aikey')),
+            ],
+            options={
+                'ordering': ['-bucket'],
+                'indexes': [models.Index(fields=['bot', 'bucket'], name='bots_aiusag_bot_id_6e5a3a_idx')],
+                'unique_together': {('bucket', 'bot', 'task', 'model', 'key')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-19 17:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bots', '0007_ai_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bot',
+            name='ai_models',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
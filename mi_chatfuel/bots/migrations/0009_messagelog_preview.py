@@ -0,0 +1,28 @@
+# Generated by Django 5.1.3 on 2026-10-19 17:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bots', '0008_bot_ai_models'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='body_text',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='messagelog',
+            name='options',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='messagelog',
+            name='wamid',
+            field=models.CharField(blank=True, db_index=True, max_length=128),
+        ),
+    ]
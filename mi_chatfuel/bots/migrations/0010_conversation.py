@@ -0,0 +1,114 @@
+# Generated by Django 5.1.3 on 2026-10-19 17:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Case, CharField, Count, F, Max, Min, Q, When
+
+
+# Copia congelada de la reconstrucción del agregado (ver models.rebuild_conversations y
+# manage.py rebuild_conversations): la migración no debe cambiar si esa función cambia.
+
+def _snippet(direction, message_type, body_text, payload):
+    """Texto del último mensaje; las filas anteriores a 0009 no tienen body_text y se lee del payload."""
+    if body_text is not None:
+        return body_text
+    p = payload if isinstance(payload, dict) else {}
+    if direction == 'in':
+        try:
+            msg = p['entry'][0]['changes'][0]['value']['messages'][0]
+        except (KeyError, IndexError, TypeError):
+            return f'[{message_type or "mensaje"}]'
+        mtype = msg.get('type') or ''
+        if mtype == 'text':
+            return (msg.get('text') or {}).get('body') or ''
+        if mtype == 'interactive':
+            inter = msg.get('interactive') or {}
+            reply = inter.get('button_reply') or inter.get('list_reply') or {}
+            return reply.get('title') or reply.get('id') or '[interacción]'
+        if mtype == 'button':
+            button = msg.get('button') or {}
+            return button.get('text') or button.get('payload') or '[interacción]'
+        return f'[{mtype or "mensaje"}]'
+    req = p.get('request') or {}
+    if message_type == 'text':
+        return (req.get('text') or {}).get('body') or ''
+    if message_type == 'interactive':
+        return ((req.get('interactive') or {}).get('body') or {}).get('text') or ''
+    return {'image': '[imagen]', 'document': '[documento]'}.get(message_type, '')
+
+
+def backfill(apps, schema_editor):
+    # Sin esto el panel y el primer contacto verían vacías las conversaciones ya existentes
+    MessageLog = apps.get_model('bots', 'MessageLog')
+    Conversation = apps.get_model('bots', 'Conversation')
+    peer = Case(When(direction='in', then=F('wa_from')), default=F('wa_to'), output_field=CharField())
+    groups = (
+        MessageLog.objects.annotate(client=peer)
+        .values('bot_id', 'client')
+        .annotate(
+            first_seen_at=Min('created_at'),
+            last_message_at=Max('created_at'),
+            first_out_at=Min('created_at', filter=Q(direction='out')),
+            last_in_at=Max('created_at', filter=Q(direction='in')),
+            last_out_at=Max('created_at', filter=Q(direction='out')),
+            in_count=Count('pk', filter=Q(direction='in')),
+            out_count=Count('pk', filter=Q(direction='out')),
+        )
+        .order_by()
+    )
+    for g in groups:
+        bot_id, wa_id = g.pop('bot_id'), g.pop('client')
+        if not wa_id:
+            continue
+        inbound = MessageLog.objects.filter(bot_id=bot_id, direction='in', wa_from=wa_id)
+        outbound = MessageLog.objects.filter(bot_id=bot_id, direction='out', wa_to=wa_id)
+        last = (inbound | outbound).order_by('-created_at').values_list('direction', 'message_type', 'body_text', 'payload').first()
+        g['last_snippet'] = (_snippet(*last) if last else '')[:200]
+        conv, _ = Conversation.objects.update_or_create(bot_id=bot_id, wa_id=wa_id, defaults=g)
+        inbound.filter(conversation__isnull=True).update(conversation=conv)
+        outbound.filter(conversation__isnull=True).update(conversation=conv)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bots', '0009_messagelog_preview'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wa_id', models.CharField(max_length=64)),
+                ('first_seen_at', models.DateTimeField()),
+                ('first_out_at', models.DateTimeField(blank=True, null=True)),
+                ('last_in_at', models.DateTimeField(blank=True, null=True)),
+                ('last_out_at', models.DateTimeField(blank=True, null=True)),
+                ('last_message_at', models.DateTimeField()),
+                ('in_count', models.PositiveIntegerField(default=0)),
+                ('out_count', models.PositiveIntegerField(default=0)),
+                ('last_snippet', models.CharField(blank=True, max_length=200)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('bot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations', to='bots.bot')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='messagelog',
+            name='conversation',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='messages', to='bots.conversation'),
+        ),
+        migrations.AddIndex(
+            model_name='messagelog',
+            index=models.Index(fields=['conversation', 'created_at'], name='bots_messag_convers_c231a8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['bot', '-last_message_at'], name='bots_conver_bot_id_545994_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='conversation',
+            unique_together={('bot', 'wa_id')},
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+from django.db import migrations
+
+import bots.fields
+
+
+BATCH = 500
+
+
+def _copy(apps, src, dst, transform):
+    MessageLog = apps.get_model('bots', 'MessageLog')
+    last_pk = 0
+    while True:
+        batch = list(MessageLog.objects.filter(pk__gt=last_pk).order_by('pk').only('pk', 'direction', src)[:BATCH])
+        if not batch:
+            break
+        for m in batch:
+            setattr(m, dst, transform(m.direction, getattr(m, src)))
+        MessageLog.objects.bulk_update(batch, [dst])
+        last_pk = batch[-1].pk
+
+
+def compress_payloads(apps, schema_editor):
+    from bots.models import compact_payload
+    _copy(apps, 'payload', 'payload_z', lambda direction, p: compact_payload(direction, p if p is not None else {}))
+
+
+def restore_payloads(apps, schema_editor):
+    _copy(apps, 'payload_z', 'payload', lambda direction, p: p if p is not None else {})
+
+
+class Migration(migrations.Migration):
+    """Payload JSON → payload compacto y comprimido: columna nueva, copia por lotes, se
+    descarta la vieja y la nueva toma su nombre."""
+
+    dependencies = [
+        ('bots', '0010_conversation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='payload_z',
+            field=bots.fields.CompressedJSONField(blank=True, null=True),
+        ),
+        migrations.RunPython(compress_payloads, restore_payloads),
+        migrations.RemoveField(
+            model_name='messagelog',
+            name='payload',
+        ),
+        migrations.RenameField(
+            model_name='messagelog',
+            old_name='payload_z',
+            new_name='payload',
+        ),
+        migrations.AlterField(
+            model_name='messagelog',
+            name='payload',
+            field=bots.fields.CompressedJSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.3 on 2026-10-19 18:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bots', '0011_messagelog_payload_compressed'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='wauser',
+            index=models.Index(condition=models.Q(('human_requested', True)), fields=['human_expires_at'], name='wauser_human_due'),
+        ),
+        migrations.AddIndex(
+            model_name='wauser',
+            index=models.Index(condition=models.Q(('flow_node__isnull', False)), fields=['last_in_at'], name='wauser_flow_due'),
+        ),
+    ]
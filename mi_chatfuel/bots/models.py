@@ -1,7 +1,13 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, CharField, Count, F, Max, Min, Q, Value, When
+from django.db.models.functions import Coalesce
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 import uuid
 
+from .fields import CompressedJSONField
+from .inbound import InboundMessage
+
 
 User = get_user_model()
 
@@ -14,6 +20,9 @@ class Bot(models.Model):
 	access_token = models.TextField()
 	verify_token = models.CharField(max_length=128)
 	is_active = models.BooleanField(default=True)
+	# Modelos de IA por tarea en orden de preferencia: {'intent': ['modelo-rápido', 'respaldo'], ...}
+	# Vacío = AI_TASK_MODELS de settings (ver bots/ai_router.py)
+	ai_models = models.JSONField(default=dict, blank=True)
 	created_at = models.DateTimeField(auto_now_add=True)
 
 	def __str__(self):
@@ -30,6 +39,11 @@ class Flow(models.Model):
 	def __str__(self):
 		return f"{self.name} - {self.bot.name}"
 
+	@property
+	def version_key(self) -> str:
+		"""Identificador de la versión guardada (clave de cachés de persona, prompt e índice)."""
+		return f"flow:{self.pk}:{self.updated_at.timestamp()}"
+
 
 class MessageLog(models.Model):
 	IN = 'in'
@@ -44,17 +58,245 @@ class MessageLog(models.Model):
 	wa_from = models.CharField(max_length=64, blank=True)
 	wa_to = models.CharField(max_length=64, blank=True)
 	message_type = models.CharField(max_length=32, blank=True)
-	payload = models.JSONField(default=dict, blank=True)
+	# Sólo el mensaje y los campos útiles de la respuesta (ver compact_payload), comprimido
+	payload = CompressedJSONField(default=dict, blank=True)
 	status = models.CharField(max_length=32, blank=True)
 	error = models.TextField(blank=True)
+	# Intención decidida por la IA para este mensaje entrante (datos de entrenamiento del clasificador local)
+	intent_label = models.CharField(max_length=40, blank=True)
+	# Extraídos del payload al guardar (el chat en vivo no necesita leer el JSON crudo).
+	# body_text NULL = fila anterior aún sin completar (ver manage.py backfill_message_previews)
+	body_text = models.TextField(null=True, blank=True)
+	options = models.JSONField(null=True, blank=True)
+	wamid = models.CharField(max_length=128, blank=True, db_index=True)
+	# Conversación (bot, wa_id) a la que pertenece; NULL en filas anteriores (ver manage.py rebuild_conversations)
+	conversation = models.ForeignKey('Conversation', null=True, blank=True, on_delete=models.SET_NULL, related_name='messages')
 	created_at = models.DateTimeField(auto_now_add=True)
 
 	class Meta:
 		ordering = ['-created_at']
+		indexes = [
+			models.Index(fields=['conversation', 'created_at']),
+		]
 
 	def __str__(self):
 		return f"{self.direction} {self.message_type} {self.created_at:%Y-%m-%d %H:%M:%S}"
 
+	def fill_preview(self):
+		"""Completa body_text, options y wamid desde el payload."""
+		self.body_text, self.options, wamid = message_preview(self.direction, self.message_type, self.payload)
+		self.wamid = self.wamid or wamid
+
+	def save(self, *args, **kwargs):
+		if self._state.adding:
+			self.payload = compact_payload(self.direction, self.payload)
+		if self.body_text is None:
+			self.fill_preview()
+			if kwargs.get('update_fields') is not None:
+				kwargs['update_fields'] = {*kwargs['update_fields'], 'body_text', 'options', 'wamid'}
+		if self._state.adding and self.conversation_id is None and self.bot_id:
+			# El agregado de la conversación se actualiza junto con el alta del mensaje
+			with transaction.atomic():
+				self.conversation_id = Conversation.record(self)
+				super().save(*args, **kwargs)
+			return
+		super().save(*args, **kwargs)
+
+	@property
+	def peer(self) -> str:
+		"""wa_id del cliente (remitente si es entrante, destinatario si es saliente)."""
+		return self.wa_from if self.direction == self.IN else self.wa_to
+
+
+def message_preview(direction: str, message_type: str, payload: dict | None) -> tuple[str, list | None, str]:
+	"""(texto visible, etiquetas de botones o None, wamid) de un MessageLog.
+	Entrantes: body crudo del webhook de Meta. Salientes: {'request': …, 'response': …}."""
+	p = payload if isinstance(payload, dict) else {}
+	if direction == MessageLog.IN:
+		inbound = InboundMessage.from_webhook(p)
+		if inbound is None:
+			return f'[{message_type or "mensaje"}]', None, ''
+		return inbound.display_text(), None, inbound.wamid
+	req = p.get('request') or {}
+	resp = p.get('response') or {}
+	wamid = ''
+	if isinstance(resp, dict):
+		wamid = ((resp.get('messages') or [{}])[0] or {}).get('id') or ''
+	body_text, options = '', None
+	if message_type == 'text':
+		body_text = (req.get('text') or {}).get('body') or ''
+	elif message_type == 'interactive':
+		ireq = req.get('interactive') or {}
+		body_text = (ireq.get('body') or {}).get('text') or ''
+		btns = (ireq.get('action') or {}).get('buttons') or []
+		options = [
+			((b.get('reply') or {}).get('title') or '').strip()
+			for b in btns if (b.get('reply') or {}).get('title')
+		] or None
+	elif message_type == 'image':
+		body_text = '[imagen]'
+	elif message_type == 'document':
+		body_text = '[documento]'
+	return body_text, options, wamid
+
+
+def compact_payload(direction: str, payload):
+	"""Payload de MessageLog sin lo redundante.
+	Entrantes: el primer mensaje con el mismo sobre del webhook (metadata.phone_number_id y
+	nombre del contacto), así InboundMessage.from_webhook lo sigue leyendo.
+	Salientes: el request sin campos fijos/repetidos y de la respuesta sólo ids y error.
+	Idempotente; lo que no reconoce (p.ej. statuses) se guarda tal cual."""
+	if not isinstance(payload, dict):
+		return payload
+	if direction == MessageLog.IN:
+		try:
+			value = payload['entry'][0]['changes'][0]['value']
+		except (KeyError, IndexError, TypeError):
+			return payload
+		messages = value.get('messages') or []
+		if not messages:
+			return payload
+		slim = {'messages': messages[:1]}
+		phone_number_id = (value.get('metadata') or {}).get('phone_number_id')
+		if phone_number_id:
+			slim['metadata'] = {'phone_number_id': phone_number_id}
+		contacts = value.get('contacts') or []
+		name = ((contacts[0].get('profile') if contacts else None) or {}).get('name')
+		if name:
+			slim['contacts'] = [{'profile': {'name': name}}]
+		return {'entry': [{'changes': [{'value': slim}]}]}
+	if 'request' not in payload and 'response' not in payload:
+		return payload
+	req = {k: v for k, v in (payload.get('request') or {}).items() if k not in ('messaging_product', 'recipient_type', 'to')}
+	resp = payload.get('response')
+	if isinstance(resp, dict):
+		slim = {}
+		ids = [m.get('id') for m in resp.get('messages') or [] if isinstance(m, dict) and m.get('id')]
+		if ids:
+			slim['messages'] = [{'id': i} for i in ids]
+		err = resp.get('error')
+		if isinstance(err, dict):
+			slim['error'] = {k: err[k] for k in ('code', 'error_subcode', 'message') if k in err}
+		if 'text' in resp:
+			slim['text'] = str(resp['text'])[:500]
+		resp = slim
+	return {'request': req, 'response': resp}
+
+
+# (bot_id, wa_id) → id de Conversation visto en este proceso; evita el SELECT por mensaje en Conversation.record
+_conversation_ids: dict[tuple[int, str], int] = {}
+CONVERSATION_IDS_MAX = 10000
+
+
+class Conversation(models.Model):
+	"""Agregado por (bot, wa_id) actualizado al registrar cada MessageLog: primer contacto,
+	listado ordenado por actividad y no leídos se resuelven leyendo una sola fila."""
+	SNIPPET_LEN = 200
+
+	bot = models.ForeignKey(Bot, on_delete=models.CASCADE, related_name='conversations')
+	wa_id = models.CharField(max_length=64)
+	first_seen_at = models.DateTimeField()
+	# NULL = el bot todavía no le ha escrito a este cliente (primer contacto)
+	first_out_at = models.DateTimeField(null=True, blank=True)
+	last_in_at = models.DateTimeField(null=True, blank=True)
+	last_out_at = models.DateTimeField(null=True, blank=True)
+	last_message_at = models.DateTimeField()
+	in_count = models.PositiveIntegerField(default=0)
+	out_count = models.PositiveIntegerField(default=0)
+	last_snippet = models.CharField(max_length=SNIPPET_LEN, blank=True)
+	# Entrantes desde la última vez que un operador abrió la conversación en el panel
+	unread_count = models.PositiveIntegerField(default=0)
+
+	class Meta:
+		unique_together = ('bot', 'wa_id')
+		indexes = [
+			models.Index(fields=['bot', '-last_message_at']),
+		]
+
+	def __str__(self):
+		return f"{self.wa_id} ({self.bot_id})"
+
+	@classmethod
+	def record(cls, log: MessageLog) -> int:
+		"""Suma `log` al agregado de su conversación (la crea con el primer mensaje) y devuelve su id."""
+		at = log.created_at or timezone.now()
+		key = {'bot_id': log.bot_id, 'wa_id': log.peer}
+		if log.direction == MessageLog.IN:
+			updates = {'last_in_at': at, 'in_count': F('in_count') + 1, 'unread_count': F('unread_count') + 1}
+		else:
+			updates = {
+				'last_out_at': at, 'out_count': F('out_count') + 1,
+				'first_out_at': Coalesce(F('first_out_at'), Value(at, output_field=models.DateTimeField())),
+			}
+		updates.update(last_message_at=at, last_snippet=(log.body_text or '')[:cls.SNIPPET_LEN])
+		# Id ya conocido: un solo UPDATE. Filtra también por (bot, wa_id), así un id obsoleto
+		# (conversación borrada o reconstruida) no actualiza nada y se vuelve a buscar.
+		pk = _conversation_ids.get((log.bot_id, log.peer))
+		if pk is not None and cls.objects.filter(pk=pk, **key).update(**updates):
+			return pk
+		pk = cls.objects.filter(**key).values_list('pk', flat=True).first()
+		if pk is None:
+			try:
+				with transaction.atomic():
+					pk = cls.objects.create(first_seen_at=at, last_message_at=at, **key).pk
+			except IntegrityError:
+				# Otro worker la creó entre la lectura y el alta
+				pk = cls.objects.filter(**key).values_list('pk', flat=True).get()
+		cls.objects.filter(pk=pk).update(**updates)
+		if len(_conversation_ids) >= CONVERSATION_IDS_MAX:
+			_conversation_ids.clear()
+		_conversation_ids[(log.bot_id, log.peer)] = pk
+		return pk
+
+	@classmethod
+	def mark_read(cls, bot_id: int, wa_id: str):
+		cls.objects.filter(bot_id=bot_id, wa_id=wa_id, unread_count__gt=0).update(unread_count=0)
+
+
+def rebuild_conversations(bot_ids=None) -> int:
+	"""Recalcula el agregado Conversation desde MessageLog (por bot y wa_id) y enlaza los mensajes
+	sin conversación. Conserva el contador de no leídos existente; devuelve cuántas conversaciones tocó.
+	(La migración 0010 tiene su propia copia congelada de esta lógica.)"""
+	IN, OUT = MessageLog.IN, MessageLog.OUT
+	peer = Case(When(direction=IN, then=F('wa_from')), default=F('wa_to'), output_field=CharField())
+	logs = MessageLog.objects.all()
+	if bot_ids is not None:
+		logs = logs.filter(bot_id__in=bot_ids)
+	groups = (
+		logs.annotate(client=peer)
+		.values('bot_id', 'client')
+		.annotate(
+			first_seen_at=Min('created_at'),
+			last_message_at=Max('created_at'),
+			first_out_at=Min('created_at', filter=Q(direction=OUT)),
+			last_in_at=Max('created_at', filter=Q(direction=IN)),
+			last_out_at=Max('created_at', filter=Q(direction=OUT)),
+			in_count=Count('pk', filter=Q(direction=IN)),
+			out_count=Count('pk', filter=Q(direction=OUT)),
+		)
+		.order_by()
+	)
+	total = 0
+	for g in groups:
+		bot_id, wa_id = g.pop('bot_id'), g.pop('client')
+		if not wa_id:
+			continue
+		inbound = MessageLog.objects.filter(bot_id=bot_id, direction=IN, wa_from=wa_id)
+		outbound = MessageLog.objects.filter(bot_id=bot_id, direction=OUT, wa_to=wa_id)
+		last = (inbound | outbound).order_by('-created_at').values_list('direction', 'message_type', 'body_text', 'payload').first()
+		snippet = ''
+		if last:
+			direction, message_type, body_text, payload = last
+			# Filas anteriores a body_text (sin backfill_message_previews): el texto sale del payload
+			snippet = body_text if body_text is not None else message_preview(direction, message_type, payload)[0]
+		g['last_snippet'] = snippet[:Conversation.SNIPPET_LEN]
+		conv, _ = Conversation.objects.update_or_create(bot_id=bot_id, wa_id=wa_id, defaults=g)
+		inbound.filter(conversation__isnull=True).update(conversation=conv)
+		outbound.filter(conversation__isnull=True).update(conversation=conv)
+		total += 1
+	_conversation_ids.clear()
+	return total
+
 
 class WaUser(models.Model):
 	"""Estado por usuario de WhatsApp para ejecución de flujo y chat humano."""
@@ -67,9 +309,16 @@ class WaUser(models.Model):
 	last_message_at = models.DateTimeField(null=True, blank=True)
 	last_in_at = models.DateTimeField(null=True, blank=True)
 	flow_node = models.CharField(max_length=128, null=True, blank=True)
+	# Últimos turnos de texto + resumen para el contexto de la IA (respaldo de la caché, ver bots/memory.py)
+	memory = models.JSONField(default=dict, blank=True)
 
 	class Meta:
 		unique_together = ('bot', 'wa_id')
+		# Vencimientos que recorre el scheduler (bots/expiry.py): sólo las filas con temporizador activo
+		indexes = [
+			models.Index(fields=['human_expires_at'], name='wauser_human_due', condition=models.Q(human_requested=True)),
+			models.Index(fields=['last_in_at'], name='wauser_flow_due', condition=models.Q(flow_node__isnull=False)),
+		]
 
 	def __str__(self):
 		return f"{self.wa_id} ({self.bot.name})"
@@ -101,3 +350,64 @@ class AIKey(models.Model):
 		label = self.name or (self.api_key[:6] + '…' if self.api_key else 'key')
 		return f"{self.get_provider_display()} • {label}"
 
+
+
+class IntentModel(models.Model):
+	"""Clasificador local de intención (n-gramas de caracteres + Naive Bayes) versionado por bot.
+	Se entrena con `manage.py train_intent_model` a partir de MessageLog.intent_label.
+	"""
+	bot = models.ForeignKey(Bot, on_delete=models.CASCADE, related_name='intent_models')
+	version = models.PositiveIntegerField()
+	artifact = models.JSONField(default=dict)
+	samples = models.PositiveIntegerField(default=0)
+	accuracy = models.FloatField(null=True, blank=True, help_text="Exactitud sobre el conjunto de validación")
+	created_at = models.DateTimeField(auto_now_add=True)
+
+	class Meta:
+		unique_together = ('bot', 'version')
+		ordering = ['bot', '-version']
+
+	def __str__(self):
+		return f"{self.bot.name} v{self.version}"
+
+
+class KnowledgeIndex(models.Model):
+	"""Índice BM25 de la base de conocimiento del Cerebro para una versión de flujo.
+	Se arma al guardar el flujo (ver bots/knowledge.py); sólo se conserva la última versión por flujo.
+	"""
+	flow = models.ForeignKey(Flow, on_delete=models.CASCADE, null=True, blank=True, related_name='knowledge_indexes')
+	version = models.CharField(max_length=100, unique=True)
+	data = models.JSONField(default=dict)
+	chunks = models.PositiveIntegerField(default=0)
+	knowledge_tokens = models.PositiveIntegerField(default=0, help_text="Tokens estimados del conocimiento completo")
+	created_at = models.DateTimeField(auto_now_add=True)
+
+	def __str__(self):
+		return self.version
+
+
+class AIUsage(models.Model):
+	"""Uso de IA agregado por hora, bot, tarea, modelo y clave (tokens, costo y latencia).
+	Se escribe en lotes desde bots/ai_usage.py; la latencia se guarda como histograma para calcular p95.
+	"""
+	bucket = models.DateTimeField(help_text="Inicio de la hora (UTC)")
+	bot = models.ForeignKey(Bot, on_delete=models.CASCADE, null=True, blank=True, related_name='ai_usage')
+	task = models.CharField(max_length=32)
+	model = models.CharField(max_length=120, blank=True)
+	key = models.ForeignKey(AIKey, on_delete=models.SET_NULL, null=True, blank=True, related_name='usage')
+	calls = models.PositiveIntegerField(default=0)
+	errors = models.PositiveIntegerField(default=0)
+	prompt_tokens = models.PositiveBigIntegerField(default=0)
+	completion_tokens = models.PositiveBigIntegerField(default=0)
+	cost_usd = models.DecimalField(max_digits=12, decimal_places=6, default=0)
+	latency_ms_total = models.FloatField(default=0)
+	# {límite superior del bucket en ms: cantidad}; ver ai_usage.LATENCY_BUCKETS_MS
+	latency_hist = models.JSONField(default=dict, blank=True)
+
+	class Meta:
+		unique_together = ('bucket', 'bot', 'task', 'model', 'key')
+		ordering = ['-bucket']
+		indexes = [models.Index(fields=['bot', 'bucket'])]
+
+	def __str__(self):
+		return f"{self.bucket:%Y-%m-%d %H}h {self.task} {self.model}"
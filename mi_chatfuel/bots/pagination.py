@@ -0,0 +1,93 @@
+"""Paginación por cursor (keyset) para las APIs del panel.
+
+El cursor codifica (fecha, id) de una fila; la página siguiente se pide con
+WHERE (fecha, id) < cursor sobre el índice de la fecha en lugar de OFFSET, así el
+costo no crece con la profundidad y no se saltan ni repiten filas cuando llegan
+mensajes nuevos entre dos consultas.
+
+- before=<cursor>: filas anteriores (scroll hacia atrás).
+- after=<cursor> / since=<cursor>: sólo lo más nuevo que el cursor (polling del delta).
+
+También se acepta una fecha ISO como cursor (sin desempate por id).
+"""
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode(ts: datetime, pk: int) -> str:
+    raw = f'{ts.isoformat()}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode(value: str) -> tuple[datetime, int | None]:
+    """(fecha, id) del cursor; una fecha ISO da (fecha, None). InvalidCursor si no es ninguno."""
+    value = (value or '').strip()
+    pk = None
+    try:
+        # parse_datetime lanza ValueError con fechas bien formadas pero imposibles (mes 13)
+        ts = parse_datetime(value)
+        if ts is None:
+            raw = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode()
+            iso, _, pk_s = raw.rpartition('|')
+            ts, pk = parse_datetime(iso), int(pk_s)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCursor(value)
+    if ts is None:
+        raise InvalidCursor(value)
+    if timezone.is_naive(ts):
+        ts = timezone.make_aware(ts)
+    return ts, pk
+
+
+def _value(row, name: str):
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+def cursor_of(row, field: str) -> str:
+    """Cursor de una instancia o de un dict de .values() (que debe incluir 'id')."""
+    return encode(_value(row, field), _value(row, 'id' if isinstance(row, dict) else 'pk'))
+
+
+def _older(field: str, cursor: tuple[datetime, int | None]) -> Q:
+    ts, pk = cursor
+    q = Q(**{f'{field}__lt': ts})
+    return q | Q(**{field: ts, 'pk__lt': pk}) if pk is not None else q
+
+
+def _newer(field: str, cursor: tuple[datetime, int | None]) -> Q:
+    ts, pk = cursor
+    q = Q(**{f'{field}__gt': ts})
+    return q | Q(**{field: ts, 'pk__gt': pk}) if pk is not None else q
+
+
+def page(qs, field: str, limit: int, before=None, after=None, newest_first: bool = False) -> tuple[list, bool]:
+    """Una página de `qs` ordenada por (field, id) y si quedan más filas en esa dirección.
+
+    Sin cursores: las `limit` filas más recientes. `after`: las más antiguas de las
+    posteriores al cursor (el delta, sin huecos si supera `limit`). `before`/`after`
+    son tuplas de decode(). El resultado va del más antiguo al más nuevo, o al revés
+    con newest_first.
+    """
+    if after is not None:
+        rows = list(qs.filter(_newer(field, after)).order_by(field, 'pk')[:limit + 1])
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if newest_first:
+            rows.reverse()
+        return rows, more
+    if before is not None:
+        qs = qs.filter(_older(field, before))
+    rows = list(qs.order_by(f'-{field}', '-pk')[:limit + 1])
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if not newest_first:
+        rows.reverse()
+    return rows, more
@@ -0,0 +1,355 @@
+"""Motor determinista de respuestas desde el Cerebro (persona), sin IA.
+
+Las palabras clave de cada intención se compilan una sola vez en un índice por
+palabra completa (así 'x' o 'hay' no coinciden dentro de otras palabras) y se
+detectan todas las intenciones del mensaje en una sola pasada por sus palabras.
+Las frases se prueban antes que sus palabras sueltas ('precio mayorista' gana a
+'precio').
+
+Los fragmentos de respuesta de cada intención se arman una vez por versión de
+persona (PersonaAnswers) y se reutilizan en cada mensaje.
+"""
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .inbound import InboundMessage, normalize, tokenize
+
+
+# Prefijo de las respuestas cuando el Cerebro no tiene el dato pedido
+PERSONA_MISSING_PREFIX = 'Por el momento no contamos'
+
+# Intenciones en orden de prioridad al componer la respuesta. Palabras normalizadas
+# (minúsculas, sin tildes); 'raíz*' acepta cualquier terminación.
+RULES = [
+    ('buy', [
+        'compr*', 'disfraz', 'disfraces', 'precio*', 'cotiz*', 'quiero comprar', 'quiero cotizar',
+        'recomiend*', 'recomend*', 'sugerenc*', 'modelo', 'modelos', 'producto', 'productos', 'sexy', 'sexi',
+    ]),
+    ('identity', ['quien eres', 'quien sos', 'quien me habla', 'tu nombre', 'como te llamas', 'quien es este']),
+    ('phone', ['telefono*', 'celular*', 'numero', 'whatsapp', 'contacto*']),
+    ('web', ['web', 'sitio', 'pagina', 'pagina web', 'tienda', 'catalogo', 'link']),
+    ('products', ['que vendes', 'que ofrecen', 'servicios', 'vendes', 'ofrecen']),
+    ('socials', ['redes', 'red social', 'instagram', 'facebook', 'tiktok', 'youtube', 'twitter', 'x', 'linktree']),
+    ('hours', ['horario', 'horarios', 'abren', 'cierran']),
+    ('address', ['direccion', 'ubicacion', 'donde estan', 'mapa']),
+    ('yape', ['yape*']),
+    ('plin', ['plin*']),
+    ('card', ['tarjeta*']),
+    ('transfer', ['transfer*']),
+    ('cod', ['contraentrega', 'contra entrega']),
+    ('payments', ['pago', 'pagos', 'pagar', 'metodos de pago']),
+    ('shipping', ['envio', 'envios', 'delivery', 'reparto', 'cobertura', 'distritos']),
+    ('wholesale', ['mayorista', 'mayoreo', 'al por mayor', 'lista mayorista', 'precio mayorista']),
+    ('ruc', ['ruc', 'razon social', 'nombre comercial']),
+    ('invoice', ['boleta', 'factura', 'comprobante*']),
+]
+# Palabras genéricas de compra: sólo cuentan si no se detectó otra intención
+WEAK_RULES = [('buy', ['tienes', 'hay', 'quiero algo', 'busco', 'buscar'])]
+PRIORITY = [intent for intent, _kws in RULES]
+PAYMENT_DETAIL = ('yape', 'plin', 'card', 'transfer', 'cod')
+
+_GOODBYE_WORDS = frozenset({'gracias', 'muchas', 'adios', 'chao', 'hasta', 'luego', 'nos', 'vemos', 'bye', 'graci'})
+
+
+def _compile():
+    """Índice de palabras clave por primera palabra (exacta o raíz) para recorrer el texto
+    palabra por palabra; en cada posición gana la frase más larga que coincida."""
+    exact: dict[str, list] = {}
+    stems: dict[str, list] = {}
+    for weak, rules in ((False, RULES), (True, WEAK_RULES)):
+        for intent, keywords in rules:
+            for kw in keywords:
+                words = kw.rstrip('*').split()
+                stem = kw.endswith('*')
+                entry = (tuple(words[1:]), stem, intent, weak)
+                if stem and len(words) == 1:
+                    stems.setdefault(words[0], []).append(entry)
+                else:
+                    exact.setdefault(words[0], []).append(entry)
+    for entries in exact.values():
+        entries.sort(key=lambda e: -len(e[0]))
+    return exact, stems, sorted({len(s) for s in stems}, reverse=True)
+
+
+_EXACT, _STEMS, _STEM_LENGTHS = _compile()
+
+
+def _match_at(tokens: list[str], i: int):
+    """(largo en palabras, intención, débil) de la palabra clave más larga que empieza en tokens[i]."""
+    tok = tokens[i]
+    for rest, _stem, intent, weak in _EXACT.get(tok, ()):
+        n = len(rest)
+        if tuple(tokens[i + 1:i + 1 + n]) == rest:
+            return n + 1, intent, weak
+    for size in _STEM_LENGTHS:
+        if len(tok) >= size:
+            hit = _STEMS.get(tok[:size])
+            if hit:
+                _rest, _stem, intent, weak = hit[0]
+                return 1, intent, weak
+    return 0, None, False
+
+
+def is_goodbye(tokens: list[str]) -> bool:
+    return bool(tokens) and len(tokens) <= 4 and all(w in _GOODBYE_WORDS for w in tokens)
+
+
+def detect(text: 'str | InboundMessage') -> list[str]:
+    """Intenciones del mensaje en orden de prioridad (todas las que aparecen, en una pasada).
+    Con un InboundMessage se reutilizan sus tokens ya normalizados."""
+    tokens = text.tokens if isinstance(text, InboundMessage) else tokenize(normalize(text))
+    if is_goodbye(tokens):
+        return ['goodbye']
+    strong, weak = set(), set()
+    i = 0
+    while i < len(tokens):
+        size, intent, is_weak = _match_at(tokens, i)
+        if size:
+            (weak if is_weak else strong).add(intent)
+            i += size
+        else:
+            i += 1
+    if not strong:
+        strong = weak
+    if strong.intersection(PAYMENT_DETAIL):
+        strong.discard('payments')
+    return [intent for intent in PRIORITY if intent in strong]
+
+
+# ===== Fragmentos por persona =====
+
+def _socials(p: dict, with_linktree: bool = True) -> list[str]:
+    labels = [('instagram', 'Instagram'), ('facebook', 'Facebook'), ('tiktok', 'TikTok'), ('youtube', 'YouTube'), ('x', 'X')]
+    if with_linktree:
+        labels.append(('linktree', 'Linktree'))
+    return [f"{label}: {p[k]}" for k, label in labels if p.get(k)]
+
+
+def _payments_summary(p: dict) -> str:
+    parts = []
+    if p.get('yape_number') or p.get('yape_holder'):
+        parts.append('🟣 Yape')
+    if p.get('plin_number') or p.get('plin_holder'):
+        parts.append('🔵 Plin')
+    if p.get('card_brands') or p.get('card_provider'):
+        parts.append('💳 Tarjeta')
+    if p.get('transfer_accounts'):
+        parts.append('🏦 Transferencia bancaria')
+    if p.get('cash_on_delivery_yes'):
+        parts.append('🚚 Contraentrega')
+    if parts:
+        return 'Aceptamos: ' + ', '.join(parts) + '. ¿Cuál prefieres?'
+    return f'{PERSONA_MISSING_PREFIX} con métodos de pago publicados.'
+
+
+def _fragments(persona: dict, brand: str | None) -> dict[str, str]:
+    p = {k: str(v).strip() for k, v in persona.items() if v is not None and not isinstance(v, (dict, list))}
+    biz = (p.get('trade_name') or p.get('legal_name') or (brand or '')).strip()
+    asist = p.get('name') or 'Asistente'
+    missing = PERSONA_MISSING_PREFIX
+    out: dict[str, str] = {}
+
+    redes = _socials(p, with_linktree=False)
+    out['goodbye'] = (
+        "¡Gracias por escribir! Puedes seguirnos: " + " | ".join(redes) if redes
+        else "¡Gracias! Si necesitas algo más, estaré atento."
+    )
+
+    order_lines = [ln.strip() for ln in (p.get('order_required') or '').split('\n') if ln.strip()]
+    if p.get('catalog_url'):
+        out['buy'] = f"¡Claro! Te ayudo a elegir. Explora opciones aquí: {p['catalog_url']} 🛍️\n¿Talla, estilo o color que prefieras?"
+    elif p.get('website'):
+        out['buy'] = f"Claro, aquí puedes ver opciones y precios: {p['website']} 🛍️\n¿Qué talla o modelo te interesa?"
+    elif order_lines:
+        out['buy'] = 'Para ayudarte con la compra, por favor compárteme: ' + ', '.join(order_lines[:6])
+    else:
+        out['buy'] = 'Con gusto te ayudo a encontrar el producto ideal. Cuéntame qué producto, talla y cantidad necesitas.'
+
+    out['identity'] = f"Soy {asist}, asistente virtual de {biz}." if biz else f"Soy {asist}, tu asistente virtual."
+
+    if p.get('phone'):
+        extra = f" | Link WhatsApp: {p['whatsapp_link']}" if p.get('whatsapp_link') else ''
+        out['phone'] = f"Teléfono: {p['phone']}{extra}"
+    elif p.get('whatsapp_link'):
+        out['phone'] = f"WhatsApp: {p['whatsapp_link']}"
+    else:
+        out['phone'] = f'{missing} con un teléfono publicado.'
+
+    links = [f"{label}: {p[k]}" for k, label in (('website', 'Web'), ('catalog_url', 'Catálogo')) if p.get(k)]
+    out['web'] = ' | '.join(links) if links else f'{missing} con enlaces de web o catálogo.'
+
+    if p.get('catalog_url'):
+        out['products'] = f"Puedes ver nuestro catálogo aquí: {p['catalog_url']}"
+    elif p.get('website'):
+        out['products'] = f"Puedes ver más información en nuestra web: {p['website']}"
+    else:
+        out['products'] = f'{missing} con un catálogo publicado.'
+
+    redes = _socials(p)
+    out['socials'] = ' | '.join(redes) if redes else f'{missing} con redes publicadas.'
+
+    hs = [f"{label}: {p[k]}" for k, label in (('hours_mon_fri', 'L-V'), ('hours_sat', 'Sábado'), ('hours_sun', 'Domingos/Feriados')) if p.get(k)]
+    out['hours'] = 'Horarios: ' + ' | '.join(hs) if hs else f'{missing} con horarios publicados.'
+
+    addr = ', '.join(a for a in (p.get('address'), p.get('city'), p.get('region'), p.get('country')) if a)
+    extras = []
+    if p.get('maps_url'):
+        extras.append(f"Mapa: {p['maps_url']}")
+    if p.get('pickup_address') and p.get('pickup_address') != p.get('address'):
+        extras.append(f"Retiro: {p['pickup_address']}")
+    if addr or extras:
+        out['address'] = ' | '.join(x for x in [f"Dirección: {addr}" if addr else ''] + extras if x)
+    else:
+        out['address'] = f'{missing} con dirección publicada.'
+
+    if p.get('yape_number') or p.get('yape_holder'):
+        line = f"🟣 Yape: {p.get('yape_number') or ''}"
+        if p.get('yape_holder'):
+            line += f" — Titular: {p['yape_holder']}"
+        if p.get('yape_alias'):
+            line += f" — Alias: {p['yape_alias']}"
+        if p.get('yape_qr'):
+            line += f" — QR: {p['yape_qr']}"
+        out['yape'] = line.strip()
+    else:
+        out['yape'] = f'{missing} con Yape.'
+
+    if p.get('plin_number') or p.get('plin_holder'):
+        line = f"🔵 Plin: {p.get('plin_number') or ''}"
+        if p.get('plin_holder'):
+            line += f" — Titular: {p['plin_holder']}"
+        if p.get('plin_qr'):
+            line += f" — QR: {p['plin_qr']}"
+        out['plin'] = line.strip()
+    else:
+        out['plin'] = f'{missing} con Plin.'
+
+    if p.get('card_brands') or p.get('card_provider') or p.get('card_paylink'):
+        item = f"💳 Tarjeta: {p.get('card_brands') or ''}"
+        if p.get('card_provider'):
+            item += f" — Proveedor: {p['card_provider']}"
+        if p.get('card_paylink'):
+            item += f" — Link de pago: {p['card_paylink']}"
+        out['card'] = item.strip()
+    else:
+        out['card'] = f'{missing} con pago con tarjeta.'
+
+    msg = []
+    if p.get('transfer_accounts'):
+        msg.append('🏦 Cuentas: ' + p['transfer_accounts'])
+    if p.get('transfer_instructions'):
+        msg.append('Instrucciones: ' + p['transfer_instructions'])
+    out['transfer'] = ' | '.join(msg) if msg else f'{missing} con información de transferencia.'
+
+    out['cod'] = (
+        f"🚚 Contraentrega: {p['cash_on_delivery_yes']}" if p.get('cash_on_delivery_yes')
+        else f'{missing} con contraentrega.'
+    )
+    out['payments'] = _payments_summary(p)
+
+    msgs = []
+    if p.get('districts_costs'):
+        msgs.append('Distritos y costos:\n' + p['districts_costs'])
+    if p.get('typical_delivery_time'):
+        msgs.append(f"Tiempo típico: {p['typical_delivery_time']}")
+    if p.get('free_shipping_from'):
+        msgs.append(f"Envío gratis desde: {p['free_shipping_from']}")
+    if p.get('delivery_partners'):
+        msgs.append(f"Socios: {p['delivery_partners']}")
+    out['shipping'] = ' | '.join(msgs) if msgs else f'{missing} con información de envíos.'
+
+    parts = []
+    if p.get('wholesale_price_list_url'):
+        parts.append(f"Lista mayorista: {p['wholesale_price_list_url']}")
+    if p.get('wholesale_min_qty'):
+        parts.append(f"Mínimo: {p['wholesale_min_qty']}")
+    if p.get('wholesale_requires_ruc'):
+        parts.append(f"Requiere RUC: {p['wholesale_requires_ruc']}")
+    out['wholesale'] = ' | '.join(parts) if parts else f'{missing} con información mayorista.'
+
+    parts = []
+    if p.get('legal_name'):
+        parts.append(f"Razón social: {p['legal_name']}")
+    if p.get('trade_name'):
+        parts.append(f"Nombre comercial: {p['trade_name']}")
+    if p.get('ruc'):
+        parts.append(f"RUC: {p['ruc']}")
+    out['ruc'] = ' | '.join(parts) if parts else f'{missing} con datos de RUC.'
+
+    parts = []
+    if p.get('boleta_yes'):
+        parts.append(f"Boleta: {p['boleta_yes']}")
+    if p.get('factura_yes'):
+        parts.append(f"Factura: {p['factura_yes']}")
+    out['invoice'] = ' | '.join(parts) if parts else f'{missing} con información de comprobantes.'
+    return out
+
+
+class PersonaAnswers:
+    """Fragmentos de respuesta ya renderizados de una persona, por intención."""
+    __slots__ = ('fragments',)
+
+    def __init__(self, persona: dict, brand: str | None = None):
+        self.fragments = _fragments(persona, brand)
+
+    def answer(self, intents: list[str], max_intents: int | None = None) -> str | None:
+        """Une los fragmentos de las intenciones (sin repetir). Si alguna tiene datos,
+        se omiten las que sólo dirían 'Por el momento no contamos…'."""
+        if max_intents is None:
+            max_intents = getattr(settings, 'AI_PERSONA_MAX_INTENTS', 3)
+        chosen: list[str] = []
+        for intent in intents:
+            frag = self.fragments.get(intent)
+            if frag and frag not in chosen:
+                chosen.append(frag)
+        known = [f for f in chosen if not f.startswith(PERSONA_MISSING_PREFIX)]
+        chosen = (known or chosen)[:max(1, max_intents)]
+        return '\n'.join(chosen) if chosen else None
+
+
+def persona_key(persona: dict):
+    # Tupla de items: hash barato (los str cachean su hash) y sin riesgo de colisiones
+    key = tuple(persona.items())
+    try:
+        hash(key)
+    except TypeError:
+        return json.dumps(persona, sort_keys=True, default=str)
+    return key
+
+
+_CACHE_MAX = 256
+_cache: OrderedDict = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def compiled_answers(persona: dict, brand: str | None = None, version: str | None = None) -> PersonaAnswers:
+    """PersonaAnswers memoizado por versión de persona (o por su contenido si no hay versión)."""
+    key = (version or persona_key(persona), brand)
+    with _cache_lock:
+        hit = _cache.get(key)
+        if hit is not None:
+            _cache.move_to_end(key)
+            return hit
+    compiled = PersonaAnswers(persona, brand)
+    with _cache_lock:
+        _cache[key] = compiled
+        while len(_cache) > _CACHE_MAX:
+            _cache.popitem(last=False)
+    return compiled
+
+
+def clear_cache() -> None:
+    with _cache_lock:
+        _cache.clear()
+
+
+def answer(user_text: 'str | InboundMessage', persona: dict | None, brand: str | None = None, version: str | None = None) -> str | None:
+    if not persona:
+        return None
+    intents = detect(user_text)
+    if not intents:
+        return None
+    return compiled_answers(persona, brand, version).answer(intents)
@@ -0,0 +1,198 @@
+"""Presupuestos de SQL por request para las rutas calientes (webhook y APIs del panel).
+
+Cada escenario ejecuta un endpoint con datos realistas (build_fixtures) y mide las
+consultas en la conexión default con un execute_wrapper: cantidad y tiempo total
+de SQL (sin contar SAVEPOINT/RELEASE, que sólo aparecen dentro de otra transacción
+como en los tests). check() falla con un reporte de las consultas, marcando las que se repiten
+con la misma forma (el síntoma de un N+1). Lo usan los tests (bots/tests.py, sólo
+la cantidad de consultas) y `manage.py benchmark --suite queries` (también el tiempo).
+"""
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Bot, Flow, MessageLog, WaUser
+
+
+# escenario → (consultas máximas, ms de SQL máximos)
+BUDGETS = {
+    'webhook_text': (10, 50),
+    'webhook_button': (9, 50),
+    'webhook_first_contact': (13, 50),
+    'conversation_list': (5, 25),
+    'conversation_fetch': (6, 25),
+    'outbox': (3, 25),
+}
+
+
+_SAVEPOINTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+class BudgetExceeded(AssertionError):
+    pass
+
+
+@dataclass
+class Measurement:
+    name: str
+    queries: list[dict] = field(default_factory=list)
+    status: int | None = None
+
+    @property
+    def statements(self) -> list[dict]:
+        return [q for q in self.queries if not q['sql'].startswith(_SAVEPOINTS)]
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    @property
+    def sql_ms(self) -> float:
+        return sum(q['ms'] for q in self.queries)
+
+    def repeated(self) -> dict[str, int]:
+        """Consultas con la misma forma (SQL sin parámetros) que aparecen más de una vez."""
+        shapes = Counter(q['sql'] for q in self.statements)
+        return {sql: n for sql, n in shapes.items() if n > 1}
+
+    def report(self, budget: tuple[int, float] | None = None) -> str:
+        max_queries, max_ms = budget or BUDGETS.get(self.name, (None, None))
+        lines = [f'{self.name}: {self.count} consultas (máx {max_queries}), {self.sql_ms:.1f} ms de SQL (máx {max_ms})']
+        for i, q in enumerate(self.queries, 1):
+            lines.append(f"  {i:>2}. [{q['ms']:6.2f} ms] {q['sql'][:300]} {list(q['params'] or ())[:8]!r}"[:400])
+        for sql, n in self.repeated().items():
+            lines.append(f'  repetida x{n}: {sql[:300]}')
+        return '\n'.join(lines)
+
+
+def measure(name: str, fn) -> Measurement:
+    queries = []
+
+    def timed(execute, sql, params, many, context):
+        t0 = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            queries.append({'sql': sql, 'params': params, 'ms': (time.perf_counter() - t0) * 1000})
+
+    with connection.execute_wrapper(timed):
+        response = fn()
+    return Measurement(name, queries, getattr(response, 'status_code', None))
+
+
+def check(m: Measurement, budget: tuple[int, float] | None = None, timing: bool = True) -> Measurement:
+    """BudgetExceeded (con el reporte de consultas) si el escenario superó su presupuesto.
+    timing=False sólo controla la cantidad de consultas: el tiempo de SQL depende de la máquina y del
+    motor, así que los tests no lo usan (queda para `manage.py benchmark --suite queries`)."""
+    max_queries, max_ms = budget or BUDGETS[m.name]
+    if m.count > max_queries or (timing and m.sql_ms > max_ms):
+        raise BudgetExceeded(m.report((max_queries, max_ms)))
+    return m
+
+
+class _Response:
+    ok = True
+    status_code = 200
+    text = ''
+
+    def json(self):
+        return {'messages': [{'id': f'wamid.budget.{time.monotonic_ns()}'}]}
+
+
+@contextmanager
+def offline():
+    """Envíos a WhatsApp sin red (respuesta OK simulada) y sin ventana de ráfaga."""
+    from django.test import override_settings
+    from . import services
+    original = services.requests.post
+    services.requests.post = lambda *a, **kw: _Response()
+    try:
+        with override_settings(AI_DEBOUNCE_S=0):
+            yield
+    finally:
+        services.requests.post = original
+
+
+FLOW = {
+    'enabled': True,
+    'start_node': 'menu',
+    'ai': {'assistant_name': 'Luna', 'catalog_url': 'https://tiendasol.pe/catalogo', 'yape_number': '999888777'},
+    'nodes': {
+        'precios': {'type': 'trigger', 'trigger_type': 'keywords', 'patterns': 'precio, precios', 'next': 'menu'},
+        'menu': {'type': 'action', 'text': '¿Qué deseas ver?', 'buttons': [
+            {'title': 'Catálogo', 'next': 'catalogo'}, {'title': 'Asesora', 'next': 'asesora'},
+        ]},
+        'catalogo': {'type': 'action', 'text': 'Mira el catálogo: https://tiendasol.pe/catalogo'},
+        'asesora': {'type': 'advisor', 'text': 'Te paso con una asesora', 'timeout_min': 15},
+    },
+}
+
+
+@dataclass
+class Fixtures:
+    owner: object
+    bot: Bot
+    wa_ids: list[str]
+
+
+def build_fixtures(username: str = 'budget', clients: int = 30, messages: int = 20) -> Fixtures:
+    """Dueño con dos bots, `clients` conversaciones de `messages` mensajes y salientes con error."""
+    owner = get_user_model().objects.create_user(username, password='x')
+    bot = Bot.objects.create(owner=owner, name='Sol', phone_number_id='100', access_token='t', verify_token='v')
+    other = Bot.objects.create(owner=owner, name='Luna', phone_number_id='200', access_token='t', verify_token='v')
+    Flow.objects.create(bot=bot, name='Principal', definition=FLOW)
+    wa_ids = [f'51900{i:04d}' for i in range(clients)]
+    for n, wa_id in enumerate(wa_ids):
+        b = bot if n % 3 else other
+        WaUser.objects.create(bot=b, wa_id=wa_id, name=f'Cliente {n}', human_requested=n % 5 == 0, last_in_at=timezone.now())
+        for i in range(messages):
+            inbound = i % 2 == 0
+            MessageLog.objects.create(
+                bot=b, direction=MessageLog.IN if inbound else MessageLog.OUT,
+                wa_from=wa_id if inbound else b.phone_number_id, wa_to=b.phone_number_id if inbound else wa_id,
+                message_type='text', payload={} if inbound else {'response': {'messages': [{'id': f'wamid.{n}.{i}'}]}},
+                body_text=f'mensaje {i}', status='received' if inbound else ('sent' if i % 4 else 'error'),
+            )
+    return Fixtures(owner, bot, wa_ids)
+
+
+def _webhook_body(wa_id: str, message: dict) -> str:
+    return json.dumps({'entry': [{'changes': [{'value': {
+        'metadata': {'phone_number_id': '100'},
+        'contacts': [{'profile': {'name': 'Ana'}}],
+        'messages': [{'id': f'wamid.in.{time.monotonic_ns()}', 'from': wa_id, **message}],
+    }}]}]})
+
+
+def scenarios(client: Client, fx: Fixtures) -> dict:
+    """Escenario → función que hace el request (el cliente ya debe estar logueado como fx.owner)."""
+    webhook = reverse('bots:whatsapp_webhook', args=[str(fx.bot.uuid)])
+    known = fx.wa_ids[1]
+
+    def post(wa_id, message):
+        return client.post(webhook, _webhook_body(wa_id, message), content_type='application/json')
+
+    return {
+        'webhook_text': lambda: post(known, {'type': 'text', 'text': {'body': 'precio del disfraz'}}),
+        'webhook_button': lambda: post(known, {'type': 'interactive', 'interactive': {
+            'button_reply': {'id': 'FLOW:catalogo', 'title': 'Catálogo'}}}),
+        'webhook_first_contact': lambda: post(f'51988{time.monotonic_ns() % 10**6:06d}', {'type': 'text', 'text': {'body': 'hola'}}),
+        'conversation_list': lambda: client.get(reverse('bots:api_list_conversations')),
+        'conversation_fetch': lambda: client.get(reverse('bots:api_get_conversation', args=[known])),
+        'outbox': lambda: client.get(reverse('bots:api_outbox'), {'only_errors': '1'}),
+    }
+
+
+def run(client: Client, fx: Fixtures, names=None) -> list[Measurement]:
+    """Mide cada escenario (con offline()) en el orden de BUDGETS."""
+    fns = scenarios(client, fx)
+    with offline():
+        return [measure(name, fns[name]) for name in (names or BUDGETS)]
@@ -1,445 +1,190 @@
+import json
+import threading
+from collections import OrderedDict
+
 import requests
 from django.conf import settings
-from .models import MessageLog, AIKey
-import unicodedata
+from .models import MessageLog
+from . import persona_engine
+from .persona_engine import PERSONA_MISSING_PREFIX, persona_key as _persona_key
 
 
 # ======= OpenRouter AI helpers =======
 
-OPENROUTER_API_URL = 'https://openrouter.ai/api/v1/chat/completions'
+def ai_chat(messages: list[dict], model: str | None = None, temperature: float = 0.3, max_tokens: int | None = 256, timeout: float = 20, task: str = 'chat', **params) -> dict | None:
+    """Chat completion vía el cliente compartido (pool + failover entre claves, ver bots/ai_client.py).
+    `task` etiqueta la contabilidad de tokens/latencia (bots/ai_usage.py). Sin `model`, el modelo
+    lo elige el router de la tarea (bots/ai_router.py), con fallback al siguiente si falla."""
+    if model is None:
+        from . import ai_router
+        return ai_router.chat(messages, task, timeout=timeout, temperature=temperature, max_tokens=max_tokens, **params)
+    from .ai_client import build_payload, chat
+    return chat(build_payload(messages, model=model, temperature=temperature, max_tokens=max_tokens, **params), timeout=timeout, task=task)
 
 
-def _get_active_ai_key() -> str | None:
-    try:
-        key = AIKey.objects.filter(is_active=True).order_by('priority', 'last_used_at').first()
-        return key.api_key if key else None
-    except Exception:
-        return None
+# ======= Deterministic knowledge extraction from persona =======
 
+def answer_from_persona(user_text: str, persona: dict | None, brand: str | None = None, version: str | None = None) -> str | None:
+    """Devuelve una respuesta directa usando los campos del 'Cerebro' sin IA generativa.
+    Cubre consultas típicas: quién eres, teléfonos, redes, web, horarios, dirección/mapa,
+    Yape/Plin, pagos, envíos, mayorista, RUC, boleta/factura, etc. Si el mensaje toca varios
+    temas responde todos (ver bots/persona_engine.py); `version` memoiza los fragmentos.
+    """
+    return persona_engine.answer(user_text, persona, brand=brand, version=version)
 
-def ai_chat(messages: list[dict], model: str | None = None, temperature: float = 0.3, max_tokens: int | None = 256) -> dict | None:
-    api_key = _get_active_ai_key()
-    if not api_key:
-        return None
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json',
-        'HTTP-Referer': 'https://opti.chat',
-        'X-Title': 'OptiChat',
-    }
-    payload = {
-        'model': model or 'openrouter/auto',
-        'messages': messages,
-        'temperature': temperature,
-    }
-    if max_tokens:
-        payload['max_tokens'] = max_tokens
-    try:
-        resp = requests.post(OPENROUTER_API_URL, json=payload, headers=headers, timeout=20)
-        resp.raise_for_status()
-        return resp.json()
-    except Exception:
-        return None
 
+class Classification:
+    """Resultado validado del clasificador combinado: trigger (id permitido o None),
+    intención (etiqueta permitida o None) y confianza 0..1."""
+    __slots__ = ('trigger', 'intent', 'confidence')
 
-# ======= Deterministic knowledge extraction from persona =======
+    def __init__(self, trigger: str | None = None, intent: str | None = None, confidence: float = 0.0):
+        self.trigger = trigger
+        self.intent = intent
+        self.confidence = confidence
 
-def _norm_text(s: str) -> str:
-    s = (s or '').lower().strip()
-    # strip accents
-    s = ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
-    return s
+    def __repr__(self):
+        return f'Classification(trigger={self.trigger!r}, intent={self.intent!r}, confidence={self.confidence:.2f})'
 
 
-def answer_from_persona(user_text: str, persona: dict | None, brand: str | None = None) -> str | None:
-    """Devuelve una respuesta directa usando los campos del 'Cerebro' sin IA generativa.
-    Cubre consultas típicas: quién eres, teléfonos, redes, web, horarios, dirección/mapa,
-    Yape/Plin, pagos, envíos, mayorista, RUC, boleta/factura, etc.
-    """
-    if not persona:
+def parse_classification(text: str, trigger_ids: list[str], labels: list[str], min_confidence: float = 0.0) -> Classification | None:
+    """Valida la respuesta JSON del modelo contra los ids y etiquetas permitidos.
+    Valores fuera de la lista se descartan; bajo `min_confidence` no se devuelve trigger ni intención."""
+    text = (text or '').strip()
+    # Algunos modelos envuelven el JSON en ```json ... ``` o agregan texto alrededor
+    start, end = text.find('{'), text.rfind('}')
+    if start < 0 or end <= start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
         return None
-    t = _norm_text(user_text)
-    p = {k: (persona.get(k) or '').strip() for k in persona.keys()}
-
-    # Nombres negocio
-    biz = (p.get('trade_name') or p.get('legal_name') or (brand or '')).strip()
-    asist = (p.get('name') or 'Asistente').strip()
-
-    # Despedidas / cierre amable con redes (evaluar temprano pero evitando falsos positivos)
-    def _is_goodbye(text_low: str) -> bool:
-        # Si contiene términos de intención fuerte, no es despedida
-        if any(kw in text_low for kw in ['compr', 'precio', 'cotiz', 'disfraz', 'envio', 'envío', 'pago', 'horario', 'direccion', 'dirección']):
-            return False
-        tokens = [w for w in text_low.replace('¡','').replace('!','').replace('?','').replace('.', '').replace(',', '').split() if w]
-        if not tokens:
-            return False
-        white = {'gracias','muchas','adios','adiós','chao','hasta','luego','nos','vemos','bye','graci'}
-        return all(w in white for w in tokens) and len(tokens) <= 4
-
-    if _is_goodbye(t):
-        redes = []
-        if p.get('instagram'):
-            redes.append(f"Instagram: {p.get('instagram')}")
-        if p.get('facebook'):
-            redes.append(f"Facebook: {p.get('facebook')}")
-        if p.get('tiktok'):
-            redes.append(f"TikTok: {p.get('tiktok')}")
-        if p.get('youtube'):
-            redes.append(f"YouTube: {p.get('youtube')}")
-        if p.get('x'):
-            redes.append(f"X: {p.get('x')}")
-        if redes:
-            return "¡Gracias por escribir! Puedes seguirnos: " + " | ".join(redes)
-        return "¡Gracias! Si necesitas algo más, estaré atento."
-
-    # Intención de compra / cotización / recomendación
-    if any(kw in t for kw in [
-        'compr', 'disfraz', 'disfraces', 'precio', 'cotiz', 'quiero comprar', 'quiero cotizar',
-        'recomiend', 'recomend', 'sugerenc', 'modelo', 'modelos', 'tienes', 'hay', 'quiero algo', 'busco', 'buscar', 'producto', 'productos', 'sexy', 'sexi'
-    ]):
-        # Preferir catálogo o web si existe
-        if p.get('catalog_url'):
-            return f"¡Claro! Te ayudo a elegir. Explora opciones aquí: {p.get('catalog_url')} 🛍️\n¿Talla, estilo o color que prefieras?"
-        if p.get('website'):
-            return f"Claro, aquí puedes ver opciones y precios: {p.get('website')} 🛍️\n¿Qué talla o modelo te interesa?"
-        # Si no hay enlaces, pedir datos mínimos si están definidos
-        req = (persona.get('order_required') or '').strip() if isinstance(persona, dict) else ''
-        lines = [ln.strip() for ln in req.split('\n') if ln.strip()]
-        if lines:
-            return 'Para ayudarte con la compra, por favor compárteme: ' + ', '.join(lines[:6])
-        return 'Con gusto te ayudo a encontrar el producto ideal. Cuéntame qué producto, talla y cantidad necesitas.'
-
-    # Saludo/Identidad
-    if any(kw in t for kw in ['quien eres', 'quien sos', 'quien me habla', 'tu nombre', 'como te llamas', 'quien es este']):
-        if biz:
-            return f"Soy {asist}, asistente virtual de {biz}."
-        return f"Soy {asist}, tu asistente virtual."
-
-    # Teléfono / WhatsApp
-    if any(kw in t for kw in ['telefono', 'celular', 'numero', 'whatsapp', 'contacto']):
-        if p.get('phone'):
-            extra = f" | Link WhatsApp: {p.get('whatsapp_link')}" if p.get('whatsapp_link') else ''
-            return f"Teléfono: {p.get('phone')}{extra}"
-        if p.get('whatsapp_link'):
-            return f"WhatsApp: {p.get('whatsapp_link')}"
-        return 'Por el momento no contamos con un teléfono publicado.'
-
-    # Sitio web / tienda / catálogo
-    if any(kw in t for kw in ['web', 'sitio', 'pagina', 'pagina web', 'tienda', 'catalogo', 'catálogo', 'link']):
-        links = []
-        if p.get('website'):
-            links.append(f"Web: {p.get('website')}")
-        if p.get('catalog_url'):
-            links.append(f"Catálogo: {p.get('catalog_url')}")
-        if links:
-            return ' | '.join(links)
-        return 'Por el momento no contamos con enlaces de web o catálogo.'
-
-    # ¿Qué vendes? Productos/servicios
-    if any(kw in t for kw in ['que vendes', 'qué vendes', 'que ofrecen', 'qué ofrecen', 'productos', 'servicios', 'vendes', 'ofrecen']):
-        if p.get('catalog_url'):
-            return f"Puedes ver nuestro catálogo aquí: {p.get('catalog_url')}"
-        # Si no hay catálogo, intenta remitir a la web si existe
-        if p.get('website'):
-            return f"Puedes ver más información en nuestra web: {p.get('website')}"
-        return 'Por el momento no contamos con un catálogo publicado.'
-
-    # Redes sociales
-    if any(kw in t for kw in ['redes', 'red social', 'instagram', 'facebook', 'tiktok', 'youtube', 'twitter', 'x', 'linktree']):
-        redes = []
-        if p.get('instagram'):
-            redes.append(f"Instagram: {p.get('instagram')}")
-        if p.get('facebook'):
-            redes.append(f"Facebook: {p.get('facebook')}")
-        if p.get('tiktok'):
-            redes.append(f"TikTok: {p.get('tiktok')}")
-        if p.get('youtube'):
-            redes.append(f"YouTube: {p.get('youtube')}")
-        if p.get('x'):
-            redes.append(f"X: {p.get('x')}")
-        if p.get('linktree'):
-            redes.append(f"Linktree: {p.get('linktree')}")
-        if redes:
-            return ' | '.join(redes)
-        return 'Por el momento no contamos con redes publicadas.'
-
-    # Horarios
-    if any(kw in t for kw in ['horario', 'horarios', 'abren', 'cierran']):
-        hs = []
-        if p.get('hours_mon_fri'):
-            hs.append(f"L-V: {p.get('hours_mon_fri')}")
-        if p.get('hours_sat'):
-            hs.append(f"Sábado: {p.get('hours_sat')}")
-        if p.get('hours_sun'):
-            hs.append(f"Domingos/Feriados: {p.get('hours_sun')}")
-        if hs:
-            return 'Horarios: ' + ' | '.join(hs)
-        return 'Por el momento no contamos con horarios publicados.'
-
-    # Dirección / mapa / ubicación
-    if any(kw in t for kw in ['direccion', 'dirección', 'ubicacion', 'ubicación', 'donde estan', 'mapa']):
-        addr_parts = [p.get('address'), p.get('city'), p.get('region'), p.get('country')]
-        addr = ', '.join([a for a in addr_parts if a])
-        extras = []
-        if p.get('maps_url'):
-            extras.append(f"Mapa: {p.get('maps_url')}")
-        if p.get('pickup_address') and p.get('pickup_address') != p.get('address'):
-            extras.append(f"Retiro: {p.get('pickup_address')}")
-        if addr or extras:
-            return ' | '.join([x for x in [f"Dirección: {addr}" if addr else ''] + extras if x])
-        return 'Por el momento no contamos con dirección publicada.'
-
-    # Pagos generales / Yape / Plin / Tarjeta / Transferencia / Contraentrega
-    if any(kw in t for kw in ['pago', 'pagos', 'metodos de pago', 'métodos de pago', 'yape', 'plin', 'tarjeta', 'transferencia', 'contraentrega']):
-        # Pregunta específica por Yape
-        if 'yape' in t:
-            if p.get('yape_number') or p.get('yape_holder'):
-                line = f"🟣 Yape: {p.get('yape_number') or ''}"
-                if p.get('yape_holder'):
-                    line += f" — Titular: {p.get('yape_holder')}"
-                if p.get('yape_alias'):
-                    line += f" — Alias: {p.get('yape_alias')}"
-                if p.get('yape_qr'):
-                    line += f" — QR: {p.get('yape_qr')}"
-                return line.strip()
-            return 'Por el momento no contamos con Yape.'
-        # Pregunta específica por Plin
-        if 'plin' in t:
-            if p.get('plin_number') or p.get('plin_holder'):
-                line = f"🔵 Plin: {p.get('plin_number') or ''}"
-                if p.get('plin_holder'):
-                    line += f" — Titular: {p.get('plin_holder')}"
-                if p.get('plin_qr'):
-                    line += f" — QR: {p.get('plin_qr')}"
-                return line.strip()
-            return 'Por el momento no contamos con Plin.'
-        # Tarjeta
-        if 'tarjeta' in t:
-            if p.get('card_brands') or p.get('card_provider') or p.get('card_paylink'):
-                item = f"💳 Tarjeta: {p.get('card_brands') or ''}"
-                if p.get('card_provider'):
-                    item += f" — Proveedor: {p.get('card_provider')}"
-                if p.get('card_paylink'):
-                    item += f" — Link de pago: {p.get('card_paylink')}"
-                return item.strip()
-            return 'Por el momento no contamos con pago con tarjeta.'
-        # Transferencia
-        if 'transfer' in t or 'transferencia' in t:
-            if p.get('transfer_accounts') or p.get('transfer_instructions'):
-                msg = []
-                if p.get('transfer_accounts'):
-                    msg.append('🏦 Cuentas: ' + p.get('transfer_accounts'))
-                if p.get('transfer_instructions'):
-                    msg.append('Instrucciones: ' + p.get('transfer_instructions'))
-                return ' | '.join(msg)
-            return 'Por el momento no contamos con información de transferencia.'
-        # Contraentrega
-        if 'contra' in t or 'entrega' in t:
-            if p.get('cash_on_delivery_yes'):
-                return f"🚚 Contraentrega: {p.get('cash_on_delivery_yes')}"
-            return 'Por el momento no contamos con contraentrega.'
-        # Resumen pagos
-        parts = []
-        if p.get('yape_number') or p.get('yape_holder'):
-            parts.append('🟣 Yape')
-        if p.get('plin_number') or p.get('plin_holder'):
-            parts.append('🔵 Plin')
-        if p.get('card_brands') or p.get('card_provider'):
-            parts.append('💳 Tarjeta')
-        if p.get('transfer_accounts'):
-            parts.append('🏦 Transferencia bancaria')
-        if p.get('cash_on_delivery_yes'):
-            parts.append('🚚 Contraentrega')
-        if parts:
-            return 'Aceptamos: ' + ', '.join(parts) + '. ¿Cuál prefieres?'
-        return 'Por el momento no contamos con métodos de pago publicados.'
-
-    # Envíos / cobertura / tiempos
-    if any(kw in t for kw in ['envio', 'envío', 'envios', 'delivery', 'reparto', 'cobertura', 'distritos']):
-        msgs = []
-        if p.get('districts_costs'):
-            msgs.append('Distritos y costos:\n' + p.get('districts_costs'))
-        if p.get('typical_delivery_time'):
-            msgs.append(f"Tiempo típico: {p.get('typical_delivery_time')}")
-        if p.get('free_shipping_from'):
-            msgs.append(f"Envío gratis desde: {p.get('free_shipping_from')}")
-        if p.get('delivery_partners'):
-            msgs.append(f"Socios: {p.get('delivery_partners')}")
-        if msgs:
-            return ' | '.join(msgs)
-        return 'Por el momento no contamos con información de envíos.'
-
-    # Mayorista
-    if any(kw in t for kw in ['mayorista', 'mayoreo', 'al por mayor', 'lista mayorista', 'precio mayorista']):
-        parts = []
-        if p.get('wholesale_price_list_url'):
-            parts.append(f"Lista mayorista: {p.get('wholesale_price_list_url')}")
-        if p.get('wholesale_min_qty'):
-            parts.append(f"Mínimo: {p.get('wholesale_min_qty')}")
-        if p.get('wholesale_requires_ruc'):
-            parts.append(f"Requiere RUC: {p.get('wholesale_requires_ruc')}")
-        if parts:
-            return ' | '.join(parts)
-        return 'Por el momento no contamos con información mayorista.'
-
-    # RUC / Razón social / Nombre comercial
-    if any(kw in t for kw in ['ruc', 'razon social', 'razón social', 'nombre comercial']):
-        parts = []
-        if p.get('legal_name'):
-            parts.append(f"Razón social: {p.get('legal_name')}")
-        if p.get('trade_name'):
-            parts.append(f"Nombre comercial: {p.get('trade_name')}")
-        if p.get('ruc'):
-            parts.append(f"RUC: {p.get('ruc')}")
-        if parts:
-            return ' | '.join(parts)
-        return 'Por el momento no contamos con datos de RUC.'
-
-    # Boleta / factura
-    if any(kw in t for kw in ['boleta', 'factura', 'comprobante']):
-        parts = []
-        if p.get('boleta_yes'):
-            parts.append(f"Boleta: {p.get('boleta_yes')}")
-        if p.get('factura_yes'):
-            parts.append(f"Factura: {p.get('factura_yes')}")
-        if parts:
-            return ' | '.join(parts)
-        return 'Por el momento no contamos con información de comprobantes.'
-
-    # (la despedida ya fue evaluada arriba)
-
-    return None
+    try:
+        confidence = max(0.0, min(1.0, float(data.get('confidence') or 0)))
+    except (TypeError, ValueError):
+        confidence = 0.0
+    if confidence < min_confidence:
+        return Classification(confidence=confidence)
+    by_id = {str(t): str(t) for t in trigger_ids}
+    by_label = {str(l).lower(): l for l in labels}
+    trigger = data.get('trigger')
+    intent = data.get('intent')
+    return Classification(
+        trigger=by_id.get(str(trigger).strip()) if trigger not in (None, '') else None,
+        intent=by_label.get(str(intent).strip().lower()) if intent not in (None, '') else None,
+        confidence=confidence,
+    )
 
 
-def ai_select_trigger(user_text: str, candidates: list[dict]) -> str | None:
-    """Devuelve el id de trigger a activar entre candidates=[{id, patterns}], o None.
-    Utiliza OpenRouter para clasificación simple por similitud semántica.
-    """
-    if not candidates:
+def ai_classify(user_text: str, candidates: list[dict] | None = None, labels: list[str] | None = None,
+                language: str = 'español', timeout: float = 8) -> Classification | None:
+    """Una sola llamada de IA que elige el trigger (candidates=[{id, patterns}]) y la etiqueta de
+    intención (`labels`) del texto del usuario. Responde JSON validado; None si la IA falló."""
+    candidates = [c for c in (candidates or []) if c.get('id')]
+    labels = [str(x).strip() for x in (labels or []) if str(x).strip()]
+    if not candidates and not labels:
         return None
     sys = {
         'role': 'system',
         'content': (
-            'Eres un clasificador. Te doy un texto del usuario y una lista de triggers con ejemplos. '
-            'Elige el trigger más adecuado y responde sólo con el ID del trigger o NONE si ninguno aplica.'
+            f'Eres un clasificador en {language}. Recibes un texto del usuario, una lista de triggers con ejemplos '
+            'y una lista de etiquetas de intención. Responde ÚNICAMENTE con un objeto JSON: '
+            '{"trigger": "<id exacto o null>", "intent": "<etiqueta exacta o null>", "confidence": <0 a 1>}. '
+            'Usa null si ninguno aplica. No agregues texto fuera del JSON.'
         )
     }
-    user = {
-        'role': 'user',
-        'content': (
-            f"TEXTO: {user_text}\n" +
-            "TRIGGERS:\n" +
-            "\n".join([f"- id: {c.get('id')}\n  ejemplos: {c.get('patterns') or ''}" for c in candidates]) +
-            "\nResponde solo con el id exacto o NONE."
-        )
-    }
-    data = ai_chat([sys, user], temperature=0.0, max_tokens=8)
+    parts = [f"TEXTO: {user_text}"]
+    if candidates:
+        parts.append("TRIGGERS:\n" + "\n".join(f"- id: {c.get('id')}\n  ejemplos: {c.get('patterns') or ''}" for c in candidates))
+    if labels:
+        parts.append("ETIQUETAS: " + ", ".join(labels))
+    user = {'role': 'user', 'content': "\n".join(parts)}
+    data = ai_chat(
+        [sys, user], temperature=0.0, max_tokens=60, timeout=timeout, task='trigger',
+        response_format={'type': 'json_object'},
+    )
     if not data:
         return None
     try:
         text = (data.get('choices') or [{}])[0].get('message', {}).get('content', '')
-        text = (text or '').strip()
-        if not text:
-            return None
-        if text.upper().startswith('NONE'):
-            return None
-        # tomar primera palabra como id
-        return text.split()[0]
     except Exception:
         return None
+    return parse_classification(
+        text, [str(c.get('id')) for c in candidates], labels,
+        min_confidence=getattr(settings, 'AI_CLASSIFY_MIN_CONFIDENCE', 0.5),
+    )
 
 
-def ai_answer(
-    user_text: str,
-    brand: str | None = None,
-    persona: dict | None = None,
-    temperature: float = 0.4,
-    max_tokens: int = 220,
-) -> str | None:
-    """Devuelve una respuesta breve de IA para dudas generales, con persona/"cerebro" opcional.
+def ai_select_trigger(user_text: str, candidates: list[dict]) -> str | None:
+    """Devuelve el id de trigger a activar entre candidates=[{id, patterns}], o None (ver ai_classify)."""
+    result = ai_classify(user_text, candidates)
+    return result.trigger if result else None
 
-        persona: {
-            'name': str,
-            'about': str,          # presentación del asistente/empresa
-            'knowledge': str,      # base de conocimiento (FAQ, productos, políticas)
-            'style': str,          # tono deseado
-            'system': str,         # instrucciones adicionales
-            'language': str,       # ej. "español"
-            'website': str,        # URL oficial
-            'phone': str,          # teléfono de contacto
-            'email': str,          # correo de contacto
-            'order_required': str, # campos requeridos de pedido (una por línea)
-                    'out_of_scope': str,   # temas fuera de alcance (una por línea)
-                    'response_policies': str, # políticas de respuesta (una por línea)
-                    'comm_policies': str,     # políticas de comunicación (una por línea)
 
-                    # Perfil del negocio
-                    'trade_name': str,
-                    'legal_name': str,
-                    'ruc': str,
-                    'timezone': str,
-                    'address': str,
-                    'city': str,
-                    'region': str,
-                    'country': str,
-                    'maps_url': str,
-                    'ubigeo': str,
-                    'hours_mon_fri': str,
-                    'hours_sat': str,
-                    'hours_sun': str,
+class KnowledgeSection(str):
+    """Sección del prompt con datos del negocio (recuperable por relevancia, ver bots/knowledge.py).
+    El resto de reglas (identidad, tono, políticas) se envía siempre."""
 
-                    # Redes y enlaces
-                    'instagram': str,
-                    'facebook': str,
-                    'tiktok': str,
-                    'youtube': str,
-                    'x': str,
-                    'linktree': str,
-                    'whatsapp_link': str,
-                    'catalog_url': str,
 
-                    # Modalidad de venta
-                    'retail_yes': str,
-                    'wholesale_yes': str,
-                    'wholesale_min_qty': str,
-                    'wholesale_price_list_url': str,
-                    'wholesale_requires_ruc': str,
-                    'prep_time_large_orders': str,
-                    'volume_discounts': str,
+class CompiledPrompt:
+    """Prompt de sistema ya armado para una versión de persona, con su estimación de tokens."""
+    __slots__ = ('rules', 'text', 'token_estimate', 'head', 'tail', 'knowledge', 'knowledge_tokens')
 
-                    # Pagos
-                    'yape_number': str,
-                    'yape_holder': str,
-                    'yape_alias': str,
-                    'yape_qr': str,
-                    'plin_number': str,
-                    'plin_holder': str,
-                    'plin_qr': str,
-                    'card_brands': str,
-                    'card_provider': str,
-                    'card_paylink': str,
-                    'card_fee_notes': str,
-                    'transfer_accounts': str,
-                    'transfer_instructions': str,
-                    'cash_on_delivery_yes': str,
+    def __init__(self, rules: list[str]):
+        self.rules = tuple(rules)
+        self.text = "\n".join(rules)
+        self.token_estimate = estimate_tokens(self.text)
+        first_kb = next((i for i, r in enumerate(rules) if isinstance(r, KnowledgeSection)), len(rules))
+        self.head = tuple(rules[:first_kb])
+        self.tail = tuple(r for r in rules[first_kb:] if not isinstance(r, KnowledgeSection))
+        self.knowledge = tuple(str(r) for r in rules if isinstance(r, KnowledgeSection))
+        self.knowledge_tokens = estimate_tokens("\n".join(self.knowledge))
 
-                    # Envíos y cobertura
-                    'districts_costs': str,
-                    'typical_delivery_time': str,
-                    'free_shipping_from': str,
-                    'pickup_address': str,
-                    'delivery_partners': str,
+    def render(self, knowledge: list[str]) -> str:
+        """Prompt con sólo los fragmentos de conocimiento indicados en lugar de todas las secciones."""
+        return "\n".join([*self.head, *knowledge, *self.tail])
 
-                    # Políticas y comprobantes
-                    'returns_policy': str,
-                    'warranty': str,
-                    'terms_url': str,
-                    'privacy_url': str,
-                    'boleta_yes': str,
-                    'factura_yes': str,
-        }
+
+def estimate_tokens(text: str) -> int:
+    """Estimación barata de tokens (~4 caracteres por token en español)."""
+    return (len(text or '') + 3) // 4
+
+
+_PROMPT_CACHE_MAX = 256
+_prompt_cache: OrderedDict = OrderedDict()
+_prompt_cache_lock = threading.Lock()
+
+
+def compiled_system_prompt(persona: dict | None, brand: str | None = None, version: str | None = None) -> CompiledPrompt:
+    """Devuelve el prompt de sistema memoizado por versión de persona.
+
+    version: identificador estable de la persona (p.ej. id y updated_at del flujo). Si no se
+    indica, la clave es el propio contenido de la persona.
     """
     p = persona or {}
+    key = (version or _persona_key(p), brand)
+    with _prompt_cache_lock:
+        hit = _prompt_cache.get(key)
+        if hit is not None:
+            _prompt_cache.move_to_end(key)
+            return hit
+    compiled = CompiledPrompt(_build_prompt_rules(p, brand))
+    with _prompt_cache_lock:
+        _prompt_cache[key] = compiled
+        while len(_prompt_cache) > _PROMPT_CACHE_MAX:
+            _prompt_cache.popitem(last=False)
+    return compiled
+
+
+def clear_prompt_cache() -> None:
+    with _prompt_cache_lock:
+        _prompt_cache.clear()
+
+
+def _build_prompt_rules(p: dict, brand: str | None) -> list[str]:
+    """Arma las reglas/secciones del prompt de sistema desde la persona (trabajo pesado; ver compiled_system_prompt)."""
     name = (p.get('name') or '').strip() or 'Asistente'
     about = (p.get('about') or p.get('presentation') or '').strip()
     # Evitar propagar placeholders típicos del builder
@@ -550,15 +295,15 @@ def ai_answer(
     if about:
         rules.append(f"Presentación: {about}")
     if knowledge:
-        rules.append(f"Base de conocimiento:\n{knowledge}")
+        rules.append(KnowledgeSection(f"Base de conocimiento:\n{knowledge}"))
     if response_policies:
         rules.append("Políticas de respuesta:\n" + response_policies)
     if comm_policies:
         rules.append("Políticas de comunicación:\n" + comm_policies)
     if sales_playbook:
-        rules.append("Guía de ventas:\n" + sales_playbook)
+        rules.append(KnowledgeSection("Guía de ventas:\n" + sales_playbook))
     if recommendation_examples:
-        rules.append("Ejemplos de recomendación:\n" + recommendation_examples)
+        rules.append(KnowledgeSection("Ejemplos de recomendación:\n" + recommendation_examples))
     # Perfil, horarios y contacto
     prof = []
     if trade_name:
@@ -586,26 +331,26 @@ def ai_answer(
         if hours_sun:
             prof.append(f"Domingos/Feriados: {hours_sun}")
     if prof:
-        rules.append("Perfil/Horarios:\n" + "\n".join(prof))
+        rules.append(KnowledgeSection("Perfil/Horarios:\n" + "\n".join(prof)))
     # Redes y enlaces
     links = []
     for label, val in [('Instagram', instagram), ('Facebook', facebook), ('TikTok', tiktok), ('YouTube', youtube), ('X', x_twitter), ('LinkTree', linktree), ('WhatsApp', whatsapp_link), ('Tienda', catalog_url)]:
         if val:
             links.append(f"{label}: {val}")
     if links:
-        rules.append("Redes y enlaces:\n" + "\n".join(links))
+        rules.append(KnowledgeSection("Redes y enlaces:\n" + "\n".join(links)))
     # Catálogo estructurado
     if categories:
-        rules.append("Categorías:\n" + categories)
+        rules.append(KnowledgeSection("Categorías:\n" + categories))
     if featured_products:
-        rules.append("Destacados:\n" + featured_products)
+        rules.append(KnowledgeSection("Destacados:\n" + featured_products))
     if size_guide_url or size_notes:
         sg = []
         if size_guide_url:
             sg.append(f"Guía de tallas: {size_guide_url}")
         if size_notes:
             sg.append(f"Notas de talla: {size_notes}")
-        rules.append("Tallas:\n" + "\n".join(sg))
+        rules.append(KnowledgeSection("Tallas:\n" + "\n".join(sg)))
     # Venta y descuentos
     sale = []
     if retail_yes:
@@ -623,7 +368,7 @@ def ai_answer(
     if volume_discounts:
         sale.append("Descuentos por volumen:\n" + volume_discounts)
     if sale:
-        rules.append("Modalidad de venta:\n" + "\n".join(sale))
+        rules.append(KnowledgeSection("Modalidad de venta:\n" + "\n".join(sale)))
     # Pagos
     pay = []
     if yape_number or yape_holder:
@@ -652,7 +397,7 @@ def ai_answer(
     if cash_on_delivery_yes:
         pay.append(f"Contraentrega: {cash_on_delivery_yes}")
     if pay:
-        rules.append("Pagos:\n" + "\n".join(pay))
+        rules.append(KnowledgeSection("Pagos:\n" + "\n".join(pay)))
     # Envíos
     ship = []
     if districts_costs:
@@ -666,7 +411,7 @@ def ai_answer(
     if delivery_partners:
         ship.append(f"Socios delivery: {delivery_partners}")
     if ship:
-        rules.append("Envíos y cobertura:\n" + "\n".join(ship))
+        rules.append(KnowledgeSection("Envíos y cobertura:\n" + "\n".join(ship)))
     # Políticas y comprobantes
     pol = []
     if returns_policy:
@@ -682,7 +427,7 @@ def ai_answer(
     if privacy_url:
         pol.append("Privacidad: " + privacy_url)
     if pol:
-        rules.append("Políticas/comprobantes:\n" + "\n".join(pol))
+        rules.append(KnowledgeSection("Políticas/comprobantes:\n" + "\n".join(pol)))
     contact_lines = []
     if website:
         contact_lines.append(f"Web: {website}")
@@ -691,7 +436,7 @@ def ai_answer(
     if email:
         contact_lines.append(f"Email: {email}")
     if contact_lines:
-        rules.append("Datos de contacto: " + " | ".join(contact_lines))
+        rules.append(KnowledgeSection("Datos de contacto: " + " | ".join(contact_lines)))
     if cta_phrases:
         rules.append("Preferencia de cierre (CTA): " + cta_phrases)
     if order_required:
@@ -704,10 +449,120 @@ def ai_answer(
         )
     if sys_extra:
         rules.append(sys_extra)
+    return rules
+
+
+def ai_answer(
+    user_text: str,
+    brand: str | None = None,
+    persona: dict | None = None,
+    temperature: float = 0.4,
+    max_tokens: int = 220,
+    timeout: float = 20,
+    persona_version: str | None = None,
+    knowledge_index=None,
+    history: list[dict] | None = None,
+) -> str | None:
+    """Devuelve una respuesta breve de IA para dudas generales, con persona/"cerebro" opcional.
+
+        persona: {
+            'name': str,
+            'about': str,          # presentación del asistente/empresa
+            'knowledge': str,      # base de conocimiento (FAQ, productos, políticas)
+            'style': str,          # tono deseado
+            'system': str,         # instrucciones adicionales
+            'language': str,       # ej. "español"
+            'website': str,        # URL oficial
+            'phone': str,          # teléfono de contacto
+            'email': str,          # correo de contacto
+            'order_required': str, # campos requeridos de pedido (una por línea)
+                    'out_of_scope': str,   # temas fuera de alcance (una por línea)
+                    'response_policies': str, # políticas de respuesta (una por línea)
+                    'comm_policies': str,     # políticas de comunicación (una por línea)
+
+                    # Perfil del negocio
+                    'trade_name': str,
+                    'legal_name': str,
+                    'ruc': str,
+                    'timezone': str,
+                    'address': str,
+                    'city': str,
+                    'region': str,
+                    'country': str,
+                    'maps_url': str,
+                    'ubigeo': str,
+                    'hours_mon_fri': str,
+                    'hours_sat': str,
+                    'hours_sun': str,
+
+                    # Redes y enlaces
+                    'instagram': str,
+                    'facebook': str,
+                    'tiktok': str,
+                    'youtube': str,
+                    'x': str,
+                    'linktree': str,
+                    'whatsapp_link': str,
+                    'catalog_url': str,
+
+                    # Modalidad de venta
+                    'retail_yes': str,
+                    'wholesale_yes': str,
+                    'wholesale_min_qty': str,
+                    'wholesale_price_list_url': str,
+                    'wholesale_requires_ruc': str,
+                    'prep_time_large_orders': str,
+                    'volume_discounts': str,
 
-    sys = { 'role': 'system', 'content': "\n".join(rules) }
+                    # Pagos
+                    'yape_number': str,
+                    'yape_holder': str,
+                    'yape_alias': str,
+                    'yape_qr': str,
+                    'plin_number': str,
+                    'plin_holder': str,
+                    'plin_qr': str,
+                    'card_brands': str,
+                    'card_provider': str,
+                    'card_paylink': str,
+                    'card_fee_notes': str,
+                    'transfer_accounts': str,
+                    'transfer_instructions': str,
+                    'cash_on_delivery_yes': str,
+
+                    # Envíos y cobertura
+                    'districts_costs': str,
+                    'typical_delivery_time': str,
+                    'free_shipping_from': str,
+                    'pickup_address': str,
+                    'delivery_partners': str,
+
+                    # Políticas y comprobantes
+                    'returns_policy': str,
+                    'warranty': str,
+                    'terms_url': str,
+                    'privacy_url': str,
+                    'boleta_yes': str,
+                    'factura_yes': str,
+        }
+
+    persona_version: versión estable de la persona para reutilizar el prompt de sistema
+    compilado (ver compiled_system_prompt); por mensaje sólo se agrega el texto del usuario.
+    knowledge_index: índice BM25 del flujo (bots/knowledge.py); si se indica, sólo se envían
+    las secciones de conocimiento relevantes al mensaje dentro del presupuesto de tokens.
+    history: turnos previos de la conversación (bots/memory.context_messages) para que
+    preguntas como "¿y en talla M?" se entiendan con el mensaje anterior.
+    """
+    compiled = compiled_system_prompt(persona, brand=brand, version=persona_version)
+    system_text = compiled.text
+    if knowledge_index is not None:
+        from .knowledge import select_knowledge
+        # El último turno del cliente ayuda a recuperar el tema de preguntas de seguimiento
+        prev_user = next((m['content'] for m in reversed(history or []) if m.get('role') == 'user'), '')
+        system_text = select_knowledge(compiled, knowledge_index, f"{prev_user} {user_text}".strip())
+    sys = { 'role': 'system', 'content': system_text }
     user = { 'role': 'user', 'content': user_text }
-    data = ai_chat([sys, user], temperature=min(temperature, 0.5), max_tokens=max_tokens)
+    data = ai_chat([sys, *(history or []), user], temperature=min(temperature, 0.5), max_tokens=max_tokens, timeout=timeout, task='answer')
     if not data:
         return None
     try:
@@ -738,6 +593,20 @@ def _wa_url(phone_number_id: str) -> str:
     return f"https://graph.facebook.com/{settings.WA_GRAPH_VERSION}/{phone_number_id}/messages"
 
 
+def _remember_outbound(bot, to_number: str, text: str) -> None:
+    """Agrega el texto enviado a la memoria corta de la conversación (bots/memory.py)."""
+    from .memory import ASSISTANT, record_turn
+    record_turn(bot.id, to_number, ASSISTANT, text)
+
+
+def _wa_error(data) -> str:
+    """Error de la Graph API como 'código: mensaje' (el cuerpo completo ya queda en el payload)."""
+    err = data.get('error') if isinstance(data, dict) else None
+    if isinstance(err, dict):
+        return f"{err.get('code', '')}: {err.get('message', '')}".strip(': ')
+    return str(data)[:500]
+
+
 def send_whatsapp_text(bot, to_number: str, text: str) -> dict:
     url = _wa_url(bot.phone_number_id)
     headers = {
@@ -770,8 +639,10 @@ def send_whatsapp_text(bot, to_number: str, text: str) -> dict:
         message_type='text',
         payload={'request': payload, 'response': data},
         status=status,
-        error='' if resp.ok else str(data)
+        error='' if resp.ok else _wa_error(data)
     )
+    if resp.ok:
+        _remember_outbound(bot, to_number, text)
 
     resp.raise_for_status()
     return data
@@ -816,8 +687,10 @@ def send_whatsapp_interactive_buttons(bot, to_number: str, body_text: str, butto
         message_type='interactive',
         payload={'request': payload, 'response': data},
         status=status,
-        error='' if resp.ok else str(data)
+        error='' if resp.ok else _wa_error(data)
     )
+    if resp.ok:
+        _remember_outbound(bot, to_number, body_text)
     resp.raise_for_status()
     return data
 
@@ -848,7 +721,7 @@ def send_whatsapp_image(bot, to_number: str, link: str, caption: str | None = No
         message_type='image',
         payload={'request': payload, 'response': data},
         status=status,
-        error='' if resp.ok else str(data)
+        error='' if resp.ok else _wa_error(data)
     )
     resp.raise_for_status()
     return data
@@ -883,7 +756,7 @@ def send_whatsapp_document(bot, to_number: str, link: str, filename: str, captio
         message_type='document',
         payload={'request': payload, 'response': data},
         status=status,
-        error='' if resp.ok else str(data)
+        error='' if resp.ok else _wa_error(data)
     )
     resp.raise_for_status()
     return data
@@ -921,7 +794,7 @@ def send_whatsapp_document_id(bot, to_number: str, media_id: str, filename: str,
         message_type='document',
         payload={'request': payload, 'response': data},
         status=status,
-        error='' if resp.ok else str(data)
+        error='' if resp.ok else _wa_error(data)
     )
     resp.raise_for_status()
     return data
@@ -1,5 +1,31 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import importlib
+import json
+import tempfile
+import time
+from io import StringIO
+from unittest.mock import MagicMock, patch
 
+import httpx
+
+from django.apps import apps as django_apps
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import ai_client, ai_router, ai_usage, archive, db, debounce, expiry, intent, knowledge, memory, query_budget, services, unit_of_work
+from .ai_stub import StubConfig, StubServer
+from .cascade import AnswerCascade
+from .inbound import InboundMessage
+from .intent import NaiveBayesIntentClassifier
+from .models import AIKey, AIUsage, Bot, Conversation, Flow, IntentModel, KnowledgeIndex, MessageLog, WaUser
 from .services import answer_from_persona
 
 
@@ -51,3 +77,988 @@ class PersonaDeterministicTests(TestCase):
 		# Si hay redes, debe incluir alguna
 		self.assertTrue(('Instagram' in res) or ('Facebook' in res))
 
+	def test_keywords_match_whole_words_only(self):
+		# 'x' (red social) y 'hay'/'tienes' (compra genérica) no deben ganar a la intención real
+		self.assertIsNone(answer_from_persona('xd ok', self.persona))
+		self.assertIn('Culqi', answer_from_persona('tienes tarjeta?', self.persona))
+		self.assertIn('Miraflores', answer_from_persona('hay delivery a surco?', self.persona))
+		self.assertTrue(answer_from_persona('precio mayorista', self.persona).startswith('Por el momento no contamos'))
+
+	def test_several_intents_in_one_message(self):
+		res = answer_from_persona('¿Tienen yape y hacen envíos?', self.persona, version='v1')
+		self.assertIn('999888777', res)
+		self.assertIn('Tiempo típico', res)
+		# Los temas sin datos se omiten si otro sí tiene respuesta
+		res = answer_from_persona('horarios y boleta', self.persona)
+		self.assertEqual(res, 'Boleta: Sí | Factura: Sí')
+
+	def test_quick_action_button_uses_versioned_persona(self):
+		user = get_user_model().objects.create_user('quick', password='x')
+		bot = Bot.objects.create(owner=user, name='Sol', phone_number_id='1', access_token='t', verify_token='v')
+		flow = Flow.objects.create(bot=bot, name='Principal', definition={'ai': {'yape_number': '999888777', 'yape_holder': 'Sol SAC'}})
+		body = {'entry': [{'changes': [{'value': {'messages': [
+			{'from': '51999', 'type': 'interactive', 'interactive': {'button_reply': {'id': 'OPEN_PAYMENTS', 'title': 'Pagos'}}},
+		]}}]}]}
+		with patch('bots.services.send_whatsapp_text') as send, \
+				patch('bots.services.answer_from_persona', wraps=answer_from_persona) as answer:
+			self.client.post(reverse('bots:whatsapp_webhook', args=[str(bot.uuid)]), json.dumps(body), content_type='application/json')
+		self.assertEqual(answer.call_args.kwargs['version'], flow.version_key)
+		self.assertIn('Yape', send.call_args.args[2])
+
+
+
+class AnswerCascadeTests(TestCase):
+	def setUp(self):
+		self.persona = {
+			'name': 'Luna',
+			'trade_name': 'Tienda Sol',
+			'yape_number': '999888777',
+			'yape_holder': 'Sol SAC',
+		}
+
+	def test_confident_persona_skips_llm(self):
+		with patch('bots.cascade.ai_answer') as ai:
+			res = AnswerCascade(self.persona, brand='Tienda Sol').run('¿Tienen yape?')
+		ai.assert_not_called()
+		self.assertEqual(res.stage, 'persona')
+		self.assertIn('999888777', res.text)
+		self.assertEqual(res.trace[0]['outcome'], 'hit')
+
+	def test_missing_data_falls_through_to_llm(self):
+		with patch('bots.cascade.ai_answer', return_value='Te cuento del envío') as ai:
+			res = AnswerCascade(self.persona, brand='Tienda Sol').run('¿hacen envíos?')
+		ai.assert_called_once()
+		self.assertEqual(res.stage, 'answer')
+
+	def test_llm_skipped_when_budget_exhausted(self):
+		started = time.monotonic() - 60
+		classify = MagicMock()
+		with patch('bots.cascade.ai_answer') as ai:
+			res = AnswerCascade(self.persona, budget_s=5, started_at=started, classify_intent_label=classify).run('¿hacen envíos?')
+		ai.assert_not_called()
+		classify.assert_not_called()
+		self.assertEqual([t['outcome'] for t in res.trace], ['miss', 'skipped', 'skipped'])
+		# La respuesta determinista sin datos se usa antes del mensaje genérico
+		self.assertEqual(res.stage, 'persona_weak')
+
+	def test_intent_stage_answers_from_persona(self):
+		classify = MagicMock(return_value='yape')
+		with patch('bots.cascade.ai_answer', return_value=None):
+			res = AnswerCascade(self.persona, classify_intent_label=classify).run('cómo te deposito el dinero')
+		self.assertEqual(res.stage, 'intent')
+		self.assertIn('999888777', res.text)
+		self.assertEqual(classify.call_count, 1)
+
+	def test_intent_stage_reuses_combined_classification(self):
+		classify = MagicMock()
+		with patch('bots.cascade.ai_answer', return_value=None):
+			res = AnswerCascade(
+				self.persona, classify_intent_label=classify,
+				classification=services.Classification(intent='yape', confidence=0.9),
+			).run('cómo te deposito el dinero')
+		classify.assert_not_called()
+		self.assertIn('999888777', res.text)
+
+
+class CombinedClassifierTests(TestCase):
+	def test_parse_validates_against_allowed_values(self):
+		parse = services.parse_classification
+		res = parse('```json\n{"trigger": "n2", "intent": "Pagos", "confidence": 0.8}\n```', ['n1', 'n2'], ['pagos', 'envios'])
+		self.assertEqual((res.trigger, res.intent, res.confidence), ('n2', 'pagos', 0.8))
+		res = parse('{"trigger": "inventado", "intent": "otra", "confidence": 2}', ['n1'], ['pagos'])
+		self.assertEqual((res.trigger, res.intent, res.confidence), (None, None, 1.0))
+		res = parse('{"trigger": "n1", "intent": "pagos", "confidence": 0.2}', ['n1'], ['pagos'], min_confidence=0.5)
+		self.assertIsNone(res.trigger)
+		self.assertIsNone(parse('NONE', ['n1'], ['pagos']))
+
+	def test_single_call_returns_trigger_and_intent(self):
+		reply = {'choices': [{'message': {'content': '{"trigger": "menu", "intent": "precios", "confidence": 0.9}'}}]}
+		with patch('bots.services.ai_chat', return_value=reply) as chat:
+			res = services.ai_classify('quiero ver precios', [{'id': 'menu', 'patterns': 'ver catálogo'}], ['precios'])
+			self.assertEqual(services.ai_select_trigger('quiero ver precios', [{'id': 'menu', 'patterns': ''}]), 'menu')
+		self.assertEqual((res.trigger, res.intent), ('menu', 'precios'))
+		self.assertEqual(chat.call_count, 2)
+		self.assertEqual(chat.call_args.kwargs['response_format'], {'type': 'json_object'})
+
+
+def _inbound_payload(text):
+	return {'entry': [{'changes': [{'value': {'messages': [{'type': 'text', 'text': {'body': text}}]}}]}]}
+
+
+class LocalIntentClassifierTests(TestCase):
+	TRAIN = [
+		('¿dónde están ubicados?', 'ubicacion'), ('cuál es su dirección', 'ubicacion'), ('ubicación de la tienda', 'ubicacion'),
+		('tienen yape?', 'yape'), ('puedo yapear', 'yape'), ('número de yape por favor', 'yape'),
+		('hacen envíos a provincia', 'envios'), ('cuánto cuesta el envío', 'envios'), ('hacen delivery?', 'envios'),
+	]
+
+	def setUp(self):
+		intent.reset_cache()
+		owner = get_user_model().objects.create(username='owner')
+		self.bot = Bot.objects.create(owner=owner, name='Sol', phone_number_id='123', access_token='t', verify_token='v')
+
+	def test_fit_predict(self):
+		clf = NaiveBayesIntentClassifier().fit([t for t, _ in self.TRAIN], [lb for _, lb in self.TRAIN])
+		label, conf = clf.predict('hacen envios a lima?')
+		self.assertEqual(label, 'envios')
+		restored = NaiveBayesIntentClassifier.from_dict(clf.to_dict())
+		self.assertEqual(restored.predict('donde estan ubicados')[0], 'ubicacion')
+
+	def test_train_command_and_cascade_uses_local_model(self):
+		for text, label in self.TRAIN * 4:
+			MessageLog.objects.create(
+				bot=self.bot, direction=MessageLog.IN, message_type='text', payload=_inbound_payload(text), intent_label=label,
+			)
+		call_command('train_intent_model', bot=[self.bot.id], min_samples=10, stdout=StringIO())
+		model = IntentModel.objects.get(bot=self.bot)
+		self.assertEqual(model.version, 1)
+		self.assertEqual(model.samples, len(self.TRAIN) * 4)
+		llm = MagicMock(return_value=None)
+		persona = {'districts_costs': 'Miraflores S/10'}
+		with patch('bots.cascade.ai_answer', return_value=None):
+			res = AnswerCascade(persona, classify_intent_label=llm, bot_id=self.bot.id).run('me lo mandan a provincia?')
+		llm.assert_not_called()
+		self.assertEqual(res.stage, 'intent')
+		self.assertIn('Miraflores', res.text)
+
+	def test_llm_label_recorded_for_training(self):
+		log = MessageLog.objects.create(bot=self.bot, direction=MessageLog.IN, payload=_inbound_payload('precio del disfraz'))
+		llm = MagicMock(return_value='precios')
+		with patch('bots.cascade.ai_answer', return_value=None):
+			AnswerCascade({}, classify_intent_label=llm, bot_id=self.bot.id, inbound_log_id=log.id).run('cuánto vale el disfraz de bruja')
+		log.refresh_from_db()
+		self.assertEqual(log.intent_label, 'precios')
+
+
+class CompiledPromptTests(TestCase):
+	def setUp(self):
+		services.clear_prompt_cache()
+		self.persona = {'name': 'Luna', 'trade_name': 'Tienda Sol', 'knowledge': 'Vendemos disfraces.'}
+
+	def test_memoized_per_persona_version(self):
+		a = services.compiled_system_prompt(self.persona, 'Tienda Sol', version='flow:1:1')
+		b = services.compiled_system_prompt(dict(self.persona, knowledge='otro'), 'Tienda Sol', version='flow:1:1')
+		c = services.compiled_system_prompt(self.persona, 'Tienda Sol', version='flow:1:2')
+		self.assertIs(a, b)
+		self.assertIsNot(a, c)
+		self.assertIn('Te llamas Luna.', a.text)
+		self.assertGreater(a.token_estimate, 0)
+
+	def test_ai_answer_compiles_once(self):
+		reply = {'choices': [{'message': {'content': 'Hola'}}]}
+		with patch('bots.services.ai_chat', return_value=reply) as chat, \
+				patch('bots.services._build_prompt_rules', wraps=services._build_prompt_rules) as build:
+			services.ai_answer('hola', brand='Tienda Sol', persona=self.persona, persona_version='v1')
+			services.ai_answer('precio?', brand='Tienda Sol', persona=self.persona, persona_version='v1')
+		self.assertEqual(build.call_count, 1)
+		messages = chat.call_args.args[0]
+		self.assertEqual(messages[1], {'role': 'user', 'content': 'precio?'})
+
+
+def _big_knowledge() -> str:
+	lines = [f"El modelo {n} de disfraz de superhéroe viene en tallas S, M y L con capa incluida." for n in range(40)]
+	lines.append("Aceptamos pagos con Yape y Plin al número 999888777.")
+	lines.append("Los envíos a provincia salen por Shalom en 2 a 4 días hábiles.")
+	return "\n".join(lines)
+
+
+class KnowledgeRetrievalTests(TestCase):
+	def setUp(self):
+		services.clear_prompt_cache()
+		knowledge.reset_cache()
+		knowledge.retrieval_stats(reset=True)
+		self.persona = {'name': 'Luna', 'trade_name': 'Tienda Sol', 'knowledge': _big_knowledge()}
+
+	def test_selects_relevant_chunk_and_keeps_identity(self):
+		compiled = services.compiled_system_prompt(self.persona, version='v1')
+		index = knowledge.build_index(compiled)
+		self.assertGreater(len(index.chunks), 3)
+		text = knowledge.select_knowledge(compiled, index, 'aceptan yape?', budget=120)
+		self.assertIn('Yape', text)
+		self.assertIn('Te llamas Luna.', text)
+		self.assertLess(services.estimate_tokens(text), compiled.token_estimate)
+		self.assertGreater(knowledge.retrieval_stats()['saved_tokens'], 0)
+
+	def test_small_knowledge_is_sent_whole(self):
+		persona = dict(self.persona, knowledge='Vendemos disfraces.')
+		compiled = services.compiled_system_prompt(persona, version='v2')
+		text = knowledge.select_knowledge(compiled, knowledge.build_index(compiled), 'hola', budget=600)
+		self.assertEqual(text, compiled.text)
+
+	def test_flow_save_builds_index(self):
+		user = get_user_model().objects.create_user('owner', password='x')
+		bot = Bot.objects.create(owner=user, name='Sol', phone_number_id='1', access_token='t', verify_token='v')
+		flow = Flow.objects.create(bot=bot, name='Principal')
+		self.client.force_login(user)
+		content = json.dumps({'nodes': {}, 'ai': {'assistant_name': 'Luna', 'knowledge': _big_knowledge()}})
+		resp = self.client.post(reverse('bots:flow_save') + f'?key={flow.pk}', {'content': content})
+		self.assertEqual(resp.status_code, 200)
+		flow.refresh_from_db()
+		row = KnowledgeIndex.objects.get(flow=flow)
+		self.assertEqual(row.version, flow.version_key)
+		self.assertGreater(row.chunks, 1)
+		self.assertIsNotNone(knowledge.index_for_version(flow.version_key, {}))
+
+
+class ConversationMemoryTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		user = get_user_model().objects.create_user('mem', password='x')
+		self.bot = Bot.objects.create(owner=user, name='Sol', phone_number_id='1', access_token='t', verify_token='v')
+		WaUser.objects.create(bot=self.bot, wa_id='519')
+
+	def test_ring_buffer_folds_old_turns_into_summary(self):
+		with self.settings(AI_MEMORY_TURNS=3, AI_MEMORY_TOKENS=400):
+			for i in range(5):
+				memory.record_turn(self.bot.id, '519', memory.USER, f'pregunta {i}')
+		data = memory.load(self.bot.id, '519')
+		self.assertEqual([t for _, t in data['turns']], ['pregunta 2', 'pregunta 3', 'pregunta 4'])
+		self.assertIn('pregunta 1', data['summary'])
+		messages = memory.context_messages(self.bot.id, '519')
+		self.assertEqual(messages[0]['role'], 'system')
+		self.assertEqual(messages[-1], {'role': 'user', 'content': 'pregunta 4'})
+
+	def test_db_fallback_when_cache_is_empty(self):
+		memory.record_turn(self.bot.id, '519', memory.USER, 'tienen disfraz de pirata?')
+		memory.record_turn(self.bot.id, '519', memory.ASSISTANT, 'Sí, a S/ 50.')
+		cache.clear()
+		turns = memory.load(self.bot.id, '519')['turns']
+		self.assertEqual(turns, [['user', 'tienen disfraz de pirata?'], ['assistant', 'Sí, a S/ 50.']])
+
+	def test_ai_answer_receives_history(self):
+		memory.record_turn(self.bot.id, '519', memory.USER, 'tienen disfraz de pirata?')
+		reply = {'choices': [{'message': {'content': 'Sí'}}]}
+		with patch('bots.services.ai_chat', return_value=reply) as chat:
+			services.ai_answer('y en talla M?', persona={'name': 'Luna'}, history=memory.context_messages(self.bot.id, '519'))
+		messages = chat.call_args.args[0]
+		self.assertEqual(messages[1], {'role': 'user', 'content': 'tienen disfraz de pirata?'})
+		self.assertEqual(messages[-1]['content'], 'y en talla M?')
+
+
+def _completion(content: str) -> dict:
+	return {'choices': [{'message': {'role': 'assistant', 'content': content}}]}
+
+
+class AIClientTests(TestCase):
+	def setUp(self):
+		AIKey.objects.create(name='a', api_key='key-a', priority=1)
+		AIKey.objects.create(name='b', api_key='key-b', priority=2)
+
+	def _client(self, handler):
+		client = ai_client.AIClient(url='http://ai.test/v1/chat/completions', transport=httpx.MockTransport(handler))
+		self.addCleanup(client.close)
+		return client
+
+	def test_failover_to_next_key(self):
+		def handler(request):
+			if request.headers['Authorization'] == 'Bearer key-a':
+				return httpx.Response(429, json={'error': 'rate limited'})
+			return httpx.Response(200, json=_completion('hola'))
+		client = self._client(handler)
+		data = client.chat(ai_client.build_payload([{'role': 'user', 'content': 'hola'}]), timeout=5)
+		self.assertEqual(ai_client.message_text(data), 'hola')
+		self.assertEqual(AIKey.objects.get(api_key='key-a').failure_count, 1)
+		self.assertIsNotNone(AIKey.objects.get(api_key='key-b').last_used_at)
+		self.assertEqual(client.stats()['failovers'], 1)
+
+	def test_chat_many_runs_concurrently(self):
+		async def handler(request):
+			await asyncio.sleep(0.2)
+			return httpx.Response(200, json=_completion('ok'))
+		client = self._client(handler)
+		payload = ai_client.build_payload([{'role': 'user', 'content': 'x'}])
+		t0 = time.monotonic()
+		results = client.chat_many([payload, payload, payload], timeout=5)
+		self.assertLess(time.monotonic() - t0, 0.5)
+		self.assertEqual([ai_client.message_text(r) for r in results], ['ok', 'ok', 'ok'])
+
+	def test_async_entry_point(self):
+		client = self._client(lambda request: httpx.Response(200, json=_completion('async')))
+		payload = ai_client.build_payload([{'role': 'user', 'content': 'x'}])
+		# record_attempts corre en otro hilo (sync_to_async): fuera de la transacción del test
+		with patch('bots.ai_client.record_attempts') as record:
+			data = asyncio.run(client.achat(payload, timeout=5, keys=['key-a']))
+		record.assert_called_once()
+		self.assertEqual(ai_client.message_text(data), 'async')
+
+	def test_identical_concurrent_calls_are_coalesced(self):
+		calls = []
+
+		async def handler(request):
+			calls.append(1)
+			await asyncio.sleep(0.2)
+			return httpx.Response(200, json=_completion('info'))
+		client = self._client(handler)
+		payload = ai_client.build_payload([{'role': 'user', 'content': 'info'}], temperature=0.0)
+		other = ai_client.build_payload([{'role': 'user', 'content': 'precio'}], temperature=0.0)
+		results = client.chat_many([payload, dict(payload), other], timeout=5, keys=['key-a'])
+		self.assertEqual(len(calls), 2)
+		self.assertEqual(client.stats()['coalesced'], 1)
+		self.assertEqual(results[0], results[1])
+
+
+class OpenRouterStubTests(TestCase):
+	def _client(self, server, keys):
+		client = ai_client.AIClient(url=server.url, key_provider=lambda: keys, record_usage=False)
+		self.addCleanup(client.close)
+		return client
+
+	def test_canned_completion_by_prompt(self):
+		with StubServer(StubConfig(latency_ms=0, distribution='fixed')) as server:
+			client = self._client(server, ['k1'])
+			payload = ai_client.build_payload([
+				{'role': 'system', 'content': 'Eres un clasificador de intención.'},
+				{'role': 'user', 'content': 'cuanto cuesta'},
+			])
+			data = client.chat(payload, timeout=5)
+		self.assertEqual(ai_client.message_text(data), 'precios')
+		self.assertIn('usage', data)
+
+	def test_errors_exhaust_all_keys(self):
+		with StubServer(StubConfig(latency_ms=0, distribution='fixed', p401=1.0)) as server:
+			client = self._client(server, ['k1', 'k2', 'k3'])
+			data = client.chat(ai_client.build_payload([{'role': 'user', 'content': 'hola'}]), timeout=5)
+			self.assertEqual(server.config.counts['401'], 3)
+		self.assertIsNone(data)
+		self.assertEqual(client.stats()['failovers'], 2)
+
+
+class AIUsageTests(TestCase):
+	def setUp(self):
+		# Descartar lo que otros tests dejaron en el buffer
+		ai_usage.flush()
+		AIUsage.objects.all().delete()
+		user = get_user_model().objects.create_user('usage', password='x')
+		self.user = user
+		self.bot = Bot.objects.create(owner=user, name='Sol', phone_number_id='1', access_token='t', verify_token='v')
+		AIKey.objects.create(name='a', api_key='key-a')
+
+	def test_calls_are_aggregated_per_hour_bot_and_task(self):
+		def handler(request):
+			body = _completion('hola')
+			body['usage'] = {'prompt_tokens': 100, 'completion_tokens': 10, 'cost': 0.002}
+			return httpx.Response(200, json=body)
+		client = ai_client.AIClient(url='http://ai.test/v1/chat/completions', transport=httpx.MockTransport(handler), single_flight=False)
+		self.addCleanup(client.close)
+		payload = ai_client.build_payload([{'role': 'user', 'content': 'hola'}], model='m-small')
+		with self.settings(AI_USAGE_FLUSH_EVERY=1000), ai_usage.usage_scope(self.bot.id):
+			client.chat(payload, timeout=5, task='intent')
+			client.chat(payload, timeout=5, task='intent')
+			self.assertEqual(AIUsage.objects.count(), 0)
+		self.assertEqual(ai_usage.flush(), 1)
+		row = AIUsage.objects.get()
+		self.assertEqual((row.bot_id, row.task, row.model, row.calls), (self.bot.id, 'intent', 'm-small', 2))
+		self.assertEqual((row.prompt_tokens, row.completion_tokens), (200, 20))
+		self.assertEqual(float(row.cost_usd), 0.004)
+		self.assertEqual(row.key.api_key, 'key-a')
+
+	def test_report_p95_and_panel(self):
+		for ms in [80] * 18 + [900, 4000]:
+			ai_usage.record('answer', 'm', None, True, ms, usage={'prompt_tokens': 10}, bot_id=self.bot.id)
+		ai_usage.flush()
+		data = ai_usage.report(Bot.objects.filter(pk=self.bot.pk))
+		task = data['by_task'][0]
+		self.assertEqual((task['label'], task['calls']), ('answer', 20))
+		self.assertEqual(task['p95_ms'], 1000.0)
+		self.client.force_login(self.user)
+		resp = self.client.get(reverse('bots:panel_ai_usage'))
+		self.assertContains(resp, 'answer')
+
+
+class AIRouterTests(TestCase):
+	def setUp(self):
+		prev, self.router = ai_router.router, ai_router.ModelRouter()
+		ai_router.router = self.router
+		self.addCleanup(setattr, ai_router, 'router', prev)
+		self.seen = []
+
+		def handler(request):
+			model = json.loads(request.content)['model']
+			self.seen.append(model)
+			if model == 'broken':
+				return httpx.Response(503, json={})
+			return httpx.Response(200, json=_completion(model))
+		client = ai_client.AIClient(
+			url='http://ai.test/v1/chat/completions', transport=httpx.MockTransport(handler),
+			key_provider=lambda: ['k'], single_flight=False, record_usage=False,
+		)
+		ai_client.reset_client(client)
+		self.addCleanup(ai_client.reset_client, None)
+
+	def test_falls_back_to_next_model_and_demotes_slo_breach(self):
+		with self.settings(AI_TASK_MODELS={'intent': ['broken', 'fast']}):
+			data = ai_router.chat([{'role': 'user', 'content': 'hola'}], 'intent', timeout=5)
+			self.assertEqual(ai_client.message_text(data), 'fast')
+			self.assertEqual(self.seen, ['broken', 'fast'])
+			# 'broken' excede el SLO de latencia: el router lo deja al final
+			for _ in range(5):
+				self.router.observe('intent', 'broken', 5000, True)
+			self.assertEqual(self.router.order('intent', ['broken', 'fast']), ['fast', 'broken'])
+			self.assertTrue(self.router.snapshot()['intent']['broken']['breached'])
+
+	def test_bot_override_and_form(self):
+		user = get_user_model().objects.create_user('router', password='x')
+		bot = Bot.objects.create(owner=user, name='Sol', phone_number_id='1', access_token='t', verify_token='v')
+		self.client.force_login(user)
+		self.client.post(reverse('bots:bot_edit', args=[bot.pk]), {
+			'name': 'Sol', 'phone_number_id': '1', 'access_token': 't', 'verify_token': 'v', 'is_active': 'on',
+			'model_answer': 'grande, respaldo',
+		})
+		bot.refresh_from_db()
+		self.assertEqual(bot.ai_models, {'answer': ['grande', 'respaldo']})
+		with ai_usage.usage_scope(bot.id):
+			data = services.ai_chat([{'role': 'user', 'content': 'hola'}], task='answer', timeout=5)
+		self.assertEqual(ai_client.message_text(data), 'grande')
+		self.assertEqual(ai_router.models_for('intent', bot.id), ai_router.default_models('intent'))
+
+
+class InboundMessageTests(TestCase):
+	def test_parse_once_from_webhook(self):
+		body = {'entry': [{'changes': [{'value': {
+			'metadata': {'phone_number_id': '123'},
+			'contacts': [{'profile': {'name': 'Ana'}}],
+			'messages': [{'id': 'wamid.1', 'from': '51999', 'type': 'text', 'text': {'body': '  ¿Hacen ENVÍOS a Piñas? '}}],
+		}}]}]}
+		msg = InboundMessage.from_webhook(body)
+		self.assertEqual((msg.wamid, msg.wa_from, msg.type, msg.profile_name, msg.phone_number_id), ('wamid.1', '51999', 'text', 'Ana', '123'))
+		self.assertEqual(msg.text, '¿Hacen ENVÍOS a Piñas?')
+		self.assertEqual(msg.norm, '¿hacen envios a pinas?')
+		self.assertEqual(msg.tokens, ['hacen', 'envios', 'a', 'pinas'])
+		self.assertEqual(msg.with_text('hola\nyape').tokens, ['hola', 'yape'])
+		self.assertIsNone(InboundMessage.from_webhook({'entry': [{'changes': [{'value': {'statuses': []}}]}]}))
+
+	def test_buttons_carry_payload_and_title(self):
+		msg = InboundMessage.from_message({'type': 'interactive', 'interactive': {'list_reply': {'id': 'FLOW:n2', 'title': 'Pagos'}}})
+		self.assertEqual((msg.payload_id, msg.turn_text, msg.text, msg.tokens), ('FLOW:n2', 'Pagos', '', []))
+		self.assertEqual(InboundMessage.from_message({'type': 'image'}).display_text(), '[image]')
+
+
+class InboundDebounceTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		user = get_user_model().objects.create_user('burst', password='x')
+		self.bot = Bot.objects.create(owner=user, name='Sol', phone_number_id='1', access_token='t', verify_token='v')
+
+	def test_burst_is_answered_once_with_all_texts(self):
+		def another_message_arrives(_s):
+			# Mientras el primer request espera, llegan dos mensajes más
+			debounce.push(self.bot.id, '51999', 'quería saber', 1)
+			debounce.push(self.bot.id, '51999', 'precio del disfraz', 1)
+		self.assertIsNone(debounce.collect(self.bot.id, '51999', 'hola', window=1, sleep=another_message_arrives))
+		self.assertEqual(
+			debounce.collect(self.bot.id, '51999', 'talla M', window=1, sleep=lambda _s: None),
+			'hola\nquería saber\nprecio del disfraz\ntalla M',
+		)
+		# La ráfaga ya se consumió: el siguiente mensaje va solo
+		self.assertEqual(debounce.collect(self.bot.id, '51999', 'gracias', window=1, sleep=lambda _s: None), 'gracias')
+
+	def test_webhook_debounces_text_but_not_buttons(self):
+		url = reverse('bots:whatsapp_webhook', args=[str(self.bot.uuid)])
+		text = {'entry': [{'changes': [{'value': {'messages': [{'from': '51999', 'type': 'text', 'text': {'body': 'hola'}}]}}]}]}
+		button = {'entry': [{'changes': [{'value': {'messages': [{
+			'from': '51999', 'type': 'interactive', 'interactive': {'button_reply': {'id': 'MENU_PRINCIPAL', 'title': 'Menú'}},
+		}]}}]}]}
+		with self.settings(AI_DEBOUNCE_S=0.01), \
+				patch('bots.debounce.collect', return_value=None) as collect, \
+				patch('bots.services.send_whatsapp_text') as send:
+			self.client.post(url, json.dumps(text), content_type='application/json')
+			self.client.post(url, json.dumps(button), content_type='application/json')
+		collect.assert_called_once()
+		self.assertEqual(collect.call_args.args[1:], ('51999', 'hola'))
+		send.assert_not_called()
+
+
+class WaUserUnitOfWorkTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		user = get_user_model().objects.create_user('uow', password='x')
+		self.bot = Bot.objects.create(owner=user, name='Sol', phone_number_id='1', access_token='t', verify_token='v')
+		Flow.objects.create(bot=self.bot, name='Principal', definition={'enabled': True, 'nodes': {
+			'menu': {'type': 'action', 'text': 'Elige', 'buttons': [{'title': 'Asesora', 'next': 'asesora'}]},
+			'asesora': {'type': 'advisor', 'text': 'Te paso con una asesora', 'timeout_min': 10},
+		}})
+		self.url = reverse('bots:whatsapp_webhook', args=[str(self.bot.uuid)])
+
+	def _state_updates(self, payload_id=None, text=None):
+		message = {'from': '51999', 'type': 'interactive', 'interactive': {'button_reply': {'id': payload_id, 'title': 'x'}}}
+		if text is not None:
+			message = {'from': '51999', 'type': 'text', 'text': {'body': text}}
+		body = {'entry': [{'changes': [{'value': {
+			'contacts': [{'profile': {'name': 'Ana'}}],
+			'messages': [message],
+		}}]}]}
+		with CaptureQueriesContext(connection) as ctx, \
+				patch('bots.services.send_whatsapp_interactive_buttons'), patch('bots.services.send_whatsapp_text'):
+			self.client.post(self.url, json.dumps(body), content_type='application/json')
+		# memory (bots/memory.py) se escribe aparte; aquí sólo cuentan los campos de estado
+		return [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE "bots_wauser"') and '"memory"' not in q['sql']]
+
+	def test_one_state_update_per_message(self):
+		# Nodo de acción + nodo asesora: antes eran dos save() distintos
+		updates = self._state_updates('FLOW:asesora')
+		self.assertEqual(len(updates), 1)
+		u = WaUser.objects.get(bot=self.bot, wa_id='51999')
+		self.assertEqual((u.name, u.flow_node, u.human_requested, u.human_timeout_min), ('Ana', 'asesora', True, 10))
+		self.assertIsNotNone(u.human_expires_at)
+		self.assertIsNotNone(u.last_in_at)
+		# Sin flujo que avanzar igual se persiste la hora del mensaje, en un único UPDATE
+		self.assertEqual(len(self._state_updates('SIN_ACCION')), 1)
+
+	def test_one_state_update_on_ai_reply_written_before_the_ai_call(self):
+		seen = []
+
+		def answer(*args, **kwargs):
+			seen.append(WaUser.objects.values_list('name', 'last_in_at').get(bot=self.bot, wa_id='51999'))
+			return 'Claro, te cuento'
+		with patch('bots.cascade.ai_answer', side_effect=answer):
+			updates = self._state_updates(text='me cuentas una historia sobre tu tienda')
+		self.assertEqual(len(updates), 1)
+		self.assertEqual(len(seen), 1)
+		self.assertEqual(seen[0][0], 'Ana')
+		self.assertIsNotNone(seen[0][1])
+
+	def test_state_written_before_outbound_send(self):
+		seen = []
+
+		def post(*args, **kwargs):
+			seen.append(WaUser.objects.values_list('flow_node', 'human_requested').get(bot=self.bot, wa_id='51999'))
+			return query_budget._Response()
+		body = {'entry': [{'changes': [{'value': {
+			'messages': [{'from': '51999', 'type': 'interactive', 'interactive': {'button_reply': {'id': 'FLOW:asesora', 'title': 'x'}}}],
+		}}]}]}
+		with patch('bots.services.requests.post', side_effect=post):
+			self.client.post(self.url, json.dumps(body), content_type='application/json')
+		# Un botón siguiente procesado por otro worker ya ve el modo humano
+		self.assertEqual(seen, [('asesora', True)])
+
+	def test_nothing_written_when_view_fails(self):
+		u = WaUser.objects.create(bot=self.bot, wa_id='51999', name='Ana')
+		with self.assertRaises(RuntimeError), unit_of_work.unit_of_work():
+			unit_of_work.track(u)
+			u.flow_node = 'menu'
+			raise RuntimeError
+		u.refresh_from_db()
+		self.assertIsNone(u.flow_node)
+		with self.assertNumQueries(0), unit_of_work.unit_of_work():
+			unit_of_work.track(u)
+
+
+class ExpirySchedulerTests(TestCase):
+	def setUp(self):
+		user = get_user_model().objects.create_user('expiry', password='x')
+		self.bot = Bot.objects.create(owner=user, name='Sol', phone_number_id='1', access_token='t', verify_token='v')
+		Flow.objects.create(bot=self.bot, name='Principal', definition={'ai': {'instagram': 'https://instagram.com/sol'}})
+		self.now = timezone.now()
+		ago = lambda minutes: self.now - timezone.timedelta(minutes=minutes)
+		WaUser.objects.create(bot=self.bot, wa_id='h_due', human_requested=True, human_expires_at=ago(1))
+		WaUser.objects.create(bot=self.bot, wa_id='h_live', human_requested=True, human_expires_at=ago(-10))
+		WaUser.objects.create(bot=self.bot, wa_id='f_due', flow_node='menu', last_in_at=ago(6))
+		WaUser.objects.create(bot=self.bot, wa_id='f_live', flow_node='menu', last_in_at=ago(2))
+
+	def test_expires_due_timers_in_bulk_and_sends_close_message(self):
+		with patch('bots.services.send_whatsapp_text') as send:
+			call_command('run_expiry', '--once', stdout=StringIO())
+		state = dict(WaUser.objects.values_list('wa_id', 'human_requested'))
+		self.assertEqual((state['h_due'], state['h_live']), (False, True))
+		flows = dict(WaUser.objects.values_list('wa_id', 'flow_node'))
+		self.assertEqual((flows['f_due'], flows['f_live']), (None, 'menu'))
+		send.assert_called_once()
+		self.assertEqual(send.call_args.args[1], 'f_due')
+		self.assertIn('Instagram: https://instagram.com/sol', send.call_args.args[2])
+		# Segunda pasada: nada más por vencer ni mensajes repetidos
+		with patch('bots.services.send_whatsapp_text') as send:
+			self.assertEqual(expiry.run_once(), {'human': 0, 'flows': 0})
+		send.assert_not_called()
+
+	def test_next_due_is_the_earliest_timer(self):
+		# Lo vencido cuenta como próximo; luego f_live vence a los 5 min de su último mensaje (en 3 min), h_live en 10
+		self.assertLessEqual(expiry.next_due(), self.now)
+		with patch('bots.services.send_whatsapp_text'):
+			expiry.run_once()
+		due = expiry.next_due()
+		self.assertAlmostEqual((due - self.now).total_seconds(), 3 * 60, delta=1)
+		WaUser.objects.update(human_requested=False, flow_node=None)
+		self.assertIsNone(expiry.next_due())
+
+
+	def test_webhook_expires_timers_when_scheduler_is_not_running(self):
+		WaUser.objects.filter(wa_id='f_due').update(human_requested=True, human_expires_at=self.now - timezone.timedelta(minutes=1))
+		body = {'entry': [{'changes': [{'value': {'messages': [{'from': 'f_due', 'type': 'text', 'text': {'body': 'hola'}}]}}]}]}
+		with patch('bots.services.send_whatsapp_text') as send, patch('bots.cascade.ai_answer', return_value=None):
+			self.client.post(reverse('bots:whatsapp_webhook', args=[str(self.bot.uuid)]), json.dumps(body), content_type='application/json')
+		u = WaUser.objects.get(wa_id='f_due')
+		self.assertEqual((u.flow_node, u.human_requested, u.human_expires_at), (None, False, None))
+		self.assertIn('Cerramos este flujo por inactividad', send.call_args_list[0].args[2])
+
+class MessagePreviewTests(TestCase):
+	def setUp(self):
+		self.user = get_user_model().objects.create_user('preview', password='x')
+		self.bot = Bot.objects.create(owner=self.user, name='Sol', phone_number_id='1', access_token='t', verify_token='v')
+		WaUser.objects.create(bot=self.bot, wa_id='51999')
+
+	def _log_out(self, **kw):
+		return MessageLog.objects.create(bot=self.bot, direction=MessageLog.OUT, wa_from='1', wa_to='51999', message_type='interactive', payload={
+			'request': {'interactive': {'body': {'text': '¿Qué deseas?'}, 'action': {'buttons': [
+				{'reply': {'id': 'A', 'title': 'Pagos'}}, {'reply': {'id': 'B', 'title': 'Envíos'}},
+			]}}},
+			'response': {'messages': [{'id': 'wamid.out'}]},
+		}, **kw)
+
+	def test_preview_columns_filled_on_write(self):
+		out = self._log_out()
+		self.assertEqual((out.body_text, out.options, out.wamid), ('¿Qué deseas?', ['Pagos', 'Envíos'], 'wamid.out'))
+		inbound = MessageLog.objects.create(bot=self.bot, direction=MessageLog.IN, wa_from='51999', wa_to='1', message_type='text', payload={
+			'entry': [{'changes': [{'value': {'messages': [{'id': 'wamid.in', 'from': '51999', 'type': 'text', 'text': {'body': 'hola'}}]}}]}],
+		})
+		self.assertEqual((inbound.body_text, inbound.wamid), ('hola', 'wamid.in'))
+
+	def test_backfill_and_conversation_api_read_columns(self):
+		log = self._log_out()
+		MessageLog.objects.filter(pk=log.pk).update(body_text=None, options=None, wamid='')
+		self.client.force_login(self.user)
+		url = reverse('bots:api_get_conversation', args=['51999'])
+		# Filas sin completar: se calculan desde el payload al vuelo
+		self.assertEqual(self.client.get(url).json()['messages'][0]['options'], ['Pagos', 'Envíos'])
+		call_command('backfill_message_previews', '--batch-size', '1', stdout=StringIO())
+		log.refresh_from_db()
+		self.assertEqual((log.body_text, log.wamid), ('¿Qué deseas?', 'wamid.out'))
+		with self.assertNumQueries(5):  # sesión, usuario, WaUser con bot, conversación, mensajes (sin payload)
+			msgs = self.client.get(url).json()['messages']
+		self.assertEqual(msgs[0]['body'], '¿Qué deseas?')
+		outbox = self.client.get(reverse('bots:api_outbox')).json()
+		self.assertEqual(outbox['items'][0]['response'], {'messages': [{'id': 'wamid.out'}]})
+
+
+class KeysetPaginationTests(TestCase):
+	def setUp(self):
+		self.user = get_user_model().objects.create_user('keyset', password='x')
+		self.bot = Bot.objects.create(owner=self.user, name='Sol', phone_number_id='1', access_token='t', verify_token='v')
+		WaUser.objects.create(bot=self.bot, wa_id='51999')
+		self.client.force_login(self.user)
+		# Mismo created_at para todos: el id desempata sin saltar ni repetir filas
+		self.at = timezone.now()
+		for i in range(5):
+			self._log(f'm{i}')
+
+	def _log(self, text, direction=MessageLog.IN):
+		frm, to = ('51999', '1') if direction == MessageLog.IN else ('1', '51999')
+		log = MessageLog.objects.create(bot=self.bot, direction=direction, wa_from=frm, wa_to=to, message_type='text', payload={}, body_text=text)
+		MessageLog.objects.filter(pk=log.pk).update(created_at=self.at)
+		return log
+
+	def test_conversation_pages_backwards_and_polls_delta(self):
+		url = reverse('bots:api_get_conversation', args=['51999'])
+		first = self.client.get(url, {'limit': 2}).json()
+		self.assertEqual([m['body'] for m in first['messages']], ['m3', 'm4'])
+		self.assertTrue(first['has_more'])
+		older = self.client.get(url, {'limit': 2, 'before': first['cursors']['before']}).json()
+		self.assertEqual([m['body'] for m in older['messages']], ['m1', 'm2'])
+		oldest = self.client.get(url, {'limit': 2, 'before': older['cursors']['before']}).json()
+		self.assertEqual(([m['body'] for m in oldest['messages']], oldest['has_more']), (['m0'], False))
+		# Polling: nada nuevo conserva el cursor; luego sólo llega el delta
+		idle = self.client.get(url, {'since': first['cursors']['after']}).json()
+		self.assertEqual((idle['messages'], idle['cursors']['after']), ([], first['cursors']['after']))
+		self._log('m5')
+		self._log('m6', MessageLog.OUT)
+		delta = self.client.get(url, {'since': first['cursors']['after']}).json()
+		self.assertEqual([m['body'] for m in delta['messages']], ['m5', 'm6'])
+		self.assertEqual(self.client.get(url, {'since': 'no-es-cursor'}).status_code, 400)
+		# Fecha bien formada pero imposible: también 400, no 500
+		self.assertEqual(self.client.get(url, {'before': '2024-13-01T00:00'}).status_code, 400)
+
+	def test_outbox_and_list_cursors(self):
+		for i in range(3):
+			self._log(f'out{i}', MessageLog.OUT)
+		outbox = reverse('bots:api_outbox')
+		page = self.client.get(outbox, {'limit': 2}).json()
+		self.assertEqual([m['id'] for m in page['items']], sorted([m['id'] for m in page['items']], reverse=True))
+		rest = self.client.get(outbox, {'limit': 2, 'before': page['cursors']['before']}).json()
+		self.assertEqual((len(rest['items']), rest['has_more']), (1, False))
+		self.assertEqual(self.client.get(outbox, {'since': page['cursors']['after']}).json()['items'], [])
+		convs = reverse('bots:api_list_conversations')
+		listing = self.client.get(convs).json()
+		self.assertEqual(self.client.get(convs, {'since': listing['cursors']['after']}).json()['items'], [])
+		MessageLog.objects.create(bot=self.bot, direction=MessageLog.IN, wa_from='51999', wa_to='1', message_type='text', payload={}, body_text='nuevo')
+		self.assertEqual(
+			[c['last_snippet'] for c in self.client.get(convs, {'since': listing['cursors']['after']}).json()['items']],
+			['nuevo'],
+		)
+
+
+class ConversationAggregateTests(TestCase):
+	def setUp(self):
+		self.user = get_user_model().objects.create_user('conv', password='x')
+		self.bot = Bot.objects.create(owner=self.user, name='Sol', phone_number_id='1', access_token='t', verify_token='v')
+
+	def _log(self, direction, text, wa_id='51999'):
+		frm, to = (wa_id, '1') if direction == MessageLog.IN else ('1', wa_id)
+		return MessageLog.objects.create(
+			bot=self.bot, direction=direction, wa_from=frm, wa_to=to, message_type='text',
+			payload={}, body_text=text,
+		)
+
+	def test_counters_first_contact_and_unread(self):
+		first = self._log(MessageLog.IN, 'hola')
+		conv = Conversation.objects.get(bot=self.bot, wa_id='51999')
+		self.assertEqual(first.conversation_id, conv.pk)
+		self.assertIsNone(conv.first_out_at)
+		self._log(MessageLog.OUT, '¡Hola! ¿En qué te ayudo?')
+		self._log(MessageLog.IN, 'precio')
+		self._log(MessageLog.IN, 'otro cliente', wa_id='51888')
+		conv.refresh_from_db()
+		self.assertEqual((conv.in_count, conv.out_count, conv.unread_count, conv.last_snippet), (2, 1, 2, 'precio'))
+		self.assertIsNotNone(conv.first_out_at)
+		self.assertEqual(conv.messages.count(), 3)
+		WaUser.objects.create(bot=self.bot, wa_id='51999', name='Ana')
+		self.client.force_login(self.user)
+		self.client.get(reverse('bots:api_get_conversation', args=['51999']))
+		conv.refresh_from_db()
+		self.assertEqual(conv.unread_count, 0)
+
+	def test_rebuild_links_old_messages_and_list_uses_aggregate(self):
+		self._log(MessageLog.IN, 'hola', wa_id='51888')
+		self._log(MessageLog.OUT, 'bienvenido', wa_id='51888')
+		self._log(MessageLog.IN, 'hola', wa_id='51999')
+		# Datos anteriores a la tabla: sin agregado ni enlace
+		MessageLog.objects.update(conversation=None)
+		Conversation.objects.all().delete()
+		call_command('rebuild_conversations', stdout=StringIO())
+		conv = Conversation.objects.get(bot=self.bot, wa_id='51888')
+		self.assertEqual((conv.in_count, conv.out_count, conv.last_snippet, conv.messages.count()), (1, 1, 'bienvenido', 2))
+		WaUser.objects.create(bot=self.bot, wa_id='51888', name='Ana', human_requested=True)
+		WaUser.objects.create(bot=self.bot, wa_id='51999', name='Luis')
+		self.client.force_login(self.user)
+		url = reverse('bots:api_list_conversations')
+		self.assertEqual([i['wa_id'] for i in self.client.get(url).json()['items']], ['51999', '51888'])
+		live = self.client.get(url, {'live': '1'}).json()['items']
+		self.assertEqual([(i['wa_id'], i['name']) for i in live], [('51888', 'Ana')])
+
+	def test_migration_backfills_existing_history(self):
+		self._log(MessageLog.IN, 'hola')
+		out = self._log(MessageLog.OUT, 'bienvenido')
+		# Filas anteriores a body_text: el snippet sale del payload
+		MessageLog.objects.filter(pk=out.pk).update(payload={'request': {'text': {'body': 'bienvenido'}}})
+		MessageLog.objects.update(conversation=None, body_text=None)
+		migration = importlib.import_module('bots.migrations.0010_conversation')
+		for rebuild in (lambda: migration.backfill(django_apps, None), lambda: call_command('rebuild_conversations', stdout=StringIO())):
+			Conversation.objects.all().delete()
+			MessageLog.objects.update(conversation=None)
+			rebuild()
+			conv = Conversation.objects.get(bot=self.bot, wa_id='51999')
+			# El cliente que vuelve no es primer contacto y conserva su historial
+			self.assertIsNotNone(conv.first_out_at)
+			self.assertEqual((conv.messages.count(), conv.last_snippet), (2, 'bienvenido'))
+
+
+class QueryBudgetTests(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.fx = query_budget.build_fixtures()
+
+	def setUp(self):
+		cache.clear()
+		self.client.force_login(self.fx.owner)
+
+	def test_hot_endpoints_stay_within_budget(self):
+		for m in query_budget.run(self.client, self.fx):
+			with self.subTest(m.name):
+				self.assertEqual(m.status, 200)
+				query_budget.check(m, timing=False)
+
+	def test_timing_is_optional(self):
+		m = query_budget.Measurement('outbox', [{'sql': 'SELECT 1', 'params': (), 'ms': 500.0}], 200)
+		self.assertIs(query_budget.check(m, timing=False), m)
+		with self.assertRaises(query_budget.BudgetExceeded):
+			query_budget.check(m)
+
+	def test_report_shows_offending_queries(self):
+		def n_plus_one():
+			return [u.bot.name for u in WaUser.objects.all()[:3]]
+		m = query_budget.measure('conversation_list', n_plus_one)
+		with self.assertRaises(query_budget.BudgetExceeded) as cm:
+			query_budget.check(m, budget=(2, 1000))
+		self.assertIn('4 consultas (máx 2)', str(cm.exception))
+		self.assertIn('repetida x3: SELECT "bots_bot"', str(cm.exception))
+
+
+class MessageArchiveTests(TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tmp.cleanup)
+		self.user = get_user_model().objects.create_user('archive', password='x')
+		self.bot = Bot.objects.create(owner=self.user, name='Sol', phone_number_id='1', access_token='t', verify_token='v')
+		WaUser.objects.create(bot=self.bot, wa_id='51999')
+
+	def _log(self, text, days_ago, wa_id='51999'):
+		log = MessageLog.objects.create(
+			bot=self.bot, direction=MessageLog.IN, wa_from=wa_id, wa_to='1', message_type='text',
+			payload={'entry': []}, body_text=text,
+		)
+		MessageLog.objects.filter(pk=log.pk).update(created_at=timezone.now() - timezone.timedelta(days=days_ago))
+		return log
+
+	def test_archive_deletes_in_chunks_and_history_reads_back(self):
+		for i, days in enumerate([200, 150, 120, 100]):
+			self._log(f'viejo {i}', days)
+		self._log('de otro cliente', 130, wa_id='51888')
+		self._log('reciente', 1)
+		with self.settings(MESSAGE_ARCHIVE_DIR=self.tmp.name):
+			call_command('archive_messages', '--days', '90', '--chunk-size', '2', stdout=StringIO())
+			self.assertEqual(list(MessageLog.objects.values_list('body_text', flat=True)), ['reciente'])
+			self.assertTrue(archive.segments(self.bot.id))
+			self.assertEqual(
+				[r['body_text'] for r in archive.read_history(self.bot.id, '51999', limit=3)],
+				['viejo 1', 'viejo 2', 'viejo 3'],
+			)
+			# El panel sigue hacia atrás: primero la base, luego lo archivado
+			self.client.force_login(self.user)
+			url = reverse('bots:api_get_conversation', args=['51999'])
+			msgs = self.client.get(url, {'before': timezone.now().isoformat(), 'limit': 3}).json()['messages']
+		self.assertEqual([m['body'] for m in msgs], ['viejo 2', 'viejo 3', 'reciente'])
+		self.assertEqual([m.get('archived', False) for m in msgs], [True, True, False])
+
+	def test_history_reads_only_indexed_members(self):
+		for i in range(4):
+			self._log(f'ana {i}', 120)
+		self._log('luis', 120, wa_id='51888')
+		with self.settings(MESSAGE_ARCHIVE_DIR=self.tmp.name):
+			call_command('archive_messages', '--chunk-size', '1', stdout=StringIO())
+			with patch('gzip.decompress', wraps=gzip.decompress) as decompress:
+				rows = archive.read_history(self.bot.id, '51888')
+			self.assertEqual(([r['body_text'] for r in rows], decompress.call_count), (['luis'], 1))
+			self.assertEqual(archive.read_history(self.bot.id, '51777'), [])
+
+	def test_refuses_to_archive_without_directory(self):
+		self._log('viejo', 120)
+		with self.settings(MESSAGE_ARCHIVE_DIR=''):
+			with self.assertRaises(CommandError):
+				call_command('archive_messages', stdout=StringIO())
+			self.assertEqual(archive.read_history(self.bot.id, '51999'), [])
+		self.assertEqual(MessageLog.objects.count(), 1)
+
+
+class StreamingExportTests(TestCase):
+	def setUp(self):
+		self.user = get_user_model().objects.create_user('export', password='x')
+		self.bot = Bot.objects.create(owner=self.user, name='Sol', phone_number_id='1', access_token='t', verify_token='v')
+		other = get_user_model().objects.create_user('ajeno', password='x')
+		self.foreign = Bot.objects.create(owner=other, name='Otro', phone_number_id='2', access_token='t', verify_token='v')
+		WaUser.objects.create(bot=self.bot, wa_id='51999', name='Ana, "la clienta"')
+		WaUser.objects.create(bot=self.foreign, wa_id='51888', name='Ajena')
+		for i, (direction, days) in enumerate([(MessageLog.IN, 10), (MessageLog.OUT, 10), (MessageLog.IN, 1)]):
+			frm, to = ('51999', '1') if direction == MessageLog.IN else ('1', '51999')
+			log = MessageLog.objects.create(bot=self.bot, direction=direction, wa_from=frm, wa_to=to, message_type='text', payload={}, body_text=f'm{i}')
+			MessageLog.objects.filter(pk=log.pk).update(created_at=timezone.now() - timezone.timedelta(days=days))
+		self.client.force_login(self.user)
+
+	def _get(self, name, **params):
+		resp = self.client.get(reverse(f'bots:{name}'), params)
+		self.assertTrue(resp.streaming)
+		return b''.join(resp.streaming_content)
+
+	def test_contacts_csv_only_own_bots(self):
+		rows = list(csv.reader(self._get('api_export_contacts').decode().splitlines()))
+		self.assertEqual(rows[0][:3], ['bot_id', 'wa_id', 'name'])
+		self.assertEqual([r[1:3] for r in rows[1:]], [['51999', 'Ana, "la clienta"']])
+
+	def test_messages_ndjson_gzip_with_filters(self):
+		since = (timezone.now() - timezone.timedelta(days=5)).date().isoformat()
+		raw = self._get('api_export_messages', format='ndjson', gzip='1', direction='in')
+		rows = [json.loads(line) for line in gzip.decompress(raw).decode().splitlines()]
+		self.assertEqual([r['body_text'] for r in rows], ['m0', 'm2'])
+		recent = gzip.decompress(self._get('api_export_messages', format='ndjson', gzip='1', since=since)).decode().splitlines()
+		self.assertEqual([json.loads(line)['body_text'] for line in recent], ['m2'])
+		self.assertEqual(self.client.get(reverse('bots:api_export_messages'), {'format': 'xml'}).status_code, 400)
+
+	def test_impossible_dates_are_rejected(self):
+		for value in ('2024-02-30', '2024-13-01T00:00'):
+			with self.subTest(value):
+				self.assertEqual(self.client.get(reverse('bots:api_export_messages'), {'since': value}).status_code, 400)
+				with self.assertRaises(CommandError):
+					call_command('export_data', 'messages', '--until', value, stdout=StringIO(), stderr=StringIO())
+
+	def test_command_writes_file(self):
+		with tempfile.TemporaryDirectory() as tmp:
+			path = f'{tmp}/mensajes.csv.gz'
+			call_command('export_data', 'messages', '--bot', str(self.bot.pk), '--direction', 'out', '--gzip', '--chunk-size', '1', '-o', path, stderr=StringIO())
+			with gzip.open(path, 'rt', encoding='utf-8') as fh:
+				rows = list(csv.reader(fh))
+		self.assertEqual([r[rows[0].index('body_text')] for r in rows[1:]], ['m1'])
+
+
+class CompactPayloadTests(TestCase):
+	def setUp(self):
+		user = get_user_model().objects.create_user('compact', password='x')
+		self.bot = Bot.objects.create(owner=user, name='Sol', phone_number_id='1', access_token='t', verify_token='v')
+
+	def _stored_size(self, log):
+		with connection.cursor() as c:
+			c.execute('SELECT LENGTH(payload) FROM bots_messagelog WHERE id = %s', [log.pk])
+			return c.fetchone()[0]
+
+	def test_inbound_keeps_message_and_shrinks(self):
+		body = {'object': 'whatsapp_business_account', 'entry': [{'id': '1098', 'changes': [{'field': 'messages', 'value': {
+			'messaging_product': 'whatsapp',
+			'metadata': {'display_phone_number': '51 999 000 111', 'phone_number_id': '1'},
+			'contacts': [{'profile': {'name': 'Ana'}, 'wa_id': '51999'}],
+			'messages': [{'from': '51999', 'id': 'wamid.HBgLNTE5OTk5', 'timestamp': '1760000000', 'type': 'text', 'text': {'body': 'hola, ¿precio?'}}],
+		}}]}]}
+		log = MessageLog.objects.create(bot=self.bot, direction=MessageLog.IN, wa_from='51999', wa_to='1', message_type='text', payload=body)
+		log = MessageLog.objects.get(pk=log.pk)
+		msg = InboundMessage.from_webhook(log.payload)
+		self.assertEqual((msg.text, msg.profile_name, msg.phone_number_id, msg.wamid), ('hola, ¿precio?', 'Ana', '1', 'wamid.HBgLNTE5OTk5'))
+		self.assertLess(self._stored_size(log) * 2, len(json.dumps(body)))
+
+	def test_outbound_keeps_request_ids_and_short_error(self):
+		with patch('bots.services.requests.post') as post:
+			post.return_value = MagicMock(ok=False, json=lambda: {'error': {
+				'message': '(#131030) Recipient phone number not in allowed list', 'type': 'OAuthException',
+				'code': 131030, 'error_data': {'messaging_product': 'whatsapp', 'details': 'x' * 200}, 'fbtrace_id': 'Abc',
+			}})
+			post.return_value.raise_for_status.side_effect = RuntimeError
+			with self.assertRaises(RuntimeError):
+				services.send_whatsapp_text(self.bot, '51999', 'hola')
+		log = MessageLog.objects.get()
+		self.assertEqual(log.error, '131030: (#131030) Recipient phone number not in allowed list')
+		self.assertEqual(log.payload['request'], {'type': 'text', 'text': {'preview_url': False, 'body': 'hola'}})
+		self.assertEqual(log.payload['response'], {'error': {'code': 131030, 'message': '(#131030) Recipient phone number not in allowed list'}})
+		self.assertEqual(log.body_text, 'hola')
+
+
+class DatabaseRoutingTests(TestCase):
+	def test_read_replica_only_inside_decorated_views(self):
+		router = db.ReplicaRouter()
+		seen = {}
+
+		@db.read_replica
+		def view():
+			seen['read'] = router.db_for_read(Bot)
+			seen['write'] = router.db_for_write(Bot)
+
+		with patch('bots.db.replica_configured', return_value=True):
+			view()
+			self.assertEqual(seen, {'read': 'replica', 'write': 'default'})
+			self.assertIsNone(router.db_for_read(Bot))
+		# Sin réplica configurada, todo queda en 'default'
+		view()
+		self.assertIsNone(seen['read'])
+		self.assertFalse(router.allow_migrate('replica', 'bots'))
+
+	def test_health_reports_connection_metrics(self):
+		db.reset_stats()
+		self.client.get(reverse('bots:health'))
+		data = self.client.get(reverse('bots:health')).json()['db']
+		self.assertEqual(data['requests'], 2)
+		self.assertIn('default', data['conn_max_age'])
+
+
+class SQLiteProfileTests(TransactionTestCase):
+	# Los PRAGMA de durabilidad no se pueden cambiar dentro de la transacción de TestCase
+	def test_pragmas_applied_on_connection(self):
+		with self.settings(SQLITE_BUSY_TIMEOUT_MS=7000):
+			db.tune_sqlite(connection)
+		with connection.cursor() as c:
+			c.execute('PRAGMA busy_timeout')
+			self.assertEqual(c.fetchone()[0], 7000)
+			c.execute('PRAGMA synchronous')
+			self.assertEqual(c.fetchone()[0], 1)  # NORMAL
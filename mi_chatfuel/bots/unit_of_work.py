@@ -0,0 +1,113 @@
+"""Unidad de trabajo para el estado del WaUser durante un mensaje entrante.
+
+Procesar un mensaje toca varios campos del WaUser (nombre, last_*_at, flow_node,
+modo humano) en distintos puntos del webhook. En lugar de un save() por paso,
+track() toma una foto de esos campos al cargar el usuario y, al terminar la vista
+decorada con @scoped, se escriben sólo los que cambiaron en un único UPDATE.
+defer() hace lo mismo con escrituras sueltas (p.ej. la memoria de la conversación,
+que se actualiza con el turno entrante y con cada respuesta): sólo corre la última
+de cada clave.
+
+El flush corre en su propio transaction.atomic() (se une a la transacción del
+request si ATOMIC_REQUESTS está activo) y no envuelve todo el procesamiento: así
+las llamadas a WhatsApp y a la IA no retienen un lock de escritura. El webhook
+llama flush() antes de esas llamadas (lentas), una vez decidido el estado: el
+flow_node y el modo humano ya están en la base cuando otro worker procesa el botón
+siguiente del mismo cliente, y el flush final sólo escribe lo que cambie después.
+Si la vista lanza una excepción no se escribe lo pendiente.
+"""
+import contextlib
+import contextvars
+import functools
+
+from django.db import transaction
+
+
+# Campos de estado que el webhook modifica (memory se escribe aparte, ver bots/memory.py)
+WAUSER_FIELDS = (
+    'name', 'human_requested', 'human_timeout_min', 'human_expires_at',
+    'last_message_at', 'last_in_at', 'flow_node',
+)
+
+_pending: contextvars.ContextVar[list | None] = contextvars.ContextVar('unit_of_work_pending', default=None)
+_deferred: contextvars.ContextVar[dict | None] = contextvars.ContextVar('unit_of_work_deferred', default=None)
+
+
+class Tracked:
+    """Foto de `fields` de una instancia; dirty() compara contra los valores actuales."""
+    __slots__ = ('instance', 'fields', '_snapshot')
+
+    def __init__(self, instance, fields=WAUSER_FIELDS):
+        self.instance = instance
+        self.fields = tuple(fields)
+        self._snapshot = self._values()
+
+    def _values(self) -> dict:
+        return {f: getattr(self.instance, f) for f in self.fields}
+
+    def dirty(self) -> list[str]:
+        current = self._values()
+        return [f for f in self.fields if current[f] != self._snapshot[f]]
+
+    def flush(self) -> list[str]:
+        """Escribe los campos modificados (un UPDATE, o ninguno) y devuelve sus nombres."""
+        fields = self.dirty()
+        if fields:
+            with transaction.atomic():
+                self.instance.save(update_fields=fields)
+            self._snapshot = self._values()
+        return fields
+
+
+def track(instance, fields=WAUSER_FIELDS) -> Tracked:
+    """Registra la instancia en la unidad de trabajo actual (sin @scoped, flush() queda a cargo del llamador)."""
+    tracked = Tracked(instance, fields)
+    pending = _pending.get()
+    if pending is not None:
+        pending.append(tracked)
+    return tracked
+
+
+def defer(key, write) -> bool:
+    """Posterga `write()` hasta el final de la unidad de trabajo (reemplaza la anterior con la misma clave).
+    Devuelve False si no hay unidad de trabajo activa: el llamador debe escribir en el momento."""
+    deferred = _deferred.get()
+    if deferred is None:
+        return False
+    deferred[key] = write
+    return True
+
+
+def flush() -> list[str]:
+    """Escribe ya los cambios pendientes de la unidad de trabajo actual (no hace nada fuera de ella)."""
+    fields: list[str] = []
+    for tracked in _pending.get() or ():
+        fields += tracked.flush()
+    return fields
+
+
+@contextlib.contextmanager
+def unit_of_work():
+    """Bloque cuyas instancias registradas con track() se escriben una vez al salir sin errores."""
+    pending: list[Tracked] = []
+    deferred: dict = {}
+    token = _pending.set(pending)
+    deferred_token = _deferred.set(deferred)
+    try:
+        yield pending
+        for tracked in pending:
+            tracked.flush()
+        for write in deferred.values():
+            write()
+    finally:
+        _pending.reset(token)
+        _deferred.reset(deferred_token)
+
+
+def scoped(view):
+    """Decorador de vistas: cada request es una unidad de trabajo (ver unit_of_work)."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with unit_of_work():
+            return view(*args, **kwargs)
+    return wrapper
@@ -24,11 +24,14 @@ urlpatterns = [
     path('send_message', views.send_message_preview, name='send_message_preview'),
     # Live chat en panel
     path('panel/live-chat/', views.panel_live_chat, name='panel_live_chat'),
+    path('panel/ai-usage/', views.panel_ai_usage, name='panel_ai_usage'),
     path('panel/api/conversations/', views.api_list_conversations, name='api_list_conversations'),
     path('panel/api/conversations/<str:wa_id>/', views.api_get_conversation, name='api_get_conversation'),
     path('panel/api/send/', views.api_panel_send_message, name='api_panel_send_message'),
     path('panel/api/human/', views.api_panel_human_toggle, name='api_panel_human_toggle'),
     path('panel/api/outbox/', views.api_outbox, name='api_outbox'),
+    path('panel/api/export/contacts/', views.api_export_contacts, name='api_export_contacts'),
+    path('panel/api/export/messages/', views.api_export_messages, name='api_export_messages'),
     path('webhooks/whatsapp/<uuid:bot_uuid>/', views.whatsapp_webhook, name='whatsapp_webhook'),
     # Compat legado: algunos clientes llaman a /webhook (singular). Aceptar ambas variantes.
     path('webhook', views.whatsapp_webhook_legacy, name='webhook_legacy_no_slash'),
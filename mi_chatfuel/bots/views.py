@@ -15,6 +15,7 @@ from .views2 import (  # noqa: F401
     health,
     panel,
     panel_live_chat,
+    panel_ai_usage,
     api_list_conversations,
     api_get_conversation,
     api_panel_send_message,
@@ -33,6 +34,8 @@ from .views2 import (  # noqa: F401
     chat_preview,
     send_message_preview,
     api_outbox,
+    api_export_contacts,
+    api_export_messages,
 )
 
 
@@ -1,6 +1,8 @@
 import json
+import logging
 import os
 import mimetypes
+import time
 from pathlib import Path
 import difflib
 
@@ -9,19 +11,27 @@ from django.http import (
     HttpResponseForbidden,
     JsonResponse,
     HttpResponseRedirect,
+    StreamingHttpResponse,
 )
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse, NoReverseMatch
-from django.db.models import Q
+from django.db import router
+from django.db.models import Exists, OuterRef, Q
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone
 import requests
 from django.conf import settings
 import mimetypes as _mtypes
 
-from .models import Bot, MessageLog, Flow, WaUser
+from . import ai_router, ai_usage, archive, expiry, export, pagination, unit_of_work
+from .db import read_replica, stats as db_stats
+from .models import Bot, Conversation, MessageLog, Flow, WaUser, message_preview
 from .forms import BotForm, FlowForm
+from .inbound import InboundMessage, normalize, tokenize
+
+
+logger = logging.getLogger(__name__)
 
 
 def index(request):
@@ -43,7 +53,7 @@ def index(request):
 
 
 def health(request):
-    return JsonResponse({"ok": True})
+    return JsonResponse({"ok": True, "db": db_stats()})
 
 
 @login_required
@@ -76,6 +86,24 @@ def panel(request):
     })
 
 
+@login_required
+def panel_ai_usage(request):
+    """Reporte de uso de IA (costo, tokens y latencia p95) por bot y por tarea."""
+    try:
+        days = max(1, min(90, int(request.GET.get('days') or '7')))
+    except ValueError:
+        days = 7
+    ai_usage.flush()
+    data = ai_usage.report(Bot.objects.filter(owner=request.user), hours=24 * days)
+    return render(request, 'bots/ai_usage.html', {
+        'brand': 'OptiChat',
+        'days': days,
+        'since': data['since'],
+        'by_bot': data['by_bot'],
+        'by_task': data['by_task'],
+    })
+
+
 @login_required
 def panel_live_chat(request):
     """Página de chat en vivo integrada en el panel."""
@@ -84,106 +112,136 @@ def panel_live_chat(request):
     })
 
 
+def _cursor_params(request):
+    """(before, after) desde ?before= y ?after= (alias ?since=); lanza pagination.InvalidCursor."""
+    before = request.GET.get('before')
+    after = request.GET.get('after') or request.GET.get('since')
+    return (
+        pagination.decode(before) if before else None,
+        pagination.decode(after) if after else None,
+    )
+
+
+def _page_info(oldest, newest, field: str, more: bool, request) -> dict:
+    """Cursores para pedir lo anterior (before) o sólo lo nuevo (after) y si quedan filas en esa dirección.
+    Con la página vacía se devuelven los cursores recibidos para que el polling no pierda su posición."""
+    return {
+        'cursors': {
+            'before': pagination.cursor_of(oldest, field) if oldest is not None else request.GET.get('before'),
+            'after': pagination.cursor_of(newest, field) if newest is not None else (request.GET.get('after') or request.GET.get('since')),
+        },
+        'has_more': more,
+    }
+
+
 @login_required
+@read_replica
 def api_list_conversations(request):
-    """Lista conversaciones recientes del usuario logueado (todas las de sus bots)."""
-    limit = int(request.GET.get('limit', '100'))
+    """Lista conversaciones recientes del usuario logueado (todas las de sus bots).
+    Paginación por cursor: ?before= para las anteriores, ?since= sólo las que tuvieron mensajes nuevos."""
+    limit = max(1, min(500, int(request.GET.get('limit', '100'))))
+    try:
+        before, after = _cursor_params(request)
+    except pagination.InvalidCursor:
+        return JsonResponse({'error': 'cursor inválido'}, status=400)
     live_param = request.GET.get('live')  # '1' -> solo abiertas, '0' -> solo cerradas, None -> todas
-    bots = list(Bot.objects.filter(owner=request.user, is_active=True))
-    bot_ids = [b.id for b in bots]
+    bots = {b.id: b for b in Bot.objects.filter(owner=request.user, is_active=True)}
     items = []
-    if bot_ids:
-        qs = WaUser.objects.filter(bot_id__in=bot_ids)
-        if live_param == '1':
-            qs = qs.filter(human_requested=True)
-        elif live_param == '0':
-            qs = qs.filter(human_requested=False)
-        qs = qs.order_by('-last_message_at')[:limit]
-        for u in qs:
+    if bots:
+        # Ordenado por el índice (bot, -last_message_at) del agregado; sólo conversaciones donde escribió el cliente
+        qs = Conversation.objects.filter(bot_id__in=list(bots), in_count__gt=0)
+        if live_param in ('1', '0'):
+            live = Exists(WaUser.objects.filter(bot_id=OuterRef('bot_id'), wa_id=OuterRef('wa_id'), human_requested=True))
+            qs = qs.filter(live) if live_param == '1' else qs.exclude(live)
+        convs, more = pagination.page(qs, 'last_message_at', limit, before=before, after=after, newest_first=True)
+        users = {
+            (u.bot_id, u.wa_id): u
+            for u in WaUser.objects.filter(bot_id__in=list(bots), wa_id__in={c.wa_id for c in convs}).only('bot_id', 'wa_id', 'name', 'human_requested')
+        }
+        for c in convs:
+            u = users.get((c.bot_id, c.wa_id))
             items.append({
-                'wa_id': u.wa_id,
-                'name': u.name,
-                'human_requested': u.human_requested,
-                'bot_id': u.bot_id,
-                'bot_name': u.bot.name,
-                'last_message_at': u.last_message_at.isoformat() if u.last_message_at else None,
+                'wa_id': c.wa_id,
+                'name': u.name if u else '',
+                'human_requested': u.human_requested if u else False,
+                'bot_id': c.bot_id,
+                'bot_name': bots[c.bot_id].name,
+                'last_message_at': c.last_message_at.isoformat(),
+                'last_snippet': c.last_snippet,
+                'unread': c.unread_count,
             })
-    return JsonResponse({'items': items})
+        return JsonResponse({'items': items, **_page_info(convs[-1] if convs else None, convs[0] if convs else None, 'last_message_at', more, request)})
+    return JsonResponse({'items': items, **_page_info(None, None, 'last_message_at', False, request)})
 
 
 @login_required
+@read_replica
 def api_get_conversation(request, wa_id: str):
-    """Devuelve mensajes de una conversación en orden ascendente."""
-    u = WaUser.objects.filter(wa_id=wa_id, bot__owner=request.user).first()
+    """Devuelve los últimos mensajes de una conversación en orden ascendente.
+    ?before=<cursor|ISO>: página anterior (scroll hacia atrás), completada con el archivo si hace falta.
+    ?since=<cursor>: sólo los mensajes posteriores al último que tiene el cliente (polling)."""
+    u = WaUser.objects.filter(wa_id=wa_id, bot__owner=request.user).select_related('bot').first()
     if not u:
         return JsonResponse({'error': 'No encontrado'}, status=404)
-    limit = int(request.GET.get('limit', '200'))
-    # Solo la conversación entre este wa_id y el número del bot seleccionado,
-    # evitando mezclar mensajes de otros clientes que comparten el mismo phone_number_id.
-    msgs = MessageLog.objects.filter(
-        bot=u.bot
-    ).filter(
-        (
-            Q(wa_from=wa_id) & Q(wa_to=u.bot.phone_number_id)
-        ) | (
-            Q(wa_from=u.bot.phone_number_id) & Q(wa_to=wa_id)
+    limit = max(1, min(500, int(request.GET.get('limit', '200'))))
+    try:
+        before, after = _cursor_params(request)
+    except pagination.InvalidCursor:
+        return JsonResponse({'error': 'cursor inválido'}, status=400)
+    conv = Conversation.objects.filter(bot=u.bot, wa_id=wa_id).only('pk', 'unread_count').first()
+    if conv is not None:
+        msgs = MessageLog.objects.filter(conversation=conv)
+        if conv.unread_count:
+            Conversation.mark_read(u.bot_id, wa_id)
+    else:
+        # Conversación sin agregado (datos anteriores a rebuild_conversations): solo los mensajes entre
+        # este wa_id y el número del bot, sin mezclar otros clientes del mismo phone_number_id.
+        msgs = MessageLog.objects.filter(
+            bot=u.bot
+        ).filter(
+            (
+                Q(wa_from=wa_id) & Q(wa_to=u.bot.phone_number_id)
+            ) | (
+                Q(wa_from=u.bot.phone_number_id) & Q(wa_to=wa_id)
+            )
         )
-    ).order_by('created_at')[:limit]
-    out = []
-    for m in msgs:
-        body_text = None
-        options = None
-        p = m.payload or {}
-
-        if m.direction == MessageLog.OUT:
-            # Mensajes enviados por el bot (nuestro request a Meta)
-            if m.message_type == 'text':
-                body_text = (p.get('request') or {}).get('text', {}).get('body')
-            elif m.message_type == 'interactive':
-                ireq = (p.get('request') or {}).get('interactive') or {}
-                body_text = (ireq.get('body') or {}).get('text')
-                # Mostrar las etiquetas de los botones como opciones
-                btns = (((ireq.get('action') or {}).get('buttons')) or [])
-                options = [
-                    ((b.get('reply') or {}).get('title') or '').strip()
-                    for b in btns if (b.get('reply') or {}).get('title')
-                ] or None
-            elif m.message_type == 'image':
-                body_text = '[imagen]'
-            elif m.message_type == 'document':
-                body_text = '[documento]'
-        else:
-            # Mensajes entrantes desde Meta (webhook crudo)
-            try:
-                entry = (p.get('entry') or [{}])[0]
-                value = (entry.get('changes') or [{}])[0].get('value') or {}
-                mm = (value.get('messages') or [{}])[0]
-                mtype = (mm.get('type') or m.message_type or '').lower()
-                if mtype == 'text':
-                    body_text = (mm.get('text') or {}).get('body')
-                elif mtype == 'interactive':
-                    inter = mm.get('interactive') or {}
-                    if 'button_reply' in inter:
-                        body_text = (inter.get('button_reply') or {}).get('title') or (inter.get('button_reply') or {}).get('id')
-                    elif 'list_reply' in inter:
-                        body_text = (inter.get('list_reply') or {}).get('title') or (inter.get('list_reply') or {}).get('id')
-                    else:
-                        body_text = '[interacción]'
-                elif mtype == 'button':
-                    body_text = (mm.get('button') or {}).get('text') or (mm.get('button') or {}).get('payload')
-                else:
-                    body_text = f'[{mtype or "mensaje"}]'
-            except Exception:
-                body_text = None
-
-        out.append({
-            'direction': m.direction,
-            'type': m.message_type,
-            'body': body_text,
-            'options': options,
-            'created_at': m.created_at.isoformat(),
-        })
-    return JsonResponse({'wa_id': wa_id, 'name': u.name, 'human_requested': u.human_requested, 'messages': out})
+    msgs = msgs.only('direction', 'message_type', 'body_text', 'options', 'created_at')
+    msgs, more = pagination.page(msgs, 'created_at', limit, before=before, after=after)
+    # Filas anteriores a las columnas de vista previa: extraer del payload en una sola consulta extra
+    pending = [m.pk for m in msgs if m.body_text is None]
+    if pending:
+        payloads = dict(MessageLog.objects.filter(pk__in=pending).values_list('pk', 'payload'))
+        for m in msgs:
+            if m.body_text is None:
+                m.body_text, m.options, _wamid = message_preview(m.direction, m.message_type, payloads.get(m.pk))
+    out = [{
+        'direction': m.direction,
+        'type': m.message_type,
+        'body': m.body_text,
+        'options': m.options,
+        'created_at': m.created_at.isoformat(),
+    } for m in msgs]
+    oldest = msgs[0] if msgs else None
+    if before is not None and not more:
+        # Una fila de más indica si el archivo tiene historia aún más antigua
+        need = limit - len(out)
+        rows = archive.read_history(u.bot_id, wa_id, before=msgs[0].created_at if msgs else before[0], limit=need + 1)
+        more = len(rows) > need
+        rows = rows[-need:] if need else []
+        if rows:
+            oldest = rows[0]
+        out = [{
+            'direction': r['direction'],
+            'type': r['message_type'],
+            'body': r['body_text'] if r['body_text'] is not None else message_preview(r['direction'], r['message_type'], r['payload'])[0],
+            'options': r['options'],
+            'created_at': r['created_at'].isoformat(),
+            'archived': True,
+        } for r in rows] + out
+    return JsonResponse({
+        'wa_id': wa_id, 'name': u.name, 'human_requested': u.human_requested, 'messages': out,
+        **_page_info(oldest, msgs[-1] if msgs else None, 'created_at', more, request),
+    })
 
 
 @login_required
@@ -201,6 +259,8 @@ def api_panel_send_message(request):
         return JsonResponse({'error': 'No encontrado'}, status=404)
     if not u.human_requested:
         return JsonResponse({'error': 'Chat humano no activo para este usuario'}, status=403)
+    # El operador está respondiendo: lo entrante ya está leído
+    Conversation.mark_read(u.bot_id, wa_id)
     from .services import send_whatsapp_text, send_whatsapp_image, send_whatsapp_document, send_whatsapp_document_id
 
     # Si viene archivo, primero subir a Cloudinary (recomendado) y luego enviar
@@ -286,37 +346,88 @@ def api_panel_send_message(request):
 
 
 @login_required
+@read_replica
 def api_outbox(request):
     """Devuelve últimos mensajes SALIENTES con su estado y respuesta de la API.
     Filtros opcionales:
       - wa: número de WhatsApp del cliente
       - limit: cantidad (por defecto 50)
       - only_errors=1: solo fallidos
+      - before / since: cursores de paginación (ver bots/pagination.py)
     """
-    limit = int(request.GET.get('limit') or '50')
+    limit = max(1, min(200, int(request.GET.get('limit') or '50')))
+    try:
+        before, after = _cursor_params(request)
+    except pagination.InvalidCursor:
+        return JsonResponse({'error': 'cursor inválido'}, status=400)
     wa = (request.GET.get('wa') or request.GET.get('wa_id') or '').strip()
     only_err = (request.GET.get('only_errors') or request.GET.get('errors')) in ('1','true','yes')
-    # Bots del usuario
-    bots = Bot.objects.filter(owner=request.user)
-    qs = MessageLog.objects.filter(bot__in=bots, direction=MessageLog.OUT).order_by('-created_at')
+    # Bots del usuario (join con el dueño, sin subconsulta)
+    qs = MessageLog.objects.filter(bot__owner_id=request.user.id, direction=MessageLog.OUT)
     if wa:
         qs = qs.filter(wa_to=wa)
     if only_err:
         qs = qs.exclude(status='sent')
-    qs = qs[:max(1, min(200, limit))]
+    qs = qs.values('id', 'created_at', 'wa_to', 'status', 'error', 'message_type', 'payload')
+    rows, more = pagination.page(qs, 'created_at', limit, before=before, after=after, newest_first=True)
     items = []
-    for m in qs:
-        resp = (m.payload or {}).get('response')
+    for m in rows:
         items.append({
-            'id': m.id,
-            'created_at': m.created_at.isoformat(),
-            'to': m.wa_to,
-            'status': m.status,
-            'error': m.error,
-            'response': resp,
-            'type': m.message_type,
+            'id': m['id'],
+            'created_at': m['created_at'].isoformat(),
+            'to': m['wa_to'],
+            'status': m['status'],
+            'error': m['error'],
+            'response': (m['payload'] or {}).get('response'),
+            'type': m['message_type'],
         })
-    return JsonResponse({'items': items})
+    return JsonResponse({'items': items, **_page_info(rows[-1] if rows else None, rows[0] if rows else None, 'created_at', more, request)})
+
+
+def _export_response(request, kind: str):
+    """Descarga en streaming (ver bots/export.py).
+    Filtros: bot (repetible), since / until (fecha ISO), direction=in|out (mensajes),
+    format=csv|ndjson, gzip=1."""
+    bot_ids = list(Bot.objects.filter(owner=request.user).values_list('pk', flat=True))
+    if request.GET.getlist('bot'):
+        try:
+            wanted = {int(b) for b in request.GET.getlist('bot')}
+        except ValueError:
+            return JsonResponse({'error': 'bot inválido'}, status=400)
+        bot_ids = [b for b in bot_ids if b in wanted]
+    fmt = (request.GET.get('format') or 'csv').lower()
+    compress = request.GET.get('gzip') in ('1', 'true', 'yes')
+    try:
+        qs = export.queryset(
+            kind, bot_ids,
+            since=export.parse_bound(request.GET.get('since')),
+            until=export.parse_bound(request.GET.get('until'), end=True),
+            direction=request.GET.get('direction') or None,
+        )
+        # El contenido se genera después de que la vista (y @read_replica) terminó: fijar la base ahora
+        qs = qs.using(router.db_for_read(qs.model))
+        body = export.stream(qs, export.FIELDS[kind], fmt, compress)
+    except export.ExportError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    resp = StreamingHttpResponse(body, content_type='application/gzip' if compress else export.CONTENT_TYPES[fmt])
+    resp['Content-Disposition'] = f'attachment; filename="{export.filename(kind, fmt, compress)}"'
+    return resp
+
+
+@login_required
+@read_replica
+def api_export_contacts(request):
+    """Exporta los contactos (WaUser) de los bots del usuario."""
+    return _export_response(request, export.CONTACTS)
+
+
+@login_required
+@read_replica
+def api_export_messages(request):
+    """Exporta el historial de mensajes de los bots del usuario."""
+    return _export_response(request, export.MESSAGES)
+
+
 @login_required
 def api_panel_human_toggle(request):
     """Activa/desactiva chat humano para un wa_id.
@@ -390,6 +501,7 @@ def bot_edit(request, pk):
         form = BotForm(request.POST, instance=bot)
         if form.is_valid():
             form.save()
+            ai_router.invalidate_bot(bot.pk)
             return HttpResponseRedirect(reverse('bots:panel'))
     else:
         form = BotForm(instance=bot)
@@ -509,7 +621,8 @@ def flow_builder(request, bot_pk, flow_pk):
                 if isinstance(legacy_data, dict) and legacy_data.get('nodes'):
                     flow_def = legacy_data
                     flow.definition = flow_def
-                    flow.save(update_fields=['definition'])
+                    flow.save(update_fields=['definition', 'updated_at'])
+                    _index_flow_knowledge(flow)
             except (OSError, json.JSONDecodeError):
                 pass
     ctx = {
@@ -545,10 +658,385 @@ def flow_save(request):
     except json.JSONDecodeError as e:
         return JsonResponse({'error': f'JSON inválido: {e}'}, status=400)
     flow.definition = data
-    flow.save(update_fields=['definition'])
+    # updated_at forma parte de la versión del flujo (cachés de persona/prompt/índice)
+    flow.save(update_fields=['definition', 'updated_at'])
+    _index_flow_knowledge(flow)
     return JsonResponse({'ok': True, 'id': flow.id})
 
 
+def _index_flow_knowledge(flow: Flow) -> None:
+    """Indexa (BM25) la base de conocimiento de la versión recién guardada del flujo."""
+    from . import knowledge
+    try:
+        knowledge.save_index(_persona_for_flow(flow.definition, flow.version_key), flow.version_key, flow=flow)
+    except Exception:
+        logger.exception('knowledge index build failed for flow %s', flow.pk)
+
+
+# Aplanar configuración de IA del builder (ai_config) a formato plano (ai)
+def _flatten_ai_cfg(cfg: dict) -> dict:
+    result = {}
+    try:
+        # Base plana si existe
+        base_ai = (cfg or {}).get('ai') or {}
+        if isinstance(base_ai, dict):
+            result.update(base_ai)
+        ai_conf = (cfg or {}).get('ai_config') or {}
+        if not isinstance(ai_conf, dict):
+            return result
+        prof = (ai_conf.get('assistant_profile') or {}) if isinstance(ai_conf.get('assistant_profile'), dict) else {}
+        biz = (ai_conf.get('business_profile') or {}) if isinstance(ai_conf.get('business_profile'), dict) else {}
+        # Ventas inteligentes (opcional)
+        if prof:
+            if prof.get('sales_playbook') and not result.get('sales_playbook'):
+                result['sales_playbook'] = prof.get('sales_playbook')
+            if isinstance(prof.get('cta_phrases'), list) and not result.get('cta_phrases'):
+                result['cta_phrases'] = ", ".join([str(x).strip() for x in prof.get('cta_phrases') if str(x).strip()])
+            if prof.get('emoji_level') and not result.get('emoji_level'):
+                result['emoji_level'] = prof.get('emoji_level')
+            if isinstance(prof.get('recommendation_examples'), list) and not result.get('recommendation_examples'):
+                result['recommendation_examples'] = "\n".join([str(x).strip() for x in prof.get('recommendation_examples') if str(x).strip()])
+        # Policies (listas) → líneas
+        not_supported = ai_conf.get('not_supported') or []
+        if isinstance(not_supported, list) and not result.get('out_of_scope'):
+            result['out_of_scope'] = "\n".join([str(x).strip() for x in not_supported if str(x).strip()])
+        policies = ai_conf.get('policies') or []
+        if isinstance(policies, list) and not result.get('response_policies'):
+            result['response_policies'] = "\n".join([str(x).strip() for x in policies if str(x).strip()])
+        # Assistant profile
+        if prof:
+            if prof.get('assistant_name') and not result.get('assistant_name'):
+                result['assistant_name'] = prof.get('assistant_name')
+            if prof.get('language') and not result.get('language'):
+                result['language'] = prof.get('language')
+            # Descripción/presentación del negocio/asistente
+            if prof.get('store_description') and not (result.get('about') or result.get('presentation')):
+                result['about'] = prof.get('store_description')
+                result['presentation'] = prof.get('store_description')
+            if (prof.get('website_url') or prof.get('website')) and not result.get('website'):
+                result['website'] = prof.get('website_url') or prof.get('website')
+            if (prof.get('phone_number') or prof.get('phone')) and not result.get('phone'):
+                result['phone'] = prof.get('phone_number') or prof.get('phone')
+            if prof.get('email') and not result.get('email'):
+                result['email'] = prof.get('email')
+            roi = prof.get('required_order_info') or []
+            if isinstance(roi, list) and not result.get('order_required'):
+                result['order_required'] = "\n".join([str(x).strip() for x in roi if str(x).strip()])
+        # Business profile
+        if biz:
+            if biz.get('business_name') and not result.get('trade_name'):
+                result['trade_name'] = biz.get('business_name')
+            if biz.get('legal_name') and not result.get('legal_name'):
+                result['legal_name'] = biz.get('legal_name')
+            if biz.get('ruc') and not result.get('ruc'):
+                result['ruc'] = biz.get('ruc')
+            hours = biz.get('hours') or {}
+            if isinstance(hours, dict):
+                if hours.get('timezone') and not result.get('timezone'):
+                    result['timezone'] = hours.get('timezone')
+                if hours.get('weekdays') and not result.get('hours_mon_fri'):
+                    result['hours_mon_fri'] = hours.get('weekdays')
+                if hours.get('saturday') and not result.get('hours_sat'):
+                    result['hours_sat'] = hours.get('saturday')
+                if hours.get('sunday') and not result.get('hours_sun'):
+                    result['hours_sun'] = hours.get('sunday')
+            addr = biz.get('address') or {}
+            if isinstance(addr, dict):
+                if addr.get('address_line') and not result.get('address'):
+                    result['address'] = addr.get('address_line')
+                if addr.get('city') and not result.get('city'):
+                    result['city'] = addr.get('city')
+                if addr.get('region') and not result.get('region'):
+                    result['region'] = addr.get('region')
+                if addr.get('country') and not result.get('country'):
+                    result['country'] = addr.get('country')
+                if addr.get('maps_url') and not result.get('maps_url'):
+                    result['maps_url'] = addr.get('maps_url')
+                if addr.get('ubigeo') and not result.get('ubigeo'):
+                    result['ubigeo'] = addr.get('ubigeo')
+            socials = biz.get('socials') or {}
+            if isinstance(socials, dict):
+                for k_src, k_dst in [
+                    ('instagram','instagram'), ('facebook','facebook'), ('tiktok','tiktok'), ('youtube','youtube'),
+                    ('x','x'), ('linktree','linktree'), ('whatsapp_link','whatsapp_link'), ('website','catalog_url')
+                ]:
+                    if socials.get(k_src) and not result.get(k_dst):
+                        result[k_dst] = socials.get(k_src)
+            # Catálogo estructurado y guías
+            if isinstance(biz.get('categories'), list) and not result.get('categories'):
+                result['categories'] = ", ".join([str(x).strip() for x in biz.get('categories') if str(x).strip()])
+            featured = biz.get('featured_products') or []
+            if isinstance(featured, list) and not result.get('featured_products'):
+                # Serializar como líneas "Nombre: URL"
+                lines = []
+                for fp in featured:
+                    if isinstance(fp, dict):
+                        nm = (fp.get('name') or '').strip()
+                        url = (fp.get('url') or '').strip()
+                        if nm or url:
+                            lines.append(f"{nm}: {url}".strip(': '))
+                if lines:
+                    result['featured_products'] = "\n".join(lines)
+            if biz.get('size_guide_url') and not result.get('size_guide_url'):
+                result['size_guide_url'] = biz.get('size_guide_url')
+            if biz.get('size_notes') and not result.get('size_notes'):
+                result['size_notes'] = biz.get('size_notes')
+            if biz.get('materials') and not result.get('materials'):
+                result['materials'] = biz.get('materials')
+            if biz.get('care_instructions') and not result.get('care_instructions'):
+                result['care_instructions'] = biz.get('care_instructions')
+            payments = biz.get('payments') or {}
+            if isinstance(payments, dict):
+                yp = payments.get('yape') or {}
+                if yp:
+                    if yp.get('phone') and not result.get('yape_number'):
+                        result['yape_number'] = yp.get('phone')
+                    if yp.get('holder') and not result.get('yape_holder'):
+                        result['yape_holder'] = yp.get('holder')
+                    if yp.get('alias') and not result.get('yape_alias'):
+                        result['yape_alias'] = yp.get('alias')
+                    if yp.get('qr_url') and not result.get('yape_qr'):
+                        result['yape_qr'] = yp.get('qr_url')
+                pl = payments.get('plin') or {}
+                if pl:
+                    if pl.get('phone') and not result.get('plin_number'):
+                        result['plin_number'] = pl.get('phone')
+                    if pl.get('holder') and not result.get('plin_holder'):
+                        result['plin_holder'] = pl.get('holder')
+                    if pl.get('qr_url') and not result.get('plin_qr'):
+                        result['plin_qr'] = pl.get('qr_url')
+                card = payments.get('card') or {}
+                if card:
+                    brands = card.get('brands')
+                    if brands and not result.get('card_brands'):
+                        result['card_brands'] = ", ".join(brands) if isinstance(brands, list) else str(brands)
+                    if card.get('provider') and not result.get('card_provider'):
+                        result['card_provider'] = card.get('provider')
+                    if card.get('link_url') and not result.get('card_paylink'):
+                        result['card_paylink'] = card.get('link_url')
+                    if (card.get('surcharge') or card.get('notes')) and not result.get('card_fee_notes'):
+                        result['card_fee_notes'] = card.get('surcharge') or card.get('notes')
+                tf = payments.get('transfer') or {}
+                if tf:
+                    banks = tf.get('banks') or []
+                    if isinstance(banks, list) and not result.get('transfer_accounts'):
+                        lines = []
+                        for bk in banks:
+                            if not isinstance(bk, dict):
+                                continue
+                            parts = [
+                                bk.get('bank') or '',
+                                bk.get('account_number') or '',
+                                bk.get('cci') or '',
+                                bk.get('holder') or '',
+                                bk.get('doc') or '',
+                            ]
+                            if any([p.strip() for p in parts]):
+                                lines.append('; '.join(parts).strip())
+                        if lines:
+                            result['transfer_accounts'] = "\n".join(lines)
+                    if tf.get('instructions') and not result.get('transfer_instructions'):
+                        result['transfer_instructions'] = tf.get('instructions')
+                cod = payments.get('cod') or {}
+                if cod and not result.get('cash_on_delivery_yes'):
+                    note = cod.get('notes')
+                    if note:
+                        result['cash_on_delivery_yes'] = note
+            shipping = biz.get('shipping') or {}
+            if isinstance(shipping, dict):
+                dRates = shipping.get('district_rates') or []
+                if isinstance(dRates, list) and not result.get('districts_costs'):
+                    lines = []
+                    for dr in dRates:
+                        if not isinstance(dr, dict):
+                            continue
+                        parts = [dr.get('district') or '', dr.get('price') or '', dr.get('eta') or '']
+                        if any([p.strip() for p in parts]):
+                            lines.append('; '.join(parts).strip())
+                    if lines:
+                        result['districts_costs'] = "\n".join(lines)
+                if shipping.get('delivery_time') and not result.get('typical_delivery_time'):
+                    result['typical_delivery_time'] = shipping.get('delivery_time')
+                if shipping.get('free_shipping_threshold') and not result.get('free_shipping_from'):
+                    result['free_shipping_from'] = shipping.get('free_shipping_threshold')
+                if shipping.get('pickup_address') and not result.get('pickup_address'):
+                    result['pickup_address'] = shipping.get('pickup_address')
+                partners = shipping.get('partners')
+                if partners and not result.get('delivery_partners'):
+                    result['delivery_partners'] = ", ".join(partners) if isinstance(partners, list) else str(partners)
+            sales = biz.get('sales') or {}
+            if isinstance(sales, dict):
+                retail = sales.get('retail') or {}
+                if isinstance(retail, dict) and result.get('retail_yes') is None:
+                    if 'enabled' in retail:
+                        result['retail_yes'] = 'Sí' if retail.get('enabled') else 'No'
+                wholesale = sales.get('wholesale') or {}
+                if isinstance(wholesale, dict):
+                    if 'enabled' in wholesale and result.get('wholesale_yes') is None:
+                        result['wholesale_yes'] = 'Sí' if wholesale.get('enabled') else 'No'
+                    if wholesale.get('min_units') and not result.get('wholesale_min_qty'):
+                        result['wholesale_min_qty'] = str(wholesale.get('min_units'))
+                    if wholesale.get('price_list_url') and not result.get('wholesale_price_list_url'):
+                        result['wholesale_price_list_url'] = wholesale.get('price_list_url')
+                    if 'requires_ruc' in wholesale and not result.get('wholesale_requires_ruc'):
+                        result['wholesale_requires_ruc'] = 'Sí' if wholesale.get('requires_ruc') else 'No'
+                    if wholesale.get('prep_time') and not result.get('prep_time_large_orders'):
+                        result['prep_time_large_orders'] = wholesale.get('prep_time')
+                    disc = wholesale.get('discounts') or []
+                    if isinstance(disc, list) and not result.get('volume_discounts'):
+                        lines = []
+                        for dct in disc:
+                            if not isinstance(dct, dict):
+                                continue
+                            parts = [
+                                (str(dct.get('from_units')) if dct.get('from_units') is not None else ''),
+                                (str(dct.get('percent')) if dct.get('percent') is not None else ''),
+                            ]
+                            if any([p.strip() for p in parts]):
+                                lines.append('; '.join(parts).strip())
+                        if lines:
+                            result['volume_discounts'] = "\n".join(lines)
+            policies = biz.get('policies') or {}
+            if isinstance(policies, dict):
+                if policies.get('returns') and not result.get('returns_policy'):
+                    result['returns_policy'] = policies.get('returns')
+                if policies.get('warranty') and not result.get('warranty'):
+                    result['warranty'] = policies.get('warranty')
+                if policies.get('terms_url') and not result.get('terms_url'):
+                    result['terms_url'] = policies.get('terms_url')
+                if policies.get('privacy_url') and not result.get('privacy_url'):
+                    result['privacy_url'] = policies.get('privacy_url')
+                inv = policies.get('invoices') or {}
+                if isinstance(inv, dict):
+                    if 'boleta' in inv and not result.get('boleta_yes'):
+                        result['boleta_yes'] = 'Sí' if inv.get('boleta') else 'No'
+                    if 'factura' in inv and not result.get('factura_yes'):
+                        result['factura_yes'] = 'Sí' if inv.get('factura') else 'No'
+    except Exception:
+        # No romper si viene mal formado
+        return result
+    return result
+
+
+def _build_persona(ai_cfg: dict) -> dict:
+    """Construye la persona/"cerebro" plana que consumen ai_answer y answer_from_persona."""
+    # Back-compat: soportar posibles claves usadas en el builder
+    _assistant_name = (
+        ai_cfg.get('assistant_name')
+        or ai_cfg.get('assistant')
+        or ai_cfg.get('assistantName')
+        or ai_cfg.get('nombre_asistente')
+        or ai_cfg.get('name')
+        or 'Asistente'
+    )
+    return {
+        'name': _assistant_name,
+        'about': ai_cfg.get('about') or ai_cfg.get('presentation') or '',
+        'knowledge': ai_cfg.get('knowledge') or ai_cfg.get('brain') or ai_cfg.get('kb') or '',
+        'style': ai_cfg.get('style') or '',
+        'system': ai_cfg.get('system') or ai_cfg.get('instructions') or '',
+        # Ventas y tono
+        'sales_playbook': ai_cfg.get('sales_playbook') or '',
+        'cta_phrases': ai_cfg.get('cta_phrases') or '',
+        'emoji_level': ai_cfg.get('emoji_level') or '',
+        'recommendation_examples': ai_cfg.get('recommendation_examples') or '',
+        'language': ai_cfg.get('language') or ai_cfg.get('lang') or 'español',
+        # Aceptar también claves del Builder: website_url y phone_number
+        'website': ai_cfg.get('website') or ai_cfg.get('website_url') or ai_cfg.get('site') or ai_cfg.get('url') or '',
+        'phone': ai_cfg.get('phone') or ai_cfg.get('phone_number') or ai_cfg.get('telefono') or '',
+        'email': ai_cfg.get('email') or ai_cfg.get('correo') or '',
+        'order_required': ai_cfg.get('order_required') or ai_cfg.get('required_info') or ai_cfg.get('required_fields') or '',
+        'out_of_scope': ai_cfg.get('out_of_scope') or ai_cfg.get('oos') or ai_cfg.get('temas_fuera') or '',
+        'response_policies': ai_cfg.get('response_policies') or ai_cfg.get('pol_resp') or '',
+        'comm_policies': ai_cfg.get('comm_policies') or ai_cfg.get('pol_comm') or '',
+        # Perfil del negocio
+        'trade_name': ai_cfg.get('trade_name') or ai_cfg.get('nombre_comercial') or '',
+        'legal_name': ai_cfg.get('legal_name') or ai_cfg.get('razon_social') or '',
+        'ruc': ai_cfg.get('ruc') or '',
+        'timezone': ai_cfg.get('timezone') or ai_cfg.get('zona_horaria') or '',
+        'address': ai_cfg.get('address') or ai_cfg.get('direccion') or '',
+        'city': ai_cfg.get('city') or ai_cfg.get('ciudad') or '',
+        'region': ai_cfg.get('region') or ai_cfg.get('departamento') or '',
+        'country': ai_cfg.get('country') or ai_cfg.get('pais') or '',
+        'maps_url': ai_cfg.get('maps_url') or ai_cfg.get('google_maps') or '',
+        'ubigeo': ai_cfg.get('ubigeo') or '',
+        'hours_mon_fri': ai_cfg.get('hours_mon_fri') or ai_cfg.get('horario_lv') or '',
+        'hours_sat': ai_cfg.get('hours_sat') or ai_cfg.get('horario_sab') or '',
+        'hours_sun': ai_cfg.get('hours_sun') or ai_cfg.get('horario_dom') or '',
+        # Redes y enlaces
+        'instagram': ai_cfg.get('instagram') or '',
+        'facebook': ai_cfg.get('facebook') or '',
+        'tiktok': ai_cfg.get('tiktok') or '',
+        'youtube': ai_cfg.get('youtube') or '',
+        'x': ai_cfg.get('x') or ai_cfg.get('twitter') or '',
+        'linktree': ai_cfg.get('linktree') or '',
+        'whatsapp_link': ai_cfg.get('whatsapp_link') or '',
+        'catalog_url': ai_cfg.get('catalog_url') or ai_cfg.get('site_shop') or '',
+        # Catálogo estructurado
+        'categories': ai_cfg.get('categories') or '',
+        'featured_products': ai_cfg.get('featured_products') or '',
+        'size_guide_url': ai_cfg.get('size_guide_url') or '',
+        'size_notes': ai_cfg.get('size_notes') or '',
+        # Modalidad de venta
+        'retail_yes': ai_cfg.get('retail_yes') or '',
+        'wholesale_yes': ai_cfg.get('wholesale_yes') or '',
+        'wholesale_min_qty': ai_cfg.get('wholesale_min_qty') or '',
+        'wholesale_price_list_url': ai_cfg.get('wholesale_price_list_url') or '',
+        'wholesale_requires_ruc': ai_cfg.get('wholesale_requires_ruc') or '',
+        'prep_time_large_orders': ai_cfg.get('prep_time_large_orders') or '',
+        'volume_discounts': ai_cfg.get('volume_discounts') or '',
+        # Pagos
+        'yape_number': ai_cfg.get('yape_number') or '',
+        'yape_holder': ai_cfg.get('yape_holder') or '',
+        'yape_alias': ai_cfg.get('yape_alias') or '',
+        'yape_qr': ai_cfg.get('yape_qr') or '',
+        'plin_number': ai_cfg.get('plin_number') or '',
+        'plin_holder': ai_cfg.get('plin_holder') or '',
+        'plin_qr': ai_cfg.get('plin_qr') or '',
+        'card_brands': ai_cfg.get('card_brands') or '',
+        'card_provider': ai_cfg.get('card_provider') or '',
+        'card_paylink': ai_cfg.get('card_paylink') or '',
+        'card_fee_notes': ai_cfg.get('card_fee_notes') or '',
+        'transfer_accounts': ai_cfg.get('transfer_accounts') or '',
+        'transfer_instructions': ai_cfg.get('transfer_instructions') or '',
+        'cash_on_delivery_yes': ai_cfg.get('cash_on_delivery_yes') or '',
+        # Envíos
+        'districts_costs': ai_cfg.get('districts_costs') or '',
+        'typical_delivery_time': ai_cfg.get('typical_delivery_time') or '',
+        'free_shipping_from': ai_cfg.get('free_shipping_from') or '',
+        'pickup_address': ai_cfg.get('pickup_address') or '',
+        'delivery_partners': ai_cfg.get('delivery_partners') or '',
+        # Políticas y comprobantes
+        'returns_policy': ai_cfg.get('returns_policy') or '',
+        'warranty': ai_cfg.get('warranty') or '',
+        'terms_url': ai_cfg.get('terms_url') or '',
+        'privacy_url': ai_cfg.get('privacy_url') or '',
+        'boleta_yes': ai_cfg.get('boleta_yes') or '',
+        'factura_yes': ai_cfg.get('factura_yes') or '',
+    }
+
+_PERSONA_CACHE_MAX = 128
+_persona_cache: dict[str, dict] = {}
+
+
+def _persona_for_flow(flow_cfg: dict, flow_version: str | None) -> dict:
+    """Persona memoizada por versión del flujo (se reconstruye sólo al guardar el flujo)."""
+    if not flow_version:
+        return _build_persona(_flatten_ai_cfg(flow_cfg))
+    persona = _persona_cache.get(flow_version)
+    if persona is None:
+        if len(_persona_cache) >= _PERSONA_CACHE_MAX:
+            _persona_cache.clear()
+        persona = _persona_cache[flow_version] = _build_persona(_flatten_ai_cfg(flow_cfg))
+    return persona
+
+
+# Saludos que disparan el mensaje de bienvenida en el primer contacto (texto normalizado, sin signos)
+_GREETINGS = frozenset({
+    'hola', 'buenas', 'buenos dias', 'buenas tardes', 'buenas noches', 'hola buen dia', 'hola buenos dias',
+})
+
+
 def verify_webhook(request, bot):
     mode = request.GET.get('hub.mode')
     token = request.GET.get('hub.verify_token')
@@ -560,37 +1048,37 @@ def verify_webhook(request, bot):
 
 
 @csrf_exempt
+@ai_usage.scoped
+@unit_of_work.scoped
 def whatsapp_webhook(request, bot_uuid):
     bot = get_object_or_404(Bot, uuid=bot_uuid, is_active=True)
+    # Llamadas de IA de este mensaje se contabilizan para el bot (bots/ai_usage.py)
+    ai_usage.set_bot(bot.id)
 
     if request.method == 'GET':
         return verify_webhook(request, bot)
 
     if request.method == 'POST':
+        # Inicio del presupuesto de latencia del mensaje (ver bots/cascade.py)
+        started_at = time.monotonic()
         try:
             body = json.loads(request.body.decode('utf-8') or '{}')
         except json.JSONDecodeError:
             body = {}
 
-        entry = (body.get('entry') or [{}])[0]
-        changes = entry.get('changes') or []
-        value = changes[0].get('value') if changes else {}
-        messages = value.get('messages') or []
-
-        if not messages:
+        # Mensaje parseado una sola vez (texto normalizado y tokens incluidos, ver bots/inbound.py)
+        inbound = InboundMessage.from_webhook(body)
+        if inbound is None:
             return JsonResponse({'status': 'ok'})
 
-        msg = messages[0]
-        wa_from = msg.get('from', '')
-        message_type = msg.get('type', '')
-        profile = (value.get('contacts') or [{}])[0].get('profile') if value.get('contacts') else {}
-        name = (profile or {}).get('name', '')
+        wa_from = inbound.wa_from
+        message_type = inbound.type
+        name = inbound.profile_name
 
         # Log in
         # Guardar usando phone_number_id (consistente con envíos) para poder cruzar luego
-        meta = value.get('metadata', {}) if isinstance(value, dict) else {}
-        wa_to_number = meta.get('phone_number_id') or bot.phone_number_id
-        MessageLog.objects.create(
+        wa_to_number = inbound.phone_number_id or bot.phone_number_id
+        inbound_log = MessageLog.objects.create(
             bot=bot,
             direction=MessageLog.IN,
             wa_from=wa_from,
@@ -598,21 +1086,33 @@ def whatsapp_webhook(request, bot_uuid):
             message_type=message_type,
             payload=body,
             status='received',
+            body_text=inbound.display_text(),
+            wamid=inbound.wamid,
         )
 
-        # Upsert WaUser
+        # Upsert WaUser; los cambios de estado se escriben en un solo UPDATE (bots/unit_of_work.py): con
+        # unit_of_work.flush() justo antes de cada envío o llamada de IA, ya decidido el estado, para que
+        # el mensaje siguiente (otro worker) lo vea; el flush final sólo escribe lo que cambie después
         user, _ = WaUser.objects.get_or_create(bot=bot, wa_id=wa_from, defaults={'name': name or ''})
+        unit_of_work.track(user)
+
+        # Memoria corta de la conversación: contexto previo para la IA + turno entrante
+        from . import memory
+        history = memory.context_messages(bot.id, wa_from, stored=user.memory)
+        memory.record_turn(bot.id, wa_from, memory.USER, inbound.turn_text)
         if name and user.name != name:
             user.name = name
         now = timezone.now()
+        previous_in = user.last_in_at
         user.last_message_at = now
         user.last_in_at = now
 
         # Helper: conseguir flow activo para el bot
+        # (la versión identifica la definición para memoizar persona y prompt de IA)
         def get_active_flow_def():
             f = bot.flows.filter(is_active=True).order_by('-updated_at').first()
             if f and f.definition:
-                return f.definition
+                return f.definition, f.version_key, f.pk
             # fallback al flow.json legado
             try:
                 legacy_path = (Path(settings.BASE_DIR).parent / 'flow.json').resolve()
@@ -620,256 +1120,12 @@ def whatsapp_webhook(request, bot_uuid):
                     with legacy_path.open('r', encoding='utf-8') as fh:
                         data = json.load(fh)
                         if isinstance(data, dict):
-                            return data
+                            return data, f"legacy:{legacy_path.stat().st_mtime}", None
             except Exception:
                 pass
-            return {'enabled': False, 'nodes': {}, 'start_node': None}
+            return {'enabled': False, 'nodes': {}, 'start_node': None}, None, None
 
-        flow_cfg = get_active_flow_def()
-
-        # Helper: aplanar configuración de IA del builder (ai_config) a formato plano (ai)
-        def _flatten_ai_cfg(cfg: dict) -> dict:
-            result = {}
-            try:
-                # Base plana si existe
-                base_ai = (cfg or {}).get('ai') or {}
-                if isinstance(base_ai, dict):
-                    result.update(base_ai)
-                ai_conf = (cfg or {}).get('ai_config') or {}
-                if not isinstance(ai_conf, dict):
-                    return result
-                prof = (ai_conf.get('assistant_profile') or {}) if isinstance(ai_conf.get('assistant_profile'), dict) else {}
-                biz = (ai_conf.get('business_profile') or {}) if isinstance(ai_conf.get('business_profile'), dict) else {}
-                # Ventas inteligentes (opcional)
-                if prof:
-                    if prof.get('sales_playbook') and not result.get('sales_playbook'):
-                        result['sales_playbook'] = prof.get('sales_playbook')
-                    if isinstance(prof.get('cta_phrases'), list) and not result.get('cta_phrases'):
-                        result['cta_phrases'] = ", ".join([str(x).strip() for x in prof.get('cta_phrases') if str(x).strip()])
-                    if prof.get('emoji_level') and not result.get('emoji_level'):
-                        result['emoji_level'] = prof.get('emoji_level')
-                    if isinstance(prof.get('recommendation_examples'), list) and not result.get('recommendation_examples'):
-                        result['recommendation_examples'] = "\n".join([str(x).strip() for x in prof.get('recommendation_examples') if str(x).strip()])
-                # Policies (listas) → líneas
-                not_supported = ai_conf.get('not_supported') or []
-                if isinstance(not_supported, list) and not result.get('out_of_scope'):
-                    result['out_of_scope'] = "\n".join([str(x).strip() for x in not_supported if str(x).strip()])
-                policies = ai_conf.get('policies') or []
-                if isinstance(policies, list) and not result.get('response_policies'):
-                    result['response_policies'] = "\n".join([str(x).strip() for x in policies if str(x).strip()])
-                # Assistant profile
-                if prof:
-                    if prof.get('assistant_name') and not result.get('assistant_name'):
-                        result['assistant_name'] = prof.get('assistant_name')
-                    if prof.get('language') and not result.get('language'):
-                        result['language'] = prof.get('language')
-                    # Descripción/presentación del negocio/asistente
-                    if prof.get('store_description') and not (result.get('about') or result.get('presentation')):
-                        result['about'] = prof.get('store_description')
-                        result['presentation'] = prof.get('store_description')
-                    if (prof.get('website_url') or prof.get('website')) and not result.get('website'):
-                        result['website'] = prof.get('website_url') or prof.get('website')
-                    if (prof.get('phone_number') or prof.get('phone')) and not result.get('phone'):
-                        result['phone'] = prof.get('phone_number') or prof.get('phone')
-                    if prof.get('email') and not result.get('email'):
-                        result['email'] = prof.get('email')
-                    roi = prof.get('required_order_info') or []
-                    if isinstance(roi, list) and not result.get('order_required'):
-                        result['order_required'] = "\n".join([str(x).strip() for x in roi if str(x).strip()])
-                # Business profile
-                if biz:
-                    if biz.get('business_name') and not result.get('trade_name'):
-                        result['trade_name'] = biz.get('business_name')
-                    if biz.get('legal_name') and not result.get('legal_name'):
-                        result['legal_name'] = biz.get('legal_name')
-                    if biz.get('ruc') and not result.get('ruc'):
-                        result['ruc'] = biz.get('ruc')
-                    hours = biz.get('hours') or {}
-                    if isinstance(hours, dict):
-                        if hours.get('timezone') and not result.get('timezone'):
-                            result['timezone'] = hours.get('timezone')
-                        if hours.get('weekdays') and not result.get('hours_mon_fri'):
-                            result['hours_mon_fri'] = hours.get('weekdays')
-                        if hours.get('saturday') and not result.get('hours_sat'):
-                            result['hours_sat'] = hours.get('saturday')
-                        if hours.get('sunday') and not result.get('hours_sun'):
-                            result['hours_sun'] = hours.get('sunday')
-                    addr = biz.get('address') or {}
-                    if isinstance(addr, dict):
-                        if addr.get('address_line') and not result.get('address'):
-                            result['address'] = addr.get('address_line')
-                        if addr.get('city') and not result.get('city'):
-                            result['city'] = addr.get('city')
-                        if addr.get('region') and not result.get('region'):
-                            result['region'] = addr.get('region')
-                        if addr.get('country') and not result.get('country'):
-                            result['country'] = addr.get('country')
-                        if addr.get('maps_url') and not result.get('maps_url'):
-                            result['maps_url'] = addr.get('maps_url')
-                        if addr.get('ubigeo') and not result.get('ubigeo'):
-                            result['ubigeo'] = addr.get('ubigeo')
-                    socials = biz.get('socials') or {}
-                    if isinstance(socials, dict):
-                        for k_src, k_dst in [
-                            ('instagram','instagram'), ('facebook','facebook'), ('tiktok','tiktok'), ('youtube','youtube'),
-                            ('x','x'), ('linktree','linktree'), ('whatsapp_link','whatsapp_link'), ('website','catalog_url')
-                        ]:
-                            if socials.get(k_src) and not result.get(k_dst):
-                                result[k_dst] = socials.get(k_src)
-                    # Catálogo estructurado y guías
-                    if isinstance(biz.get('categories'), list) and not result.get('categories'):
-                        result['categories'] = ", ".join([str(x).strip() for x in biz.get('categories') if str(x).strip()])
-                    featured = biz.get('featured_products') or []
-                    if isinstance(featured, list) and not result.get('featured_products'):
-                        # Serializar como líneas "Nombre: URL"
-                        lines = []
-                        for fp in featured:
-                            if isinstance(fp, dict):
-                                nm = (fp.get('name') or '').strip()
-                                url = (fp.get('url') or '').strip()
-                                if nm or url:
-                                    lines.append(f"{nm}: {url}".strip(': '))
-                        if lines:
-                            result['featured_products'] = "\n".join(lines)
-                    if biz.get('size_guide_url') and not result.get('size_guide_url'):
-                        result['size_guide_url'] = biz.get('size_guide_url')
-                    if biz.get('size_notes') and not result.get('size_notes'):
-                        result['size_notes'] = biz.get('size_notes')
-                    if biz.get('materials') and not result.get('materials'):
-                        result['materials'] = biz.get('materials')
-                    if biz.get('care_instructions') and not result.get('care_instructions'):
-                        result['care_instructions'] = biz.get('care_instructions')
-                    payments = biz.get('payments') or {}
-                    if isinstance(payments, dict):
-                        yp = payments.get('yape') or {}
-                        if yp:
-                            if yp.get('phone') and not result.get('yape_number'):
-                                result['yape_number'] = yp.get('phone')
-                            if yp.get('holder') and not result.get('yape_holder'):
-                                result['yape_holder'] = yp.get('holder')
-                            if yp.get('alias') and not result.get('yape_alias'):
-                                result['yape_alias'] = yp.get('alias')
-                            if yp.get('qr_url') and not result.get('yape_qr'):
-                                result['yape_qr'] = yp.get('qr_url')
-                        pl = payments.get('plin') or {}
-                        if pl:
-                            if pl.get('phone') and not result.get('plin_number'):
-                                result['plin_number'] = pl.get('phone')
-                            if pl.get('holder') and not result.get('plin_holder'):
-                                result['plin_holder'] = pl.get('holder')
-                            if pl.get('qr_url') and not result.get('plin_qr'):
-                                result['plin_qr'] = pl.get('qr_url')
-                        card = payments.get('card') or {}
-                        if card:
-                            brands = card.get('brands')
-                            if brands and not result.get('card_brands'):
-                                result['card_brands'] = ", ".join(brands) if isinstance(brands, list) else str(brands)
-                            if card.get('provider') and not result.get('card_provider'):
-                                result['card_provider'] = card.get('provider')
-                            if card.get('link_url') and not result.get('card_paylink'):
-                                result['card_paylink'] = card.get('link_url')
-                            if (card.get('surcharge') or card.get('notes')) and not result.get('card_fee_notes'):
-                                result['card_fee_notes'] = card.get('surcharge') or card.get('notes')
-                        tf = payments.get('transfer') or {}
-                        if tf:
-                            banks = tf.get('banks') or []
-                            if isinstance(banks, list) and not result.get('transfer_accounts'):
-                                lines = []
-                                for bk in banks:
-                                    if not isinstance(bk, dict):
-                                        continue
-                                    parts = [
-                                        bk.get('bank') or '',
-                                        bk.get('account_number') or '',
-                                        bk.get('cci') or '',
-                                        bk.get('holder') or '',
-                                        bk.get('doc') or '',
-                                    ]
-                                    if any([p.strip() for p in parts]):
-                                        lines.append('; '.join(parts).strip())
-                                if lines:
-                                    result['transfer_accounts'] = "\n".join(lines)
-                            if tf.get('instructions') and not result.get('transfer_instructions'):
-                                result['transfer_instructions'] = tf.get('instructions')
-                        cod = payments.get('cod') or {}
-                        if cod and not result.get('cash_on_delivery_yes'):
-                            note = cod.get('notes')
-                            if note:
-                                result['cash_on_delivery_yes'] = note
-                    shipping = biz.get('shipping') or {}
-                    if isinstance(shipping, dict):
-                        dRates = shipping.get('district_rates') or []
-                        if isinstance(dRates, list) and not result.get('districts_costs'):
-                            lines = []
-                            for dr in dRates:
-                                if not isinstance(dr, dict):
-                                    continue
-                                parts = [dr.get('district') or '', dr.get('price') or '', dr.get('eta') or '']
-                                if any([p.strip() for p in parts]):
-                                    lines.append('; '.join(parts).strip())
-                            if lines:
-                                result['districts_costs'] = "\n".join(lines)
-                        if shipping.get('delivery_time') and not result.get('typical_delivery_time'):
-                            result['typical_delivery_time'] = shipping.get('delivery_time')
-                        if shipping.get('free_shipping_threshold') and not result.get('free_shipping_from'):
-                            result['free_shipping_from'] = shipping.get('free_shipping_threshold')
-                        if shipping.get('pickup_address') and not result.get('pickup_address'):
-                            result['pickup_address'] = shipping.get('pickup_address')
-                        partners = shipping.get('partners')
-                        if partners and not result.get('delivery_partners'):
-                            result['delivery_partners'] = ", ".join(partners) if isinstance(partners, list) else str(partners)
-                    sales = biz.get('sales') or {}
-                    if isinstance(sales, dict):
-                        retail = sales.get('retail') or {}
-                        if isinstance(retail, dict) and result.get('retail_yes') is None:
-                            if 'enabled' in retail:
-                                result['retail_yes'] = 'Sí' if retail.get('enabled') else 'No'
-                        wholesale = sales.get('wholesale') or {}
-                        if isinstance(wholesale, dict):
-                            if 'enabled' in wholesale and result.get('wholesale_yes') is None:
-                                result['wholesale_yes'] = 'Sí' if wholesale.get('enabled') else 'No'
-                            if wholesale.get('min_units') and not result.get('wholesale_min_qty'):
-                                result['wholesale_min_qty'] = str(wholesale.get('min_units'))
-                            if wholesale.get('price_list_url') and not result.get('wholesale_price_list_url'):
-                                result['wholesale_price_list_url'] = wholesale.get('price_list_url')
-                            if 'requires_ruc' in wholesale and not result.get('wholesale_requires_ruc'):
-                                result['wholesale_requires_ruc'] = 'Sí' if wholesale.get('requires_ruc') else 'No'
-                            if wholesale.get('prep_time') and not result.get('prep_time_large_orders'):
-                                result['prep_time_large_orders'] = wholesale.get('prep_time')
-                            disc = wholesale.get('discounts') or []
-                            if isinstance(disc, list) and not result.get('volume_discounts'):
-                                lines = []
-                                for dct in disc:
-                                    if not isinstance(dct, dict):
-                                        continue
-                                    parts = [
-                                        (str(dct.get('from_units')) if dct.get('from_units') is not None else ''),
-                                        (str(dct.get('percent')) if dct.get('percent') is not None else ''),
-                                    ]
-                                    if any([p.strip() for p in parts]):
-                                        lines.append('; '.join(parts).strip())
-                                if lines:
-                                    result['volume_discounts'] = "\n".join(lines)
-                    policies = biz.get('policies') or {}
-                    if isinstance(policies, dict):
-                        if policies.get('returns') and not result.get('returns_policy'):
-                            result['returns_policy'] = policies.get('returns')
-                        if policies.get('warranty') and not result.get('warranty'):
-                            result['warranty'] = policies.get('warranty')
-                        if policies.get('terms_url') and not result.get('terms_url'):
-                            result['terms_url'] = policies.get('terms_url')
-                        if policies.get('privacy_url') and not result.get('privacy_url'):
-                            result['privacy_url'] = policies.get('privacy_url')
-                        inv = policies.get('invoices') or {}
-                        if isinstance(inv, dict):
-                            if 'boleta' in inv and not result.get('boleta_yes'):
-                                result['boleta_yes'] = 'Sí' if inv.get('boleta') else 'No'
-                            if 'factura' in inv and not result.get('factura_yes'):
-                                result['factura_yes'] = 'Sí' if inv.get('factura') else 'No'
-            except Exception:
-                # No romper si viene mal formado
-                return result
-            return result
+        flow_cfg, flow_version, flow_pk = get_active_flow_def()
 
         # Helpers envío y IA
         from .services import (
@@ -878,9 +1134,10 @@ def whatsapp_webhook(request, bot_uuid):
             send_whatsapp_image,
             send_whatsapp_document,
             answer_from_persona,
-            ai_select_trigger,
-            ai_answer,
+            ai_classify,
         )
+        from .cascade import INTENT_LABELS, AnswerCascade
+        from . import knowledge
         # OpenRouter helpers para clasificación de intención y naturalización
         try:
             from services.ai_service import classify_intent_label, naturalize_from_answer
@@ -892,6 +1149,7 @@ def whatsapp_webhook(request, bot_uuid):
             nodes = (flow_cfg or {}).get('nodes') or {}
             node = nodes.get(node_id)
             if not node:
+                unit_of_work.flush()
                 send_whatsapp_text(bot, wa_from, '⚠️ Flujo no disponible en este paso.')
                 return
             ntype = (node.get('type') or 'action').lower()
@@ -899,7 +1157,6 @@ def whatsapp_webhook(request, bot_uuid):
 
             # Guardar estado
             user.flow_node = node_id
-            user.save(update_fields=['name', 'last_message_at', 'last_in_at', 'flow_node'])
 
             if ntype == 'advisor':
                 raw_phone = (node.get('phone') or '').strip()
@@ -927,7 +1184,7 @@ def whatsapp_webhook(request, bot_uuid):
                 user.human_requested = True
                 user.human_timeout_min = tmin
                 user.human_expires_at = now + timezone.timedelta(minutes=max(1, tmin))
-                user.save(update_fields=['human_requested', 'human_timeout_min', 'human_expires_at'])
+                unit_of_work.flush()
                 buttons = [{ 'id': 'MENU_PRINCIPAL', 'title': '🔙 Menú principal' }]
                 try:
                     send_whatsapp_interactive_buttons(bot, wa_from, body_text, buttons)
@@ -941,6 +1198,25 @@ def whatsapp_webhook(request, bot_uuid):
                 send_flow_node(node.get('next'))
                 return
 
+            # Botones o texto simple
+            raw_buttons = (node.get('buttons') or [])[:3]
+            buttons = []
+            for b in raw_buttons:
+                title = b.get('title') or 'Opción'
+                target = None
+                if b.get('next'):
+                    target = f"FLOW:{b['next']}"
+                elif b.get('id'):
+                    target = b['id']
+                if target:
+                    buttons.append({'id': target, 'title': title})
+            # Encadenar si action con next
+            chained = not buttons and (node.get('type') or 'action').lower() == 'action' and node.get('next')
+            if not buttons and not chained:
+                # Terminal: limpiar estado
+                user.flow_node = None
+            unit_of_work.flush()
+
             # Enviar assets primero
             for asset in (node.get('assets') or [])[:5]:
                 atype = (asset.get('type') or '').lower()
@@ -954,18 +1230,6 @@ def whatsapp_webhook(request, bot_uuid):
                 except Exception:
                     pass
 
-            # Botones o texto simple
-            raw_buttons = (node.get('buttons') or [])[:3]
-            buttons = []
-            for b in raw_buttons:
-                title = b.get('title') or 'Opción'
-                target = None
-                if b.get('next'):
-                    target = f"FLOW:{b['next']}"
-                elif b.get('id'):
-                    target = b['id']
-                if target:
-                    buttons.append({'id': target, 'title': title})
             if buttons:
                 try:
                     send_whatsapp_interactive_buttons(bot, wa_from, text or ' ', buttons)
@@ -977,30 +1241,11 @@ def whatsapp_webhook(request, bot_uuid):
                         send_whatsapp_text(bot, wa_from, text)
                     except Exception:
                         pass
-                # Encadenar si action con next
-                if (node.get('type') or 'action').lower() == 'action' and node.get('next'):
+                if chained:
                     send_flow_node(node.get('next'))
-                else:
-                    # Terminal: limpiar estado
-                    user.flow_node = None
-                    user.save(update_fields=['flow_node'])
-
-        # Extraer payload interactivo o texto
-        payload_id = None
-        if message_type == 'interactive':
-            it = msg.get('interactive') or {}
-            if 'button_reply' in it:
-                payload_id = (it['button_reply'] or {}).get('id')
-            elif 'list_reply' in it:
-                payload_id = (it['list_reply'] or {}).get('id')
-        elif message_type == 'button':
-            payload_id = (msg.get('button') or {}).get('payload') or (msg.get('button') or {}).get('text')
-        elif message_type == 'text':
-            payload_id = None
-        else:
-            payload_id = None
 
-        # Manejo de payloads
+        # Manejo de payloads (botones interactivos, listas y botones de plantilla)
+        payload_id = inbound.payload_id
         if payload_id:
             pid = (payload_id or '').strip()
             if pid.upper().startswith('FLOW:'):
@@ -1012,48 +1257,13 @@ def whatsapp_webhook(request, bot_uuid):
                 return JsonResponse({'status': 'ok'})
             # Acciones rápidas de bienvenida (Catálogo, Pagos, Envíos)
             if pid.upper() in ('OPEN_CATALOG','OPEN_PAYMENTS','OPEN_SHIPPING'):
-                ai_cfg_wc = _flatten_ai_cfg(flow_cfg)
-                persona = {
-                    'name': (
-                        ai_cfg_wc.get('assistant_name')
-                        or ai_cfg_wc.get('assistant')
-                        or ai_cfg_wc.get('assistantName')
-                        or ai_cfg_wc.get('nombre_asistente')
-                        or ai_cfg_wc.get('name')
-                        or 'Asistente'
-                    ),
-                    'about': ai_cfg_wc.get('about') or ai_cfg_wc.get('presentation') or '',
-                    'language': ai_cfg_wc.get('language') or 'español',
-                    'website': ai_cfg_wc.get('website') or ai_cfg_wc.get('website_url') or '',
-                    'catalog_url': ai_cfg_wc.get('catalog_url') or '',
-                    # Pagos
-                    'yape_number': ai_cfg_wc.get('yape_number') or '',
-                    'yape_holder': ai_cfg_wc.get('yape_holder') or '',
-                    'yape_alias': ai_cfg_wc.get('yape_alias') or '',
-                    'yape_qr': ai_cfg_wc.get('yape_qr') or '',
-                    'plin_number': ai_cfg_wc.get('plin_number') or '',
-                    'plin_holder': ai_cfg_wc.get('plin_holder') or '',
-                    'plin_qr': ai_cfg_wc.get('plin_qr') or '',
-                    'card_brands': ai_cfg_wc.get('card_brands') or '',
-                    'card_provider': ai_cfg_wc.get('card_provider') or '',
-                    'card_paylink': ai_cfg_wc.get('card_paylink') or '',
-                    'transfer_accounts': ai_cfg_wc.get('transfer_accounts') or '',
-                    'transfer_instructions': ai_cfg_wc.get('transfer_instructions') or '',
-                    'cash_on_delivery_yes': ai_cfg_wc.get('cash_on_delivery_yes') or '',
-                    # Envíos
-                    'districts_costs': ai_cfg_wc.get('districts_costs') or '',
-                    'typical_delivery_time': ai_cfg_wc.get('typical_delivery_time') or '',
-                    'free_shipping_from': ai_cfg_wc.get('free_shipping_from') or '',
-                    'delivery_partners': ai_cfg_wc.get('delivery_partners') or '',
-                }
-                quick_text = None
-                if pid.upper() == 'OPEN_CATALOG':
-                    quick_text = answer_from_persona('web', persona, brand=((flow_cfg or {}).get('brand') or None))
-                elif pid.upper() == 'OPEN_PAYMENTS':
-                    quick_text = answer_from_persona('pagos', persona, brand=((flow_cfg or {}).get('brand') or None))
-                elif pid.upper() == 'OPEN_SHIPPING':
-                    quick_text = answer_from_persona('envios', persona, brand=((flow_cfg or {}).get('brand') or None))
+                # Misma persona memoizada que la cascada; `version` reutiliza los fragmentos compilados
+                persona = _persona_for_flow(flow_cfg, flow_version)
+                brand = (flow_cfg or {}).get('brand') or None
+                topic = {'OPEN_CATALOG': 'web', 'OPEN_PAYMENTS': 'pagos', 'OPEN_SHIPPING': 'envios'}[pid.upper()]
+                quick_text = answer_from_persona(topic, persona, brand=brand, version=flow_version)
                 if quick_text:
+                    unit_of_work.flush()
                     try:
                         send_whatsapp_text(bot, wa_from, quick_text)
                     except Exception:
@@ -1061,68 +1271,88 @@ def whatsapp_webhook(request, bot_uuid):
                 return JsonResponse({'status': 'ok'})
             return JsonResponse({'status': 'ok'})
 
-        # Expirar flujo si no hubo respuesta del usuario > 5 min
-        if user.flow_node and user.last_in_at and (timezone.now() - user.last_in_at) > timezone.timedelta(minutes=5):
-            # Enviar aviso de cierre por inactividad + redes sociales (si están configuradas)
+        # El cierre de flujos inactivos y el fin del chat humano los hace el scheduler (bots/expiry.py);
+        # si no está corriendo, se resuelven aquí con el mensaje siguiente del usuario
+        if expiry.expire_on_message(user, previous_in, now):
+            unit_of_work.flush()
             try:
-                ai_cfg_wc = _flatten_ai_cfg(flow_cfg)
-                redes = []
-                if ai_cfg_wc.get('instagram'):
-                    redes.append(f"Instagram: {ai_cfg_wc.get('instagram')}")
-                if ai_cfg_wc.get('facebook'):
-                    redes.append(f"Facebook: {ai_cfg_wc.get('facebook')}")
-                if ai_cfg_wc.get('tiktok'):
-                    redes.append(f"TikTok: {ai_cfg_wc.get('tiktok')}")
-                if ai_cfg_wc.get('youtube'):
-                    redes.append(f"YouTube: {ai_cfg_wc.get('youtube')}")
-                if ai_cfg_wc.get('x'):
-                    redes.append(f"X: {ai_cfg_wc.get('x')}")
-                if ai_cfg_wc.get('linktree'):
-                    redes.append(f"Linktree: {ai_cfg_wc.get('linktree')}")
-                base_msg = "Cerramos este flujo por inactividad (no hubo respuesta). Puedes escribirnos en cualquier momento."
-                if redes:
-                    base_msg += "\nSíguenos: " + " | ".join(redes)
-                send_whatsapp_text(bot, wa_from, base_msg)
+                send_whatsapp_text(bot, wa_from, expiry.close_message(flow_cfg))
             except Exception:
                 # no impedir el cierre si falló el envío
                 pass
-            user.flow_node = None
-            user.save(update_fields=['flow_node'])
 
         # Texto libre: lógica de triggers + cierre de flujo + IA
-        raw_text = (msg.get('text', {}).get('body') or '').strip()
-        text_low = raw_text.lower()
+        if message_type == 'text' and inbound.text and not user.human_requested:
+            # Ráfaga de mensajes seguidos: sólo el último request responde, con todos los textos
+            from . import debounce
+            if debounce.window_s():
+                unit_of_work.flush()
+            burst = debounce.collect(bot.id, wa_from, inbound.text)
+            if burst is None:
+                return JsonResponse({'status': 'ok'})
+            if burst != inbound.text:
+                inbound = inbound.with_text(burst)
+            # La espera de la ventana no cuenta contra el presupuesto de la IA
+            started_at = time.monotonic()
+        raw_text = inbound.text
+        text_low = inbound.norm
         nodes = (flow_cfg or {}).get('nodes') or {}
         enabled = (flow_cfg or {}).get('enabled', True)
 
-        # Marcar si es primer contacto (el envío se hará más abajo para evitar duplicados con triggers)
+        def reply_free_text(classification=None):
+            # Cascada Cerebro → IA con presupuesto por mensaje; siempre envía algo
+            unit_of_work.flush()
+            persona = _persona_for_flow(flow_cfg, flow_version)
+            brand = (
+                (flow_cfg or {}).get('brand')
+                or persona.get('trade_name')
+                or persona.get('legal_name')
+                or None
+            )
+            result = AnswerCascade(
+                persona,
+                brand=brand,
+                started_at=started_at,
+                classify_intent_label=classify_intent_label,
+                naturalize_from_answer=naturalize_from_answer,
+                bot_id=bot.id,
+                inbound_log_id=inbound_log.id,
+                persona_version=flow_version,
+                knowledge_index=knowledge.index_for_version(flow_version, persona, flow_id=flow_pk),
+                history=history,
+                classification=classification,
+            ).run(inbound)
+            try:
+                send_whatsapp_text(bot, wa_from, result.text)
+            except Exception:
+                pass
+
+        # Marcar si es primer contacto (el envío se hará más abajo para evitar duplicados con triggers):
+        # el bot nunca le escribió a este wa_id según el agregado de la conversación
         try:
-            is_first_contact = not MessageLog.objects.filter(
-                bot=bot,
-                direction=MessageLog.OUT,
-                wa_to=wa_from,
+            is_first_contact = Conversation.objects.filter(
+                pk=inbound_log.conversation_id,
+                first_out_at__isnull=True,
             ).exists()
         except Exception:
             is_first_contact = False
 
         # Comando: Cerrar flujo (si hay flujo activo)
-        def _norm_close(s: str) -> bool:
-            return s.replace('á','a').replace('é','e').replace('í','i').replace('ó','o').replace('ú','u').strip() == 'cerrar flujo'
-
         if enabled and nodes:
             if user.flow_node:
-                if _norm_close(text_low):
+                if inbound.tokens == ['cerrar', 'flujo']:
                     # Cerrar el flujo y desactivar modo humano para reactivar IA
                     user.flow_node = None
                     user.human_requested = False
                     user.human_expires_at = None
-                    user.save(update_fields=['flow_node', 'human_requested', 'human_expires_at'])
+                    unit_of_work.flush()
                     try:
                         send_whatsapp_text(bot, wa_from, '✅ Flujo cerrado. Puedes escribir otra cosa cuando quieras.')
                     except Exception:
                         pass
                     return JsonResponse({'status': 'ok'})
                 # Mientras hay flujo activo, pedimos elegir opción (no activar IA)
+                unit_of_work.flush()
                 try:
                     send_whatsapp_text(bot, wa_from, 'Por favor, elige una opción del menú.')
                 except Exception:
@@ -1130,16 +1360,17 @@ def whatsapp_webhook(request, bot_uuid):
                 return JsonResponse({'status': 'ok'})
 
             # Buscar triggers ACTIVOS (keywords, deeplink, IA)
-            def ai_match(user_text: str, patterns: str) -> bool:
+            utoks = {t for t in inbound.tokens if len(t) >= 3}
+
+            def ai_match(patterns: str) -> bool:
                 # Heurística simple: similitud con muestras (una por línea) o coincidencia de 2+ palabras clave
-                lines = [p.strip().lower() for p in patterns.split('\n') if p.strip()]
+                lines = [normalize(p) for p in patterns.split('\n') if p.strip()]
                 for pat in lines:
-                    if difflib.SequenceMatcher(None, user_text, pat).ratio() >= 0.72:
+                    if difflib.SequenceMatcher(None, text_low, pat).ratio() >= 0.72:
                         return True
                     # token match: al menos 2 tokens compartidos de longitud >=3
-                    utoks = [t for t in user_text.split() if len(t) >= 3]
-                    ptoks = [t for t in pat.split() if len(t) >= 3]
-                    if len(set(utoks) & set(ptoks)) >= 2:
+                    ptoks = {t for t in tokenize(pat) if len(t) >= 3}
+                    if len(utoks & ptoks) >= 2:
                         return True
                 return False
 
@@ -1154,15 +1385,15 @@ def whatsapp_webhook(request, bot_uuid):
                     if not pats:
                         continue
                     if ttype == 'keywords':
-                        kws = [p.strip().lower() for p in pats.split(',') if p.strip()]
+                        kws = [normalize(p) for p in pats.split(',') if p.strip()]
                         if any(k and k in text_low for k in kws):
                             return node.get('next') or nid
                     elif ttype == 'deeplink':
-                        lines = [p.strip().lower() for p in pats.split('\n') if p.strip()]
+                        lines = [normalize(p) for p in pats.split('\n') if p.strip()]
                         if text_low in lines:
                             return node.get('next') or nid
                     elif ttype == 'ai':
-                        if ai_match(text_low, pats):
+                        if ai_match(pats):
                             return node.get('next') or nid
                 return None
 
@@ -1171,34 +1402,29 @@ def whatsapp_webhook(request, bot_uuid):
                 send_flow_node(target)
                 return JsonResponse({'status': 'ok'})
 
-            # Trigger IA con OpenRouter si existen triggers tipo 'ai'
+            # Trigger IA con OpenRouter si existen triggers tipo 'ai': una sola llamada elige el trigger
+            # y la intención; la intención se reutiliza en la respuesta con el Cerebro
             ai_triggers = []
             for nid, node in nodes.items():
                 if (node.get('type') or '').lower() == 'trigger' and (node.get('trigger_type') or '').lower() == 'ai':
                     ai_triggers.append({'id': node.get('next') or nid, 'patterns': node.get('patterns') or ''})
+            classification = None
             if ai_triggers:
-                chosen = ai_select_trigger(raw_text, ai_triggers)
-                if chosen:
-                    send_flow_node(chosen)
+                unit_of_work.flush()
+                classification = ai_classify(
+                    raw_text, ai_triggers, INTENT_LABELS,
+                    language=_persona_for_flow(flow_cfg, flow_version).get('language') or 'español',
+                )
+                if classification and classification.trigger:
+                    send_flow_node(classification.trigger)
                     return JsonResponse({'status': 'ok'})
 
             # Saludo inicial moved: solo si es primer contacto, no hubo trigger y el usuario saludó
-            def _looks_like_greeting(s: str) -> bool:
-                t = (s or '').lower().strip()
-                t = t.replace('¡','').replace('!','').replace('.','').replace(',','')
-                return t in ('hola','buenas','buenos dias','buenas tardes','buenas noches','hola buen dia','hola buenos dias')
+            looks_like_greeting = ' '.join(inbound.tokens) in _GREETINGS
 
-            if is_first_contact and not user.human_requested and not user.flow_node and raw_text and _looks_like_greeting(raw_text) and (((flow_cfg or {}).get('ai') or (flow_cfg or {}).get('ai_config'))):
+            if is_first_contact and not user.human_requested and not user.flow_node and raw_text and looks_like_greeting and (((flow_cfg or {}).get('ai') or (flow_cfg or {}).get('ai_config'))):
                 ai_cfg_wc = _flatten_ai_cfg(flow_cfg)
-                _assistant_name = (
-                    ai_cfg_wc.get('assistant_name')
-                    or ai_cfg_wc.get('assistant')
-                    or ai_cfg_wc.get('assistantName')
-                    or ai_cfg_wc.get('nombre_asistente')
-                    or ai_cfg_wc.get('name')
-                    or 'Asistente'
-                )
-                assistant_name = (_assistant_name or '').strip()
+                assistant_name = (_persona_for_flow(flow_cfg, flow_version).get('name') or '').strip()
                 welcome_message = (
                     ai_cfg_wc.get('welcome_message')
                     or ai_cfg_wc.get('welcome')
@@ -1211,6 +1437,7 @@ def whatsapp_webhook(request, bot_uuid):
                     welcome_message = f"Hola, soy {assistant_name}, tu asistente de ventas. ¿Qué te gustaría ver hoy?"
                 welcome_message = welcome_message.strip()
                 # Intentar enviar botones de bienvenida según datos disponibles
+                unit_of_work.flush()
                 try:
                     buttons = []
                     has_catalog = bool((ai_cfg_wc.get('catalog_url') or ai_cfg_wc.get('website')))
@@ -1236,291 +1463,12 @@ def whatsapp_webhook(request, bot_uuid):
 
             # Respuesta IA general sólo si NO humano y NO flujo activo
             if not user.human_requested:
-                # Construir persona/"cerebro" desde el flujo
-                ai_cfg = _flatten_ai_cfg(flow_cfg)
-                # Back-compat: soportar posibles claves usadas en el builder
-                _assistant_name = (
-                    ai_cfg.get('assistant_name')
-                    or ai_cfg.get('assistant')
-                    or ai_cfg.get('assistantName')
-                    or ai_cfg.get('nombre_asistente')
-                    or ai_cfg.get('name')
-                    or 'Asistente'
-                )
-                persona = {
-                    'name': _assistant_name,
-                    'about': ai_cfg.get('about') or ai_cfg.get('presentation') or '',
-                    'knowledge': ai_cfg.get('knowledge') or ai_cfg.get('brain') or ai_cfg.get('kb') or '',
-                    'style': ai_cfg.get('style') or '',
-                    'system': ai_cfg.get('system') or ai_cfg.get('instructions') or '',
-                    # Ventas y tono
-                    'sales_playbook': ai_cfg.get('sales_playbook') or '',
-                    'cta_phrases': ai_cfg.get('cta_phrases') or '',
-                    'emoji_level': ai_cfg.get('emoji_level') or '',
-                    'recommendation_examples': ai_cfg.get('recommendation_examples') or '',
-                    'language': ai_cfg.get('language') or ai_cfg.get('lang') or 'español',
-                    # Aceptar también claves del Builder: website_url y phone_number
-                    'website': ai_cfg.get('website') or ai_cfg.get('website_url') or ai_cfg.get('site') or ai_cfg.get('url') or '',
-                    'phone': ai_cfg.get('phone') or ai_cfg.get('phone_number') or ai_cfg.get('telefono') or '',
-                    'email': ai_cfg.get('email') or ai_cfg.get('correo') or '',
-                    'order_required': ai_cfg.get('order_required') or ai_cfg.get('required_info') or ai_cfg.get('required_fields') or '',
-                    'out_of_scope': ai_cfg.get('out_of_scope') or ai_cfg.get('oos') or ai_cfg.get('temas_fuera') or '',
-                    'response_policies': ai_cfg.get('response_policies') or ai_cfg.get('pol_resp') or '',
-                    'comm_policies': ai_cfg.get('comm_policies') or ai_cfg.get('pol_comm') or '',
-                    # Perfil del negocio
-                    'trade_name': ai_cfg.get('trade_name') or ai_cfg.get('nombre_comercial') or '',
-                    'legal_name': ai_cfg.get('legal_name') or ai_cfg.get('razon_social') or '',
-                    'ruc': ai_cfg.get('ruc') or '',
-                    'timezone': ai_cfg.get('timezone') or ai_cfg.get('zona_horaria') or '',
-                    'address': ai_cfg.get('address') or ai_cfg.get('direccion') or '',
-                    'city': ai_cfg.get('city') or ai_cfg.get('ciudad') or '',
-                    'region': ai_cfg.get('region') or ai_cfg.get('departamento') or '',
-                    'country': ai_cfg.get('country') or ai_cfg.get('pais') or '',
-                    'maps_url': ai_cfg.get('maps_url') or ai_cfg.get('google_maps') or '',
-                    'ubigeo': ai_cfg.get('ubigeo') or '',
-                    'hours_mon_fri': ai_cfg.get('hours_mon_fri') or ai_cfg.get('horario_lv') or '',
-                    'hours_sat': ai_cfg.get('hours_sat') or ai_cfg.get('horario_sab') or '',
-                    'hours_sun': ai_cfg.get('hours_sun') or ai_cfg.get('horario_dom') or '',
-                    # Redes y enlaces
-                    'instagram': ai_cfg.get('instagram') or '',
-                    'facebook': ai_cfg.get('facebook') or '',
-                    'tiktok': ai_cfg.get('tiktok') or '',
-                    'youtube': ai_cfg.get('youtube') or '',
-                    'x': ai_cfg.get('x') or ai_cfg.get('twitter') or '',
-                    'linktree': ai_cfg.get('linktree') or '',
-                    'whatsapp_link': ai_cfg.get('whatsapp_link') or '',
-                    'catalog_url': ai_cfg.get('catalog_url') or ai_cfg.get('site_shop') or '',
-                    # Catálogo estructurado
-                    'categories': ai_cfg.get('categories') or '',
-                    'featured_products': ai_cfg.get('featured_products') or '',
-                    'size_guide_url': ai_cfg.get('size_guide_url') or '',
-                    'size_notes': ai_cfg.get('size_notes') or '',
-                    # Modalidad de venta
-                    'retail_yes': ai_cfg.get('retail_yes') or '',
-                    'wholesale_yes': ai_cfg.get('wholesale_yes') or '',
-                    'wholesale_min_qty': ai_cfg.get('wholesale_min_qty') or '',
-                    'wholesale_price_list_url': ai_cfg.get('wholesale_price_list_url') or '',
-                    'wholesale_requires_ruc': ai_cfg.get('wholesale_requires_ruc') or '',
-                    'prep_time_large_orders': ai_cfg.get('prep_time_large_orders') or '',
-                    'volume_discounts': ai_cfg.get('volume_discounts') or '',
-                    # Pagos
-                    'yape_number': ai_cfg.get('yape_number') or '',
-                    'yape_holder': ai_cfg.get('yape_holder') or '',
-                    'yape_alias': ai_cfg.get('yape_alias') or '',
-                    'yape_qr': ai_cfg.get('yape_qr') or '',
-                    'plin_number': ai_cfg.get('plin_number') or '',
-                    'plin_holder': ai_cfg.get('plin_holder') or '',
-                    'plin_qr': ai_cfg.get('plin_qr') or '',
-                    'card_brands': ai_cfg.get('card_brands') or '',
-                    'card_provider': ai_cfg.get('card_provider') or '',
-                    'card_paylink': ai_cfg.get('card_paylink') or '',
-                    'card_fee_notes': ai_cfg.get('card_fee_notes') or '',
-                    'transfer_accounts': ai_cfg.get('transfer_accounts') or '',
-                    'transfer_instructions': ai_cfg.get('transfer_instructions') or '',
-                    'cash_on_delivery_yes': ai_cfg.get('cash_on_delivery_yes') or '',
-                    # Envíos
-                    'districts_costs': ai_cfg.get('districts_costs') or '',
-                    'typical_delivery_time': ai_cfg.get('typical_delivery_time') or '',
-                    'free_shipping_from': ai_cfg.get('free_shipping_from') or '',
-                    'pickup_address': ai_cfg.get('pickup_address') or '',
-                    'delivery_partners': ai_cfg.get('delivery_partners') or '',
-                    # Políticas y comprobantes
-                    'returns_policy': ai_cfg.get('returns_policy') or '',
-                    'warranty': ai_cfg.get('warranty') or '',
-                    'terms_url': ai_cfg.get('terms_url') or '',
-                    'privacy_url': ai_cfg.get('privacy_url') or '',
-                    'boleta_yes': ai_cfg.get('boleta_yes') or '',
-                    'factura_yes': ai_cfg.get('factura_yes') or '',
-                }
-                # Primero: IA generativa orientada a ventas (anclada al Cerebro)
-                brand = (
-                    (flow_cfg or {}).get('brand')
-                    or persona.get('trade_name')
-                    or persona.get('legal_name')
-                    or None
-                )
-                answer = ai_answer(raw_text, brand=brand, persona=persona)
-                if answer:
-                    try:
-                        send_whatsapp_text(bot, wa_from, answer)
-                    except Exception:
-                        pass
-                    return JsonResponse({'status': 'ok'})
-                # Segundo: intento determinista basado en el Cerebro
-                quick = answer_from_persona(raw_text, persona, brand=brand)
-                if quick:
-                    try:
-                        send_whatsapp_text(bot, wa_from, quick)
-                    except Exception:
-                        pass
-                    return JsonResponse({'status': 'ok'})
-                # Segundo: si no encontró, usar IA SOLO para detectar intención y responder con datos del Cerebro
-                # (no inventar información; la respuesta final se arma desde persona)
-                if callable(classify_intent_label):
-                    allowed_labels = [
-                        'ubicacion','telefono','web','redes','horarios','pagos','yape','plin','tarjeta','transferencia','contraentrega',
-                        'envios','mayorista','ruc','boleta','factura',
-                        # Conversión/venta
-                        'compra','producto','productos','recomendacion','catalogo','modelos','precios'
-                    ]
-                    label = classify_intent_label(raw_text, allowed_labels, language=(persona.get('language') or 'español'))
-                    if label:
-                        # Mapear algunas etiquetas a prompts canónicos del motor determinista
-                        mapped = label
-                        if label in ('compra','producto','productos','recomendacion','catalogo','modelos','precios'):
-                            mapped = 'comprar'
-                        # Reusar motor determinista con prompt canónico
-                        quick2 = answer_from_persona(mapped, persona, brand=( (flow_cfg or {}).get('brand') or persona.get('trade_name') or persona.get('legal_name') or None ))
-                        if quick2:
-                            final_text = quick2
-                            if callable(naturalize_from_answer):
-                                refined = naturalize_from_answer(raw_text, quick2, assistant_name=persona.get('name'), language=(persona.get('language') or 'español'))
-                                if (refined or '').strip():
-                                    final_text = refined.strip()
-                            try:
-                                send_whatsapp_text(bot, wa_from, final_text)
-                            except Exception:
-                                pass
-                            return JsonResponse({'status': 'ok'})
-                # Si aún no hubo respuesta, usar IA una vez más (por si se armó mejor con label)
-                answer = ai_answer(raw_text, brand=brand, persona=persona)
-                if not answer:
-                    # Fallback amable sin inventar información
-                    name = persona.get('name') or 'Asistente'
-                    order_lines = [ln.strip() for ln in (persona.get('order_required') or '').split('\n') if ln.strip()]
-                    pedido_hint = ("\nSi deseas hacer un pedido, por favor comparte: " + ", ".join(order_lines[:5])) if order_lines else ''
-                    answer = f"Disculpa, no te entendí bien. ¿Podrías reformular o darme un poco más de detalle?{pedido_hint}"
-                try:
-                    send_whatsapp_text(bot, wa_from, answer)
-                except Exception:
-                    pass
+                reply_free_text(classification)
                 return JsonResponse({'status': 'ok'})
 
         # Fallback: aunque el flujo esté deshabilitado o sin nodos, permitir IA si no está activado el modo humano
         if not user.human_requested and raw_text:
-            ai_cfg = _flatten_ai_cfg(flow_cfg)
-            _assistant_name = (
-                ai_cfg.get('assistant_name')
-                or ai_cfg.get('assistant')
-                or ai_cfg.get('assistantName')
-                or ai_cfg.get('nombre_asistente')
-                or ai_cfg.get('name')
-                or 'Asistente'
-            )
-            persona = {
-                'name': _assistant_name,
-                'about': ai_cfg.get('about') or ai_cfg.get('presentation') or '',
-                'knowledge': ai_cfg.get('knowledge') or ai_cfg.get('brain') or ai_cfg.get('kb') or '',
-                'style': ai_cfg.get('style') or '',
-                'system': ai_cfg.get('system') or ai_cfg.get('instructions') or '',
-                'sales_playbook': ai_cfg.get('sales_playbook') or '',
-                'cta_phrases': ai_cfg.get('cta_phrases') or '',
-                'emoji_level': ai_cfg.get('emoji_level') or '',
-                'recommendation_examples': ai_cfg.get('recommendation_examples') or '',
-                'language': ai_cfg.get('language') or ai_cfg.get('lang') or 'español',
-                'website': ai_cfg.get('website') or ai_cfg.get('website_url') or ai_cfg.get('site') or ai_cfg.get('url') or '',
-                'phone': ai_cfg.get('phone') or ai_cfg.get('phone_number') or ai_cfg.get('telefono') or '',
-                'email': ai_cfg.get('email') or ai_cfg.get('correo') or '',
-                'order_required': ai_cfg.get('order_required') or ai_cfg.get('required_info') or ai_cfg.get('required_fields') or '',
-                'out_of_scope': ai_cfg.get('out_of_scope') or ai_cfg.get('oos') or ai_cfg.get('temas_fuera') or '',
-                'response_policies': ai_cfg.get('response_policies') or ai_cfg.get('pol_resp') or '',
-                'comm_policies': ai_cfg.get('comm_policies') or ai_cfg.get('pol_comm') or '',
-                # Perfil del negocio
-                'trade_name': ai_cfg.get('trade_name') or ai_cfg.get('nombre_comercial') or '',
-                'legal_name': ai_cfg.get('legal_name') or ai_cfg.get('razon_social') or '',
-                'ruc': ai_cfg.get('ruc') or '',
-                'timezone': ai_cfg.get('timezone') or ai_cfg.get('zona_horaria') or '',
-                'address': ai_cfg.get('address') or ai_cfg.get('direccion') or '',
-                'city': ai_cfg.get('city') or ai_cfg.get('ciudad') or '',
-                'region': ai_cfg.get('region') or ai_cfg.get('departamento') or '',
-                'country': ai_cfg.get('country') or ai_cfg.get('pais') or '',
-                'maps_url': ai_cfg.get('maps_url') or ai_cfg.get('google_maps') or '',
-                'ubigeo': ai_cfg.get('ubigeo') or '',
-                'hours_mon_fri': ai_cfg.get('hours_mon_fri') or ai_cfg.get('horario_lv') or '',
-                'hours_sat': ai_cfg.get('hours_sat') or ai_cfg.get('horario_sab') or '',
-                'hours_sun': ai_cfg.get('hours_sun') or ai_cfg.get('horario_dom') or '',
-                # Redes y enlaces
-                'instagram': ai_cfg.get('instagram') or '',
-                'facebook': ai_cfg.get('facebook') or '',
-                'tiktok': ai_cfg.get('tiktok') or '',
-                'youtube': ai_cfg.get('youtube') or '',
-                'x': ai_cfg.get('x') or ai_cfg.get('twitter') or '',
-                'linktree': ai_cfg.get('linktree') or '',
-                'whatsapp_link': ai_cfg.get('whatsapp_link') or '',
-                'catalog_url': ai_cfg.get('catalog_url') or ai_cfg.get('site_shop') or '',
-                'categories': ai_cfg.get('categories') or '',
-                'featured_products': ai_cfg.get('featured_products') or '',
-                'size_guide_url': ai_cfg.get('size_guide_url') or '',
-                'size_notes': ai_cfg.get('size_notes') or '',
-                # Modalidad de venta
-                'retail_yes': ai_cfg.get('retail_yes') or '',
-                'wholesale_yes': ai_cfg.get('wholesale_yes') or '',
-                'wholesale_min_qty': ai_cfg.get('wholesale_min_qty') or '',
-                'wholesale_price_list_url': ai_cfg.get('wholesale_price_list_url') or '',
-                'wholesale_requires_ruc': ai_cfg.get('wholesale_requires_ruc') or '',
-                'prep_time_large_orders': ai_cfg.get('prep_time_large_orders') or '',
-                'volume_discounts': ai_cfg.get('volume_discounts') or '',
-                # Pagos
-                'yape_number': ai_cfg.get('yape_number') or '',
-                'yape_holder': ai_cfg.get('yape_holder') or '',
-                'yape_alias': ai_cfg.get('yape_alias') or '',
-                'yape_qr': ai_cfg.get('yape_qr') or '',
-                'plin_number': ai_cfg.get('plin_number') or '',
-                'plin_holder': ai_cfg.get('plin_holder') or '',
-                'plin_qr': ai_cfg.get('plin_qr') or '',
-                'card_brands': ai_cfg.get('card_brands') or '',
-                'card_provider': ai_cfg.get('card_provider') or '',
-                'card_paylink': ai_cfg.get('card_paylink') or '',
-                'card_fee_notes': ai_cfg.get('card_fee_notes') or '',
-                'transfer_accounts': ai_cfg.get('transfer_accounts') or '',
-                'transfer_instructions': ai_cfg.get('transfer_instructions') or '',
-                'cash_on_delivery_yes': ai_cfg.get('cash_on_delivery_yes') or '',
-                # Envíos
-                'districts_costs': ai_cfg.get('districts_costs') or '',
-                'typical_delivery_time': ai_cfg.get('typical_delivery_time') or '',
-                'free_shipping_from': ai_cfg.get('free_shipping_from') or '',
-                'pickup_address': ai_cfg.get('pickup_address') or '',
-                'delivery_partners': ai_cfg.get('delivery_partners') or '',
-                # Políticas y comprobantes
-                'returns_policy': ai_cfg.get('returns_policy') or '',
-                'warranty': ai_cfg.get('warranty') or '',
-                'terms_url': ai_cfg.get('terms_url') or '',
-                'privacy_url': ai_cfg.get('privacy_url') or '',
-                'boleta_yes': ai_cfg.get('boleta_yes') or '',
-                'factura_yes': ai_cfg.get('factura_yes') or '',
-            }
-
-            # IA generativa primero
-            brand = (
-                (flow_cfg or {}).get('brand')
-                or persona.get('trade_name')
-                or persona.get('legal_name')
-                or None
-            )
-            answer = ai_answer(raw_text, brand=brand, persona=persona)
-            if answer:
-                try:
-                    send_whatsapp_text(bot, wa_from, answer)
-                except Exception:
-                    pass
-                return JsonResponse({'status': 'ok'})
-            # Segundo: intento determinista
-            quick = answer_from_persona(raw_text, persona, brand=brand)
-            if quick:
-                try:
-                    send_whatsapp_text(bot, wa_from, quick)
-                except Exception:
-                    pass
-                return JsonResponse({'status': 'ok'})
-            if not answer:
-                name = persona.get('name') or 'Asistente'
-                order_lines = [ln.strip() for ln in (persona.get('order_required') or '').split('\n') if ln.strip()]
-                pedido_hint = ("\nSi deseas hacer un pedido, por favor comparte: " + ", ".join(order_lines[:5])) if order_lines else ''
-                answer = f"Disculpa, no te entendí bien. ¿Podrías reformular o darme un poco más de detalle?{pedido_hint}"
-            try:
-                send_whatsapp_text(bot, wa_from, answer)
-            except Exception:
-                pass
+            reply_free_text()
             return JsonResponse({'status': 'ok'})
 
         # No activar flujo si no hay trigger; no responder
@@ -11,8 +11,10 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 from pathlib import Path
+import importlib.util
 import os
 import environ
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -97,11 +99,48 @@ WSGI_APPLICATION = 'mi_chatfuel.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# DATABASE_URL (p.ej. postgres://… en Render) o SQLite local. DATABASE_REPLICA_URL opcional: las vistas
+# de sólo lectura del panel leen de ahí (bots/db.py). Conexiones persistentes DB_CONN_MAX_AGE segundos
+# con health check; DB_POOL usa el pool de psycopg 3 (Django ≥ 5.1; instalar psycopg[binary,pool], no
+# viene en requirements.txt) y DB_PGBOUNCER desactiva los cursores del lado del servidor (PgBouncer en
+# modo transacción).
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    'default': env.db('DATABASE_URL', default=f'sqlite:///{BASE_DIR / "db.sqlite3"}'),
+}
+if env('DATABASE_REPLICA_URL', default=''):
+    DATABASES['replica'] = env.db('DATABASE_REPLICA_URL')
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+    DATABASE_ROUTERS = ['bots.db.ReplicaRouter']
+for _db in DATABASES.values():
+    _db['CONN_MAX_AGE'] = env.int('DB_CONN_MAX_AGE', default=60)
+    _db['CONN_HEALTH_CHECKS'] = env.bool('DB_CONN_HEALTH_CHECKS', default=True)
+    if _db['ENGINE'] == 'django.db.backends.postgresql':
+        _db['DISABLE_SERVER_SIDE_CURSORS'] = env.bool('DB_PGBOUNCER', default=False)
+        if env.bool('DB_POOL', default=False):
+            # requirements.txt trae psycopg2, que no tiene pool: sin psycopg 3 fallaría cada conexión
+            if not (importlib.util.find_spec('psycopg') and importlib.util.find_spec('psycopg_pool')):
+                raise ImproperlyConfigured(
+                    "DB_POOL=1 requiere psycopg 3 con pool: pip install 'psycopg[binary,pool]' (o quita DB_POOL)."
+                )
+            # El pool de Django no admite conexiones persistentes
+            _db.setdefault('OPTIONS', {})['pool'] = True
+            _db['CONN_MAX_AGE'] = 0
+
+# Perfil SQLite para un solo nodo con varios workers (bots/db.py): WAL, busy_timeout, synchronous=NORMAL
+# y mmap. Transacciones IMMEDIATE: toman el candado de escritura al empezar (los escritores hacen cola
+# hasta busy_timeout) y no fallan con "database is locked" al pasar de lectura a escritura.
+SQLITE_TUNED = env.bool('SQLITE_TUNED', default=False)
+SQLITE_BUSY_TIMEOUT_MS = env.int('SQLITE_BUSY_TIMEOUT_MS', default=5000)
+SQLITE_MMAP_SIZE = env.int('SQLITE_MMAP_SIZE', default=256 * 1024 * 1024)
+if SQLITE_TUNED and DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default'].setdefault('OPTIONS', {}).update({
+        'transaction_mode': 'IMMEDIATE',
+        'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000,
+    })
+
+# Caché (memoria de conversaciones, etc.). Ej: CACHE_URL=redis://127.0.0.1:6379/1
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
 }
 
 
@@ -157,6 +196,99 @@ REST_FRAMEWORK = {
 # WhatsApp Graph API version
 WA_GRAPH_VERSION = env('WA_GRAPH_VERSION', default='v21.0')
 
+# OpenRouter (bots/ai_client.py): las claves se administran en AIKey; OPENROUTER_API_KEY es el último recurso
+OPENROUTER_API_URL = env('OPENROUTER_API_URL', default='https://openrouter.ai/api/v1/chat/completions')
+OPENROUTER_API_KEY = env('OPENROUTER_API_KEY', default='')
+OPENROUTER_MODEL = env('OPENROUTER_MODEL', default='openrouter/auto')
+OPENROUTER_SITE_URL = env('OPENROUTER_SITE_URL', default='https://opti.chat')
+OPENROUTER_APP_NAME = env('OPENROUTER_APP_NAME', default='OptiChat')
+# Conexiones del pool compartido y reintentos por clave (429/5xx) antes de pasar a la siguiente
+AI_CLIENT_MAX_CONNECTIONS = env.int('AI_CLIENT_MAX_CONNECTIONS', default=20)
+AI_CLIENT_RETRIES = env.int('AI_CLIENT_RETRIES', default=0)
+AI_CLIENT_BACKOFF_S = env.float('AI_CLIENT_BACKOFF_S', default=0.25)
+# Llamadas idénticas simultáneas comparten una sola petición (single-flight)
+AI_SINGLE_FLIGHT = env.bool('AI_SINGLE_FLIGHT', default=True)
+# Contabilidad de uso (bots/ai_usage.py): volcado en lote a AIUsage cada N segundos o N llamadas
+AI_USAGE_FLUSH_S = env.int('AI_USAGE_FLUSH_S', default=30)
+AI_USAGE_FLUSH_EVERY = env.int('AI_USAGE_FLUSH_EVERY', default=50)
+# Precios USD por 1M tokens [entrada, salida] cuando la respuesta no trae usage.cost.
+# Ej: AI_MODEL_PRICES={"openai/gpt-4o-mini": [0.15, 0.6]}
+AI_MODEL_PRICES = env.json('AI_MODEL_PRICES', default={})
+
+# Ruteo de modelos por tarea (bots/ai_router.py). Cada bot puede sobreescribir la lista en Bot.ai_models.
+# Ej: AI_TASK_MODELS={"trigger": ["openai/gpt-4o-mini", "google/gemini-flash-1.5"]}
+AI_TASK_MODELS = env.json('AI_TASK_MODELS', default={})
+# SLO de latencia p95 (ms) por tarea; un modelo que lo excede (o supera la tasa de error) pasa al final
+AI_TASK_SLO_MS = {
+    'trigger': env.int('AI_SLO_TRIGGER_MS', default=1500),
+    'intent': env.int('AI_SLO_INTENT_MS', default=1500),
+    'naturalize': env.int('AI_SLO_NATURALIZE_MS', default=3000),
+    'answer': env.int('AI_SLO_ANSWER_MS', default=8000),
+    'generate': env.int('AI_SLO_GENERATE_MS', default=8000),
+}
+AI_ROUTER_WINDOW = env.int('AI_ROUTER_WINDOW', default=20)
+AI_ROUTER_MIN_SAMPLES = env.int('AI_ROUTER_MIN_SAMPLES', default=5)
+AI_ROUTER_MAX_ERROR_RATE = env.float('AI_ROUTER_MAX_ERROR_RATE', default=0.3)
+AI_ROUTER_COOLDOWN_S = env.int('AI_ROUTER_COOLDOWN_S', default=30)
+
+# Cascada de respuesta a texto libre (bots/cascade.py)
+# Etapas en orden; presupuesto total por mensaje y mínimo restante para intentar cada etapa de IA.
+AI_CASCADE_STAGES = env.list('AI_CASCADE_STAGES', default=['persona', 'answer', 'intent'])
+AI_CASCADE_BUDGET_S = env.float('AI_CASCADE_BUDGET_S', default=12.0)
+AI_CASCADE_MIN_REMAINING_S = {
+    'answer': env.float('AI_CASCADE_MIN_ANSWER_S', default=3.0),
+    'intent': env.float('AI_CASCADE_MIN_INTENT_S', default=2.0),
+    'naturalize': env.float('AI_CASCADE_MIN_NATURALIZE_S', default=2.0),
+}
+# Máximo de palabras para confiar en una respuesta determinista del Cerebro
+AI_CASCADE_PERSONA_MAX_WORDS = env.int('AI_CASCADE_PERSONA_MAX_WORDS', default=8)
+# Temas que la respuesta determinista puede cubrir en un mismo mensaje (bots/persona_engine.py)
+AI_PERSONA_MAX_INTENTS = env.int('AI_PERSONA_MAX_INTENTS', default=3)
+
+# Ventana (s) para agrupar mensajes de texto seguidos de una conversación antes de responder (bots/debounce.py).
+# 0 (por defecto) = responder cada mensaje de inmediato. El request que espera ocupa su worker durante la
+# ventana: activarlo sólo con CACHE_URL compartida y workers con hilos (gunicorn --threads N o gthread);
+# con workers sync el mensaje siguiente de la ráfaga queda en cola detrás del que espera y no se agrupa.
+AI_DEBOUNCE_S = env.float('AI_DEBOUNCE_S', default=0.0)
+
+# Clasificador combinado trigger + intención (services.ai_classify): confianza mínima para aceptar su respuesta
+AI_CLASSIFY_MIN_CONFIDENCE = env.float('AI_CLASSIFY_MIN_CONFIDENCE', default=0.5)
+
+# Clasificador local de intención (bots/intent.py): confianza mínima para no consultar a la IA
+INTENT_LOCAL_THRESHOLD = env.float('INTENT_LOCAL_THRESHOLD', default=0.75)
+# Cada cuántos segundos un worker verifica si hay una versión nueva del modelo
+INTENT_MODEL_RECHECK_S = env.int('INTENT_MODEL_RECHECK_S', default=300)
+
+# Recuperación BM25 del conocimiento del Cerebro (bots/knowledge.py)
+# Si el conocimiento supera el presupuesto de tokens se envían sólo los fragmentos más relevantes.
+AI_RETRIEVAL_ENABLED = env.bool('AI_RETRIEVAL_ENABLED', default=True)
+AI_KNOWLEDGE_TOKEN_BUDGET = env.int('AI_KNOWLEDGE_TOKEN_BUDGET', default=600)
+AI_KNOWLEDGE_TOP_K = env.int('AI_KNOWLEDGE_TOP_K', default=6)
+AI_KNOWLEDGE_CHUNK_TOKENS = env.int('AI_KNOWLEDGE_CHUNK_TOKENS', default=80)
+
+# Memoria corta por conversación (bots/memory.py): turnos y tokens máximos, resumen acumulado y TTL en caché
+AI_MEMORY_TURNS = env.int('AI_MEMORY_TURNS', default=8)
+AI_MEMORY_TOKENS = env.int('AI_MEMORY_TOKENS', default=400)
+AI_MEMORY_SUMMARY_TOKENS = env.int('AI_MEMORY_SUMMARY_TOKENS', default=120)
+AI_MEMORY_TTL_S = env.int('AI_MEMORY_TTL_S', default=86400)
+
+# Retención de MessageLog (bots/archive.py, manage.py archive_messages): lo anterior a N días pasa a
+# segmentos NDJSON gzip por bot y mes en MESSAGE_ARCHIVE_DIR y se borra de la base en lotes.
+# Sin valor por defecto: debe ser almacenamiento persistente (no el disco efímero del servicio);
+# sin configurar, archive_messages no corre.
+MESSAGE_RETENTION_DAYS = env.int('MESSAGE_RETENTION_DAYS', default=90)
+MESSAGE_ARCHIVE_DIR = env('MESSAGE_ARCHIVE_DIR', default='')
+MESSAGE_ARCHIVE_CHUNK = env.int('MESSAGE_ARCHIVE_CHUNK', default=1000)
+
+# Scheduler de vencimientos (bots/expiry.py, manage.py run_expiry): minutos sin respuesta para cerrar un flujo,
+# espera máxima entre pasadas (para ver temporizadores nuevos) y filas por UPDATE
+FLOW_INACTIVITY_MIN = env.int('FLOW_INACTIVITY_MIN', default=5)
+EXPIRY_MAX_SLEEP_S = env.float('EXPIRY_MAX_SLEEP_S', default=30.0)
+EXPIRY_BATCH = env.int('EXPIRY_BATCH', default=500)
+
+# Exportaciones en streaming (bots/export.py): filas leídas por vuelta del cursor
+EXPORT_CHUNK = env.int('EXPORT_CHUNK', default=2000)
+
 # Auth redirects
 LOGIN_URL = '/accounts/login/'
 LOGIN_REDIRECT_URL = '/panel/'
@@ -1,108 +1,40 @@
 import os
-import requests
 from typing import List, Dict, Optional
-from datetime import datetime
 
 AI_ENABLED = os.getenv("AI_ENABLED", "0") == "1"
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "openrouter/auto")
 STORE_URL = os.getenv("STORE_URL", "")
 
-# Intentar leer claves desde la base de datos de Django si está disponible
-def _get_db_openrouter_keys() -> List[str]:
-    try:
-        # Carga perezosa de Django
-        from django.conf import settings as _dj_settings  # noqa: F401
-        from mi_chatfuel.bots.models import AIKey  # type: ignore
-        # Solo activas, orden por prioridad y menos usadas primero
-        rows = AIKey.objects.filter(provider='openrouter', is_active=True).order_by('priority', 'last_used_at').all()
-        keys = []
-        for r in rows:
-            k = (r.api_key or '').strip()
-            if k:
-                keys.append(k)
-        return keys
-    except Exception:
-        return []
+# Encabezados propios de este módulo (el resto los pone el cliente compartido)
+_HEADERS = {
+    "HTTP-Referer": os.getenv('OPENROUTER_SITE_URL', STORE_URL) or "",
+    "X-Title": os.getenv('OPENROUTER_APP_NAME', 'OptiChat WhatsApp Bot'),
+}
 
 
-def _mark_key_used_success(api_key: str):
+def _chat(messages: List[Dict[str, str]], temperature: float, max_tokens: int, timeout: float, task: str) -> str:
+    """Una llamada a OpenRouter vía el cliente compartido de Django (pool, rotación de claves DB + ENV
+    y failover en bots/ai_client.py). El modelo lo elige el router de la tarea (bots/ai_router.py:
+    modelos del bot o AI_TASK_MODELS, con fallback si uno viola el SLO). Retorna el texto o ''."""
     try:
-        from mi_chatfuel.bots.models import AIKey  # type: ignore
-        it = AIKey.objects.filter(provider='openrouter', api_key=api_key).first()
-        if it:
-            it.last_used_at = datetime.utcnow()
-            if it.failure_count:
-                it.failure_count = 0
-            it.save(update_fields=['last_used_at', 'failure_count'])
+        from bots import ai_router
+        from bots.ai_client import message_text
     except Exception:
-        pass
-
-
-def _mark_key_failure(api_key: str):
-    try:
-        from mi_chatfuel.bots.models import AIKey  # type: ignore
-        it = AIKey.objects.filter(provider='openrouter', api_key=api_key).first()
-        if it:
-            it.failure_count = (it.failure_count or 0) + 1
-            it.last_used_at = datetime.utcnow()
-            it.save(update_fields=['failure_count', 'last_used_at'])
-    except Exception:
-        pass
-
-
-def _get_all_openrouter_keys_with_fallback() -> List[str]:
-    keys = _get_db_openrouter_keys()
-    env_key = (OPENROUTER_API_KEY or '').strip()
-    if env_key:
-        # Colocar ENV al final como último recurso
-        if env_key not in keys:
-            keys.append(env_key)
-    return [k for k in keys if k]
+        return ""
+    data = ai_router.chat(messages, task, timeout=timeout, headers=_HEADERS, temperature=temperature, max_tokens=max_tokens)
+    return message_text(data)
 
 
 def generate_reply(messages: List[Dict[str, str]], instruction: str = "", timeout: int = 12) -> str:
     """Llama a OpenRouter con rotación de claves (DB + ENV), retorna texto o ''."""
     if not AI_ENABLED:
         return ""
-    keys = _get_all_openrouter_keys_with_fallback()
-    if not keys:
-        return ""
     system_prompt = (
         "Eres 'OptiChat', una asistente de WhatsApp amable y concisa para un negocio. "
         "Ayuda en español latino, guía hacia tienda, pagos y envíos según corresponda. "
         f"Sitio: {STORE_URL}. " + (instruction or "")
     )
-    payload = {
-        "model": OPENROUTER_MODEL,
-        "messages": [{"role": "system", "content": system_prompt}] + messages,
-        "temperature": 0.5,
-        "max_tokens": 300,
-    }
-    base_headers = {
-        "Content-Type": "application/json",
-        "HTTP-Referer": os.getenv('OPENROUTER_SITE_URL', STORE_URL) or "",
-        "X-Title": os.getenv('OPENROUTER_APP_NAME', 'OptiChat WhatsApp Bot'),
-    }
-    for key in keys:
-        try:
-            headers = {**base_headers, "Authorization": f"Bearer {key}"}
-            resp = requests.post("https://openrouter.ai/api/v1/chat/completions", json=payload, headers=headers, timeout=timeout)
-            if 200 <= resp.status_code < 300:
-                data = resp.json()
-                choices = (data or {}).get('choices') or []
-                if choices:
-                    content = ((choices[0].get('message') or {}).get('content') or '').strip()
-                    _mark_key_used_success(key)
-                    return content[:1800]
-            # Si status sugiere invalidación o límite, probar siguiente
-            if resp.status_code in (401, 403, 429, 500, 502, 503, 504):
-                _mark_key_failure(key)
-                continue
-        except Exception:
-            _mark_key_failure(key)
-            continue
-    return ""
+    content = _chat([{"role": "system", "content": system_prompt}] + messages, 0.5, 300, timeout, 'generate')
+    return content[:1800]
 
 
 def classify_should_trigger(user_text: str, instruction: str = "", timeout: int = 8) -> bool:
@@ -111,55 +43,21 @@ def classify_should_trigger(user_text: str, instruction: str = "", timeout: int
     """
     if not AI_ENABLED:
         return False
-    keys = _get_all_openrouter_keys_with_fallback()
-    if not keys:
-        return False
-    try:
-        system_prompt = (
-            "Eres un clasificador binario. Tu ÚNICA salida debe ser 'SI' o 'NO'. "
-            "Lee la instrucción del operador y el texto del usuario. "
-            "Responde 'SI' solo si el texto cumple estrictamente lo pedido. "
-            "Si no estás seguro o no coincide, responde 'NO'."
-        )
-        user_payload = (
-            f"Instrucción del operador: {instruction or 'N/A'}\n"
-            f"Texto del usuario: {user_text or ''}\n"
-            "Responde exactamente 'SI' o 'NO'."
-        )
-        payload = {
-            "model": OPENROUTER_MODEL,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_payload},
-            ],
-            "temperature": 0.0,
-            "max_tokens": 3,
-        }
-        base_headers = {
-            "Content-Type": "application/json",
-            "HTTP-Referer": os.getenv('OPENROUTER_SITE_URL', STORE_URL) or "",
-            "X-Title": os.getenv('OPENROUTER_APP_NAME', 'OptiChat WhatsApp Bot'),
-        }
-        for key in keys:
-            try:
-                headers = {**base_headers, "Authorization": f"Bearer {key}"}
-                resp = requests.post("https://openrouter.ai/api/v1/chat/completions", json=payload, headers=headers, timeout=timeout)
-                if 200 <= resp.status_code < 300:
-                    data = resp.json() or {}
-                    choices = data.get('choices') or []
-                    if choices:
-                        content = ((choices[0].get('message') or {}).get('content') or '').strip().lower()
-                        _mark_key_used_success(key)
-                        return content in ('si', 'sí')
-                if resp.status_code in (401, 403, 429, 500, 502, 503, 504):
-                    _mark_key_failure(key)
-                    continue
-            except Exception:
-                _mark_key_failure(key)
-                continue
-        return False
-    except Exception:
-        return False
+    system_prompt = (
+        "Eres un clasificador binario. Tu ÚNICA salida debe ser 'SI' o 'NO'. "
+        "Lee la instrucción del operador y el texto del usuario. "
+        "Responde 'SI' solo si el texto cumple estrictamente lo pedido. "
+        "Si no estás seguro o no coincide, responde 'NO'."
+    )
+    user_payload = (
+        f"Instrucción del operador: {instruction or 'N/A'}\n"
+        f"Texto del usuario: {user_text or ''}\n"
+        "Responde exactamente 'SI' o 'NO'."
+    )
+    content = _chat(
+        [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_payload}], 0.0, 3, timeout, 'trigger'
+    )
+    return content.lower() in ('si', 'sí')
 
 
 def classify_intent_label(user_text: str, labels: List[str], language: str = "español", timeout: int = 8) -> Optional[str]:
@@ -172,62 +70,25 @@ def classify_intent_label(user_text: str, labels: List[str], language: str = "es
     labels = [str(x).strip() for x in (labels or []) if str(x).strip()]
     if not labels:
         return None
-    keys = _get_all_openrouter_keys_with_fallback()
-    if not keys:
-        return None
     allowed = ", ".join(labels)
-    try:
-        system_prompt = (
-            f"Eres un clasificador de intención. Responde en {language}. "
-            "Debes responder ÚNICAMENTE con una etiqueta EXACTA de la lista permitida. "
-            "Si no estás seguro, responde 'none'.\n"
-            f"Etiquetas permitidas: {allowed}"
-        )
-        user_payload = (
-            f"Texto del usuario: {user_text or ''}\n"
-            "Responde solo con una etiqueta exacta de la lista, o 'none'."
-        )
-        payload = {
-            "model": OPENROUTER_MODEL,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_payload},
-            ],
-            "temperature": 0.0,
-            "max_tokens": 6,
-        }
-        base_headers = {
-            "Content-Type": "application/json",
-            "HTTP-Referer": os.getenv('OPENROUTER_SITE_URL', STORE_URL) or "",
-            "X-Title": os.getenv('OPENROUTER_APP_NAME', 'OptiChat WhatsApp Bot'),
-        }
-        for key in keys:
-            try:
-                headers = {**base_headers, "Authorization": f"Bearer {key}"}
-                resp = requests.post("https://openrouter.ai/api/v1/chat/completions", json=payload, headers=headers, timeout=timeout)
-                if 200 <= resp.status_code < 300:
-                    data = resp.json() or {}
-                    choices = data.get('choices') or []
-                    if choices:
-                        content = ((choices[0].get('message') or {}).get('content') or '').strip()
-                        _mark_key_used_success(key)
-                        label = content.lower().strip()
-                        if label in [l.lower() for l in labels]:
-                            # Devuelve etiqueta con el mismo casing de entrada si coincide
-                            for l in labels:
-                                if l.lower() == label:
-                                    return l
-                        if label in ('none', 'ninguna'):
-                            return None
-                if resp.status_code in (401, 403, 429, 500, 502, 503, 504):
-                    _mark_key_failure(key)
-                    continue
-            except Exception:
-                _mark_key_failure(key)
-                continue
-        return None
-    except Exception:
-        return None
+    system_prompt = (
+        f"Eres un clasificador de intención. Responde en {language}. "
+        "Debes responder ÚNICAMENTE con una etiqueta EXACTA de la lista permitida. "
+        "Si no estás seguro, responde 'none'.\n"
+        f"Etiquetas permitidas: {allowed}"
+    )
+    user_payload = (
+        f"Texto del usuario: {user_text or ''}\n"
+        "Responde solo con una etiqueta exacta de la lista, o 'none'."
+    )
+    label = _chat(
+        [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_payload}], 0.0, 6, timeout, 'intent'
+    ).lower()
+    # Devuelve etiqueta con el mismo casing de entrada si coincide
+    for l in labels:
+        if l.lower() == label:
+            return l
+    return None
 
 
 def naturalize_from_answer(user_text: str, base_answer: str, assistant_name: Optional[str] = None, language: str = "español", timeout: int = 8) -> str:
@@ -241,52 +102,18 @@ def naturalize_from_answer(user_text: str, base_answer: str, assistant_name: Opt
     base_answer = (base_answer or '').strip()
     if not base_answer:
         return ""
-    keys = _get_all_openrouter_keys_with_fallback()
-    if not keys:
-        return ""
-    try:
-        name = (assistant_name or '').strip() or 'Asistente'
-        system_prompt = (
-            f"Eres {name}, una asistente amable en {language}. "
-            "Reescribe la respuesta dada de forma natural y breve (1-2 frases). "
-            "NO inventes ni agregues datos que no estén en la respuesta provista. "
-            "Mantén números, URLs y nombres exactamente iguales."
-        )
-        user_payload = (
-            f"Pregunta del usuario: {user_text or ''}\n"
-            f"Respuesta del sistema (no la alteres en contenido, sólo redacción):\n{base_answer}"
-        )
-        payload = {
-            "model": OPENROUTER_MODEL,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_payload},
-            ],
-            "temperature": 0.1,
-            "max_tokens": 120,
-        }
-        base_headers = {
-            "Content-Type": "application/json",
-            "HTTP-Referer": os.getenv('OPENROUTER_SITE_URL', STORE_URL) or "",
-            "X-Title": os.getenv('OPENROUTER_APP_NAME', 'OptiChat WhatsApp Bot'),
-        }
-        for key in keys:
-            try:
-                headers = {**base_headers, "Authorization": f"Bearer {key}"}
-                resp = requests.post("https://openrouter.ai/api/v1/chat/completions", json=payload, headers=headers, timeout=timeout)
-                if 200 <= resp.status_code < 300:
-                    data = resp.json() or {}
-                    choices = data.get('choices') or []
-                    if choices:
-                        content = ((choices[0].get('message') or {}).get('content') or '').strip()
-                        _mark_key_used_success(key)
-                        return content[:1000]
-                if resp.status_code in (401, 403, 429, 500, 502, 503, 504):
-                    _mark_key_failure(key)
-                    continue
-            except Exception:
-                _mark_key_failure(key)
-                continue
-        return ""
-    except Exception:
-        return ""
+    name = (assistant_name or '').strip() or 'Asistente'
+    system_prompt = (
+        f"Eres {name}, una asistente amable en {language}. "
+        "Reescribe la respuesta dada de forma natural y breve (1-2 frases). "
+        "NO inventes ni agregues datos que no estén en la respuesta provista. "
+        "Mantén números, URLs y nombres exactamente iguales."
+    )
+    user_payload = (
+        f"Pregunta del usuario: {user_text or ''}\n"
+        f"Respuesta del sistema (no la alteres en contenido, sólo redacción):\n{base_answer}"
+    )
+    content = _chat(
+        [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_payload}], 0.1, 120, timeout, 'naturalize'
+    )
+    return content[:1000]